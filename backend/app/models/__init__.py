@@ -1,5 +1,6 @@
 from .user import User
 from .expense import Expense, TransactionType
 from .category import Category
+from .tag import Tag, expense_tags
 
-__all__ = ['User', 'Expense', 'TransactionType', 'Category'] 
\ No newline at end of file
+__all__ = ['User', 'Expense', 'TransactionType', 'Category', 'Tag', 'expense_tags'] 
\ No newline at end of file
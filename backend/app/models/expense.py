@@ -21,11 +21,12 @@ class Expense(Base):
     notes = Column(String)
     is_recurring = Column(Boolean, default=False)
     recurring_frequency = Column(String, nullable=True)  # daily, weekly, monthly, yearly
-    tags = Column(String)  # Comma-separated tags
+    tags = Column(String)  # Legacy comma-separated tags; migrated to tag_list (python -m app.services.tags migrate)
     
     # Relationships
     user = relationship("User", back_populates="expenses")
     category = relationship("Category", back_populates="expenses")
+    tag_list = relationship("Tag", secondary="expense_tags", back_populates="expenses")
     
     def __repr__(self):
         return f"<Expense {self.description} - {self.amount}>" 
\ No newline at end of file
@@ -0,0 +1,29 @@
+from sqlalchemy import Column, Integer, String, ForeignKey, Table, Index, UniqueConstraint
+from sqlalchemy.orm import relationship
+from ..database import Base
+
+# Association between expenses and normalised tags; (tag_id, expense_id) serves tag filters
+expense_tags = Table(
+    "expense_tags",
+    Base.metadata,
+    Column("expense_id", Integer, ForeignKey("expenses.id", ondelete="CASCADE"), primary_key=True),
+    Column("tag_id", Integer, ForeignKey("tags.id", ondelete="CASCADE"), primary_key=True),
+    Index("ix_expense_tags_tag_expense", "tag_id", "expense_id"),
+)
+
+class Tag(Base):
+    __tablename__ = "tags"
+
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    name = Column(String(50), nullable=False)
+    
+    # Relationships
+    expenses = relationship("Expense", secondary=expense_tags, back_populates="tag_list")
+    
+    __table_args__ = (
+        UniqueConstraint("user_id", "name", name="uq_tags_user_name"),
+    )
+    
+    def __repr__(self):
+        return f"<Tag {self.name}>"
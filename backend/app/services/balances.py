@@ -0,0 +1,290 @@
+"""Running balances from monthly checkpoints.
+
+`balance_checkpoints` holds one row per (user, currency, month) in which the
+user has transactions: the cumulative balance and transaction count through
+the end of that month. A balance as of any moment is then
+
+    the latest checkpoint before the moment's month      (one index seek)
+  + the rows from the first of that month up to the moment (a tail scan of
+                                                           at most a month)
+
+per currency, converted to the user's currency at the as-of date's rates.
+Amounts without a currency are in the user's default currency already.
+
+Writes keep the checkpoints current in the writing transaction
+(`apply_deltas`). A change of `delta` in month m adds `delta` to the
+checkpoints from m onwards with one UPDATE, so back-dated inserts, edits and
+deletes roll forward through every later month. If m has no checkpoint yet,
+one is created from the previous checkpoint. Writers serialise on the
+database write lock (SQLite) that the transaction write already holds.
+
+The first read of a user in a process checks that the latest checkpoints
+match the ledger's totals (CheckpointVerifier). On a mismatch it rebuilds
+them in one grouped pass. That covers history written before the table
+existed, and users moved by a shard rebalance.
+"""
+import bisect
+import functools
+import threading
+from collections import defaultdict
+from datetime import date, datetime, timedelta
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+from sqlalchemy import Table, and_, bindparam, delete, func, insert, or_, select, update
+from sqlalchemy.engine import Connection, Engine
+
+from .fx import FxRates
+
+# Float sums drift a little between incremental updates and a fresh SUM
+_TOLERANCE = 0.005
+
+
+def month_key(value: datetime) -> str:
+    return f"{value.year:04d}-{value.month:02d}"
+
+
+def _month_start(value: datetime) -> datetime:
+    return datetime(value.year, value.month, 1)
+
+
+def _next_month(value: datetime) -> datetime:
+    return datetime(value.year + value.month // 12, value.month % 12 + 1, 1)
+
+
+def checkpoint_deltas(changes: Iterable[Tuple[int, Optional[str], Optional[datetime], Optional[float], int]]):
+    """Sum (user_id, currency, date, amount delta, count delta) changes per (user_id, currency, month)."""
+    deltas: Dict[Tuple[int, str, str], List[float]] = defaultdict(lambda: [0.0, 0])
+    for user_id, currency, when, amount, count in changes:
+        if when is None:
+            continue
+        delta = deltas[(user_id, currency or "", month_key(when))]
+        delta[0] += amount or 0.0
+        delta[1] += count
+    return {key: (amount, count) for key, (amount, count) in deltas.items() if amount or count}
+
+
+@functools.lru_cache(maxsize=None)
+def _statements(checkpoints: Table):
+    """Statements for apply_deltas, built once; they run on every transaction write."""
+    c = checkpoints.c
+    owner = and_(c.user_id == bindparam("key_user_id"), c.currency == bindparam("key_currency"))
+    return (
+        update(checkpoints)
+        .where(owner, c.month >= bindparam("key_month"))
+        .values(balance=c.balance + bindparam("delta_amount"),
+                transaction_count=c.transaction_count + bindparam("delta_count")),
+        select(c.month, c.balance, c.transaction_count)
+        .where(owner, c.month < bindparam("key_month"))
+        .order_by(c.month.desc())
+        .limit(1),
+        select(c.month).where(owner, c.month == bindparam("key_month")),
+        insert(checkpoints),
+    )
+
+
+def apply_deltas(conn: Connection, checkpoints: Table, deltas: Dict[Tuple[int, str, str], Tuple[float, int]]):
+    """Roll per-month deltas forward through the user's checkpoints."""
+    if not deltas:
+        return
+    roll_forward, previous, exists, create = _statements(checkpoints)
+    for (user_id, currency, month), (amount, count) in sorted(deltas.items()):
+        key = {"key_user_id": user_id, "key_currency": currency, "key_month": month}
+        conn.execute(roll_forward, {**key, "delta_amount": amount, "delta_count": count})
+        if conn.execute(exists, key).first() is None:
+            base = conn.execute(previous, key).first()
+            conn.execute(create, {
+                "user_id": user_id, "currency": currency, "month": month,
+                "balance": (base.balance if base else 0.0) + amount,
+                "transaction_count": (base.transaction_count if base else 0) + count,
+                "updated_at": datetime.utcnow(),
+            })
+
+
+def rebuild(conn: Connection, checkpoints: Table, transactions, user_id: int) -> int:
+    """Recompute all of a user's checkpoints from one grouped pass; returns the row count."""
+    t = transactions.c
+    conn.execute(delete(checkpoints).where(checkpoints.c.user_id == user_id))
+    day = func.date(t.date)
+    rows = conn.execute(
+        select(func.coalesce(t.currency, ""), day, func.coalesce(func.sum(t.amount), 0.0), func.count())
+        .where(t.user_id == user_id, t.date.is_not(None))
+        .group_by(func.coalesce(t.currency, ""), day)
+    ).all()
+    months: Dict[Tuple[str, str], List[float]] = defaultdict(lambda: [0.0, 0])
+    for currency, key, amount, count in rows:
+        totals = months[(currency, str(key)[:7])]
+        totals[0] += amount
+        totals[1] += count
+    running: Dict[str, List[float]] = defaultdict(lambda: [0.0, 0])
+    payload = []
+    now = datetime.utcnow()
+    for (currency, key), (amount, count) in sorted(months.items()):
+        totals = running[currency]
+        totals[0] += amount
+        totals[1] += count
+        payload.append({
+            "user_id": user_id, "currency": currency, "month": key,
+            "balance": totals[0], "transaction_count": totals[1], "updated_at": now,
+        })
+    if payload:
+        conn.execute(insert(checkpoints), payload)
+    return len(payload)
+
+
+class CheckpointVerifier:
+    """Users whose checkpoints this process has checked against the ledger.
+
+    Every write path in the app keeps the checkpoints current, so the full
+    scan behind the check runs once per user per process.
+    """
+
+    def __init__(self):
+        self._verified = set()
+        self._lock = threading.Lock()
+
+    def ensure(self, engine: Engine, checkpoints: Table, transactions, user_id: int) -> int:
+        """Rebuild the user's checkpoints if their latest values disagree with the ledger; returns rows rebuilt."""
+        with self._lock:
+            if user_id in self._verified:
+                return 0
+        t, c = transactions.c, checkpoints.c
+        with engine.connect() as conn:
+            latest = select(c.currency, func.max(c.month).label("month")).where(c.user_id == user_id).group_by(c.currency).subquery()
+            stored = {
+                row.currency: (row.balance, row.transaction_count)
+                for row in conn.execute(
+                    select(c.currency, c.balance, c.transaction_count)
+                    .join(latest, and_(c.currency == latest.c.currency, c.month == latest.c.month))
+                    .where(c.user_id == user_id)
+                )
+            }
+            ledger = {
+                currency: (amount, count)
+                for currency, amount, count in conn.execute(
+                    select(func.coalesce(t.currency, ""), func.coalesce(func.sum(t.amount), 0.0), func.count())
+                    .where(t.user_id == user_id, t.date.is_not(None))
+                    .group_by(func.coalesce(t.currency, ""))
+                )
+            }
+        consistent = stored.keys() == ledger.keys() and all(
+            stored[key][1] == ledger[key][1] and abs(stored[key][0] - ledger[key][0]) <= _TOLERANCE
+            for key in ledger
+        )
+        rebuilt = 0
+        if not consistent:
+            with engine.begin() as conn:
+                rebuilt = rebuild(conn, checkpoints, transactions, user_id)
+        with self._lock:
+            self._verified.add(user_id)
+        return rebuilt
+
+
+def balance_as_of(conn: Connection, checkpoints: Table, transactions, user_id: int,
+                  as_of: datetime) -> Dict[str, Tuple[float, int]]:
+    """{currency: (balance, transaction count)} over every row dated on or before `as_of`."""
+    t, c = transactions.c, checkpoints.c
+    month = month_key(as_of)
+    # Latest checkpoint per currency before the as-of month: a seek on the (user, currency, month) key each
+    current = checkpoints.alias("current")
+    previous = (
+        select(func.max(c.month))
+        .where(c.user_id == user_id, c.currency == current.c.currency, c.month < month)
+        .scalar_subquery()
+    )
+    totals: Dict[str, List[float]] = defaultdict(lambda: [0.0, 0])
+    for currency, balance, count in conn.execute(
+        select(current.c.currency, current.c.balance, current.c.transaction_count)
+        .where(current.c.user_id == user_id, current.c.month == previous)
+    ):
+        totals[currency] = [balance, count]
+    # The tail: this month's rows up to the moment
+    for currency, amount, count in conn.execute(
+        select(func.coalesce(t.currency, ""), func.coalesce(func.sum(t.amount), 0.0), func.count())
+        .where(t.user_id == user_id, t.date >= _month_start(as_of), t.date <= as_of)
+        .group_by(func.coalesce(t.currency, ""))
+    ):
+        totals[currency][0] += amount
+        totals[currency][1] += count
+    return {currency: (balance, count) for currency, (balance, count) in totals.items()}
+
+
+def _month_ranges(months: Iterable[str]) -> List[Tuple[datetime, datetime]]:
+    """Contiguous [lower, upper) datetime ranges covering the given YYYY-MM months."""
+    ranges: List[List[datetime]] = []
+    for month in sorted(set(months)):
+        lower = datetime.strptime(month, "%Y-%m")
+        upper = _next_month(lower)
+        if ranges and ranges[-1][1] == lower:
+            ranges[-1][1] = upper
+        else:
+            ranges.append([lower, upper])
+    return [(lower, upper) for lower, upper in ranges]
+
+
+def balance_series(conn: Connection, checkpoints: Table, transactions, user_id: int,
+                   days: Sequence[date]) -> List[Dict[str, float]]:
+    """{currency: balance} at the end of each of the ascending `days`.
+
+    A day that ends its month is the month's checkpoint. Other days add that
+    month's rows up to the day, from one grouped pass over just those months.
+    """
+    if not days:
+        return []
+    t, c = transactions.c, checkpoints.c
+    marks: Dict[str, Tuple[List[str], List[float]]] = defaultdict(lambda: ([], []))
+    for currency, month, balance in conn.execute(
+        select(c.currency, c.month, c.balance)
+        .where(c.user_id == user_id, c.month <= month_key(days[-1]))
+        .order_by(c.currency, c.month)
+    ):
+        marks[currency][0].append(month)
+        marks[currency][1].append(balance)
+
+    partial = [month_key(day) for day in days if (day + timedelta(days=1)).day != 1]
+    daily: Dict[str, Tuple[List[str], List[float]]] = defaultdict(lambda: ([], []))
+    if partial:
+        ranges = [and_(t.date >= lower, t.date < upper) for lower, upper in _month_ranges(partial)]
+        # func.date groups per day and skips the DateTime result processor
+        day_of = func.date(t.date)
+        for currency, key, amount in conn.execute(
+            select(func.coalesce(t.currency, ""), day_of, func.coalesce(func.sum(t.amount), 0.0))
+            .where(t.user_id == user_id, or_(*ranges))
+            .group_by(func.coalesce(t.currency, ""), day_of)
+            .order_by(func.coalesce(t.currency, ""), day_of)
+        ):
+            keys, sums = daily[currency]
+            keys.append(str(key)[:10])
+            sums.append((sums[-1] if sums else 0.0) + amount)
+
+    series = []
+    for day in days:
+        month = month_key(day)
+        whole = (day + timedelta(days=1)).day == 1
+        balances = {}
+        for currency in set(marks) | set(daily):
+            months, values = marks.get(currency, ([], []))
+            # Whole month: its own checkpoint (or the last before it, if it had no rows); else the one before it
+            index = (bisect.bisect_right(months, month) if whole else bisect.bisect_left(months, month)) - 1
+            balance = values[index] if index >= 0 else 0.0
+            if not whole:
+                keys, sums = daily.get(currency, ([], []))
+                # Running sums over the fetched days: the month's share up to `day`
+                upto = bisect.bisect_right(keys, day.isoformat()) - 1
+                before = bisect.bisect_left(keys, f"{month}-01") - 1
+                if upto > before:
+                    balance += sums[upto] - (sums[before] if before >= 0 else 0.0)
+            balances[currency] = balance
+        series.append(balances)
+    return series
+
+
+def converted_balance(by_currency: Dict[str, float], target: str, fx: FxRates, day) -> Tuple[float, List[str]]:
+    """Total in `target` at the day's rates, and the currencies that have no rate."""
+    total, unconverted = 0.0, []
+    for currency, amount in by_currency.items():
+        value = fx.convert_one(amount, currency or None, day, target)
+        if value is None:
+            unconverted.append(currency)
+        else:
+            total += value
+    return total, sorted(unconverted)
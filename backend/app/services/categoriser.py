@@ -0,0 +1,319 @@
+"""Per-user transaction categoriser learned from (title, category) pairs.
+
+Each user gets a multinomial naive-Bayes model over title tokens plus an
+exact-title memory (a title seen before almost always keeps its category).
+The model is a set of counters, so a write is an O(tokens) add or remove and
+nothing is ever retrained from scratch on the request path. For scoring,
+the counters are compiled lazily into a dense log-probability matrix and a
+batch of titles is scored with one gather and one np.add.reduceat.
+
+State is persisted per user as zlib-compressed JSON together with the highest
+transaction id it has seen, so a fresh worker loads the snapshot and only
+catches up on newer rows.
+"""
+import json
+import os
+import re
+import threading
+import time
+import zlib
+from collections import Counter, OrderedDict
+from datetime import datetime
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+from sqlalchemy import Table, delete, insert, select
+from sqlalchemy.engine import Engine
+
+TOKEN_RE = re.compile(r"[a-z]+|\d+")
+
+
+def normalise_title(title: Optional[str]) -> str:
+    return " ".join(TOKEN_RE.findall((title or "").lower()))
+
+
+def tokenize(title: Optional[str]) -> List[str]:
+    """Lower-case word tokens; numbers collapse to one token so amounts and dates don't fragment the vocabulary."""
+    return ["<num>" if token.isdigit() else token for token in TOKEN_RE.findall((title or "").lower())]
+
+
+class NaiveBayesCategoriser:
+    """Incrementally updated multinomial naive Bayes with Laplace smoothing."""
+
+    def __init__(self):
+        self.category_docs: Counter = Counter()
+        self.category_tokens: Counter = Counter()
+        self.token_counts: Dict[str, Counter] = {}
+        self.exact: Dict[str, Counter] = {}
+        self.trained_through_id = 0
+        self._compiled = None
+
+    # Updates -------------------------------------------------------------
+
+    def _update(self, title: str, category: str, delta: int):
+        if not category:
+            return
+        tokens = tokenize(title)
+        self.category_docs[category] += delta
+        self.category_tokens[category] += delta * len(tokens)
+        for token in tokens:
+            counts = self.token_counts.setdefault(token, Counter())
+            counts[category] += delta
+            if counts[category] <= 0:
+                del counts[category]
+                if not counts:
+                    del self.token_counts[token]
+        key = normalise_title(title)
+        if key:
+            counts = self.exact.setdefault(key, Counter())
+            counts[category] += delta
+            if counts[category] <= 0:
+                del counts[category]
+                if not counts:
+                    del self.exact[key]
+        if self.category_docs[category] <= 0:
+            del self.category_docs[category]
+            self.category_tokens.pop(category, None)
+        self._compiled = None
+
+    def add(self, title: str, category: str):
+        self._update(title, category, 1)
+
+    def remove(self, title: str, category: str):
+        self._update(title, category, -1)
+
+    # Scoring -------------------------------------------------------------
+
+    def _compile(self):
+        if self._compiled is None:
+            categories = sorted(self.category_docs)
+            vocabulary = {token: i for i, token in enumerate(self.token_counts)}
+            counts = np.zeros((len(vocabulary) + 1, len(categories)))
+            category_index = {c: j for j, c in enumerate(categories)}
+            for token, i in vocabulary.items():
+                for category, count in self.token_counts[token].items():
+                    counts[i, category_index[category]] = count
+            totals = np.array([self.category_tokens[c] for c in categories], dtype=np.float64)
+            denominators = totals + len(vocabulary) + 1
+            # The last row is the "unseen token" row: only the smoothing term
+            log_likelihood = np.log((counts + 1.0) / denominators)
+            docs = np.array([self.category_docs[c] for c in categories], dtype=np.float64)
+            log_prior = np.log(docs / docs.sum()) if len(docs) else docs
+            self._compiled = (categories, vocabulary, log_likelihood, log_prior)
+        return self._compiled
+
+    def predict_many(self, titles: List[str], top_k: int = 3) -> List[List[Tuple[str, float]]]:
+        """Top-k (category, probability) suggestions for each title."""
+        categories, vocabulary, log_likelihood, log_prior = self._compile()
+        if not categories:
+            return [[] for _ in titles]
+        unknown = len(vocabulary)
+        token_ids, offsets = [], []
+        for title in titles:
+            offsets.append(len(token_ids))
+            token_ids.extend(vocabulary.get(token, unknown) for token in tokenize(title))
+        lengths = np.diff(np.append(offsets, len(token_ids)))
+        scores = np.tile(log_prior, (len(titles), 1))
+        if token_ids:
+            gathered = log_likelihood[np.asarray(token_ids)]
+            nonempty = lengths > 0
+            sums = np.add.reduceat(gathered, np.asarray(offsets)[nonempty], axis=0)
+            scores[nonempty] += sums
+        scores -= scores.max(axis=1, keepdims=True)
+        probabilities = np.exp(scores)
+        probabilities /= probabilities.sum(axis=1, keepdims=True)
+
+        k = min(top_k, len(categories))
+        best = np.argsort(-probabilities, axis=1)[:, :k]
+        results = []
+        for row, title in enumerate(titles):
+            exact = self.exact.get(normalise_title(title))
+            if exact:
+                total = sum(exact.values())
+                suggestions = [(category, count / total) for category, count in exact.most_common(k)]
+                seen = {category for category, _ in suggestions}
+                suggestions += [
+                    (categories[j], float(probabilities[row, j]) * 0.01)
+                    for j in best[row] if categories[j] not in seen
+                ][: k - len(suggestions)]
+            else:
+                suggestions = [(categories[j], float(probabilities[row, j])) for j in best[row]]
+            results.append(suggestions)
+        return results
+
+    def predict(self, title: str, top_k: int = 3) -> List[Tuple[str, float]]:
+        return self.predict_many([title], top_k)[0]
+
+    # Persistence ---------------------------------------------------------
+
+    def to_bytes(self) -> bytes:
+        state = {
+            "docs": self.category_docs,
+            "tokens": self.category_tokens,
+            "counts": self.token_counts,
+            "exact": self.exact,
+        }
+        return zlib.compress(json.dumps(state, separators=(",", ":")).encode(), 6)
+
+    @classmethod
+    def from_bytes(cls, data: bytes, trained_through_id: int = 0) -> "NaiveBayesCategoriser":
+        state = json.loads(zlib.decompress(data))
+        model = cls()
+        model.category_docs = Counter(state["docs"])
+        model.category_tokens = Counter(state["tokens"])
+        model.token_counts = {token: Counter(counts) for token, counts in state["counts"].items()}
+        model.exact = {title: Counter(counts) for title, counts in state["exact"].items()}
+        model.trained_through_id = trained_through_id
+        return model
+
+
+class CategoriserRegistry:
+    """Warm per-user models for one worker process.
+
+    Models are loaded on first use from `models_table` (user_id, state,
+    trained_through_id, updated_at) and caught up from `transactions` by id.
+    Writes committed by this worker are applied at once through `apply`, and
+    their ids are remembered so the next catch-up does not count them twice.
+    New rows from other workers arrive through the periodic catch-up; their
+    edits and deletes of older rows are only seen after `forget`. Dirty
+    models are saved every `save_every` updates and on shutdown.
+    """
+
+    def __init__(self, engine: Engine, transactions: Table, models_table: Table,
+                 max_users: int = 2000, save_every: int = 20, catch_up_seconds: float = 60.0,
+                 engine_for: Optional[Callable[[int], Engine]] = None):
+        self.engine = engine
+        # Sharded deployments keep each user's ledger and model in the user's shard
+        self.engine_for = engine_for or (lambda user_id: engine)
+        self.transactions = transactions
+        self.models_table = models_table
+        self.max_users = max_users
+        self.save_every = save_every
+        self.catch_up_seconds = catch_up_seconds
+        self._models: "OrderedDict[int, NaiveBayesCategoriser]" = OrderedDict()
+        self._dirty: Counter = Counter()
+        self._local_ids: Dict[int, set] = {}
+        self._caught_up_at: Dict[int, float] = {}
+        self._lock = threading.RLock()
+
+    @classmethod
+    def from_env(cls, engine: Engine, transactions: Table, models_table: Table,
+                 engine_for: Optional[Callable[[int], Engine]] = None) -> "CategoriserRegistry":
+        return cls(
+            engine, transactions, models_table,
+            engine_for=engine_for,
+            max_users=int(os.getenv("CATEGORISER_MAX_USERS", "2000")),
+            save_every=int(os.getenv("CATEGORISER_SAVE_EVERY", "20")),
+            catch_up_seconds=float(os.getenv("CATEGORISER_CATCH_UP_SECONDS", "60")),
+        )
+
+    def _load(self, user_id: int) -> NaiveBayesCategoriser:
+        with self.engine_for(user_id).connect() as conn:
+            row = conn.execute(
+                select(self.models_table.c.state, self.models_table.c.trained_through_id)
+                .where(self.models_table.c.user_id == user_id)
+            ).first()
+        if row is not None:
+            return NaiveBayesCategoriser.from_bytes(row.state, row.trained_through_id or 0)
+        return NaiveBayesCategoriser()
+
+    def _catch_up(self, user_id: int, model: NaiveBayesCategoriser):
+        t = self.transactions.c
+        with self.engine_for(user_id).connect() as conn:
+            rows = conn.execute(
+                select(t.id, t.title, t.category)
+                .where(t.user_id == user_id, t.id > model.trained_through_id)
+                .order_by(t.id)
+            ).all()
+        local = self._local_ids.get(user_id, set())
+        for row_id, title, category in rows:
+            if row_id not in local:
+                model.add(title, category)
+                self._dirty[user_id] += 1
+            model.trained_through_id = row_id
+        self._local_ids[user_id] = {i for i in local if i > model.trained_through_id}
+        self._caught_up_at[user_id] = time.monotonic()
+
+    def get(self, user_id: int) -> NaiveBayesCategoriser:
+        with self._lock:
+            model = self._models.get(user_id)
+            if model is None:
+                model = self._load(user_id)
+                self._models[user_id] = model
+                self._catch_up(user_id, model)
+                while len(self._models) > self.max_users:
+                    oldest = next(iter(self._models))
+                    if self._dirty.get(oldest):
+                        self.save(oldest)
+                    self._models.pop(oldest)
+                    self._local_ids.pop(oldest, None)
+                    self._caught_up_at.pop(oldest, None)
+            else:
+                self._models.move_to_end(user_id)
+                if time.monotonic() - self._caught_up_at.get(user_id, 0) > self.catch_up_seconds:
+                    self._catch_up(user_id, model)
+            return model
+
+    def apply(self, user_id: int, ops: Iterable[Tuple[str, Optional[int], str, str]]) -> bool:
+        """Apply committed ("add" | "remove", transaction_id, title, category) ops.
+
+        An edit arrives as a remove of the old values plus an add of the new
+        ones. Only models already in memory are updated; a model loaded later
+        sees the rows through its catch-up. Returns True when the model has
+        enough unsaved updates that it should be saved.
+        """
+        with self._lock:
+            model = self._models.get(user_id)
+            if model is None:
+                return False
+            local = self._local_ids.setdefault(user_id, set())
+            for op, transaction_id, title, category in ops:
+                uncounted = transaction_id is not None and transaction_id > model.trained_through_id
+                if op == "add":
+                    model.add(title, category)
+                    if uncounted:
+                        local.add(transaction_id)
+                elif not uncounted or transaction_id in local:
+                    # Rows from other workers not caught up yet were never counted
+                    model.remove(title, category)
+                self._dirty[user_id] += 1
+            return self._dirty[user_id] >= self.save_every
+
+    def forget(self, user_id: int):
+        """Drop a user's model and snapshot so it is rebuilt from the ledger on next use."""
+        with self._lock:
+            self._models.pop(user_id, None)
+            self._dirty.pop(user_id, None)
+            self._local_ids.pop(user_id, None)
+            self._caught_up_at.pop(user_id, None)
+        with self.engine_for(user_id).begin() as conn:
+            conn.execute(delete(self.models_table).where(self.models_table.c.user_id == user_id))
+
+    def suggest(self, user_id: int, titles: List[str], top_k: int = 3) -> List[List[Tuple[str, float]]]:
+        with self._lock:
+            return self.get(user_id).predict_many(titles, top_k)
+
+    def save(self, user_id: int):
+        """Persist a model; it is caught up first so trained_through_id covers every counted row."""
+        with self._lock:
+            model = self._models.get(user_id)
+            if model is None:
+                return
+            self._catch_up(user_id, model)
+            state = model.to_bytes()
+            trained_through_id = model.trained_through_id
+            self._dirty.pop(user_id, None)
+            with self.engine_for(user_id).begin() as conn:
+                conn.execute(delete(self.models_table).where(self.models_table.c.user_id == user_id))
+                conn.execute(insert(self.models_table).values(
+                    user_id=user_id,
+                    state=state,
+                    trained_through_id=trained_through_id,
+                    updated_at=datetime.utcnow(),
+                ))
+
+    def save_dirty(self):
+        with self._lock:
+            dirty = [user_id for user_id, count in self._dirty.items() if count]
+        for user_id in dirty:
+            self.save(user_id)
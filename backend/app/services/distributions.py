@@ -0,0 +1,460 @@
+"""Per-category spend distributions from mergeable t-digest sketches.
+
+Exact quantiles mean sorting every amount in the range, so instead every
+(user, category, month, currency) keeps a t-digest of its absolute amounts in
+`category_distributions`, with its count, sum, min and max. The centroids
+are stored as packed float arrays; at the default compression of 200 a digest
+has at most about 100 centroids, 1.2 kB. Buckets under about 60 transactions
+keep every value, so their quantiles are exact.
+
+Writes keep the sketches current inside the writing transaction:
+  - inserted transactions are added to their bucket (`record_additions`);
+  - updates and deletes cannot be subtracted from a digest, so they mark the
+    old and new buckets stale (`mark_stale`), and set-based updates mark the
+    user's months stale wholesale (`mark_user_stale`).
+
+A read merges the sketches for the whole months in the range, rebuilding
+stale months from the ledger first. The first read of a user in a process
+also compares the user's sketch counts with the ledger (SketchVerifier) and
+rebuilds everything on a mismatch. That fills in history written before this
+table existed, and users moved by a shard rebalance. The ragged months at
+either end of the range are read row by row and digested on the spot, so any
+date range gives the same answer as the rows themselves, within the digest's
+accuracy.
+
+Buckets are converted to the user's currency by scaling the digest with the
+rate in the middle of the month. Amounts without a currency are already in
+the user's default currency.
+
+Configuration (.env): DISTRIBUTION_COMPRESSION
+"""
+import functools
+import math
+import threading
+from collections import defaultdict
+from datetime import date, datetime
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+from sqlalchemy import Table, and_, bindparam, delete, func, insert, or_, select, update
+from sqlalchemy.engine import Connection, Engine
+
+from .fx import FxRates
+
+DEFAULT_COMPRESSION = 200
+
+_MEANS = np.dtype("<f8")
+_WEIGHTS = np.dtype("<f4")
+
+
+class TDigest:
+    """Merging t-digest (k1 scale function) over float values.
+
+    Compression is one vectorised pass: sort every centroid and group them by
+    the whole unit of k their left edge falls in.
+    """
+
+    def __init__(self, compression: float = DEFAULT_COMPRESSION, means=None, weights=None,
+                 count: int = 0, total: float = 0.0, minimum: float = math.inf, maximum: float = -math.inf):
+        self.compression = compression
+        self.means = np.asarray(means if means is not None else [], dtype=np.float64)
+        self.weights = np.asarray(weights if weights is not None else [], dtype=np.float64)
+        self.count = count
+        self.total = total
+        self.min = minimum
+        self.max = maximum
+
+    @classmethod
+    def of(cls, values: Sequence[float], compression: float = DEFAULT_COMPRESSION) -> "TDigest":
+        digest = cls(compression)
+        digest.update(values)
+        return digest
+
+    def update(self, values: Sequence[float]):
+        values = np.asarray(values, dtype=np.float64)
+        if not len(values):
+            return
+        self.count += len(values)
+        self.total += float(values.sum())
+        self.min = min(self.min, float(values.min()))
+        self.max = max(self.max, float(values.max()))
+        self._compress(np.concatenate([self.means, values]), np.concatenate([self.weights, np.ones(len(values))]))
+
+    @classmethod
+    def merged(cls, digests: Sequence["TDigest"], compression: float = DEFAULT_COMPRESSION) -> "TDigest":
+        """One digest of all of them, compressed once rather than pairwise."""
+        digest = cls(compression)
+        digests = [other for other in digests if other.count]
+        if digests:
+            digest.count = sum(other.count for other in digests)
+            digest.total = sum(other.total for other in digests)
+            digest.min = min(other.min for other in digests)
+            digest.max = max(other.max for other in digests)
+            digest._compress(np.concatenate([other.means for other in digests]),
+                             np.concatenate([other.weights for other in digests]))
+        return digest
+
+    def _compress(self, means: np.ndarray, weights: np.ndarray):
+        order = np.argsort(means, kind="stable")
+        means, weights = means[order], weights[order]
+        left = (np.cumsum(weights) - weights) / weights.sum()
+        # A centroid may span at most one unit of k, so the tails stay fine-grained: group
+        # the sorted points by the unit their left edge falls in
+        k = self.compression / (2 * math.pi) * np.arcsin(np.clip(2 * left - 1, -1.0, 1.0))
+        units = np.floor(k - k[0])
+        starts = np.flatnonzero(np.r_[True, units[1:] != units[:-1]])
+        self.weights = np.add.reduceat(weights, starts)
+        self.means = np.add.reduceat(means * weights, starts) / self.weights
+
+    def quantile(self, q: float) -> Optional[float]:
+        """Interpolated like numpy's default, so all-singleton digests give the exact answer."""
+        if not self.count:
+            return None
+        if len(self.means) == 1:
+            return float(self.means[0])
+        total = self.weights.sum()
+        centers = np.cumsum(self.weights) - self.weights / 2
+        positions = np.concatenate([[0.5], centers, [total - 0.5]])
+        values = np.concatenate([[self.min], self.means, [self.max]])
+        return float(np.interp(q * (total - 1) + 0.5, positions, values))
+
+    def scaled(self, factor: float) -> "TDigest":
+        """The digest of every value multiplied by a positive factor."""
+        return TDigest(self.compression, self.means * factor, self.weights.copy(), self.count,
+                       self.total * factor, self.min * factor, self.max * factor)
+
+    def centroid_bytes(self) -> bytes:
+        return self.means.astype(_MEANS).tobytes() + self.weights.astype(_WEIGHTS).tobytes()
+
+    @classmethod
+    def from_row(cls, row, compression: float = DEFAULT_COMPRESSION) -> "TDigest":
+        blob = row.centroids or b""
+        size = len(blob) // (_MEANS.itemsize + _WEIGHTS.itemsize)
+        split = size * _MEANS.itemsize
+        return cls(
+            compression,
+            np.frombuffer(blob[:split], dtype=_MEANS).astype(np.float64),
+            np.frombuffer(blob[split:], dtype=_WEIGHTS).astype(np.float64),
+            row.transaction_count, row.total_amount, row.min_amount, row.max_amount,
+        )
+
+
+def month_key(value: datetime) -> str:
+    return f"{value.year:04d}-{value.month:02d}"
+
+
+def _month_start(value: datetime) -> datetime:
+    return datetime(value.year, value.month, 1)
+
+
+def _next_month(value: datetime) -> datetime:
+    return datetime(value.year + value.month // 12, value.month % 12 + 1, 1)
+
+
+def _month_middle(key: str) -> date:
+    return date(int(key[:4]), int(key[5:7]), 15)
+
+
+def _row_values(digest: TDigest) -> dict:
+    return {
+        "transaction_count": digest.count,
+        "total_amount": digest.total,
+        "min_amount": digest.min,
+        "max_amount": digest.max,
+        "centroids": digest.centroid_bytes(),
+        "stale": False,
+        "updated_at": datetime.utcnow(),
+    }
+
+
+def record_additions(conn: Connection, sketches: Table, rows: Iterable[Tuple[int, str, datetime, Optional[str], float]],
+                     compression: float = DEFAULT_COMPRESSION):
+    """Add new transactions, given as (user_id, category, date, currency, amount), to their buckets.
+
+    Runs in the writer's transaction; the sketch row is read FOR UPDATE so
+    concurrent writers to one bucket serialise (SQLite already holds the
+    database write lock at this point).
+    """
+    buckets: Dict[Tuple[int, str, str, str], List[float]] = defaultdict(list)
+    for user_id, category, when, currency, amount in rows:
+        if when is None:
+            continue
+        buckets[(user_id, category or "", month_key(when), currency or "")].append(abs(amount or 0.0))
+    select_bucket, insert_bucket, update_bucket = _bucket_statements(sketches)
+    for (user_id, category, month, currency), amounts in buckets.items():
+        key = {"key_user_id": user_id, "key_category": category, "key_month": month, "key_currency": currency}
+        row = conn.execute(select_bucket, key).first()
+        if row is None:
+            digest = TDigest.of(amounts, compression)
+            conn.execute(insert_bucket, {
+                "user_id": user_id, "category": category, "month": month, "currency": currency, **_row_values(digest)
+            })
+        elif not row.stale:
+            digest = TDigest.from_row(row, compression)
+            digest.update(amounts)
+            conn.execute(update_bucket, {**key, **_row_values(digest)})
+        # A stale bucket is rebuilt from the rows on its next read, new ones included
+
+
+@functools.lru_cache(maxsize=None)
+def _bucket_statements(sketches: Table):
+    """Select-for-update, insert and update of one bucket, built once; this runs on every transaction write."""
+    s = sketches.c
+    key = and_(
+        s.user_id == bindparam("key_user_id"), s.category == bindparam("key_category"),
+        s.month == bindparam("key_month"), s.currency == bindparam("key_currency"),
+    )
+    values = {name: bindparam(name) for name in _row_values(TDigest())}
+    return (
+        select(sketches).where(key).with_for_update(),
+        insert(sketches),
+        update(sketches).where(key).values(**values),
+    )
+
+
+def mark_stale(conn: Connection, sketches: Table, buckets: Iterable[Tuple[int, Optional[str], Optional[datetime]]]):
+    """Mark the (user_id, category, date) buckets for a rebuild, in every currency."""
+    s = sketches.c
+    keys = {(user_id, category or "", month_key(when)) for user_id, category, when in buckets if when is not None}
+    if keys:
+        conn.execute(
+            update(sketches)
+            .where(or_(*(and_(s.user_id == u, s.category == c, s.month == m) for u, c, m in keys)))
+            .values(stale=True)
+        )
+
+
+def mark_user_stale(conn: Connection, sketches: Table, user_id: int,
+                    start: Optional[datetime] = None, end: Optional[datetime] = None):
+    """Mark a user's buckets overlapping [start, end] (all of them by default) for a rebuild."""
+    s = sketches.c
+    conditions = [s.user_id == user_id]
+    if start is not None:
+        conditions.append(s.month >= month_key(start))
+    if end is not None:
+        conditions.append(s.month <= month_key(end))
+    conn.execute(update(sketches).where(*conditions).values(stale=True))
+
+
+def _full_months(start: Optional[datetime], end: Optional[datetime]) -> Tuple[Optional[datetime], Optional[datetime], bool]:
+    """[lower, upper) covering the whole months inside [start, end]; None is unbounded. The flag is False when empty."""
+    lower = None if start is None else (start if start == _month_start(start) else _next_month(start))
+    upper = None if end is None else _month_start(end)
+    return lower, upper, lower is None or upper is None or lower < upper
+
+
+def _span_conditions(t, user_id: int, lower: Optional[datetime], upper: Optional[datetime]) -> list:
+    # Only (user_id, date), so counting the span stays inside ix_transactions_user_date
+    conditions = [t.user_id == user_id, t.date.is_not(None)]
+    if lower is not None:
+        conditions.append(t.date >= lower)
+    if upper is not None:
+        conditions.append(t.date < upper)
+    return conditions
+
+
+def _month_conditions(s, user_id: int, lower: Optional[datetime], upper: Optional[datetime]) -> list:
+    conditions = [s.user_id == user_id]
+    if lower is not None:
+        conditions.append(s.month >= month_key(lower))
+    if upper is not None:
+        conditions.append(s.month < month_key(upper))
+    return conditions
+
+
+def rebuild(conn: Connection, sketches: Table, transactions, user_id: int,
+            lower: Optional[datetime] = None, upper: Optional[datetime] = None,
+            compression: float = DEFAULT_COMPRESSION) -> int:
+    """Recompute the user's buckets for the months in [lower, upper) from the ledger; returns the bucket count."""
+    t, s = transactions.c, sketches.c
+    # Delete first: on SQLite that takes the write lock before the rows are read
+    conn.execute(delete(sketches).where(*_month_conditions(s, user_id, lower, upper)))
+    rows = conn.execute(
+        select(t.category, t.currency, t.date, t.amount).where(*_span_conditions(t, user_id, lower, upper))
+    ).all()
+    buckets: Dict[Tuple[str, str, str], List[float]] = defaultdict(list)
+    for category, currency, when, amount in rows:
+        # Uncategorised rows get a bucket too, so sketch counts always match the ledger's
+        buckets[(category or "", month_key(when), currency or "")].append(abs(amount or 0.0))
+    if buckets:
+        conn.execute(insert(sketches), [
+            {"user_id": user_id, "category": category, "month": month, "currency": currency,
+             **_row_values(TDigest.of(amounts, compression))}
+            for (category, month, currency), amounts in buckets.items()
+        ])
+    return len(buckets)
+
+
+class SketchVerifier:
+    """Users whose sketches this process has checked against the ledger.
+
+    Every write path in the app keeps the sketches current, so the count
+    check, an index-only COUNT over the user's rows, runs once per user per
+    process. It catches history written before the sketches existed and users
+    moved by an offline rebalance.
+    """
+
+    def __init__(self):
+        self._verified = set()
+        self._lock = threading.Lock()
+
+    def ensure(self, engine: Engine, sketches: Table, transactions, user_id: int,
+               compression: float = DEFAULT_COMPRESSION) -> int:
+        """Rebuild all of the user's buckets if their counts disagree with the ledger; returns buckets rebuilt."""
+        with self._lock:
+            if user_id in self._verified:
+                return 0
+        t, s = transactions.c, sketches.c
+        rebuilt = 0
+        with engine.connect() as conn:
+            sketched = conn.execute(
+                select(func.coalesce(func.sum(s.transaction_count), 0)).where(s.user_id == user_id)
+            ).scalar_one()
+            expected = conn.execute(
+                select(func.count()).select_from(transactions).where(*_span_conditions(t, user_id, None, None))
+            ).scalar_one()
+        if sketched != expected:
+            with engine.begin() as conn:
+                rebuilt = rebuild(conn, sketches, transactions, user_id, compression=compression)
+        with self._lock:
+            self._verified.add(user_id)
+        return rebuilt
+
+
+def _load_sketches(engine: Engine, sketches: Table, transactions, user_id: int, lower, upper,
+                   compression: float) -> Tuple[list, int]:
+    """Sketch rows for the whole months in [lower, upper), rebuilding stale months first."""
+    s = sketches.c
+    with engine.connect() as conn:
+        rows = conn.execute(select(sketches).where(*_month_conditions(s, user_id, lower, upper))).all()
+    stale = sorted({row.month for row in rows if row.stale})
+    if not stale:
+        return rows, 0
+    first = datetime(int(stale[0][:4]), int(stale[0][5:7]), 1)
+    last = _next_month(datetime(int(stale[-1][:4]), int(stale[-1][5:7]), 1))
+    with engine.begin() as conn:
+        rebuilt = rebuild(conn, sketches, transactions, user_id, first, last, compression)
+        rows = conn.execute(select(sketches).where(*_month_conditions(s, user_id, lower, upper))).all()
+    return rows, rebuilt
+
+
+def category_distributions(engine: Engine, sketches: Table, transactions, user_id: int,
+                           start: Optional[datetime], end: Optional[datetime], category: Optional[str],
+                           currency: str, fx: FxRates, quantiles: Sequence[float],
+                           compression: float = DEFAULT_COMPRESSION, outliers: int = 0,
+                           verifier: Optional[SketchVerifier] = None) -> dict:
+    """Quantiles, mean, extremes and a Tukey outlier fence per category over [start, end].
+
+    `transactions` is the table, or the partition union, holding all of the
+    user's rows. Pass a shared SketchVerifier to check the user's sketches
+    against the ledger once per process.
+    """
+    t = transactions.c
+    lower, upper, has_full_months = _full_months(start, end)
+    parts: Dict[str, List[TDigest]] = defaultdict(list)
+    unconverted: Dict[str, int] = defaultdict(int)
+    rebuilt = verifier.ensure(engine, sketches, transactions, user_id, compression) if verifier is not None else 0
+    rows = []
+    if has_full_months:
+        rows, stale_rebuilt = _load_sketches(engine, sketches, transactions, user_id, lower, upper, compression)
+        rebuilt += stale_rebuilt
+    # Uncategorised rows only keep the counts whole
+    rows = [row for row in rows if row.category and (category is None or row.category == category)]
+
+    rates: Dict[Tuple[str, str], Optional[float]] = {}
+    for row in rows:
+        factor = 1.0
+        if row.currency and row.currency != currency:
+            key = (row.currency, row.month)
+            if key not in rates:
+                rates[key] = fx.convert_one(1.0, row.currency, _month_middle(row.month), currency)
+            factor = rates[key]
+        if factor is None:
+            unconverted[row.category] += row.transaction_count
+            continue
+        digest = TDigest.from_row(row, compression)
+        parts[row.category].append(digest if factor == 1.0 else digest.scaled(factor))
+
+    # The ragged ends of the range, digested from their rows: (from, to, to is inclusive)
+    edges = []
+    if not has_full_months:
+        edges.append((start, end, True))
+    else:
+        if start is not None and lower != start:
+            edges.append((start, lower, False))
+        if end is not None:
+            edges.append((upper, end, True))
+    with engine.connect() as conn:
+        for edge_start, edge_end, inclusive in edges:
+            conditions = [t.user_id == user_id, t.amount.is_not(None), t.category.is_not(None), t.date.is_not(None)]
+            if edge_start is not None:
+                conditions.append(t.date >= edge_start)
+            if edge_end is not None:
+                conditions.append(t.date <= edge_end if inclusive else t.date < edge_end)
+            if category is not None:
+                conditions.append(t.category == category)
+            # func.date skips the DateTime result processor; only the day is needed for the rate
+            rows = conn.execute(select(t.category, t.currency, func.date(t.date), t.amount).where(*conditions)).all()
+            if not rows:
+                continue
+            names = np.array([row[0] for row in rows], dtype=object)
+            converted = fx.convert(
+                np.abs(np.array([row[3] for row in rows], dtype=np.float64)),
+                np.array([row[1] for row in rows], dtype=object),
+                np.array([str(row[2])[:10] for row in rows], dtype="datetime64[D]"),
+                currency,
+            )
+            for name in set(names.tolist()):
+                amounts = converted[names == name]
+                missing = np.isnan(amounts)
+                unconverted[name] += int(missing.sum())
+                parts[name].append(TDigest.of(amounts[~missing], compression))
+
+        digests = {name: TDigest.merged(digests, compression) for name, digests in parts.items()}
+        result = []
+        for name in sorted(set(digests) | set(unconverted)):
+            digest = digests.get(name) or TDigest(compression)
+            fence = None
+            if digest.count:
+                q1, q3 = digest.quantile(0.25), digest.quantile(0.75)
+                fence = q3 + 1.5 * (q3 - q1)
+            entry = {
+                "category": name,
+                "transaction_count": digest.count,
+                "total_amount": digest.total,
+                "currency": currency,
+                "unconverted_count": unconverted.get(name, 0),
+                "mean": digest.total / digest.count if digest.count else None,
+                "min": digest.min if digest.count else None,
+                "max": digest.max if digest.count else None,
+                "quantiles": {f"{q:g}": digest.quantile(q) for q in quantiles},
+                "outlier_above": fence,
+            }
+            if outliers and fence is not None and digest.max > fence:
+                entry["outliers"] = _outliers(conn, transactions, user_id, name, start, end, currency, fx, fence, outliers)
+            result.append(entry)
+    return {"currency": currency, "categories": result, "rebuilt_buckets": rebuilt}
+
+
+def _outliers(conn: Connection, transactions, user_id: int, category: str, start, end, currency: str,
+              fx: FxRates, fence: float, limit: int) -> List[dict]:
+    """The largest transactions above the fence; candidates come from raw magnitudes, then get converted."""
+    t = transactions.c
+    conditions = [t.user_id == user_id, t.category == category, t.amount.is_not(None)]
+    if start is not None:
+        conditions.append(t.date >= start)
+    if end is not None:
+        conditions.append(t.date <= end)
+    candidates = conn.execute(
+        select(t.id, t.title, t.amount, t.currency, t.date)
+        .where(*conditions)
+        .order_by(func.abs(t.amount).desc())
+        .limit(limit * 4)
+    ).all()
+    flagged = []
+    for row in candidates:
+        converted = fx.convert_one(abs(row.amount), row.currency, row.date.date(), currency) if row.date else None
+        if converted is not None and converted > fence:
+            flagged.append({"id": row.id, "title": row.title, "amount": converted, "date": row.date.isoformat()})
+    flagged.sort(key=lambda item: -item["amount"])
+    return flagged[:limit]
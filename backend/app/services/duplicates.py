@@ -0,0 +1,127 @@
+"""Duplicate-transaction fingerprints.
+
+A fingerprint is a hash of (user, amount in cents, date bucket, normalised
+title). Retries, double imports and re-materialised recurring rows all land on
+the same fingerprint, so with an index on (user_id, fingerprint) a duplicate is
+one index probe at insert time, and the duplicates report is a single GROUP BY
+over the index instead of a pairwise comparison of the ledger.
+
+The bucket width is DUPLICATE_DATE_BUCKET_DAYS (default 1: same calendar day).
+Changing it changes every fingerprint; run the backfill with --recompute
+afterwards.
+"""
+import argparse
+import hashlib
+import os
+from datetime import datetime
+from itertools import groupby
+from typing import Any, Dict, List, Optional
+
+from sqlalchemy import bindparam, func, select, update
+from sqlalchemy.engine import Connection, Engine
+
+from app.services.categoriser import normalise_title
+
+DATE_BUCKET_DAYS = max(1, int(os.getenv("DUPLICATE_DATE_BUCKET_DAYS", "1")))
+
+
+def transaction_fingerprint(user_id: Optional[int], amount: Optional[float], date: Optional[datetime],
+                            title: Optional[str], bucket_days: int = DATE_BUCKET_DAYS) -> Optional[str]:
+    if user_id is None or amount is None or date is None:
+        return None
+    key = f"{user_id}|{int(round(amount * 100))}|{date.toordinal() // bucket_days}|{normalise_title(title)}"
+    return hashlib.sha1(key.encode()).hexdigest()[:32]
+
+
+def backfill_fingerprints(engine: Engine, table, batch_size: int = 10000, recompute: bool = False) -> int:
+    """Fill in fingerprints for rows written before the column existed, in id order and batches."""
+    t = table.c
+    statement = (
+        update(table)
+        .where(t.id == bindparam("row_id"))
+        .values(fingerprint=bindparam("row_fingerprint"))
+    )
+    updated, last_id = 0, 0
+    while True:
+        query = select(t.id, t.user_id, t.amount, t.date, t.title).where(t.id > last_id)
+        if not recompute:
+            query = query.where(t.fingerprint.is_(None))
+        with engine.begin() as conn:
+            rows = conn.execute(query.order_by(t.id).limit(batch_size)).all()
+            if not rows:
+                return updated
+            params = [
+                {"row_id": row.id, "row_fingerprint": fingerprint}
+                for row in rows
+                if (fingerprint := transaction_fingerprint(row.user_id, row.amount, row.date, row.title)) is not None
+            ]
+            if params:
+                conn.execute(statement, params)
+        updated += len(params)
+        last_id = rows[-1].id
+
+
+def duplicate_clusters(conn: Connection, transactions, user_id: int, limit: int = 100) -> Dict[str, Any]:
+    """Groups of a user's transactions that share a fingerprint, largest first.
+
+    One statement: the fingerprints with more than one row (a GROUP BY over the
+    (user_id, fingerprint) index) joined back to their rows.
+    """
+    t = transactions.c
+    groups = (
+        select(t.fingerprint, func.count().label("size"))
+        .where(t.user_id == user_id, t.fingerprint.is_not(None))
+        .group_by(t.fingerprint)
+        .having(func.count() > 1)
+        .order_by(func.count().desc(), t.fingerprint)
+        .limit(limit)
+        .subquery()
+    )
+    rows = conn.execute(
+        select(t.id, t.title, t.amount, t.category, t.date, t.fingerprint, groups.c.size)
+        .join_from(transactions, groups, t.fingerprint == groups.c.fingerprint)
+        .where(t.user_id == user_id)
+        .order_by(groups.c.size.desc(), t.fingerprint, t.date, t.id)
+    ).all()
+
+    clusters: List[Dict[str, Any]] = []
+    for fingerprint, members in groupby(rows, key=lambda row: row.fingerprint):
+        members = list(members)
+        clusters.append({
+            "fingerprint": fingerprint,
+            "count": len(members),
+            # Everything after the first row is what the duplicates add to totals
+            "excess_amount": round(sum(row.amount for row in members[1:]), 2),
+            "transactions": [
+                {
+                    "id": row.id,
+                    "title": row.title,
+                    "amount": row.amount,
+                    "category": row.category,
+                    "date": row.date.isoformat() if row.date else None,
+                }
+                for row in members
+            ],
+        })
+    return {
+        "clusters": clusters,
+        "cluster_count": len(clusters),
+        "duplicate_transactions": sum(c["count"] - 1 for c in clusters),
+        "excess_amount": round(sum(c["excess_amount"] for c in clusters), 2),
+    }
+
+
+def main():
+    from sqlalchemy import MetaData, Table, create_engine
+
+    parser = argparse.ArgumentParser(description="Backfill transaction fingerprints")
+    parser.add_argument("--database-url", default=os.getenv("DATABASE_URL", "sqlite:///./finance_app.db"))
+    parser.add_argument("--recompute", action="store_true", help="recompute every row, e.g. after changing the bucket width")
+    args = parser.parse_args()
+    engine = create_engine(args.database_url)
+    table = Table("transactions", MetaData(), autoload_with=engine)
+    print(f"updated {backfill_fingerprints(engine, table, recompute=args.recompute)} rows")
+
+
+if __name__ == "__main__":
+    main()
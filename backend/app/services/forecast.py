@@ -0,0 +1,382 @@
+"""Cashflow forecasting from recurring series and per-category spending trends.
+
+The forecast for one user is built from three arrays-in, arrays-out steps:
+
+1. Recurring series are expanded into future occurrence dates with NumPy
+   datetime64 arithmetic. Monthly and yearly series keep their anchor day and
+   clamp it to the month length, so a series anchored on the 31st falls on
+   Feb 28/29 and is back on the 31st in March.
+2. Non-recurring transactions of the last `lookback_months` complete months
+   are totalled per (category, month) and a least-squares line is fitted per
+   category, all categories at once.
+3. Both are spread over a daily grid and accumulated onto the current
+   balance.
+
+Batch mode (python -m app.services.forecast) computes forecasts for every
+user in a process pool and stores them in forecast_snapshots, on the shard
+that holds the user's transactions (DATABASE_SHARD_URLS). Each snapshot is
+anchored on the server's local date at its `computed_at` (`anchor_date`), the
+same day an on-demand forecast would use.
+"""
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date, datetime, timezone
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from dotenv import load_dotenv
+from sqlalchemy import MetaData, Table, create_engine, delete, func, insert, or_, select
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.sql import FromClause
+
+from app.services.fx import FxRates, converted_totals
+from app.utils.partitioning import archived_years, attach_sqlite_archive, partition_union
+from app.utils.sharding import ShardRouter
+from app.utils.sqlite_profile import apply_sqlite_profile
+
+load_dotenv()
+
+FIXED_STEP_DAYS = {"daily": 1, "weekly": 7}
+MONTH_STEPS = {"monthly": 1, "yearly": 12}
+
+
+def _month_start(today: date, months_back: int = 0) -> datetime:
+    month = today.month - 1 - months_back
+    return datetime(today.year + month // 12, month % 12 + 1, 1)
+
+
+def _as_day(value) -> np.datetime64:
+    if isinstance(value, datetime):
+        value = value.date()
+    return np.datetime64(value, "D")
+
+
+def anchor_date(computed_at: datetime) -> date:
+    """Local date a forecast computed at this naive UTC time is anchored on (date.today() at that moment)."""
+    return computed_at.replace(tzinfo=timezone.utc).astimezone().date()
+
+
+def days_in_month(months: np.ndarray) -> np.ndarray:
+    """Number of days in each datetime64[M] month."""
+    return ((months + 1).astype("datetime64[D]") - months.astype("datetime64[D]")).astype(np.int64)
+
+
+def _expand_ranges(counts: np.ndarray, starts: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """For series i, yield k = starts[i] .. starts[i] + counts[i] - 1; returns (series_index, k)."""
+    counts = np.maximum(counts, 0)
+    total = int(counts.sum())
+    series = np.repeat(np.arange(len(counts)), counts)
+    if total == 0:
+        return series, np.zeros(0, dtype=np.int64)
+    offsets = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+    return series, starts[series] + offsets
+
+
+def expand_fixed_step(anchors: np.ndarray, steps: np.ndarray, start: np.datetime64, end: np.datetime64) -> Tuple[np.ndarray, np.ndarray]:
+    """Occurrences anchor + k * step (days) that fall within [start, end]."""
+    anchor_days = anchors.astype("datetime64[D]").astype(np.int64)
+    start_day, end_day = start.astype(np.int64), end.astype(np.int64)
+    first_k = np.maximum(0, -((anchor_days - start_day) // steps))
+    last_k = np.floor_divide(end_day - anchor_days, steps)
+    series, k = _expand_ranges(last_k - first_k + 1, first_k)
+    dates = (anchor_days[series] + k * steps[series]).astype("datetime64[D]")
+    return series, dates
+
+
+def expand_month_step(anchors: np.ndarray, step_months: np.ndarray, start: np.datetime64, end: np.datetime64) -> Tuple[np.ndarray, np.ndarray]:
+    """Occurrences every step_months months on the anchor day, clamped to month end."""
+    anchor_days = anchors.astype("datetime64[D]")
+    anchor_months = anchor_days.astype("datetime64[M]")
+    anchor_dom = (anchor_days - anchor_months.astype("datetime64[D]")).astype(np.int64)
+    month_index = anchor_months.astype(np.int64)
+    start_month = start.astype("datetime64[M]").astype(np.int64)
+    end_month = end.astype("datetime64[M]").astype(np.int64)
+    first_k = np.maximum(0, -((month_index - start_month) // step_months))
+    last_k = np.floor_divide(end_month - month_index, step_months)
+    series, k = _expand_ranges(last_k - first_k + 1, first_k)
+    months = (month_index[series] + k * step_months[series]).astype("datetime64[M]")
+    dom = np.minimum(anchor_dom[series], days_in_month(months) - 1)
+    dates = months.astype("datetime64[D]") + dom
+    keep = (dates >= start) & (dates <= end)
+    return series[keep], dates[keep]
+
+
+def expand_recurring(series_rows: List[dict], start: date, end: date) -> Tuple[np.ndarray, np.ndarray]:
+    """Expand recurring series into (dates, amounts) arrays within [start, end].
+
+    Each row needs amount, recurrence_frequency, date and next_recurrence_date.
+    The anchor is the next due date (falling back to the original date); custom
+    series repeat every (next_recurrence_date - date) days, as in
+    process_recurring_transactions.
+    """
+    start_d, end_d = _as_day(start), _as_day(end)
+    out_dates, out_amounts = [], []
+    fixed_anchor, fixed_step, fixed_amount = [], [], []
+    month_anchor, month_step, month_amount = [], [], []
+    for row in series_rows:
+        frequency = row["recurrence_frequency"]
+        anchor = row["next_recurrence_date"] or row["date"]
+        if anchor is None:
+            continue
+        if frequency in FIXED_STEP_DAYS:
+            fixed_anchor.append(_as_day(anchor)); fixed_step.append(FIXED_STEP_DAYS[frequency]); fixed_amount.append(row["amount"])
+        elif frequency in MONTH_STEPS:
+            month_anchor.append(_as_day(anchor)); month_step.append(MONTH_STEPS[frequency]); month_amount.append(row["amount"])
+        elif frequency == "custom" and row["next_recurrence_date"] and row["date"]:
+            interval = (_as_day(row["next_recurrence_date"]) - _as_day(row["date"])).astype(np.int64)
+            if interval > 0:
+                fixed_anchor.append(_as_day(anchor)); fixed_step.append(int(interval)); fixed_amount.append(row["amount"])
+
+    if fixed_anchor:
+        series, dates = expand_fixed_step(np.array(fixed_anchor), np.array(fixed_step, dtype=np.int64), start_d, end_d)
+        out_dates.append(dates); out_amounts.append(np.asarray(fixed_amount, dtype=np.float64)[series])
+    if month_anchor:
+        series, dates = expand_month_step(np.array(month_anchor), np.array(month_step, dtype=np.int64), start_d, end_d)
+        out_dates.append(dates); out_amounts.append(np.asarray(month_amount, dtype=np.float64)[series])
+    if not out_dates:
+        return np.zeros(0, dtype="datetime64[D]"), np.zeros(0)
+    return np.concatenate(out_dates), np.concatenate(out_amounts)
+
+
+def category_trends(categories: np.ndarray, dates: np.ndarray, amounts: np.ndarray, first_month: np.datetime64, months: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Least-squares monthly trend per category.
+
+    Returns (category_names, intercepts, slopes) where month 0 is first_month
+    and the fitted total for month t is intercept + slope * t.
+    """
+    if len(amounts) == 0:
+        return np.array([], dtype=object), np.zeros(0), np.zeros(0)
+    names, codes = np.unique(categories, return_inverse=True)
+    month_idx = (dates.astype("datetime64[M]") - first_month).astype(np.int64)
+    totals = np.zeros((len(names), months))
+    np.add.at(totals, (codes, month_idx), amounts)
+    x = np.arange(months, dtype=np.float64)
+    x_centered = x - x.mean()
+    denom = (x_centered ** 2).sum() or 1.0
+    means = totals.mean(axis=1)
+    slopes = (totals - means[:, None]) @ x_centered / denom
+    intercepts = means - slopes * x.mean()
+    return names, intercepts, slopes
+
+
+def build_forecast(
+    current_balance: float,
+    series_rows: List[dict],
+    history: Tuple[np.ndarray, np.ndarray, np.ndarray],
+    today: date,
+    horizon_days: int,
+    lookback_months: int = 6,
+) -> dict:
+    """Daily projected balance for the next horizon_days days."""
+    start = _as_day(today) + 1
+    end = _as_day(today) + horizon_days
+    days = np.arange(start, end + 1, dtype="datetime64[D]")
+
+    recurring = np.zeros(len(days))
+    occurrence_dates, occurrence_amounts = expand_recurring(series_rows, start.astype(object), end.astype(object))
+    np.add.at(recurring, (occurrence_dates - start).astype(np.int64), occurrence_amounts)
+
+    categories, dates, amounts = history
+    first_month = _as_day(today).astype("datetime64[M]") - lookback_months
+    names, intercepts, slopes = category_trends(categories, dates, amounts, first_month, lookback_months)
+    # Month t of the forecast grid, counted from first_month like the fit
+    day_months = days.astype("datetime64[M]")
+    t = (day_months - first_month).astype(np.int64)
+    monthly = intercepts[:, None] + slopes[:, None] * t[None, :]
+    # Never let a trend flip a category's sign (spend turning into income)
+    sign = np.sign(intercepts + slopes * (lookback_months - 1))
+    monthly = np.where(sign[:, None] < 0, np.minimum(monthly, 0), np.maximum(monthly, 0))
+    trend_by_category = monthly / days_in_month(day_months)[None, :]
+    trend = trend_by_category.sum(axis=0) if len(names) else np.zeros(len(days))
+
+    balance = current_balance + np.cumsum(recurring + trend)
+    return {
+        "horizon_days": horizon_days,
+        "as_of": str(today),
+        "current_balance": round(float(current_balance), 2),
+        "projected_balance": round(float(balance[-1]), 2) if len(balance) else round(float(current_balance), 2),
+        "recurring_occurrences": int(len(occurrence_dates)),
+        "category_trends": [
+            {
+                "category": str(name),
+                "monthly_projection": round(float(monthly[i, -1]), 2),
+                "monthly_slope": round(float(slopes[i]), 2),
+            }
+            for i, name in enumerate(names)
+        ],
+        "series": [
+            {
+                "date": str(day),
+                "balance": round(float(value), 2),
+                "recurring": round(float(rec), 2),
+                "trend": round(float(tr), 2),
+            }
+            for day, value, rec, tr in zip(days, balance, recurring, trend)
+        ],
+    }
+
+
+def load_user_inputs(conn: Connection, transactions: FromClause, user_id: int, today: date, lookback_months: int = 6,
+                     currency: Optional[str] = None, fx: Optional[FxRates] = None):
+    """Fetch the balance, recurring series heads and trend history for one user.
+
+    `transactions` is the transactions table or any selectable with the same
+    columns (e.g. the partition-aware union from TransactionPartitions). With
+    `currency` and `fx`, amounts are converted to `currency`: past amounts at
+    their own date's rate, recurring amounts at today's rate.
+    """
+    t = transactions.c
+    now = datetime.combine(today, datetime.max.time())
+    convert = currency is not None and fx is not None
+    if convert:
+        balance = converted_totals(conn, transactions, [t.user_id == user_id, t.date <= now], currency, fx)
+        current_balance = balance.get(None, (0.0, 0, 0))[0]
+    else:
+        current_balance = conn.execute(
+            select(func.coalesce(func.sum(t.amount), 0.0)).where(t.user_id == user_id, t.date <= now)
+        ).scalar()
+
+    # process_recurring_transactions copies the recurring flag onto every
+    # materialised row, so one series appears many times; keep only the row
+    # with the latest next_recurrence_date per (title, amount, category, frequency)
+    columns = [t.title, t.amount, t.category, t.recurrence_frequency, t.date, t.next_recurrence_date]
+    rows = conn.execute(
+        select(*columns, *([t.currency] if convert else []))
+        .where(t.user_id == user_id, t.is_recurring == True)
+    ).mappings().all()
+    heads: Dict[tuple, dict] = {}
+    for row in rows:
+        key = (row["title"], row["amount"], row["category"], row["recurrence_frequency"], row.get("currency"))
+        current = heads.get(key)
+        if current is None or (row["next_recurrence_date"] or datetime.min) > (current["next_recurrence_date"] or datetime.min):
+            heads[key] = dict(row)
+    if convert:
+        for head in heads.values():
+            head["amount"] = fx.convert_one(head["amount"] or 0.0, head.pop("currency"), today, currency)
+        heads = {key: head for key, head in heads.items() if head["amount"] is not None}
+
+    history = conn.execute(
+        select(t.category, t.date, t.amount, *([t.currency] if convert else [])).where(
+            t.user_id == user_id,
+            or_(t.is_recurring == False, t.is_recurring.is_(None)),
+            t.date >= _month_start(today, lookback_months),
+            t.date < _month_start(today),
+        )
+    ).all()
+    categories = np.array([row[0] or "Uncategorized" for row in history], dtype=object)
+    dates = np.array([row[1] for row in history], dtype="datetime64[D]") if history else np.zeros(0, dtype="datetime64[D]")
+    amounts = np.array([row[2] or 0.0 for row in history], dtype=np.float64)
+    if convert and history:
+        amounts = fx.convert(amounts, np.array([row[3] for row in history], dtype=object), dates, currency)
+        # Rows in a currency without rates are left out of the trend
+        known = ~np.isnan(amounts)
+        categories, dates, amounts = categories[known], dates[known], amounts[known]
+    return float(current_balance), list(heads.values()), (categories, dates, amounts)
+
+
+def forecast_for_user(conn: Connection, transactions: FromClause, user_id: int, horizon_days: int, today: Optional[date] = None,
+                      lookback_months: int = 6, currency: Optional[str] = None, fx: Optional[FxRates] = None) -> dict:
+    today = today or date.today()
+    balance, series_rows, history = load_user_inputs(conn, transactions, user_id, today, lookback_months, currency, fx)
+    forecast = build_forecast(balance, series_rows, history, today, horizon_days, lookback_months)
+    if currency is not None:
+        forecast["currency"] = currency
+    return forecast
+
+
+# Batch mode -----------------------------------------------------------------
+
+_worker_router: Optional[ShardRouter] = None
+_worker_tables: Dict[Engine, Tuple[Table, Table]] = {}
+_worker_users: Optional[Table] = None
+_worker_fx: Optional[FxRates] = None
+
+
+def _init_worker(database_url: str):
+    global _worker_router, _worker_users, _worker_fx
+    engine = create_engine(database_url)
+    apply_sqlite_profile(engine)
+    attach_sqlite_archive(engine)
+    _worker_router = ShardRouter.from_env(engine)
+    _worker_users = Table("users", MetaData(), autoload_with=engine)
+    _worker_fx = FxRates.from_env()
+
+
+def _tables_for(engine: Engine) -> Tuple[Table, Table]:
+    if engine not in _worker_tables:
+        metadata = MetaData()
+        # Shards have no users table, so foreign keys to it cannot be followed
+        _worker_tables[engine] = (
+            Table("transactions", metadata, autoload_with=engine, resolve_fks=False),
+            Table("forecast_snapshots", metadata, autoload_with=engine, resolve_fks=False),
+        )
+    return _worker_tables[engine]
+
+
+def _forecast_chunk(user_ids: List[int], horizon_days: int) -> int:
+    router = _worker_router
+    users = _worker_users.c
+    computed_at = datetime.utcnow()
+    today = anchor_date(computed_at)
+    default_currency = os.getenv("DEFAULT_CURRENCY", "USD")
+    with router.global_engine.connect() as conn:
+        currencies = dict(conn.execute(select(users.id, users.default_currency).where(users.id.in_(user_ids))).all())
+    by_engine: Dict[Engine, List[int]] = {}
+    for user_id in user_ids:
+        by_engine.setdefault(router.engine_for(user_id), []).append(user_id)
+
+    count = 0
+    for engine, shard_user_ids in by_engine.items():
+        transactions, snapshots = _tables_for(engine)
+        with engine.connect() as conn:
+            # Archived years are only attached on the main database (SQLITE_ARCHIVE_PATH excludes sharding)
+            years = archived_years(conn) if engine is router.global_engine and os.getenv("SQLITE_ARCHIVE_PATH") else []
+            rows = [
+                {
+                    "user_id": user_id,
+                    "horizon_days": horizon_days,
+                    "computed_at": computed_at,
+                    "payload": json.dumps(forecast_for_user(
+                        conn, partition_union(transactions, years, user_id) if years else transactions,
+                        user_id, horizon_days, today,
+                        currency=currencies.get(user_id) or default_currency, fx=_worker_fx,
+                    )),
+                }
+                for user_id in shard_user_ids
+            ]
+        with engine.begin() as conn:
+            conn.execute(delete(snapshots).where(snapshots.c.user_id.in_(shard_user_ids)))
+            conn.execute(insert(snapshots), rows)
+        count += len(rows)
+    return count
+
+
+def forecast_all_users(database_url: str, horizon_days: int = 90, processes: Optional[int] = None, chunk_size: int = 500) -> int:
+    """Precompute forecasts for every user into forecast_snapshots."""
+    engine = create_engine(database_url)
+    users = Table("users", MetaData(), autoload_with=engine)
+    with engine.connect() as conn:
+        user_ids = conn.execute(select(users.c.id).order_by(users.c.id)).scalars().all()
+    engine.dispose()
+    chunks = [user_ids[i:i + chunk_size] for i in range(0, len(user_ids), chunk_size)]
+    with ProcessPoolExecutor(max_workers=processes, initializer=_init_worker, initargs=(database_url,)) as pool:
+        return sum(pool.map(_forecast_chunk, chunks, [horizon_days] * len(chunks)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Precompute cashflow forecasts for all users")
+    parser.add_argument("--database-url", default=os.getenv("DATABASE_URL", "sqlite:///./finance_app.db"))
+    parser.add_argument("--horizon-days", type=int, default=90)
+    parser.add_argument("--processes", type=int, default=None)
+    parser.add_argument("--chunk-size", type=int, default=500)
+    args = parser.parse_args()
+    started = time.perf_counter()
+    count = forecast_all_users(args.database_url, args.horizon_days, args.processes, args.chunk_size)
+    print(f"Forecast {count} users in {time.perf_counter() - started:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,194 @@
+"""Currency conversion from a local FX rate file.
+
+FX_RATES_PATH points at a CSV with `date,currency,rate` rows, where `rate` is
+units of `currency` per one unit of FX_BASE_CURRENCY (the layout of the ECB
+reference rates). Nothing is fetched over the network; replace the file and
+it is picked up on the next lookup after FX_RELOAD_SECONDS.
+
+Rates are held per currency as a sorted datetime64 array. A single lookup is a
+bisect; a batch is one np.searchsorted per currency, using the latest rate on
+or before each date (the earliest rate for dates before the file starts).
+
+Reports convert set-based: `converted_totals` lets SQL collapse the ledger to
+one row per (group, currency, day) in a single pass and converts those rows
+with NumPy, so the conversion work grows with distinct days rather than with
+transactions.
+"""
+import bisect
+import csv
+import os
+import threading
+import time
+from collections import defaultdict
+from datetime import date, datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+from sqlalchemy import func, select
+from sqlalchemy.engine import Connection
+
+
+def normalise_currency(value: Optional[str]) -> Optional[str]:
+    """Upper-case ISO 4217 code, or None when the value is not three letters."""
+    if not isinstance(value, str):
+        return None
+    code = value.strip().upper()
+    return code if len(code) == 3 and code.isalpha() else None
+
+
+class FxRates:
+    """Date-indexed rate cache loaded from a CSV file."""
+
+    def __init__(self, base: str = "EUR", path: Optional[str] = None, reload_seconds: float = 60.0):
+        self.base = base
+        self.path = path
+        self.reload_seconds = reload_seconds
+        self._days: Dict[str, np.ndarray] = {}
+        self._ordinals: Dict[str, List[int]] = {}
+        self._rates: Dict[str, np.ndarray] = {}
+        self._mtime: Optional[float] = None
+        self._checked_at = float("-inf")
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls) -> "FxRates":
+        return cls(
+            base=normalise_currency(os.getenv("FX_BASE_CURRENCY", "EUR")) or "EUR",
+            path=os.getenv("FX_RATES_PATH") or None,
+            reload_seconds=float(os.getenv("FX_RELOAD_SECONDS", "60")),
+        )
+
+    def load_rows(self, rows):
+        """Replace the table with (date, currency, rate) rows."""
+        series = defaultdict(dict)
+        for day, currency, rate in rows:
+            series[currency][day] = rate
+        days, ordinals, rates = {}, {}, {}
+        for currency, by_day in series.items():
+            ordered = sorted(by_day.items())
+            days[currency] = np.array([d for d, _ in ordered], dtype="datetime64[D]")
+            ordinals[currency] = [d.toordinal() for d, _ in ordered]
+            rates[currency] = np.array([r for _, r in ordered], dtype=np.float64)
+        self._days, self._ordinals, self._rates = days, ordinals, rates
+
+    def _read_file(self):
+        rows = []
+        with open(self.path, newline="") as f:
+            for record in csv.DictReader(f):
+                currency = normalise_currency(record.get("currency"))
+                try:
+                    day = date.fromisoformat(record["date"].strip())
+                    rate = float(record["rate"])
+                except (KeyError, ValueError, AttributeError):
+                    continue
+                if currency and rate > 0:
+                    rows.append((day, currency, rate))
+        self.load_rows(rows)
+
+    def _ensure_loaded(self):
+        if not self.path:
+            return
+        with self._lock:
+            if time.monotonic() - self._checked_at < self.reload_seconds:
+                return
+            self._checked_at = time.monotonic()
+            try:
+                mtime = os.path.getmtime(self.path)
+            except OSError as e:
+                print(f"FX rate file unavailable: {str(e)}")
+                return
+            if mtime != self._mtime:
+                self._read_file()
+                self._mtime = mtime
+
+    def currencies(self) -> List[str]:
+        self._ensure_loaded()
+        return sorted(set(self._rates) | {self.base})
+
+    def rate(self, currency: str, day: date) -> Optional[float]:
+        """Units of `currency` per unit of the base currency on `day`."""
+        self._ensure_loaded()
+        if currency == self.base:
+            return 1.0
+        ordinals = self._ordinals.get(currency)
+        if not ordinals:
+            return None
+        if isinstance(day, datetime):
+            day = day.date()
+        index = max(bisect.bisect_right(ordinals, day.toordinal()) - 1, 0)
+        return float(self._rates[currency][index])
+
+    def rates(self, currency: str, days: np.ndarray) -> np.ndarray:
+        """Vectorised `rate` over a datetime64[D] array; NaN for an unknown currency."""
+        self._ensure_loaded()
+        if currency == self.base:
+            return np.ones(len(days))
+        known = self._days.get(currency)
+        if known is None:
+            return np.full(len(days), np.nan)
+        index = np.clip(np.searchsorted(known, days, side="right") - 1, 0, None)
+        return self._rates[currency][index]
+
+    def convert(self, amounts: np.ndarray, currencies: np.ndarray, days: np.ndarray, target: str) -> np.ndarray:
+        """Convert each amount from its currency to `target` at its day's rate.
+
+        A missing currency means the amount is already in `target`. Amounts
+        in a currency with no rates come back as NaN.
+        """
+        amounts = np.asarray(amounts, dtype=np.float64)
+        currencies = np.asarray(currencies, dtype=object)
+        days = np.asarray(days, dtype="datetime64[D]")
+        converted = amounts.copy()
+        target_rates = None
+        for currency in set(currencies.tolist()):
+            if currency is None or currency == target:
+                continue
+            mask = currencies == currency
+            if target_rates is None:
+                target_rates = self.rates(target, days)
+            converted[mask] = amounts[mask] * target_rates[mask] / self.rates(currency, days[mask])
+        return converted
+
+    def convert_one(self, amount: float, currency: Optional[str], day: date, target: str) -> Optional[float]:
+        if currency is None or currency == target:
+            return amount
+        source_rate, target_rate = self.rate(currency, day), self.rate(target, day)
+        if source_rate is None or target_rate is None:
+            return None
+        return amount * target_rate / source_rate
+
+
+def converted_totals(conn: Connection, transactions, conditions: list, target: str, fx: FxRates,
+                     group_by=None) -> Dict[Any, Tuple[float, int, int]]:
+    """Sum amounts in `target`, optionally per value of `group_by`.
+
+    Returns {group: (total, count, unconverted)}; `unconverted` counts rows in
+    a currency the rate file does not cover, which are left out of the total.
+    `transactions` is the table or a selectable with the same columns.
+    """
+    t = transactions.c
+    keys = [group_by] if group_by is not None else []
+    day = func.date(t.date)
+    rows = conn.execute(
+        select(*keys, t.currency, day, func.coalesce(func.sum(t.amount), 0.0), func.count())
+        .where(*conditions)
+        .group_by(*keys, t.currency, day)
+    ).all()
+
+    offset = len(keys)
+    group = [row[0] if keys else None for row in rows]
+    currencies = np.array([row[offset] for row in rows], dtype=object)
+    # Undated rows cannot be looked up, so they go through at face value when already in target
+    days = np.array([str(row[offset + 1])[:10] if row[offset + 1] is not None else "NaT" for row in rows], dtype="datetime64[D]")
+    sums = np.array([row[offset + 2] for row in rows], dtype=np.float64)
+    counts = [row[-1] for row in rows]
+    converted = fx.convert(sums, currencies, days, target)
+
+    totals: Dict[Any, List[float]] = defaultdict(lambda: [0.0, 0, 0])
+    for key, value, count in zip(group, converted.tolist(), counts):
+        if np.isnan(value):
+            totals[key][2] += count
+        else:
+            totals[key][0] += value
+            totals[key][1] += count
+    return {key: (total, count, unconverted) for key, (total, count, unconverted) in totals.items()}
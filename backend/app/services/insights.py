@@ -0,0 +1,414 @@
+"""Nightly insights for every user: month-over-month changes, top-growing
+categories and unusual spend, precomputed so /api/insights is one row read.
+
+For a run `as_of` day D, "the month" is the last complete month before D and
+is compared with the month before it; month-to-date compares D's month so far
+with the same days of the previous month. A category's spend in the month is
+unusual when it is above the mean plus UNUSUAL_Z standard deviations of the
+BASELINE_MONTHS months before, with spend in at least MIN_ACTIVE_MONTHS of
+them and at least MIN_EXCESS above the mean. Amounts are in the user's default
+currency at each row's day rate; rows in a currency without rates are counted
+as unconverted and left out.
+
+Batch pipeline (python -m app.services.insights run):
+
+- The users table is cut into chunks of consecutive user ids, recorded in
+  insight_run_chunks when a run starts.
+- Chunks run in a process pool. A worker streams the chunk's rows of the
+  window from every shard through a server-side cursor (one user-id range
+  scan per shard, CHUNK_ROWS at a time, kept as NumPy arrays) and computes
+  every user of the chunk at once with bincount over (user, category, month)
+  cells, then replaces the chunk's rows in insight_snapshots.
+- The parent marks a chunk finished when its worker returns. A run that is
+  interrupted, or stops because it reached --window-minutes, is left
+  `partial`; the next invocation resumes it with the chunks not yet
+  finished. Rewriting a chunk is idempotent, so a chunk cut off by a crash is
+  simply computed again.
+
+Run one batch at a time. Writes after a run do not refresh its snapshots;
+they show up in the next night's run.
+"""
+import argparse
+import json
+import os
+import time
+import uuid
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from datetime import date, datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+from dotenv import load_dotenv
+from sqlalchemy import MetaData, Table, create_engine, delete, func, insert, select, update
+from sqlalchemy.engine import Connection, Engine
+
+from app.services.fx import FxRates
+from app.utils.partitioning import archive_table, archived_years, attach_sqlite_archive
+from app.utils.sharding import ShardRouter
+from app.utils.sqlite_profile import apply_sqlite_profile
+
+load_dotenv()
+
+BASELINE_MONTHS = 6
+# Month columns: the baseline months, the month, then month-to-date
+MONTHS = BASELINE_MONTHS + 2
+CURRENT, MONTH_TO_DATE = BASELINE_MONTHS, BASELINE_MONTHS + 1
+UNUSUAL_Z = 2.0
+MIN_ACTIVE_MONTHS = 3
+MIN_EXCESS = 10.0
+TOP = 5
+CHUNK_ROWS = 20000
+
+RUNNING, PARTIAL, COMPLETE = "running", "partial", "complete"
+
+
+def _month_start(day: date, months_back: int = 0) -> datetime:
+    month = day.month - 1 - months_back
+    return datetime(day.year + month // 12, month % 12 + 1, 1)
+
+
+def window(as_of: date) -> Tuple[datetime, datetime]:
+    """[first baseline month, start of the as_of day): the rows a run reads."""
+    return _month_start(as_of, BASELINE_MONTHS + 1), datetime(as_of.year, as_of.month, as_of.day)
+
+
+def _top_per_user(mask: np.ndarray, score: np.ndarray, owners: np.ndarray, k: int) -> Dict[int, np.ndarray]:
+    """Indexes of the up to k highest-scoring masked entries of each owner."""
+    candidates = np.flatnonzero(mask)
+    if not len(candidates):
+        return {}
+    candidates = candidates[np.lexsort((-score[candidates], owners[candidates]))]
+    sorted_owners = owners[candidates]
+    starts = np.r_[0, np.flatnonzero(np.diff(sorted_owners)) + 1]
+    ranks = np.arange(len(candidates)) - np.repeat(starts, np.diff(np.r_[starts, len(candidates)]))
+    keep = ranks < k
+    candidates, sorted_owners = candidates[keep], sorted_owners[keep]
+    bounds = np.r_[0, np.flatnonzero(np.diff(sorted_owners)) + 1, len(candidates)]
+    return {int(sorted_owners[a]): candidates[a:b] for a, b in zip(bounds[:-1], bounds[1:])}
+
+
+def _change(current: float, previous: float) -> Dict[str, Any]:
+    return {
+        "current": round(current, 2),
+        "previous": round(previous, 2),
+        "change": round(current - previous, 2),
+        "change_pct": round((current - previous) / abs(previous) * 100, 1) if previous else None,
+    }
+
+
+def compute_insights(user_ids: np.ndarray, users: np.ndarray, months: np.ndarray, early: np.ndarray,
+                     categories: np.ndarray, amounts: np.ndarray, as_of: date) -> List[Dict[str, Any]]:
+    """Insights for every user in `user_ids` (sorted) from one row per transaction.
+
+    `months` is each row's month column (0 .. MONTHS - 1), `early` whether its
+    day of month is before the as_of day, and `amounts` are converted, NaN
+    where they could not be.
+    """
+    n_users = len(user_ids)
+    index = np.searchsorted(user_ids, users)
+    converted = ~np.isnan(amounts)
+    unconverted = np.bincount(index[~converted], minlength=n_users)
+    index, months, early, categories, amounts = (
+        index[converted], months[converted], early[converted], categories[converted], amounts[converted]
+    )
+    spend = np.where(amounts < 0, -amounts, 0.0)
+    income = np.where(amounts > 0, amounts, 0.0)
+
+    cells = index * MONTHS + months
+    user_spend = np.bincount(cells, spend, n_users * MONTHS).reshape(n_users, MONTHS)
+    user_income = np.bincount(cells, income, n_users * MONTHS).reshape(n_users, MONTHS)
+    user_count = np.bincount(cells, minlength=n_users * MONTHS).reshape(n_users, MONTHS)
+    # The same days of the month before, for month-to-date
+    same_days = early & (months == CURRENT)
+    early_spend = np.bincount(index[same_days], spend[same_days], n_users)
+    early_income = np.bincount(index[same_days], income[same_days], n_users)
+
+    if len(categories):
+        names, codes = np.unique(categories, return_inverse=True)
+    else:
+        names, codes = np.array([], dtype=object), np.zeros(0, np.int64)
+    pair_keys = index.astype(np.int64) * max(len(names), 1) + codes
+    pairs, pair_index = np.unique(pair_keys, return_inverse=True)
+    pair_spend = np.bincount(pair_index * MONTHS + months, spend, len(pairs) * MONTHS).reshape(len(pairs), MONTHS)
+    pair_owner = pairs // max(len(names), 1)
+    pair_name = names[pairs % max(len(names), 1)] if len(names) else np.array([], dtype=object)
+
+    current, previous = pair_spend[:, CURRENT], pair_spend[:, CURRENT - 1]
+    growth = current - previous
+    growing = _top_per_user((growth > 0) & (current > 0), growth, pair_owner, TOP)
+
+    baseline = pair_spend[:, :BASELINE_MONTHS]
+    mean, std = baseline.mean(axis=1), baseline.std(axis=1)
+    unusual_mask = (
+        ((baseline > 0).sum(axis=1) >= MIN_ACTIVE_MONTHS)
+        & (current > mean + UNUSUAL_Z * std)
+        & (current - mean >= MIN_EXCESS)
+    )
+    z_scores = (current - mean) / np.maximum(std, 0.01)
+    unusual = _top_per_user(unusual_mask, current - mean, pair_owner, TOP)
+
+    month, previous_month = _month_start(as_of, 1), _month_start(as_of, 2)
+    month_to_date = as_of.day > 1
+    empty = np.zeros(0, np.int64)
+    results = []
+    for i, user_id in enumerate(user_ids.tolist()):
+        spent, earned = user_spend[i].tolist(), user_income[i].tolist()
+        results.append({
+            "user_id": user_id,
+            "as_of": as_of.isoformat(),
+            "month": month.strftime("%Y-%m"),
+            "previous_month": previous_month.strftime("%Y-%m"),
+            "month_over_month": {
+                "expenses": _change(spent[CURRENT], spent[CURRENT - 1]),
+                "income": _change(earned[CURRENT], earned[CURRENT - 1]),
+                "net": _change(earned[CURRENT] - spent[CURRENT], earned[CURRENT - 1] - spent[CURRENT - 1]),
+            },
+            "month_to_date": {
+                "expenses": _change(spent[MONTH_TO_DATE], float(early_spend[i])),
+                "income": _change(earned[MONTH_TO_DATE], float(early_income[i])),
+            } if month_to_date else None,
+            "top_growing_categories": [
+                {"category": pair_name[p], **_change(float(current[p]), float(previous[p]))}
+                for p in growing.get(i, empty).tolist()
+            ],
+            "unusual_spend": [
+                {
+                    "category": pair_name[p],
+                    "spent": round(float(current[p]), 2),
+                    "typical": round(float(mean[p]), 2),
+                    "z_score": round(float(z_scores[p]), 1),
+                }
+                for p in unusual.get(i, empty).tolist()
+            ],
+            "transaction_count": int(user_count[i, CURRENT]),
+            "unconverted_count": int(unconverted[i]),
+        })
+    return results
+
+
+def _stream_rows(conn: Connection, sources: List[Table], first_user: int, last_user: int, start: datetime,
+                 end: datetime, currencies: Dict[int, str], fx: FxRates) -> Dict[str, np.ndarray]:
+    """Column arrays of the user-id range's rows in [start, end), amounts already converted."""
+    first_month = np.datetime64(start.date(), "M")
+    as_of_day = end.day
+    parts: Dict[str, list] = {"users": [], "months": [], "early": [], "categories": [], "amounts": []}
+    for source in sources:
+        t = source.c
+        result = conn.execution_options(stream_results=True, yield_per=CHUNK_ROWS).execute(
+            select(t.user_id, func.date(t.date), t.category, t.amount, t.currency)
+            .where(t.user_id.between(first_user, last_user), t.date >= start, t.date < end)
+        )
+        for rows in result.partitions():
+            users, days, categories, amounts, row_currencies = zip(*rows)
+            users = np.array(users, dtype=np.int64)
+            days = np.array([str(day)[:10] for day in days], dtype="datetime64[D]")
+            amounts = np.array([a or 0.0 for a in amounts], dtype=np.float64)
+            row_currencies = np.array(row_currencies, dtype=object)
+            targets = np.array([currencies[u] for u in users.tolist()], dtype=object)
+            converted = np.empty_like(amounts)
+            for target in set(targets.tolist()):
+                mask = targets == target
+                converted[mask] = fx.convert(amounts[mask], row_currencies[mask], days[mask], target)
+            month_starts = days.astype("datetime64[M]")
+            parts["users"].append(users)
+            parts["months"].append((month_starts - first_month).astype(np.int64))
+            parts["early"].append((days - month_starts.astype("datetime64[D]")).astype(np.int64) + 1 < as_of_day)
+            parts["categories"].append(np.array([c or "Uncategorised" for c in categories], dtype=object))
+            parts["amounts"].append(converted)
+    empty = {"users": np.int64, "months": np.int64, "early": bool, "categories": object, "amounts": np.float64}
+    return {name: np.concatenate(values) if values else np.zeros(0, empty[name]) for name, values in parts.items()}
+
+
+# Worker processes -------------------------------------------------------------
+
+_worker_router: Optional[ShardRouter] = None
+_worker_tables: Dict[Engine, Tuple[Table, Table]] = {}
+_worker_users: Optional[Table] = None
+_worker_fx: Optional[FxRates] = None
+
+
+def _init_worker(database_url: str):
+    global _worker_router, _worker_users, _worker_fx
+    engine = create_engine(database_url)
+    apply_sqlite_profile(engine)
+    attach_sqlite_archive(engine)
+    _worker_router = ShardRouter.from_env(engine)
+    _worker_users = Table("users", MetaData(), autoload_with=engine)
+    _worker_fx = FxRates.from_env()
+
+
+def _tables_for(engine: Engine) -> Tuple[Table, Table]:
+    if engine not in _worker_tables:
+        metadata = MetaData()
+        # Shards have no users table, so foreign keys to it cannot be followed
+        _worker_tables[engine] = (
+            Table("transactions", metadata, autoload_with=engine, resolve_fks=False),
+            Table("insight_snapshots", metadata, autoload_with=engine, resolve_fks=False),
+        )
+    return _worker_tables[engine]
+
+
+def _insights_chunk(first_user: int, last_user: int, as_of: date) -> Tuple[int, int]:
+    """Compute and store the snapshots of every user in [first_user, last_user]: (users, rows read)."""
+    start, end = window(as_of)
+    default_currency = os.getenv("DEFAULT_CURRENCY", "USD")
+    router = _worker_router
+    u = _worker_users.c
+    with router.global_engine.connect() as conn:
+        currencies = {
+            user_id: currency or default_currency
+            for user_id, currency in conn.execute(
+                select(u.id, u.default_currency).where(u.id.between(first_user, last_user))
+            ).all()
+        }
+    by_engine: Dict[Engine, List[int]] = {}
+    for user_id in sorted(currencies):
+        by_engine.setdefault(router.engine_for(user_id), []).append(user_id)
+
+    computed_at = datetime.utcnow()
+    rows_read = 0
+    for engine, user_ids in by_engine.items():
+        transactions, snapshots = _tables_for(engine)
+        with engine.connect() as conn:
+            sources = [transactions]
+            # Archived years are only attached on the main database (SQLITE_ARCHIVE_PATH excludes sharding)
+            if engine is router.global_engine and os.getenv("SQLITE_ARCHIVE_PATH"):
+                sources += [archive_table(transactions, year) for year in archived_years(conn)
+                            if start.year <= year <= end.year]
+            columns = _stream_rows(conn, sources, user_ids[0], user_ids[-1], start, end, currencies, _worker_fx)
+        rows_read += len(columns["users"])
+        insights = compute_insights(
+            np.array(user_ids, dtype=np.int64), columns["users"], columns["months"], columns["early"],
+            columns["categories"], columns["amounts"], as_of,
+        )
+        with engine.begin() as conn:
+            conn.execute(delete(snapshots).where(snapshots.c.user_id.between(user_ids[0], user_ids[-1])))
+            conn.execute(insert(snapshots), [
+                {
+                    "user_id": payload["user_id"],
+                    "as_of": datetime(as_of.year, as_of.month, as_of.day),
+                    "computed_at": computed_at,
+                    "payload": json.dumps({
+                        **payload, "currency": currencies[payload["user_id"]], "computed_at": computed_at.isoformat(),
+                    }),
+                }
+                for payload in insights
+            ])
+    return len(currencies), rows_read
+
+
+# Runs -------------------------------------------------------------------------
+
+def _start_run(conn: Connection, runs: Table, chunks: Table, users: Table, as_of: date, chunk_users: int) -> str:
+    run_id = uuid.uuid4().hex
+    conn.execute(insert(runs).values(
+        id=run_id, as_of=datetime(as_of.year, as_of.month, as_of.day), status=RUNNING, started_at=datetime.utcnow(),
+        chunks_total=0, chunks_done=0, users_done=0, rows_read=0,
+    ))
+    user_ids = conn.execute(select(users.c.id).order_by(users.c.id)).scalars().all()
+    rows = [
+        {"run_id": run_id, "first_user_id": user_ids[i], "last_user_id": user_ids[min(i + chunk_users, len(user_ids)) - 1]}
+        for i in range(0, len(user_ids), chunk_users)
+    ]
+    if rows:
+        conn.execute(insert(chunks), rows)
+    conn.execute(update(runs).where(runs.c.id == run_id).values(chunks_total=len(rows)))
+    return run_id
+
+
+def run_insights(database_url: str, as_of: Optional[date] = None, processes: Optional[int] = None,
+                 chunk_users: int = 1000, window_minutes: Optional[float] = None, fresh: bool = False) -> Dict[str, Any]:
+    """Run (or resume) the nightly batch; stops submitting chunks once `window_minutes` have passed."""
+    started = time.monotonic()
+    engine = create_engine(database_url)
+    apply_sqlite_profile(engine)
+    metadata = MetaData()
+    runs = Table("insight_runs", metadata, autoload_with=engine)
+    chunks = Table("insight_run_chunks", metadata, autoload_with=engine)
+    users = Table("users", metadata, autoload_with=engine)
+    r, c = runs.c, chunks.c
+
+    with engine.begin() as conn:
+        unfinished = conn.execute(
+            select(r.id, r.as_of).where(r.status != COMPLETE).order_by(r.started_at.desc()).limit(1)
+        ).first()
+        if unfinished is not None and not fresh and (as_of is None or unfinished.as_of.date() == as_of):
+            run_id, as_of = unfinished.id, unfinished.as_of.date()
+            resumed = True
+            conn.execute(update(runs).where(r.id == run_id).values(status=RUNNING))
+        else:
+            as_of = as_of or datetime.utcnow().date()
+            run_id = _start_run(conn, runs, chunks, users, as_of, chunk_users)
+            resumed = False
+    with engine.connect() as conn:
+        pending = conn.execute(
+            select(c.first_user_id, c.last_user_id)
+            .where(c.run_id == run_id, c.finished_at.is_(None)).order_by(c.first_user_id)
+        ).all()
+
+    processes = processes or os.cpu_count() or 1
+    deadline = started + window_minutes * 60 if window_minutes else float("inf")
+    users_done = rows_read = 0
+    remaining = list(reversed(pending))
+    with ProcessPoolExecutor(max_workers=processes, initializer=_init_worker, initargs=(database_url,)) as pool:
+        in_flight = {}
+        while remaining or in_flight:
+            # Two chunks queued per process keep every worker busy without reading ahead of the window
+            while remaining and len(in_flight) < processes * 2 and time.monotonic() < deadline:
+                first, last = remaining.pop()
+                in_flight[pool.submit(_insights_chunk, first, last, as_of)] = first
+            if not in_flight:
+                break
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                first = in_flight.pop(future)
+                chunk_users_done, chunk_rows = future.result()
+                users_done += chunk_users_done
+                rows_read += chunk_rows
+                with engine.begin() as conn:
+                    conn.execute(update(chunks).where(c.run_id == run_id, c.first_user_id == first).values(
+                        finished_at=datetime.utcnow(), users=chunk_users_done, rows_read=chunk_rows,
+                    ))
+                    conn.execute(update(runs).where(r.id == run_id).values(
+                        chunks_done=r.chunks_done + 1, users_done=r.users_done + chunk_users_done,
+                        rows_read=r.rows_read + chunk_rows,
+                    ))
+
+    status = PARTIAL if remaining else COMPLETE
+    with engine.begin() as conn:
+        conn.execute(update(runs).where(r.id == run_id).values(
+            status=status, finished_at=datetime.utcnow() if status == COMPLETE else None,
+        ))
+    engine.dispose()
+    return {
+        "run_id": run_id,
+        "as_of": as_of.isoformat(),
+        "resumed": resumed,
+        "status": status,
+        "chunks": len(pending) - len(remaining),
+        "chunks_left": len(remaining),
+        "users": users_done,
+        "rows": rows_read,
+        "seconds": round(time.monotonic() - started, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Nightly insights batch")
+    sub = parser.add_subparsers(dest="command", required=True)
+    run = sub.add_parser("run", help="run the batch, resuming an unfinished run")
+    run.add_argument("--database-url", default=os.getenv("DATABASE_URL", "sqlite:///./finance_app.db"))
+    run.add_argument("--as-of", type=date.fromisoformat, default=None, help="day the run is for (default today, UTC)")
+    run.add_argument("--processes", type=int, default=int(os.getenv("INSIGHTS_PROCESSES") or 0) or None)
+    run.add_argument("--chunk-users", type=int, default=int(os.getenv("INSIGHTS_CHUNK_USERS", "1000")))
+    run.add_argument("--window-minutes", type=float, default=float(os.getenv("INSIGHTS_WINDOW_MINUTES", "240")))
+    run.add_argument("--fresh", action="store_true", help="start a new run even if one is unfinished")
+    args = parser.parse_args()
+
+    summary = run_insights(args.database_url, args.as_of, args.processes, args.chunk_users,
+                           args.window_minutes, args.fresh)
+    print(json.dumps(summary))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,539 @@
+"""Ad-hoc pivots over a user's transactions from an in-memory columnar cache.
+
+A user's whole history is loaded once into a ColumnarFrame: one NumPy array
+per column, amounts already converted to the user's currency, and category,
+type and currency dictionary-encoded as small integer codes (dictionaries
+sorted, so code order is label order). Month and weekday are derived at load.
+A pivot is then a boolean filter mask, one integer code array per dimension
+combined into a single group index, and np.bincount per measure (ufunc.at
+for min and max), with no SQL and no Python loop over rows.
+
+PivotCache keeps frames in an LRU bounded by their array bytes. Committed
+row changes are patched into a copy of the cached frame (new rows appended,
+edited ones replaced, deleted ones dropped; tens of milliseconds per million
+rows) instead of reloading it, and changes that land while a frame loads are
+applied to it before it is cached. Writes without row images (set-based
+updates) mark the frame stale, as does the TTL, which covers writes made by
+other worker processes: a stale frame is still served while one background
+thread rebuilds it.
+
+Request shape:
+    dimensions  up to MAX_DIMENSIONS of DIMENSIONS
+    measures    MEASURES (default sum and count)
+    filters     start_date, end_date (ISO dates, inclusive), categories,
+                types, currencies (lists), min_amount, max_amount (on the
+                absolute converted amount), recurring (bool)
+    amount_bands  ascending band edges for the amount_band dimension
+    sort        a measure or dimension, "-" prefix for descending
+    limit       at most MAX_GROUPS groups returned
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from datetime import date
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from sqlalchemy import func, select
+from sqlalchemy.engine import Connection
+
+from app.services.fx import FxRates
+
+DIMENSIONS = ("category", "type", "currency", "year", "quarter", "month", "weekday", "day", "amount_band", "recurring")
+MEASURES = ("sum", "count", "mean", "min", "max", "income", "expenses")
+MAX_DIMENSIONS = 3
+MAX_GROUPS = 10000
+DEFAULT_BANDS = (10.0, 50.0, 100.0, 500.0, 1000.0)
+WEEKDAYS = ("Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday")
+LOAD_CHUNK_ROWS = 50000
+# Group index spaces up to this size are counted densely; larger ones are compacted with np.unique first
+DENSE_GROUPS = 1 << 22
+
+
+@dataclass
+class ColumnarFrame:
+    user_id: int
+    currency: str
+    id: np.ndarray  # int64 transaction ids, to find rows to patch
+    day: np.ndarray  # int32 days since 1970-01-01
+    month: np.ndarray  # int32 months since 1970-01
+    weekday: np.ndarray  # int8, Monday = 0
+    amount: np.ndarray  # float64 in `currency`, NaN where no rate was available
+    category: np.ndarray  # int32 codes into categories
+    type: np.ndarray  # int8 codes into types
+    source_currency: np.ndarray  # int16 codes into currencies
+    recurring: np.ndarray  # bool
+    categories: List[str] = field(default_factory=list)
+    types: List[str] = field(default_factory=list)
+    currencies: List[str] = field(default_factory=list)
+
+    @property
+    def rows(self) -> int:
+        return len(self.amount)
+
+    @property
+    def nbytes(self) -> int:
+        arrays = (self.id, self.day, self.month, self.weekday, self.amount, self.category, self.type, self.source_currency,
+                  self.recurring)
+        names = self.categories + self.types + self.currencies
+        # Strings in the dictionaries: payload plus CPython's per-object overhead
+        return sum(a.nbytes for a in arrays) + sum(len(name) + 49 for name in names) + 1024
+
+
+def _encode(values: List[Optional[str]], missing: str) -> Tuple[np.ndarray, List[str]]:
+    """Codes into a sorted dictionary, so that code order is label order."""
+    # A dict pass and a remap of the few distinct values; np.unique would sort a million Python strings
+    lookup: Dict[Optional[str], int] = {}
+    codes = np.fromiter((lookup.setdefault(value, len(lookup)) for value in values), dtype=np.int32, count=len(values))
+    labels = {}
+    for value, code in lookup.items():
+        labels.setdefault(value or missing, []).append(code)
+    names = sorted(labels)
+    remap = np.zeros(len(lookup), np.int32)
+    for position, name in enumerate(names):
+        remap[labels[name]] = position
+    return remap[codes], names
+
+
+def _extend(codes: np.ndarray, names: List[str], values: List[Optional[str]], missing: str) -> Tuple[np.ndarray, List[str]]:
+    """`codes` followed by the codes of `values`, growing the sorted dictionary (and renumbering) for new labels."""
+    labels = [value or missing for value in values]
+    merged = sorted(set(names).union(labels))
+    position = {name: code for code, name in enumerate(merged)}
+    if merged != names:
+        codes = np.array([position[name] for name in names], dtype=codes.dtype)[codes]
+    return np.concatenate([codes, np.array([position[label] for label in labels], dtype=codes.dtype)]), merged
+
+
+def _type_of(kind: Optional[str], amount: float) -> str:
+    # Legacy rows without a type are typed by sign, as the create endpoints do
+    return kind or ("income" if amount > 0 else "expense")
+
+
+def _day_parts(day: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """(day number, month number, weekday) columns of a datetime64[D] array."""
+    day_numbers = day.astype(np.int64)
+    # 1970-01-01 was a Thursday
+    return day_numbers.astype(np.int32), day.astype("datetime64[M]").astype(np.int32), ((day_numbers + 3) % 7).astype(np.int8)
+
+
+def load_frame(conn: Connection, transactions, user_id: int, currency: str, fx: FxRates) -> ColumnarFrame:
+    """Read every dated row of the user (live and archived) into a ColumnarFrame."""
+    t = transactions.c
+    result = conn.execution_options(stream_results=True, yield_per=LOAD_CHUNK_ROWS).execute(
+        select(t.id, func.date(t.date), t.amount, t.category, t.type, t.currency, t.is_recurring)
+        .where(t.user_id == user_id, t.date.is_not(None))
+    )
+    ids, days, amounts, categories, types, currencies, recurring = [], [], [], [], [], [], []
+    for rows in result.partitions():
+        chunk_ids, chunk_days, chunk_amounts, chunk_categories, chunk_types, chunk_currencies, chunk_recurring = zip(*rows)
+        chunk_days = np.array([str(day)[:10] for day in chunk_days], dtype="datetime64[D]")
+        chunk_amounts = np.array([a or 0.0 for a in chunk_amounts], dtype=np.float64)
+        ids.append(np.array(chunk_ids, dtype=np.int64))
+        days.append(chunk_days)
+        amounts.append(fx.convert(chunk_amounts, np.array(chunk_currencies, dtype=object), chunk_days, currency))
+        categories.extend(chunk_categories)
+        types.extend(_type_of(kind, a) for kind, a in zip(chunk_types, chunk_amounts.tolist()))
+        currencies.extend(chunk_currencies)
+        recurring.append(np.array(chunk_recurring, dtype=bool))
+
+    day = np.concatenate(days) if days else np.zeros(0, "datetime64[D]")
+    category, category_names = _encode(categories, "Uncategorised")
+    kind, type_names = _encode(types, "expense")
+    source_currency, currency_names = _encode(currencies, currency)
+    day_numbers, month, weekday = _day_parts(day)
+    return ColumnarFrame(
+        user_id=user_id,
+        currency=currency,
+        id=np.concatenate(ids) if ids else np.zeros(0, np.int64),
+        day=day_numbers,
+        month=month,
+        weekday=weekday,
+        amount=np.concatenate(amounts) if amounts else np.zeros(0),
+        category=category,
+        type=kind.astype(np.int8),
+        source_currency=source_currency.astype(np.int16),
+        recurring=np.concatenate(recurring) if recurring else np.zeros(0, bool),
+        categories=category_names,
+        types=type_names,
+        currencies=currency_names,
+    )
+
+
+def patch_frame(frame: ColumnarFrame, changes: List[Tuple[str, Dict[str, Any]]], fx: FxRates) -> ColumnarFrame:
+    """A copy of `frame` with `changes` applied, in commit order.
+
+    Each change is ("created" | "updated" | "deleted", row) where a row has
+    the transaction's id, date, amount, currency, category, type and
+    is_recurring (a deleted one just its id). Created and updated rows are
+    upserts, so a change the frame already holds is harmless; rows without a
+    date are left out, as in load_frame.
+    """
+    latest: Dict[int, Optional[Dict[str, Any]]] = {}
+    for action, row in changes:
+        latest[row["id"]] = None if action == "deleted" else row
+    keep = ~np.isin(frame.id, np.fromiter(latest, dtype=np.int64, count=len(latest)))
+    rows = [row for row in latest.values() if row is not None and row.get("date")]
+    day = np.array([str(row["date"])[:10] for row in rows], dtype="datetime64[D]")
+    raw = np.array([row["amount"] or 0.0 for row in rows], dtype=np.float64)
+    row_currencies = [row.get("currency") for row in rows]
+    category, category_names = _extend(frame.category[keep], frame.categories, [row["category"] for row in rows],
+                                       "Uncategorised")
+    kind, type_names = _extend(frame.type[keep], frame.types,
+                               [_type_of(row["type"], a) for row, a in zip(rows, raw.tolist())], "expense")
+    source_currency, currency_names = _extend(frame.source_currency[keep], frame.currencies, row_currencies,
+                                              frame.currency)
+    day_numbers, month, weekday = _day_parts(day)
+    return ColumnarFrame(
+        user_id=frame.user_id,
+        currency=frame.currency,
+        id=np.concatenate([frame.id[keep], np.array([row["id"] for row in rows], dtype=np.int64)]),
+        day=np.concatenate([frame.day[keep], day_numbers]),
+        month=np.concatenate([frame.month[keep], month]),
+        weekday=np.concatenate([frame.weekday[keep], weekday]),
+        amount=np.concatenate([frame.amount[keep],
+                               fx.convert(raw, np.array(row_currencies, dtype=object), day, frame.currency)]),
+        category=category,
+        type=kind,
+        source_currency=source_currency,
+        recurring=np.concatenate([frame.recurring[keep], np.array([bool(row["is_recurring"]) for row in rows], bool)]),
+        categories=category_names,
+        types=type_names,
+        currencies=currency_names,
+    )
+
+
+# Evaluation -------------------------------------------------------------------
+
+def _codes_in(names: List[str], wanted: Sequence[str]) -> np.ndarray:
+    lookup = {name: code for code, name in enumerate(names)}
+    return np.array([lookup[name] for name in wanted if name in lookup], dtype=np.int64)
+
+
+def _day_number(value: Any, name: str) -> int:
+    try:
+        return int(np.datetime64(date.fromisoformat(str(value)[:10]), "D").astype(np.int64))
+    except ValueError:
+        raise ValueError(f"{name} must be an ISO date")
+
+
+def _mask(frame: ColumnarFrame, filters: Dict[str, Any]) -> Optional[np.ndarray]:
+    """Rows passing `filters` (converted amounts only); None when every row passes."""
+    unknown = set(filters) - {"start_date", "end_date", "categories", "types", "currencies", "min_amount",
+                              "max_amount", "recurring"}
+    if unknown:
+        raise ValueError(f"Unknown filters: {', '.join(sorted(unknown))}")
+    conditions = []
+    if np.isnan(frame.amount).any():
+        conditions.append(~np.isnan(frame.amount))
+    if filters.get("start_date") is not None:
+        conditions.append(frame.day >= _day_number(filters["start_date"], "start_date"))
+    if filters.get("end_date") is not None:
+        conditions.append(frame.day <= _day_number(filters["end_date"], "end_date"))
+    for key, column, names in (("categories", frame.category, frame.categories), ("types", frame.type, frame.types),
+                               ("currencies", frame.source_currency, frame.currencies)):
+        if filters.get(key) is not None:
+            if not isinstance(filters[key], list):
+                raise ValueError(f"{key} must be a list")
+            conditions.append(np.isin(column, _codes_in(names, filters[key])))
+    if filters.get("min_amount") is not None or filters.get("max_amount") is not None:
+        magnitude = np.abs(frame.amount)
+        if filters.get("min_amount") is not None:
+            conditions.append(magnitude >= float(filters["min_amount"]))
+        if filters.get("max_amount") is not None:
+            conditions.append(magnitude <= float(filters["max_amount"]))
+    if filters.get("recurring") is not None:
+        conditions.append(frame.recurring == bool(filters["recurring"]))
+    if not conditions:
+        return None
+    mask = conditions[0]
+    for condition in conditions[1:]:
+        mask = mask & condition
+    return mask
+
+
+def _dimension(frame: ColumnarFrame, name: str, rows: Callable[[np.ndarray], np.ndarray],
+               bands: Sequence[float]) -> Tuple[np.ndarray, int, Callable[[int], Any]]:
+    """(codes of the selected rows, number of codes, code -> label) for one dimension."""
+    if name == "category":
+        return rows(frame.category), len(frame.categories), frame.categories.__getitem__
+    if name == "type":
+        return rows(frame.type), len(frame.types), frame.types.__getitem__
+    if name == "currency":
+        return rows(frame.source_currency), len(frame.currencies), frame.currencies.__getitem__
+    if name == "weekday":
+        return rows(frame.weekday), 7, WEEKDAYS.__getitem__
+    if name == "recurring":
+        return rows(frame.recurring), 2, lambda code: bool(code)
+    if name == "amount_band":
+        edges = np.asarray(bands, dtype=np.float64)
+        labels = [f"{low:g}-{high:g}" for low, high in zip([0.0] + edges.tolist(), edges.tolist())] + [f"{edges[-1]:g}+"]
+        return np.searchsorted(edges, np.abs(rows(frame.amount)), side="right"), len(labels), labels.__getitem__
+
+    if name == "day":
+        values = rows(frame.day)
+        to_label = lambda v: str(np.datetime64(int(v), "D"))
+    else:
+        values = rows(frame.month)
+        if name == "year":
+            values = values // 12
+            to_label = lambda v: int(v) + 1970
+        elif name == "quarter":
+            values = values // 3
+            to_label = lambda v: f"{int(v) // 4 + 1970}-Q{int(v) % 4 + 1}"
+        else:
+            to_label = lambda v: str(np.datetime64(int(v), "M"))
+    if not len(values):
+        return values.astype(np.int64), 1, to_label
+    low = int(values.min())
+    return values.astype(np.int64) - low, int(values.max()) - low + 1, lambda code: to_label(code + low)
+
+
+def pivot(frame: ColumnarFrame, dimensions: Sequence[str], measures: Sequence[str] = ("sum", "count"),
+          filters: Optional[Dict[str, Any]] = None, amount_bands: Optional[Sequence[float]] = None,
+          sort: Optional[str] = None, limit: int = 1000) -> Dict[str, Any]:
+    """Group the frame's rows by `dimensions` and compute `measures` per group."""
+    dimensions, measures = list(dimensions), list(measures) or ["sum", "count"]
+    if len(dimensions) > MAX_DIMENSIONS or len(set(dimensions)) != len(dimensions):
+        raise ValueError(f"Up to {MAX_DIMENSIONS} distinct dimensions")
+    for name in dimensions:
+        if name not in DIMENSIONS:
+            raise ValueError(f"Unknown dimension {name!r}; expected one of {', '.join(DIMENSIONS)}")
+    for name in measures:
+        if name not in MEASURES:
+            raise ValueError(f"Unknown measure {name!r}; expected one of {', '.join(MEASURES)}")
+    bands = list(amount_bands) if amount_bands else list(DEFAULT_BANDS)
+    if any(b <= a for a, b in zip(bands, bands[1:])) or bands[0] <= 0:
+        raise ValueError("amount_bands must be ascending positive numbers")
+    if not 1 <= limit <= MAX_GROUPS:
+        raise ValueError(f"limit must be between 1 and {MAX_GROUPS}")
+    sort_key = (sort or "").lstrip("-")
+    if sort_key and sort_key not in measures and sort_key not in dimensions:
+        raise ValueError("sort must be one of the requested measures or dimensions")
+
+    mask = _mask(frame, filters or {})
+    rows = (lambda column: column) if mask is None else (lambda column: column[mask])
+    amount = rows(frame.amount)
+
+    group = np.zeros(len(amount), np.int64)
+    sizes, labellers = [], []
+    for name in dimensions:
+        codes, size, labeller = _dimension(frame, name, rows, bands)
+        group = group * size + codes
+        sizes.append(size)
+        labellers.append(labeller)
+    space = int(np.prod(sizes, dtype=np.float64)) if sizes else 1
+    if space <= DENSE_GROUPS:
+        counts = np.bincount(group, minlength=space)
+        present = np.flatnonzero(counts)
+        index = np.full(space, -1, np.int64)
+        index[present] = np.arange(len(present))
+        group, counts = index[group], counts[present]
+    else:
+        present, group, counts = np.unique(group, return_inverse=True, return_counts=True)
+
+    n_groups = len(present)
+    values: Dict[str, np.ndarray] = {"count": counts}
+    if {"sum", "mean"} & set(measures):
+        values["sum"] = np.bincount(group, amount, n_groups)
+        values["mean"] = values["sum"] / np.maximum(counts, 1)
+    if "income" in measures:
+        values["income"] = np.bincount(group, np.where(amount > 0, amount, 0.0), n_groups)
+    if "expenses" in measures:
+        values["expenses"] = np.bincount(group, np.where(amount < 0, -amount, 0.0), n_groups)
+    if {"min", "max"} & set(measures):
+        values["min"], values["max"] = np.full(n_groups, np.inf), np.full(n_groups, -np.inf)
+        np.minimum.at(values["min"], group, amount)
+        np.maximum.at(values["max"], group, amount)
+
+    if sort_key in measures:
+        order = np.argsort(values[sort_key], kind="stable")
+        if sort.startswith("-"):
+            order = order[::-1]
+    elif sort_key:
+        position = dimensions.index(sort_key)
+        codes = np.unravel_index(present, sizes)[position]
+        order = np.argsort(codes, kind="stable")
+        if sort.startswith("-"):
+            order = order[::-1]
+    else:
+        # Group ids are already in dimension order: chronological months, alphabetical categories
+        order = np.arange(n_groups)
+    order = order[:limit]
+
+    codes = np.unravel_index(present[order], sizes) if sizes else []
+    columns = {name: values[name][order].tolist() for name in measures}
+    result_rows = []
+    for i in range(len(order)):
+        row = {name: labellers[d](int(codes[d][i])) for d, name in enumerate(dimensions)}
+        for name in measures:
+            value = columns[name][i]
+            row[name] = value if name == "count" else round(value, 2)
+        result_rows.append(row)
+    return {
+        "currency": frame.currency,
+        "dimensions": dimensions,
+        "measures": measures,
+        "rows": result_rows,
+        "groups": n_groups,
+        "truncated": n_groups > len(order),
+        "row_count": int(len(amount)),
+        "unconverted_count": int(np.isnan(frame.amount).sum()),
+    }
+
+
+# Cache ------------------------------------------------------------------------
+
+@dataclass
+class _Cached:
+    frame: ColumnarFrame
+    loaded_at: float
+    stale: bool = False
+
+
+class PivotCache:
+    """Per-user ColumnarFrames in an LRU bounded by `max_bytes`, patched by writes."""
+
+    def __init__(self, fx: FxRates, max_bytes: int = 256 * 1024 * 1024, ttl: float = 600.0, load_stripes: int = 64):
+        self.fx = fx
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.current_bytes = 0
+        self._entries: "OrderedDict[int, _Cached]" = OrderedDict()
+        self._generations: Dict[int, int] = {}
+        # Changes committed while a user's frame loads, applied to it before it is cached
+        self._loading: Dict[int, List[Tuple[str, Dict[str, Any]]]] = {}
+        self._refreshing: set = set()
+        self._lock = threading.Lock()
+        # One loader per user at a time; concurrent pivots for a cold user wait for that load
+        self._load_locks = [threading.Lock() for _ in range(load_stripes)]
+        # One patch per user at a time, so two commits never patch the same frame
+        self._patch_locks = [threading.Lock() for _ in range(load_stripes)]
+        self._counts = {"hits": 0, "stale_hits": 0, "misses": 0, "evictions": 0, "patches": 0, "invalidations": 0,
+                        "load_seconds": 0.0, "patch_seconds": 0.0}
+
+    @classmethod
+    def from_env(cls, fx: FxRates, prefix: str = "PIVOT_CACHE") -> "PivotCache":
+        return cls(
+            fx,
+            max_bytes=int(os.getenv(f"{prefix}_MAX_BYTES", str(256 * 1024 * 1024))),
+            ttl=float(os.getenv(f"{prefix}_TTL_SECONDS", "600")),
+        )
+
+    def get(self, user_id: int, currency: str, loader: Callable[[], ColumnarFrame]) -> ColumnarFrame:
+        """The user's frame; a stale one is returned as is while a background thread reloads it.
+
+        `loader` may run on that thread after the request is gone, so it must
+        open its own connection.
+        """
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and entry.frame.currency == currency:
+                self._entries.move_to_end(user_id)
+                refresh = self._is_stale(entry) and user_id not in self._refreshing
+                if refresh:
+                    self._refreshing.add(user_id)
+                self._counts["stale_hits" if self._is_stale(entry) else "hits"] += 1
+                frame = entry.frame
+            else:
+                frame = refresh = None
+        if refresh:
+            threading.Thread(target=self._refresh, args=(user_id, currency, loader), name="pivot-refresh",
+                             daemon=True).start()
+        if frame is not None:
+            return frame
+        return self._load(user_id, currency, loader)
+
+    def _is_stale(self, entry: _Cached) -> bool:
+        return entry.stale or time.monotonic() - entry.loaded_at > self.ttl
+
+    def _refresh(self, user_id: int, currency: str, loader: Callable[[], ColumnarFrame]):
+        try:
+            self._load(user_id, currency, loader)
+        except Exception as e:
+            print(f"Pivot frame refresh failed for user {user_id}: {str(e)}")
+        finally:
+            with self._lock:
+                self._refreshing.discard(user_id)
+
+    def _load(self, user_id: int, currency: str, loader: Callable[[], ColumnarFrame]) -> ColumnarFrame:
+        with self._load_locks[user_id % len(self._load_locks)]:
+            with self._lock:
+                entry = self._entries.get(user_id)
+                if entry is not None and entry.frame.currency == currency and not self._is_stale(entry):
+                    return entry.frame
+                generation = self._generations.get(user_id, 0)
+                self._loading[user_id] = []
+            started = time.perf_counter()
+            try:
+                frame = loader()
+            except Exception:
+                with self._lock:
+                    self._loading.pop(user_id, None)
+                raise
+            with self._lock:
+                pending = self._loading.pop(user_id)
+                self._counts["misses"] += 1
+                self._counts["load_seconds"] += time.perf_counter() - started
+                # A set-based write committed during the load may or may not be in it; row changes are replayed
+                if self._generations.get(user_id, 0) == generation:
+                    if pending:
+                        frame = patch_frame(frame, pending, self.fx)
+                    self._store(user_id, frame)
+        return frame
+
+    def _store(self, user_id: int, frame: ColumnarFrame, loaded_at: Optional[float] = None, stale: bool = False):
+        self._remove(user_id)
+        if frame.nbytes > self.max_bytes:
+            return
+        self._entries[user_id] = _Cached(frame, time.monotonic() if loaded_at is None else loaded_at, stale)
+        self.current_bytes += frame.nbytes
+        while self.current_bytes > self.max_bytes:
+            _, entry = self._entries.popitem(last=False)
+            self.current_bytes -= entry.frame.nbytes
+            self._counts["evictions"] += 1
+
+    def _remove(self, user_id: int):
+        entry = self._entries.pop(user_id, None)
+        if entry is not None:
+            self.current_bytes -= entry.frame.nbytes
+
+    def apply(self, user_id: int, changes: List[Tuple[str, Dict[str, Any]]]):
+        """Patch committed row changes (see patch_frame) into the user's cached or loading frame."""
+        with self._patch_locks[user_id % len(self._patch_locks)]:
+            with self._lock:
+                if user_id in self._loading:
+                    self._loading[user_id].extend(changes)
+                entry = self._entries.get(user_id)
+            if entry is None:
+                return
+            # Readers may hold the old frame, so the patch builds a new one
+            started = time.perf_counter()
+            frame = patch_frame(entry.frame, changes, self.fx)
+            with self._lock:
+                if self._entries.get(user_id) is entry:
+                    self._store(user_id, frame, entry.loaded_at, entry.stale)
+                self._counts["patches"] += 1
+                self._counts["patch_seconds"] += time.perf_counter() - started
+
+    def invalidate(self, user_id: int):
+        """For writes without row images: keep serving the frame, but rebuild it on the next read."""
+        with self._lock:
+            self._generations[user_id] = self._generations.get(user_id, 0) + 1
+            entry = self._entries.get(user_id)
+            if entry is not None:
+                entry.stale = True
+            self._counts["invalidations"] += 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                **self._counts,
+                "load_seconds": round(self._counts["load_seconds"], 3),
+                "patch_seconds": round(self._counts["patch_seconds"], 3),
+                "entries": len(self._entries),
+                "bytes": self.current_bytes,
+                "max_bytes": self.max_bytes,
+            }
@@ -0,0 +1,283 @@
+"""Heavy per-user reports, computed by a JobRunner in worker processes.
+
+Kinds and their parameters:
+
+  annual_summary      year             income, expenses and net per month and
+                                       per category, and the largest rows
+  category_breakdown  start_year,      net, income and expenses per category
+                      end_year         per year, at most MAX_BREAKDOWN_YEARS
+  tax_export          year             CSV of every row with its amount in the
+                                       user's currency
+
+Amounts are converted to the user's default currency at each row's day rate;
+rows in a currency without rates are counted as unconverted and left out of
+totals (the export leaves their converted column empty). Rows are read in
+chunks through a server-side cursor, so a report over a long history keeps
+flat memory. Results are written to the result directory as <job id>.json or
+<job id>.csv, via a temporary file and a rename.
+
+Command line (the dedicated worker process; API processes only enqueue unless
+REPORTS_RUNNER=true, which is meant for single-process deployments):
+    python -m app.services.reports worker
+"""
+import argparse
+import csv
+import heapq
+import json
+import os
+from collections import defaultdict
+from datetime import datetime
+from typing import Any, Dict, Iterator, List, Optional
+
+import numpy as np
+from dotenv import load_dotenv
+from sqlalchemy import MetaData, Table, create_engine, select
+from sqlalchemy.engine import Connection, Engine
+
+from app.services.fx import FxRates
+from app.utils.jobs import JobQueue, JobRunner
+from app.utils.partitioning import archived_years, attach_sqlite_archive, partition_union
+from app.utils.sharding import ShardRouter
+from app.utils.sqlite_profile import apply_sqlite_profile
+
+load_dotenv()
+
+REPORT_KINDS = ("annual_summary", "category_breakdown", "tax_export")
+MAX_BREAKDOWN_YEARS = 20
+CHUNK_ROWS = 5000
+EXPORT_COLUMNS = ["id", "date", "title", "category", "type", "amount", "currency"]
+
+
+def validate_params(kind: str, params: Dict[str, Any]) -> Dict[str, Any]:
+    """The normalised parameters for a report kind; ValueError on anything invalid."""
+    if kind not in REPORT_KINDS:
+        raise ValueError(f"Unknown report kind {kind!r}; expected one of {', '.join(REPORT_KINDS)}")
+
+    def year(name):
+        try:
+            value = int(params[name])
+        except (KeyError, TypeError, ValueError):
+            raise ValueError(f"{name} must be a year")
+        if not 1900 <= value <= 2200:
+            raise ValueError(f"{name} must be a year")
+        return value
+
+    if kind == "category_breakdown":
+        start, end = year("start_year"), year("end_year")
+        if end < start or end - start >= MAX_BREAKDOWN_YEARS:
+            raise ValueError(f"end_year must be from start_year to start_year + {MAX_BREAKDOWN_YEARS - 1}")
+        return {"start_year": start, "end_year": end}
+    return {"year": year("year")}
+
+
+def result_file(result_dir: str, job: Dict[str, Any]) -> str:
+    extension = "csv" if job["kind"] == "tax_export" else "json"
+    return os.path.join(result_dir, f"{job['id']}.{extension}")
+
+
+def remove_result(result_dir: str, job: Dict[str, Any]):
+    try:
+        os.remove(result_file(result_dir, job))
+    except FileNotFoundError:
+        pass
+
+
+def _chunks(conn: Connection, transactions, user_id: int, start: datetime, end: datetime) -> Iterator[dict]:
+    """Column arrays for the user's rows in [start, end), CHUNK_ROWS at a time, in date order."""
+    t = transactions.c
+    result = conn.execution_options(stream_results=True, yield_per=CHUNK_ROWS).execute(
+        select(t.id, t.date, t.title, t.category, t.type, t.amount, t.currency)
+        .where(t.user_id == user_id, t.date >= start, t.date < end)
+        .order_by(t.date, t.id)
+    )
+    for rows in result.partitions():
+        columns = list(zip(*rows))
+        yield {
+            "id": columns[0],
+            "date": columns[1],
+            "title": columns[2],
+            "category": columns[3],
+            "type": columns[4],
+            "amount": np.array([a or 0.0 for a in columns[5]], dtype=np.float64),
+            "currency": np.array(columns[6], dtype=object),
+            "day": np.array([d.date() for d in columns[1]], dtype="datetime64[D]"),
+        }
+
+
+def _convert(chunk: dict, fx: FxRates, currency: str) -> np.ndarray:
+    return fx.convert(chunk["amount"], chunk["currency"], chunk["day"], currency)
+
+
+def _totals() -> Dict[str, float]:
+    return {"income": 0.0, "expenses": 0.0, "net": 0.0, "count": 0}
+
+
+def _add(totals: Dict[str, float], value: float):
+    totals["income" if value > 0 else "expenses"] += value
+    totals["net"] += value
+    totals["count"] += 1
+
+
+def annual_summary(conn: Connection, transactions, user_id: int, year: int, currency: str, fx: FxRates,
+                   top: int = 10) -> Dict[str, Any]:
+    months = defaultdict(_totals)
+    categories = defaultdict(_totals)
+    overall = _totals()
+    largest: List[tuple] = []
+    unconverted = 0
+    for chunk in _chunks(conn, transactions, user_id, datetime(year, 1, 1), datetime(year + 1, 1, 1)):
+        converted = _convert(chunk, fx, currency)
+        for i, value in enumerate(converted.tolist()):
+            if np.isnan(value):
+                unconverted += 1
+                continue
+            _add(months[chunk["date"][i].month], value)
+            _add(categories[chunk["category"][i] or "Uncategorised"], value)
+            _add(overall, value)
+            entry = (abs(value), chunk["id"][i], chunk["date"][i].isoformat(), chunk["title"][i], value)
+            if len(largest) < top:
+                heapq.heappush(largest, entry)
+            elif entry > largest[0]:
+                heapq.heapreplace(largest, entry)
+    return {
+        "year": year,
+        "currency": currency,
+        "totals": overall,
+        "unconverted_count": unconverted,
+        "months": [{"month": f"{year:04d}-{m:02d}", **months[m]} for m in range(1, 13)],
+        "categories": [{"category": name, **values} for name, values in sorted(categories.items())],
+        "largest": [
+            {"id": row_id, "date": day, "title": title, "amount": value}
+            for _, row_id, day, title, value in sorted(largest, reverse=True)
+        ],
+    }
+
+
+def category_breakdown(conn: Connection, transactions, user_id: int, start_year: int, end_year: int,
+                       currency: str, fx: FxRates) -> Dict[str, Any]:
+    cells = defaultdict(_totals)
+    unconverted = 0
+    for chunk in _chunks(conn, transactions, user_id, datetime(start_year, 1, 1), datetime(end_year + 1, 1, 1)):
+        converted = _convert(chunk, fx, currency)
+        for i, value in enumerate(converted.tolist()):
+            if np.isnan(value):
+                unconverted += 1
+                continue
+            _add(cells[(chunk["category"][i] or "Uncategorised", chunk["date"][i].year)], value)
+    years = list(range(start_year, end_year + 1))
+    names = sorted({name for name, _ in cells})
+    return {
+        "start_year": start_year,
+        "end_year": end_year,
+        "currency": currency,
+        "unconverted_count": unconverted,
+        "years": years,
+        "categories": [
+            {"category": name, "years": [{"year": y, **cells.get((name, y), _totals())} for y in years]}
+            for name in names
+        ],
+    }
+
+
+def tax_export(conn: Connection, transactions, user_id: int, year: int, currency: str, fx: FxRates, path: str) -> int:
+    count = 0
+    with open(path, "w", newline="") as handle:
+        writer = csv.writer(handle)
+        writer.writerow(EXPORT_COLUMNS + [f"amount_{currency.lower()}"])
+        for chunk in _chunks(conn, transactions, user_id, datetime(year, 1, 1), datetime(year + 1, 1, 1)):
+            converted = _convert(chunk, fx, currency)
+            amounts = chunk["amount"].tolist()
+            writer.writerows(
+                [
+                    chunk["id"][i], chunk["date"][i].isoformat(), chunk["title"][i], chunk["category"][i],
+                    chunk["type"][i], amounts[i], chunk["currency"][i] or currency,
+                    "" if np.isnan(value) else round(value, 2),
+                ]
+                for i, value in enumerate(converted.tolist())
+            )
+            count += len(converted)
+    return count
+
+
+# Worker processes -------------------------------------------------------------
+
+_worker_router: Optional[ShardRouter] = None
+_worker_tables: Dict[Engine, Table] = {}
+_worker_fx: Optional[FxRates] = None
+_worker_result_dir: Optional[str] = None
+
+
+def init_worker(database_url: str, result_dir: str):
+    global _worker_router, _worker_fx, _worker_result_dir
+    engine = create_engine(database_url)
+    apply_sqlite_profile(engine)
+    attach_sqlite_archive(engine)
+    _worker_router = ShardRouter.from_env(engine)
+    _worker_fx = FxRates.from_env()
+    _worker_result_dir = result_dir
+
+
+def _transactions_for(user_id: int):
+    engine = _worker_router.engine_for(user_id)
+    if engine not in _worker_tables:
+        # Shards have no users table, so foreign keys to it cannot be followed
+        _worker_tables[engine] = Table("transactions", MetaData(), autoload_with=engine, resolve_fks=False)
+    return engine, _worker_tables[engine]
+
+
+def run_report(job: Dict[str, Any]) -> Dict[str, Any]:
+    """JobRunner handler: compute the report and write its result file."""
+    params, user_id = job["params"], job["user_id"]
+    engine, source = _transactions_for(user_id)
+    path = result_file(_worker_result_dir, job)
+    partial_path = f"{path}.partial"
+    with engine.connect() as conn:
+        # Archived years are only attached on the main database (SQLITE_ARCHIVE_PATH excludes sharding)
+        years = archived_years(conn) if engine is _worker_router.global_engine and os.getenv("SQLITE_ARCHIVE_PATH") else []
+        transactions = partition_union(source, years, user_id) if years else source
+        currency = params["currency"]
+        if job["kind"] == "tax_export":
+            rows = tax_export(conn, transactions, user_id, params["year"], currency, _worker_fx, partial_path)
+            media_type = "text/csv"
+        else:
+            if job["kind"] == "annual_summary":
+                report = annual_summary(conn, transactions, user_id, params["year"], currency, _worker_fx)
+                rows = report["totals"]["count"] + report["unconverted_count"]
+            else:
+                report = category_breakdown(conn, transactions, user_id, params["start_year"], params["end_year"],
+                                            currency, _worker_fx)
+                rows = sum(cell["count"] for entry in report["categories"] for cell in entry["years"]) + report["unconverted_count"]
+            with open(partial_path, "w") as handle:
+                json.dump(report, handle)
+            media_type = "application/json"
+    os.replace(partial_path, path)
+    return {"file": os.path.basename(path), "media_type": media_type, "bytes": os.path.getsize(path), "rows": rows}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Report job worker")
+    sub = parser.add_subparsers(dest="command", required=True)
+    worker = sub.add_parser("worker", help="claim and run report jobs until interrupted")
+    worker.add_argument("--database-url", default=os.getenv("DATABASE_URL", "sqlite:///./finance_app.db"))
+    worker.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args()
+
+    result_dir = os.path.abspath(os.getenv("REPORTS_DIR") or "./reports")
+    os.makedirs(result_dir, exist_ok=True)
+    engine = create_engine(args.database_url)
+    apply_sqlite_profile(engine)
+    queue = JobQueue.from_env(engine, Table("report_jobs", MetaData(), autoload_with=engine))
+    if queue is None:
+        parser.error("REPORTS_ENABLED is false")
+    runner = JobRunner(queue, run_report, workers=args.workers or max(1, (os.cpu_count() or 2) // 2),
+                       poll_seconds=float(os.getenv("REPORTS_POLL_SECONDS", "2")), initializer=init_worker,
+                       initargs=(args.database_url, result_dir), on_purge=lambda job: remove_result(result_dir, job))
+    print(f"Report worker {runner.owner}: {runner.workers} processes")
+    try:
+        runner.run_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,204 @@
+"""Normalised transaction tags.
+
+Tags live in a `tags` table, one row per (user_id, name), and are linked to
+transactions through an association table with primary key
+(transaction_id, tag_id) plus an index on (tag_id, transaction_id). A tag
+filter therefore resolves names to ids through the unique (user_id, name)
+index and then reads only the matching link rows; no LIKE scans and no string
+splitting at query time.
+
+The association has no foreign key to the transactions table on purpose:
+archived and Postgres-partitioned rows keep their ids but move tables, and a
+partitioned table's key includes the date.
+
+Command line (bulk migration of comma-separated strings, e.g. expenses.tags):
+    python -m app.services.tags migrate --source expenses --link expense_tags --link-column expense_id
+"""
+import argparse
+import os
+from typing import Dict, Iterable, List, Optional, Sequence
+
+from sqlalchemy import Table, and_, delete, func, insert, select
+from sqlalchemy.engine import Connection, Engine
+
+MAX_TAG_LENGTH = 50
+
+
+def insert_ignore(conn: Connection, table: Table, rows: List[dict]):
+    """Multi-row INSERT that skips rows hitting a unique key (ON CONFLICT DO NOTHING)."""
+    if not rows:
+        return
+    if conn.dialect.name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert as dialect_insert
+    elif conn.dialect.name == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert as dialect_insert
+    else:
+        conn.execute(insert(table), rows)
+        return
+    conn.execute(dialect_insert(table).on_conflict_do_nothing(), rows)
+
+
+def split_tags(value) -> List[str]:
+    """Tag names from a list or a comma-separated string: trimmed, lower-cased, de-duplicated."""
+    if value is None:
+        return []
+    parts = value.split(",") if isinstance(value, str) else value
+    names = []
+    for part in parts:
+        name = " ".join(str(part).split()).lower()[:MAX_TAG_LENGTH]
+        if name and name not in names:
+            names.append(name)
+    return names
+
+
+def ensure_tags(conn: Connection, tags: Table, user_id: int, names: Sequence[str]) -> Dict[str, int]:
+    """Ids for a user's tag names, inserting the missing ones in one statement."""
+    if not names:
+        return {}
+    ids = dict(conn.execute(
+        select(tags.c.name, tags.c.id).where(tags.c.user_id == user_id, tags.c.name.in_(names))
+    ).all())
+    missing = [name for name in names if name not in ids]
+    if missing:
+        # A concurrent request may create some of them first; those rows are skipped
+        insert_ignore(conn, tags, [{"user_id": user_id, "name": name} for name in missing])
+        ids.update(conn.execute(
+            select(tags.c.name, tags.c.id).where(tags.c.user_id == user_id, tags.c.name.in_(missing))
+        ).all())
+    return ids
+
+
+def set_transaction_tags(conn: Connection, tags: Table, links: Table, user_id: int, transaction_id: int, names: Sequence[str]):
+    """Replace the tags on one transaction."""
+    link_column = links.c.transaction_id
+    conn.execute(delete(links).where(link_column == transaction_id))
+    ids = ensure_tags(conn, tags, user_id, names)
+    if ids:
+        conn.execute(insert(links), [{"transaction_id": transaction_id, "tag_id": tag_id} for tag_id in ids.values()])
+
+
+def tags_for(conn: Connection, tags: Table, links: Table, transaction_ids: Iterable[int], chunk_size: int = 500) -> Dict[int, List[str]]:
+    """{transaction_id: [tag names]} for a set of transactions, read through the link primary key."""
+    transaction_ids = list(transaction_ids)
+    result: Dict[int, List[str]] = {}
+    for i in range(0, len(transaction_ids), chunk_size):
+        rows = conn.execute(
+            select(links.c.transaction_id, tags.c.name)
+            .join_from(links, tags, links.c.tag_id == tags.c.id)
+            .where(links.c.transaction_id.in_(transaction_ids[i:i + chunk_size]))
+            .order_by(tags.c.name)
+        ).all()
+        for transaction_id, name in rows:
+            result.setdefault(transaction_id, []).append(name)
+    return result
+
+
+def tag_condition(id_column, tags: Table, links: Table, user_id: int, names: Sequence[str], mode: str = "any"):
+    """WHERE clause restricting `id_column` to transactions tagged with any / all of `names`.
+
+    The names are resolved by a subquery on (user_id, name); the link rows
+    are then read from the (tag_id, transaction_id) index.
+    """
+    tag_ids = select(tags.c.id).where(tags.c.user_id == user_id, tags.c.name.in_(names))
+    matching = select(links.c.transaction_id).where(links.c.tag_id.in_(tag_ids))
+    if mode == "all":
+        matching = matching.group_by(links.c.transaction_id).having(
+            func.count(links.c.tag_id) == len(set(names))
+        )
+    return id_column.in_(matching)
+
+
+def tagged_rows(transactions, tags: Table, links: Table, user_id: int):
+    """Subquery of the user's (tag, transaction columns) pairs, for per-tag aggregates."""
+    t = transactions.c
+    return (
+        select(tags.c.name.label("tag"), *[column for column in t])
+        .join_from(tags, links, links.c.tag_id == tags.c.id)
+        .join(transactions, t.id == links.c.transaction_id)
+        .where(tags.c.user_id == user_id, t.user_id == user_id)
+        .subquery("tagged")
+    )
+
+
+def migrate_comma_tags(engine: Engine, source: Table, tags: Table, links: Table, link_column: str,
+                       tags_column: str = "tags", batch_size: int = 5000, clear: bool = False) -> int:
+    """Split a comma-separated tags column into the normalised tables, in id order and batches.
+
+    Every batch inserts its new tag names with one multi-row INSERT and its
+    links with another. Re-running is safe: links that already exist are
+    skipped. With `clear` the source column is set to NULL once migrated.
+    """
+    s = source.c
+    link_target = links.c[link_column]
+    migrated, last_id = 0, 0
+    while True:
+        with engine.begin() as conn:
+            rows = conn.execute(
+                select(s.id, s.user_id, s[tags_column])
+                .where(s.id > last_id, s.user_id.is_not(None), s[tags_column].is_not(None), s[tags_column] != "")
+                .order_by(s.id)
+                .limit(batch_size)
+            ).all()
+            if not rows:
+                return migrated
+            wanted = {(row.user_id, name) for row in rows for name in split_tags(row[2])}
+            existing = set(conn.execute(
+                select(tags.c.user_id, tags.c.name).where(
+                    tags.c.name.in_({name for _, name in wanted}),
+                    tags.c.user_id.in_({user_id for user_id, _ in wanted}),
+                )
+            ).all())
+            insert_ignore(conn, tags, [{"user_id": user_id, "name": name} for user_id, name in sorted(wanted - existing, key=str)])
+            ids = {
+                (user_id, name): tag_id
+                for tag_id, user_id, name in conn.execute(
+                    select(tags.c.id, tags.c.user_id, tags.c.name).where(
+                        tags.c.name.in_({name for _, name in wanted}),
+                        tags.c.user_id.in_({user_id for user_id, _ in wanted}),
+                    )
+                )
+            }
+            pairs = {
+                (row.id, ids[(row.user_id, name)])
+                for row in rows for name in split_tags(row[2])
+            }
+            present = set(conn.execute(
+                select(link_target, links.c.tag_id).where(link_target.in_([row.id for row in rows]))
+            ).all())
+            new_links = [{link_column: row_id, "tag_id": tag_id} for row_id, tag_id in sorted(pairs - present)]
+            insert_ignore(conn, links, new_links)
+            if clear:
+                conn.execute(
+                    source.update()
+                    .where(and_(s.id > last_id, s.id <= rows[-1].id))
+                    .values({tags_column: None})
+                )
+            migrated += len(new_links)
+            last_id = rows[-1].id
+
+
+def main(argv: Optional[List[str]] = None):
+    from sqlalchemy import MetaData, create_engine
+
+    parser = argparse.ArgumentParser(description="Normalised tag maintenance")
+    sub = parser.add_subparsers(dest="command", required=True)
+    migrate = sub.add_parser("migrate", help="split a comma-separated tags column into tags + link table")
+    migrate.add_argument("--database-url", default=os.getenv("DATABASE_URL", "sqlite:///./finance_app.db"))
+    migrate.add_argument("--source", default="expenses")
+    migrate.add_argument("--column", default="tags")
+    migrate.add_argument("--link", default="expense_tags")
+    migrate.add_argument("--link-column", default="expense_id")
+    migrate.add_argument("--clear", action="store_true", help="set the source column to NULL once migrated")
+    args = parser.parse_args(argv)
+
+    engine = create_engine(args.database_url)
+    metadata = MetaData()
+    source = Table(args.source, metadata, autoload_with=engine)
+    tags = Table("tags", metadata, autoload_with=engine)
+    links = Table(args.link, metadata, autoload_with=engine)
+    count = migrate_comma_tags(engine, source, tags, links, args.link_column, args.column, clear=args.clear)
+    print(f"created {count} tag links from {args.source}.{args.column}")
+
+
+if __name__ == "__main__":
+    main()
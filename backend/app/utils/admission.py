@@ -0,0 +1,253 @@
+"""Admission control and load shedding for the ASGI app.
+
+Each HTTP request is matched by path prefix to a route class. A class has a
+concurrency limit, a bounded wait queue, a queue deadline and a priority;
+all classes also share one worker-wide concurrency limit. When a slot frees up
+the waiting request with the best (priority, arrival) whose class is under its
+own limit is admitted, so cheap reads keep flowing while heavy analytics and
+Argon2 logins wait their turn.
+
+A request is shed with 503 and a Retry-After header instead of waiting when
+  - its class queue is full,
+  - the wait predicted from the class's recent service time already exceeds
+    the deadline, or
+  - the deadline passes before a slot frees up.
+
+Long-lived streams (the change feed) are exempt; holding a slot for the life
+of a connection would starve everything else. WebSockets are never counted.
+
+Configuration (.env):
+    ADMISSION_ENABLED, ADMISSION_MAX_CONCURRENCY
+    ADMISSION_CLASSES                 match order, e.g. stream,auth,analytics,default
+    ADMISSION_<CLASS>_PATHS           comma-separated path prefixes
+    ADMISSION_<CLASS>_LIMIT / _QUEUE / _TIMEOUT_MS / _PRIORITY / _EXEMPT
+"""
+import asyncio
+import bisect
+import itertools
+import json
+import math
+import os
+import time
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+
+@dataclass
+class RouteClass:
+    name: str
+    prefixes: Tuple[str, ...]
+    limit: int = 64
+    queue_size: int = 256
+    timeout: float = 5.0
+    # Lower values are admitted first
+    priority: int = 0
+    exempt: bool = False
+
+
+# Argon2 and analytics threads compete with the event loop for the CPU, so more
+# of them than cores only adds latency to everything else
+CPU_BOUND_LIMIT = max(1, (os.cpu_count() or 1) // 2)
+
+DEFAULT_CLASSES = [
+    RouteClass("stream", ("/api/events",), exempt=True),
+    # Only the Argon2 endpoints; refresh and logout are cheap and go with everything else
+    RouteClass("auth", ("/api/auth/login", "/api/auth/register"), limit=CPU_BOUND_LIMIT, queue_size=32, timeout=2.0, priority=1),
+    RouteClass(
+        "analytics",
+        ("/api/categories/stats", "/api/analytics/", "/api/tags/stats", "/api/transactions/duplicates"),
+        limit=CPU_BOUND_LIMIT, queue_size=16, timeout=1.0, priority=2,
+    ),
+    RouteClass("default", ("/",), limit=64, queue_size=256, timeout=5.0, priority=0),
+]
+
+
+@dataclass
+class ClassStats:
+    active: int = 0
+    waiting: int = 0
+    admitted: int = 0
+    queued: int = 0
+    shed_queue_full: int = 0
+    shed_predicted: int = 0
+    shed_deadline: int = 0
+    # Exponentially weighted mean of the time a request holds its slot
+    service_time: Optional[float] = None
+
+
+class AdmissionController:
+    """Per-class and worker-wide slot accounting for one event loop.
+
+    All methods run on the event loop thread, so no locking is needed.
+    """
+
+    def __init__(self, classes: List[RouteClass], max_concurrency: int = 64, smoothing: float = 0.2):
+        self.classes = classes
+        self.max_concurrency = max_concurrency
+        self.smoothing = smoothing
+        self.stats: Dict[str, ClassStats] = {route.name: ClassStats() for route in classes}
+        self._active_total = 0
+        # Sorted (priority, arrival, route, future); small because every class queue is bounded
+        self._waiters: List[tuple] = []
+        self._arrivals = itertools.count()
+
+    @classmethod
+    def from_env(cls) -> Optional["AdmissionController"]:
+        if os.getenv("ADMISSION_ENABLED", "true").lower() != "true":
+            return None
+        defaults = {route.name: route for route in DEFAULT_CLASSES}
+        names = [name.strip() for name in os.getenv("ADMISSION_CLASSES", ",".join(defaults)).split(",") if name.strip()]
+        classes = []
+        for name in names:
+            base = defaults.get(name) or RouteClass(name, ())
+            prefix = f"ADMISSION_{name.upper()}"
+
+            def setting(key, default):
+                # An empty value keeps the built-in default
+                return os.getenv(f"{prefix}_{key}") or default
+
+            paths = os.getenv(f"{prefix}_PATHS")
+            classes.append(RouteClass(
+                name=name,
+                prefixes=tuple(p.strip() for p in paths.split(",") if p.strip()) if paths else base.prefixes,
+                limit=int(setting("LIMIT", base.limit)),
+                queue_size=int(setting("QUEUE", base.queue_size)),
+                timeout=float(setting("TIMEOUT_MS", base.timeout * 1000)) / 1000,
+                priority=int(setting("PRIORITY", base.priority)),
+                exempt=str(setting("EXEMPT", base.exempt)).lower() == "true",
+            ))
+        return cls(classes, max_concurrency=int(os.getenv("ADMISSION_MAX_CONCURRENCY", "64")))
+
+    def classify(self, path: str) -> Optional[RouteClass]:
+        """First class with a matching prefix, in configuration order."""
+        for route in self.classes:
+            if any(path.startswith(prefix) for prefix in route.prefixes):
+                return route
+        return None
+
+    def _can_run(self, route: RouteClass) -> bool:
+        return self._active_total < self.max_concurrency and self.stats[route.name].active < route.limit
+
+    def _grant(self, route: RouteClass):
+        self._active_total += 1
+        stats = self.stats[route.name]
+        stats.active += 1
+        stats.admitted += 1
+
+    def _retry_after(self, route: RouteClass) -> int:
+        stats = self.stats[route.name]
+        expected = (stats.service_time or route.timeout) * (stats.waiting + 1) / max(route.limit, 1)
+        return max(1, math.ceil(expected))
+
+    async def acquire(self, route: RouteClass) -> Optional[int]:
+        """Wait for a slot. Returns None once admitted, or a Retry-After in seconds when shed."""
+        stats = self.stats[route.name]
+        # Anything that could run would already have been dispatched, so a free slot is ours
+        if self._can_run(route):
+            self._grant(route)
+            return None
+        if stats.waiting >= route.queue_size:
+            stats.shed_queue_full += 1
+            return self._retry_after(route)
+        if stats.service_time is not None and stats.service_time * (stats.waiting + 1) / max(route.limit, 1) > route.timeout:
+            stats.shed_predicted += 1
+            return self._retry_after(route)
+
+        future = asyncio.get_running_loop().create_future()
+        waiter = (route.priority, next(self._arrivals), route.name, future)
+        bisect.insort(self._waiters, waiter, key=lambda w: w[:2])
+        stats.waiting += 1
+        stats.queued += 1
+        try:
+            await asyncio.wait({future}, timeout=route.timeout)
+        except BaseException:
+            # Client went away while queued; give back a slot granted in the meantime
+            self._forget(waiter, stats)
+            if future.done() and not future.cancelled():
+                self.release(route)
+            raise
+        self._forget(waiter, stats)
+        if future.done():
+            return None
+        future.cancel()
+        stats.shed_deadline += 1
+        return self._retry_after(route)
+
+    def _forget(self, waiter: tuple, stats: ClassStats):
+        index = bisect.bisect_left(self._waiters, waiter[:2], key=lambda w: w[:2])
+        if index < len(self._waiters) and self._waiters[index] is waiter:
+            del self._waiters[index]
+            stats.waiting -= 1
+
+    def release(self, route: RouteClass, elapsed: Optional[float] = None):
+        self._active_total -= 1
+        stats = self.stats[route.name]
+        stats.active -= 1
+        if elapsed is None:
+            pass
+        elif stats.service_time is None:
+            stats.service_time = elapsed
+        else:
+            stats.service_time += self.smoothing * (elapsed - stats.service_time)
+        self._dispatch()
+
+    def _dispatch(self):
+        by_name = {route.name: route for route in self.classes}
+        index = 0
+        while index < len(self._waiters) and self._active_total < self.max_concurrency:
+            _, _, name, future = self._waiters[index]
+            route = by_name[name]
+            if future.done() or not self._can_run(route):
+                index += 1
+                continue
+            del self._waiters[index]
+            self.stats[name].waiting -= 1
+            self._grant(route)
+            future.set_result(True)
+
+    def snapshot(self) -> Dict[str, dict]:
+        return {
+            name: {
+                "active": s.active, "waiting": s.waiting, "admitted": s.admitted, "queued": s.queued,
+                "shed_queue_full": s.shed_queue_full, "shed_predicted": s.shed_predicted,
+                "shed_deadline": s.shed_deadline,
+                "service_time_ms": round(s.service_time * 1000, 2) if s.service_time is not None else None,
+            }
+            for name, s in self.stats.items()
+        }
+
+
+class AdmissionMiddleware:
+    """Pure ASGI middleware, so a shed request costs no routing or dependency work."""
+
+    def __init__(self, app, controller: AdmissionController):
+        self.app = app
+        self.controller = controller
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        route = self.controller.classify(scope["path"])
+        if route is None or route.exempt:
+            return await self.app(scope, receive, send)
+
+        retry_after = await self.controller.acquire(route)
+        if retry_after is not None:
+            body = json.dumps({"detail": "Server is busy, please retry later"}).encode()
+            await send({
+                "type": "http.response.start",
+                "status": 503,
+                "headers": [
+                    (b"content-type", b"application/json"),
+                    (b"content-length", str(len(body)).encode()),
+                    (b"retry-after", str(retry_after).encode()),
+                ],
+            })
+            await send({"type": "http.response.body", "body": body})
+            return
+
+        started = time.monotonic()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.controller.release(route, time.monotonic() - started)
@@ -0,0 +1,342 @@
+"""Append-only change log of who changed which row, written behind the request.
+
+Entries carry the before and after image of a row (column name -> value; no
+before image for a create, no after image for a delete) plus the owning user,
+the acting user and the time. `flush_changes` builds them from a session
+flush; set-based writes that bypass the ORM build their own with
+`audit_entry`. An update's after image holds only the columns it changed;
+`query` returns it merged over the before image, so readers see full rows
+while each update encodes and stores one full image instead of two.
+
+Where an entry goes depends on the durability mode:
+
+  async          buffered in memory after commit and inserted by a background
+                 thread in batches, when `max_batch` entries are pending or
+                 `flush_interval` seconds have passed. A crash loses at most
+                 the unflushed tail.
+  spool          as async, but each committed batch is also appended to a
+                 local spool file (handed to the OS, not fsynced) that is
+                 replayed on the next start, so a process crash loses nothing.
+                 Replay is at-least-once: a crash between the database commit
+                 and the spool cleanup writes that batch twice.
+  transactional  inserted in the writing transaction itself, so the entry
+                 commits or rolls back with the change. Costs one more insert
+                 per write; atomic only when the log and the data share a
+                 database file.
+
+`table` must have id, user_id, actor_id, entity, entity_id, action, before,
+after and created_at columns; images are stored as JSON text.
+"""
+import glob
+import json
+import os
+import threading
+import time
+from datetime import date, datetime
+from typing import Any, Dict, List, Optional
+
+from sqlalchemy import Table, inspect, insert, select
+from sqlalchemy.engine import Connection, Engine
+
+MODES = ("async", "spool", "transactional")
+
+
+def audit_entry(user_id: Optional[int], actor_id: Optional[int], entity: str, entity_id: Optional[int], action: str,
+                before: Optional[dict] = None, after: Optional[dict] = None,
+                created_at: Optional[datetime] = None) -> Dict[str, Any]:
+    return {
+        "user_id": user_id,
+        "actor_id": actor_id,
+        "entity": entity,
+        "entity_id": entity_id,
+        "action": action,
+        "before": before,
+        "after": after,
+        "created_at": created_at or datetime.utcnow(),
+    }
+
+
+_column_keys: Dict[Any, List[str]] = {}
+
+
+def flush_changes(session, entities: Dict[type, str], actor_id: Optional[int] = None) -> List[Dict[str, Any]]:
+    """Entries for the new, changed and deleted objects of the mapped classes in `entities` ({class: name}).
+
+    Call from after_flush, while attribute history still holds the pre-flush
+    values. Only loaded attributes are read, so this never emits SQL; updates
+    that changed no column are skipped.
+    """
+    now = datetime.utcnow()
+    entries = []
+    for action, objects in (("created", session.new), ("updated", session.dirty), ("deleted", session.deleted)):
+        for obj in objects:
+            entity = entities.get(type(obj))
+            if entity is None:
+                continue
+            state = inspect(obj)
+            keys = _column_keys.get(state.mapper)
+            if keys is None:
+                keys = _column_keys[state.mapper] = [attr.key for attr in state.mapper.column_attrs]
+            image = {key: state.dict.get(key) for key in keys}
+            before = after = None
+            if action == "created":
+                after = image
+            elif action == "deleted":
+                before = image
+            else:
+                # committed_state names just the attributes set since the last flush
+                before, after = image, {}
+                for key in keys:
+                    if key in state.committed_state:
+                        history = state.attrs[key].history
+                        if history.has_changes():
+                            before[key] = history.deleted[0] if history.deleted else None
+                            after[key] = history.added[0] if history.added else None
+                if not after:
+                    continue
+            entries.append(audit_entry(image.get("user_id"), actor_id, entity, image.get("id"), action,
+                                       before, after, now))
+    return entries
+
+
+def _json_default(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    raise TypeError(f"{type(value).__name__} is not JSON serialisable")
+
+
+_encoder = json.JSONEncoder(default=_json_default, separators=(",", ":"))
+
+
+def _dumps(value) -> Optional[str]:
+    if value is None:
+        return None
+    return _encoder.encode(value)
+
+
+def _row(entry: Dict[str, Any]) -> Dict[str, Any]:
+    return {**entry, "before": _dumps(entry["before"]), "after": _dumps(entry["after"])}
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class AuditLog:
+    """Buffer, batch and query audit entries in `table` (see the module docstring for the modes)."""
+
+    def __init__(self, engine: Engine, table: Table, mode: str = "async", max_batch: int = 500,
+                 flush_interval: float = 1.0, max_pending: int = 100_000, spool_path: str = "./audit_log.spool"):
+        if mode not in MODES:
+            raise ValueError(f"Unknown audit log mode {mode!r}; expected one of {', '.join(MODES)}")
+        self.engine = engine
+        self.table = table
+        self.mode = mode
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        # One spool per process, so several workers can share a directory
+        self.spool_path = f"{os.path.abspath(spool_path)}.{os.getpid()}"
+        self._pending: List[Dict[str, Any]] = []
+        self._lock = threading.Lock()
+        self._wake = threading.Condition(self._lock)
+        self._flush_lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._stopping = False
+        self._spool = None
+        self._spool_seq = 0
+        self._flushed_spools: List[str] = []
+        self._counts: Dict[str, int] = {"written": 0, "batches": 0, "failures": 0, "dropped": 0, "replayed": 0}
+        self._last_flush_ms = 0.0
+        if mode == "spool":
+            self._replay_spools(spool_path)
+
+    @classmethod
+    def from_env(cls, engine: Engine, table: Table) -> Optional["AuditLog"]:
+        """AUDIT_LOG_MODE is async, spool or transactional; off disables the log."""
+        mode = os.getenv("AUDIT_LOG_MODE", "async").lower()
+        if mode == "off":
+            return None
+        return cls(
+            engine,
+            table,
+            mode=mode,
+            max_batch=int(os.getenv("AUDIT_LOG_MAX_BATCH", "500")),
+            flush_interval=float(os.getenv("AUDIT_LOG_FLUSH_INTERVAL_MS", "1000")) / 1000,
+            max_pending=int(os.getenv("AUDIT_LOG_MAX_PENDING", "100000")),
+            spool_path=os.getenv("AUDIT_LOG_SPOOL_PATH") or "./audit_log.spool",
+        )
+
+    def write(self, conn: Connection, entries: List[Dict[str, Any]]):
+        """Transactional mode: insert the entries on the writer's own connection, in its transaction."""
+        if entries:
+            conn.execute(insert(self.table), [_row(entry) for entry in entries])
+            with self._lock:
+                self._counts["written"] += len(entries)
+
+    def record(self, entries: List[Dict[str, Any]]):
+        """Queue committed entries for the background flush."""
+        if not entries:
+            return
+        with self._lock:
+            if len(self._pending) + len(entries) > self.max_pending:
+                # The database has been unreachable for a while; memory is the one thing not to run out of
+                self._counts["dropped"] += len(entries)
+                print(f"Audit log buffer full, dropped {len(entries)} entries")
+                return
+            if self.mode == "spool":
+                entries = [_row(entry) for entry in entries]
+                self._spool_append(entries)
+            self._pending.extend(entries)
+            if len(self._pending) >= self.max_batch:
+                self._wake.notify()
+            if self._thread is None and not self._stopping:
+                self._thread = threading.Thread(target=self._run, name="audit-log", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._lock:
+                if not self._stopping and len(self._pending) < self.max_batch:
+                    self._wake.wait(self.flush_interval)
+                stopping = self._stopping
+            self.flush()
+            if stopping:
+                return
+
+    def flush(self) -> int:
+        """Insert everything pending now; returns the number of entries written.
+
+        On failure the batch goes back to the front of the buffer for the next
+        attempt (and, in spool mode, stays on disk until it lands).
+        """
+        with self._flush_lock:
+            with self._lock:
+                batch, self._pending = self._pending, []
+                if batch and self.mode == "spool":
+                    self._spool_rotate()
+            if not batch:
+                return 0
+            started = time.perf_counter()
+            rows = batch if self.mode == "spool" else [_row(entry) for entry in batch]
+            try:
+                self._insert(rows)
+            except Exception as e:
+                with self._lock:
+                    self._pending[:0] = batch
+                    self._counts["failures"] += 1
+                print(f"Audit log flush failed, {len(batch)} entries kept for retry: {str(e)}")
+                return 0
+            for path in self._flushed_spools:
+                os.remove(path)
+            self._flushed_spools = []
+            with self._lock:
+                self._counts["written"] += len(rows)
+                self._counts["batches"] += 1
+                self._last_flush_ms = (time.perf_counter() - started) * 1000
+            return len(rows)
+
+    def _insert(self, rows: List[Dict[str, Any]]):
+        with self.engine.begin() as conn:
+            for offset in range(0, len(rows), self.max_batch):
+                conn.execute(insert(self.table), rows[offset:offset + self.max_batch])
+
+    # Spool files: <spool_path>.<pid> is appended to; a flush renames it to
+    # <spool_path>.<pid>.<n>.flushing and removes that once the rows are in
+
+    def _spool_append(self, rows: List[Dict[str, Any]]):
+        if self._spool is None:
+            self._spool = open(self.spool_path, "a", encoding="utf-8")
+        self._spool.write("".join(json.dumps(row, default=_json_default) + "\n" for row in rows))
+        self._spool.flush()
+
+    def _spool_rotate(self):
+        if self._spool is None:
+            return
+        self._spool.close()
+        self._spool = None
+        self._spool_seq += 1
+        path = f"{self.spool_path}.{self._spool_seq}.flushing"
+        os.replace(self.spool_path, path)
+        self._flushed_spools.append(path)
+
+    def _replay_spools(self, spool_path: str):
+        """Insert the entries left in the spools of processes that are gone (our pid's is from a previous life)."""
+        base = os.path.abspath(spool_path)
+        paths = []
+        for path in sorted(glob.glob(f"{glob.escape(base)}.*")):
+            pid = path[len(base) + 1:].split(".")[0]
+            if pid.isdigit() and (int(pid) == os.getpid() or not _pid_alive(int(pid))):
+                paths.append(path)
+        rows = []
+        for path in paths:
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        row = json.loads(line)
+                    except ValueError:
+                        continue  # a line torn by the crash
+                    row["created_at"] = datetime.fromisoformat(row["created_at"])
+                    rows.append(row)
+        if rows:
+            self._insert(rows)
+            self._counts["replayed"] += len(rows)
+        for path in paths:
+            os.remove(path)
+
+    def close(self):
+        """Flush what is pending and stop the background thread."""
+        with self._lock:
+            self._stopping = True
+            self._wake.notify()
+            thread = self._thread
+        if thread is not None:
+            thread.join()
+        self.flush()
+        if self._spool is not None:
+            self._spool.close()
+            self._spool = None
+            if not self._pending and os.path.exists(self.spool_path) and not os.path.getsize(self.spool_path):
+                os.remove(self.spool_path)
+
+    def query(self, user_id: Optional[int] = None, entity: Optional[str] = None, entity_id: Optional[int] = None,
+              action: Optional[str] = None, actor_id: Optional[int] = None, before_id: Optional[int] = None,
+              limit: int = 100) -> List[Dict[str, Any]]:
+        """Entries newest first; page with before_id = the last id returned."""
+        t = self.table.c
+        conditions = []
+        for column, value in ((t.user_id, user_id), (t.entity, entity), (t.entity_id, entity_id),
+                              (t.action, action), (t.actor_id, actor_id)):
+            if value is not None:
+                conditions.append(column == value)
+        if before_id is not None:
+            conditions.append(t.id < before_id)
+        with self.engine.connect() as conn:
+            rows = conn.execute(
+                select(self.table).where(*conditions).order_by(t.id.desc()).limit(limit)
+            ).mappings().all()
+        entries = []
+        for row in rows:
+            before = json.loads(row["before"]) if row["before"] else None
+            after = json.loads(row["after"]) if row["after"] else None
+            changed = None
+            if row["action"] == "updated" and before is not None:
+                changed, after = sorted(after), {**before, **after}
+            entries.append({**row, "before": before, "after": after, "changed": changed,
+                            "created_at": row["created_at"].isoformat()})
+        return entries
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "mode": self.mode,
+                "pending": len(self._pending),
+                **self._counts,
+                "last_flush_ms": round(self._last_flush_ms, 2),
+            }
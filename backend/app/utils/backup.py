@@ -0,0 +1,408 @@
+"""Online backups that do not block writers, with incremental mode and timed restore.
+
+SQLite: the database is copied with the online backup API, `pages_per_step`
+pages at a time with `step_sleep` between steps. Each step holds only a read
+lock (in WAL mode writers are never blocked; in rollback-journal mode they
+wait for at most one step), and the copy is a consistent snapshot, unlike
+copying the file while a transaction commits. A write from another connection
+restarts the copy; after `max_restarts` restarts the rest is copied in one
+step, which in WAL mode still only holds a read transaction.
+
+Every backup gets the next number in the directory's change sequence.
+A full backup stores the database image. An incremental backup copies a
+snapshot the same way into a staging file and stores only the pages whose
+hash differs from the previous backup's (page hashes are kept next to each
+backup), so its size follows what changed, not the database size. Restore
+copies the full image and replays the incremental pages of the chain in
+order, checks the SHA-256 of the result against the manifest and runs
+PRAGMA integrity_check before it replaces the target. Stop the app first:
+the target's WAL is discarded.
+
+Postgres: a full backup streams `pg_dump --format=custom` to the file and
+restore runs `pg_restore --clean`. Incremental backups need WAL archiving
+there and are not supported.
+
+The attached archive database (SQLITE_ARCHIVE_PATH) and shard files are
+separate databases with their own backup directories.
+
+Configuration (.env):
+    BACKUP_ENABLED, BACKUP_DIR, BACKUP_PAGES_PER_STEP, BACKUP_STEP_SLEEP_MS,
+    BACKUP_MAX_RESTARTS, BACKUP_KEEP_FULL
+
+Command line:
+    python -m app.utils.backup backup [--incremental]
+    python -m app.utils.backup list | verify SEQ | restore SEQ [--target PATH]
+"""
+import argparse
+import glob
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import struct
+import subprocess
+import threading
+import time
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+from dotenv import load_dotenv
+from sqlalchemy.engine import make_url
+
+load_dotenv()
+
+FULL, INCREMENTAL = "full", "incremental"
+_PAGE_HEADER = struct.Struct(">I")
+_DELTA_HEADER = struct.Struct(">II")
+
+
+class BackupInProgress(Exception):
+    """Another backup or restore is running in this process."""
+
+
+class _TooManyRestarts(Exception):
+    pass
+
+
+def _sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as handle:
+        for block in iter(lambda: handle.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _page_size(path: str) -> int:
+    with open(path, "rb") as handle:
+        handle.seek(16)
+        size = struct.unpack(">H", handle.read(2))[0]
+    return 65536 if size == 1 else size
+
+
+def _page_hashes(path: str, page_size: int) -> np.ndarray:
+    """A 64-bit BLAKE2b hash per page of the database file."""
+    hashes = []
+    with open(path, "rb") as handle:
+        for page in iter(lambda: handle.read(page_size), b""):
+            hashes.append(int.from_bytes(hashlib.blake2b(page, digest_size=8).digest(), "big"))
+    return np.array(hashes, dtype=np.uint64)
+
+
+def _integrity(path: str) -> str:
+    conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        rows = conn.execute("PRAGMA integrity_check").fetchall()
+    finally:
+        conn.close()
+    return "; ".join(row[0] for row in rows)
+
+
+class BackupManager:
+    """Numbered backups of one database in `directory`."""
+
+    def __init__(self, database_url: str, directory: str, pages_per_step: int = 256, step_sleep: float = 0.005,
+                 max_restarts: int = 3, keep_full: int = 3):
+        self.url = make_url(database_url)
+        self.directory = directory
+        self.pages_per_step = pages_per_step
+        self.step_sleep = step_sleep
+        self.max_restarts = max_restarts
+        self.keep_full = keep_full
+        self._lock = threading.Lock()
+        if self.url.get_backend_name() not in ("sqlite", "postgresql"):
+            raise ValueError(f"Backups support SQLite and Postgres, not {self.url.get_backend_name()}")
+
+    @classmethod
+    def from_env(cls, database_url: str, name: Optional[str] = None) -> Optional["BackupManager"]:
+        if os.getenv("BACKUP_ENABLED", "true").lower() != "true":
+            return None
+        directory = os.path.abspath(os.getenv("BACKUP_DIR") or "./backups")
+        return cls(
+            database_url,
+            os.path.join(directory, name) if name else directory,
+            pages_per_step=int(os.getenv("BACKUP_PAGES_PER_STEP", "256")),
+            step_sleep=float(os.getenv("BACKUP_STEP_SLEEP_MS", "5")) / 1000,
+            max_restarts=int(os.getenv("BACKUP_MAX_RESTARTS", "3")),
+            keep_full=int(os.getenv("BACKUP_KEEP_FULL", "3")),
+        )
+
+    @property
+    def sqlite(self) -> bool:
+        return self.url.get_backend_name() == "sqlite"
+
+    @property
+    def database_path(self) -> str:
+        return os.path.abspath(self.url.database)
+
+    def _path(self, seq: int, suffix: str) -> str:
+        return os.path.join(self.directory, f"{seq:06d}{suffix}")
+
+    # Manifests ------------------------------------------------------------
+
+    def list(self) -> List[Dict[str, Any]]:
+        manifests = []
+        for path in sorted(glob.glob(os.path.join(self.directory, "[0-9]" * 6 + ".json"))):
+            with open(path) as handle:
+                manifests.append(json.load(handle))
+        return manifests
+
+    def get(self, seq: int) -> Optional[Dict[str, Any]]:
+        try:
+            with open(self._path(seq, ".json")) as handle:
+                return json.load(handle)
+        except FileNotFoundError:
+            return None
+
+    def _chain(self, seq: int) -> List[Dict[str, Any]]:
+        """The full backup and the incrementals leading up to `seq`, oldest first."""
+        chain = []
+        manifest = self.get(seq)
+        while manifest is not None:
+            chain.append(manifest)
+            if manifest["kind"] == FULL:
+                return list(reversed(chain))
+            manifest = self.get(manifest["parent"])
+        raise ValueError(f"Backup {seq} is missing or its chain is broken")
+
+    # Backup ---------------------------------------------------------------
+
+    def _snapshot(self, target: str) -> Dict[str, int]:
+        """Consistent copy of the database into `target` via the online backup API."""
+        source = sqlite3.connect(self.database_path, timeout=30)
+        stats = {"steps": 0, "restarts": 0, "single_step": 0}
+        last_remaining = None
+
+        def progress(status, remaining, total):
+            nonlocal last_remaining
+            stats["steps"] += 1
+            if last_remaining is not None and remaining > last_remaining:
+                stats["restarts"] += 1
+                if stats["restarts"] > self.max_restarts:
+                    raise _TooManyRestarts()
+            last_remaining = remaining
+
+        try:
+            destination = sqlite3.connect(target)
+            try:
+                try:
+                    source.backup(destination, pages=self.pages_per_step, progress=progress, sleep=self.step_sleep)
+                except _TooManyRestarts:
+                    # Writes keep restarting the stepped copy; finish in one step (one read transaction)
+                    stats["single_step"] = 1
+                    source.backup(destination, pages=-1)
+            finally:
+                destination.close()
+        finally:
+            source.close()
+        return stats
+
+    def backup(self, incremental: bool = False) -> Dict[str, Any]:
+        if not self._lock.acquire(blocking=False):
+            raise BackupInProgress("A backup or restore is already running")
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            previous = self.list()
+            seq = previous[-1]["seq"] + 1 if previous else 1
+            started = time.perf_counter()
+            if not self.sqlite:
+                if incremental:
+                    raise ValueError("Incremental backups need SQLite; use WAL archiving on Postgres")
+                manifest = self._pg_dump(seq)
+            elif incremental and previous:
+                manifest = self._incremental(seq, previous[-1])
+            else:
+                manifest = self._full(seq)
+            manifest.update(seq=seq, created_at=datetime.utcnow().isoformat(),
+                            seconds=round(time.perf_counter() - started, 3))
+            partial = self._path(seq, ".json.partial")
+            with open(partial, "w") as handle:
+                json.dump(manifest, handle)
+            # The manifest goes last: a backup without one never happened
+            os.replace(partial, self._path(seq, ".json"))
+            if manifest["kind"] == FULL:
+                self._prune()
+            return manifest
+        finally:
+            self._lock.release()
+
+    def _full(self, seq: int) -> Dict[str, Any]:
+        path = self._path(seq, ".sqlite")
+        stats = self._snapshot(f"{path}.partial")
+        page_size = _page_size(f"{path}.partial")
+        hashes = _page_hashes(f"{path}.partial", page_size)
+        sha256 = _sha256(f"{path}.partial")
+        os.replace(f"{path}.partial", path)
+        hashes.tofile(self._path(seq, ".hashes"))
+        return {
+            "kind": FULL, "parent": None, "file": os.path.basename(path), "bytes": os.path.getsize(path),
+            "page_size": page_size, "page_count": len(hashes), "changed_pages": len(hashes), "sha256": sha256, **stats,
+        }
+
+    def _incremental(self, seq: int, parent: Dict[str, Any]) -> Dict[str, Any]:
+        staging = os.path.join(self.directory, ".staging.sqlite")
+        try:
+            stats = self._snapshot(staging)
+            page_size = _page_size(staging)
+            if page_size != parent["page_size"]:
+                raise ValueError("Page size changed since the last backup; take a full backup")
+            hashes = _page_hashes(staging, page_size)
+            old = np.fromfile(self._path(parent["seq"], ".hashes"), dtype=np.uint64)
+            shared = min(len(old), len(hashes))
+            changed = np.concatenate([np.flatnonzero(hashes[:shared] != old[:shared]), np.arange(shared, len(hashes))])
+            path = self._path(seq, ".pages.gz")
+            with open(staging, "rb") as image, gzip.open(f"{path}.partial", "wb", compresslevel=1) as delta:
+                delta.write(_DELTA_HEADER.pack(page_size, len(hashes)))
+                for page in changed.tolist():
+                    image.seek(page * page_size)
+                    delta.write(_PAGE_HEADER.pack(page))
+                    delta.write(image.read(page_size))
+            sha256 = _sha256(staging)
+            os.replace(f"{path}.partial", path)
+            hashes.tofile(self._path(seq, ".hashes"))
+        finally:
+            if os.path.exists(staging):
+                os.remove(staging)
+        return {
+            "kind": INCREMENTAL, "parent": parent["seq"], "file": os.path.basename(path), "bytes": os.path.getsize(path),
+            "page_size": page_size, "page_count": len(hashes), "changed_pages": len(changed), "sha256": sha256, **stats,
+        }
+
+    def _libpq_url(self) -> str:
+        return self.url.set(drivername="postgresql").render_as_string(hide_password=False)
+
+    def _pg_dump(self, seq: int) -> Dict[str, Any]:
+        path = self._path(seq, ".dump")
+        # pg_dump streams straight to the file from one repeatable-read snapshot
+        subprocess.run(["pg_dump", "--format=custom", "--no-owner", f"--file={path}.partial", self._libpq_url()],
+                       check=True)
+        sha256 = _sha256(f"{path}.partial")
+        os.replace(f"{path}.partial", path)
+        return {"kind": FULL, "parent": None, "file": os.path.basename(path), "bytes": os.path.getsize(path),
+                "sha256": sha256}
+
+    def _prune(self):
+        """Drop the chains older than the newest `keep_full` full backups."""
+        fulls = [m["seq"] for m in self.list() if m["kind"] == FULL]
+        if len(fulls) <= self.keep_full:
+            return
+        oldest_kept = fulls[-self.keep_full]
+        for manifest in self.list():
+            if manifest["seq"] < oldest_kept:
+                os.remove(self._path(manifest["seq"], ".json"))
+                for suffix in (".sqlite", ".pages.gz", ".hashes", ".dump"):
+                    if os.path.exists(self._path(manifest["seq"], suffix)):
+                        os.remove(self._path(manifest["seq"], suffix))
+
+    # Restore --------------------------------------------------------------
+
+    def _materialise(self, seq: int, target: str) -> Dict[str, Any]:
+        """Rebuild backup `seq` as a database file at `target` and check it."""
+        chain = self._chain(seq)
+        started = time.perf_counter()
+        shutil.copyfile(os.path.join(self.directory, chain[0]["file"]), target)
+        pages = 0
+        with open(target, "r+b") as image:
+            for manifest in chain[1:]:
+                with gzip.open(os.path.join(self.directory, manifest["file"]), "rb") as delta:
+                    page_size, page_count = _DELTA_HEADER.unpack(delta.read(_DELTA_HEADER.size))
+                    while header := delta.read(_PAGE_HEADER.size):
+                        image.seek(_PAGE_HEADER.unpack(header)[0] * page_size)
+                        image.write(delta.read(page_size))
+                        pages += 1
+                image.truncate(page_count * page_size)
+        applied = time.perf_counter()
+        sha256_ok = _sha256(target) == chain[-1]["sha256"]
+        integrity = _integrity(target) if sha256_ok else "skipped: checksum mismatch"
+        return {
+            "seq": seq,
+            "ok": sha256_ok and integrity == "ok",
+            "sha256_match": sha256_ok,
+            "integrity": integrity,
+            "chain": [m["seq"] for m in chain],
+            "pages_applied": pages,
+            "apply_seconds": round(applied - started, 3),
+            "check_seconds": round(time.perf_counter() - applied, 3),
+        }
+
+    def verify(self, seq: int) -> Dict[str, Any]:
+        """Restore `seq` into a scratch file and check its checksum and integrity."""
+        manifest = self.get(seq)
+        if manifest is None:
+            raise ValueError(f"Backup {seq} not found")
+        if not self.sqlite:
+            listed = subprocess.run(["pg_restore", "--list", os.path.join(self.directory, manifest["file"])],
+                                    capture_output=True)
+            sha256_ok = _sha256(os.path.join(self.directory, manifest["file"])) == manifest["sha256"]
+            return {"seq": seq, "ok": sha256_ok and listed.returncode == 0, "sha256_match": sha256_ok,
+                    "integrity": listed.stderr.decode().strip() or "ok"}
+        scratch = os.path.join(self.directory, ".verify.sqlite")
+        try:
+            return self._materialise(seq, scratch)
+        finally:
+            if os.path.exists(scratch):
+                os.remove(scratch)
+
+    def restore(self, seq: int, target: Optional[str] = None) -> Dict[str, Any]:
+        """Replace `target` (default: the database itself) with backup `seq`. Stop the app first."""
+        if not self._lock.acquire(blocking=False):
+            raise BackupInProgress("A backup or restore is already running")
+        try:
+            started = time.perf_counter()
+            manifest = self.get(seq)
+            if manifest is None:
+                raise ValueError(f"Backup {seq} not found")
+            if not self.sqlite:
+                subprocess.run(["pg_restore", "--clean", "--if-exists", "--no-owner", f"--dbname={self._libpq_url()}",
+                                os.path.join(self.directory, manifest["file"])], check=True)
+                return {"seq": seq, "ok": True, "seconds": round(time.perf_counter() - started, 3)}
+            target = os.path.abspath(target or self.database_path)
+            staging = f"{target}.restoring"
+            result = self._materialise(seq, staging)
+            if not result["ok"]:
+                os.remove(staging)
+                raise ValueError(f"Backup {seq} failed verification: {result['integrity']}")
+            # A WAL left from the old file would be replayed over the restored one
+            for suffix in ("-wal", "-shm"):
+                if os.path.exists(target + suffix):
+                    os.remove(target + suffix)
+            os.replace(staging, target)
+            return {**result, "target": target, "seconds": round(time.perf_counter() - started, 3)}
+        finally:
+            self._lock.release()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Online database backups")
+    parser.add_argument("--database-url", default=os.getenv("DATABASE_URL", "sqlite:///./finance_app.db"))
+    sub = parser.add_subparsers(dest="command", required=True)
+    backup = sub.add_parser("backup", help="take a backup while the app keeps running")
+    backup.add_argument("--incremental", action="store_true", help="only the pages changed since the last backup")
+    sub.add_parser("list", help="list backups")
+    verify = sub.add_parser("verify", help="restore into a scratch file and check it")
+    verify.add_argument("seq", type=int)
+    restore = sub.add_parser("restore", help="replace the database with a backup (stop the app first)")
+    restore.add_argument("seq", type=int)
+    restore.add_argument("--target", default=None, help="restore to this file instead of the database")
+    args = parser.parse_args()
+
+    manager = BackupManager.from_env(args.database_url)
+    if manager is None:
+        parser.error("BACKUP_ENABLED is false")
+    if args.command == "backup":
+        print(json.dumps(manager.backup(args.incremental)))
+    elif args.command == "list":
+        for manifest in manager.list():
+            print(f"{manifest['seq']:6d}  {manifest['kind']:<11}  {manifest['created_at']}  {manifest['bytes']:>12,} bytes")
+    elif args.command == "verify":
+        result = manager.verify(args.seq)
+        print(json.dumps(result))
+        raise SystemExit(0 if result["ok"] else 1)
+    else:
+        print(json.dumps(manager.restore(args.seq, args.target)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+import itertools
+import os
+import threading
+import time
+from typing import Dict, List, Optional
+
+from dotenv import load_dotenv
+from sqlalchemy import create_engine, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.orm import Session, sessionmaker
+
+from .sqlite_profile import apply_sqlite_profile
+
+load_dotenv()
+
+
+class ReplicaRouter:
+    """Route read-only sessions to replicas and keep writes on the primary.
+
+    A user who has just committed a write is pinned to the primary for
+    `sticky_seconds` so they always read their own writes, regardless of
+    replication lag. Replicas that fail their first round trip are taken out of
+    rotation for `retry_after` seconds and the read falls back to the next
+    replica, and finally to the primary.
+
+    The sticky window is tracked per process; with several workers it only
+    holds if the load balancer keeps a user on one worker, or if the window is
+    at least as long as the worst replication lag.
+    """
+
+    def __init__(
+        self,
+        primary: Engine,
+        replicas: Optional[List[Engine]] = None,
+        sticky_seconds: float = 5.0,
+        retry_after: float = 30.0,
+        session_factory: Optional[sessionmaker] = None,
+    ):
+        self.primary = primary
+        self.replicas = replicas or []
+        self.sticky_seconds = sticky_seconds
+        self.retry_after = retry_after
+        self._primary_sessions = session_factory or sessionmaker(autocommit=False, autoflush=False, bind=primary)
+        self._replica_sessions = {
+            replica: sessionmaker(autocommit=False, autoflush=False, bind=replica)
+            for replica in self.replicas
+        }
+        self._recent_writes: Dict[int, float] = {}
+        self._down_until: Dict[Engine, float] = {}
+        self._rotation = itertools.cycle(range(len(self.replicas))) if self.replicas else None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls, primary: Engine, session_factory: Optional[sessionmaker] = None, **engine_kwargs) -> "ReplicaRouter":
+        """Build a router from DATABASE_REPLICA_URLS (comma-separated)."""
+        urls = [url.strip() for url in os.getenv("DATABASE_REPLICA_URLS", "").split(",") if url.strip()]
+        replicas = []
+        for url in urls:
+            replica = create_engine(url, pool_pre_ping=True, **engine_kwargs)
+            apply_sqlite_profile(replica)
+            replicas.append(replica)
+        return cls(
+            primary,
+            replicas,
+            sticky_seconds=float(os.getenv("READ_YOUR_WRITES_SECONDS", "5")),
+            retry_after=float(os.getenv("REPLICA_RETRY_SECONDS", "30")),
+            session_factory=session_factory,
+        )
+
+    def mark_write(self, user_id: int):
+        """Pin a user to the primary for the sticky window after a commit."""
+        if not self.replicas:
+            return
+        now = time.monotonic()
+        with self._lock:
+            self._recent_writes[user_id] = now + self.sticky_seconds
+            if len(self._recent_writes) > 10000:
+                self._recent_writes = {uid: until for uid, until in self._recent_writes.items() if until > now}
+
+    def is_sticky(self, user_id: Optional[int]) -> bool:
+        if user_id is None:
+            return False
+        with self._lock:
+            until = self._recent_writes.get(user_id)
+        return until is not None and until > time.monotonic()
+
+    def mark_down(self, replica: Engine):
+        """Take a replica out of rotation for the retry window."""
+        with self._lock:
+            self._down_until[replica] = time.monotonic() + self.retry_after
+
+    def _healthy_replicas(self) -> List[Engine]:
+        now = time.monotonic()
+        with self._lock:
+            start = next(self._rotation)
+            ordered = self.replicas[start:] + self.replicas[:start]
+            return [replica for replica in ordered if self._down_until.get(replica, 0) <= now]
+
+    def write_session(self) -> Session:
+        return self._primary_sessions()
+
+    def read_session(self, user_id: Optional[int] = None) -> Session:
+        """Open a session for a read-only request.
+
+        The replica connection is checked out eagerly so a dead replica is
+        detected here, not halfway through the handler.
+        """
+        if not self.replicas or self.is_sticky(user_id):
+            return self._primary_sessions()
+        for replica in self._healthy_replicas():
+            session = self._replica_sessions[replica]()
+            try:
+                session.execute(text("SELECT 1"))
+                session.info["replica"] = True
+                return session
+            except DBAPIError:
+                session.close()
+                self.mark_down(replica)
+        return self._primary_sessions()
@@ -0,0 +1,254 @@
+import asyncio
+import json
+import os
+import queue
+import select
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from typing import Any, Callable, Dict, List, Optional, Set
+
+
+class LocalBackend:
+    """Single-process fan-out: published events are delivered straight back."""
+
+    def start(self, deliver: Callable[[dict], None]):
+        self._deliver = deliver
+
+    def publish(self, event: dict):
+        self._deliver(event)
+
+    def close(self):
+        pass
+
+
+class PostgresNotifyBackend:
+    """Cross-worker fan-out over Postgres LISTEN/NOTIFY.
+
+    Every worker LISTENs on `channel` and receives every event, including its
+    own, so each worker's resume history is complete. Publishing happens on a
+    background thread so a commit never waits on the NOTIFY round trip.
+    NOTIFY payloads are limited to 8000 bytes, which the compact deltas stay
+    well under.
+    """
+
+    def __init__(self, dsn: str, channel: str = "finance_events"):
+        # libpq does not understand SQLAlchemy's driver suffix
+        self.dsn = dsn.replace("postgresql+psycopg2://", "postgresql://")
+        self.channel = channel
+        self._outbox: "queue.Queue[Optional[dict]]" = queue.Queue()
+        self._stopping = threading.Event()
+
+    def start(self, deliver: Callable[[dict], None]):
+        self._deliver = deliver
+        threading.Thread(target=self._listen, name="events-listen", daemon=True).start()
+        threading.Thread(target=self._publish_loop, name="events-notify", daemon=True).start()
+
+    def _connect(self):
+        import psycopg2
+
+        conn = psycopg2.connect(self.dsn)
+        conn.autocommit = True
+        return conn
+
+    def _listen(self):
+        while not self._stopping.is_set():
+            try:
+                conn = self._connect()
+                with conn.cursor() as cursor:
+                    cursor.execute(f"LISTEN {self.channel}")
+                while not self._stopping.is_set():
+                    if select.select([conn], [], [], 5.0) == ([], [], []):
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        notify = conn.notifies.pop(0)
+                        self._deliver(json.loads(notify.payload))
+            except Exception as e:
+                print(f"Event listener error, reconnecting: {str(e)}")
+                time.sleep(1.0)
+
+    def _publish_loop(self):
+        conn = None
+        while True:
+            event = self._outbox.get()
+            if event is None:
+                break
+            try:
+                if conn is None or conn.closed:
+                    conn = self._connect()
+                with conn.cursor() as cursor:
+                    cursor.execute("SELECT pg_notify(%s, %s)", (self.channel, json.dumps(event, separators=(",", ":"), default=str)))
+            except Exception as e:
+                print(f"Event publish failed: {str(e)}")
+                conn = None
+        if conn is not None:
+            conn.close()
+
+    def publish(self, event: dict):
+        self._outbox.put(event)
+
+    def close(self):
+        self._stopping.set()
+        self._outbox.put(None)
+
+
+class Subscription:
+    """One connected client: a bounded queue of events for one user."""
+
+    def __init__(self, user_id: int, max_queue: int):
+        self.user_id = user_id
+        self.queue: "asyncio.Queue[dict]" = asyncio.Queue(maxsize=max_queue)
+        self.overflowed = False
+
+    def offer(self, event: dict):
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            # A client this far behind refetches instead of receiving a backlog
+            self.overflowed = True
+            while not self.queue.empty():
+                self.queue.get_nowait()
+
+    async def next(self, timeout: float) -> Optional[dict]:
+        """The next event, a reset marker after an overflow, or None on timeout."""
+        if self.overflowed:
+            self.overflowed = False
+            return {"id": None, "type": "reset", "data": {}}
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+
+class EventBroker:
+    """Per-user change feed fanned out to SSE and WebSocket subscribers.
+
+    `publish` may be called from any thread (typically a session's
+    after_commit hook). Events go through the backend and come back through
+    `_deliver`, which hands them to the event loop; subscriber queues and the
+    per-user resume history are only touched on the loop thread.
+
+    Event ids are microsecond timestamps made strictly increasing per process,
+    so a client can resume with the last id it saw on any worker that shares
+    the backend. If the id is older than the retained history the client is
+    told to reset and refetch.
+
+    Functions registered with `on_remote_event` are called on the loop thread
+    with (user_id, event) for events published by other workers, so per-process
+    caches can follow writes made elsewhere (only with a shared backend).
+    """
+
+    def __init__(self, backend=None, history_size: int = 200, max_users: int = 10000,
+                 max_queue: int = 256, heartbeat: float = 15.0):
+        self.backend = backend or LocalBackend()
+        self.history_size = history_size
+        self.max_users = max_users
+        self.max_queue = max_queue
+        self.heartbeat = heartbeat
+        self._history: "OrderedDict[int, deque]" = OrderedDict()
+        self._subscribers: Dict[int, Set[Subscription]] = {}
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._last_id = 0
+        self._started_id = time.time_ns() // 1000
+        self._id_lock = threading.Lock()
+        self._origin = uuid.uuid4().hex
+        self._remote_listeners: List[Callable[[int, dict], None]] = []
+
+    @classmethod
+    def from_env(cls) -> "EventBroker":
+        backend = None
+        if os.getenv("EVENTS_BACKEND", "local").lower() == "postgres":
+            backend = PostgresNotifyBackend(
+                os.environ["EVENTS_BACKEND_URL"],
+                channel=os.getenv("EVENTS_CHANNEL", "finance_events"),
+            )
+        return cls(
+            backend=backend,
+            history_size=int(os.getenv("EVENTS_HISTORY_SIZE", "200")),
+            max_queue=int(os.getenv("EVENTS_QUEUE_SIZE", "256")),
+            heartbeat=float(os.getenv("EVENTS_HEARTBEAT_SECONDS", "15")),
+        )
+
+    def start(self, loop: asyncio.AbstractEventLoop):
+        self._loop = loop
+        self.backend.start(self._deliver)
+
+    def close(self):
+        self.backend.close()
+        self._loop = None
+
+    def _next_id(self) -> int:
+        with self._id_lock:
+            self._last_id = max(self._last_id + 1, time.time_ns() // 1000)
+            return self._last_id
+
+    def on_remote_event(self, listener: Callable[[int, dict], None]):
+        self._remote_listeners.append(listener)
+
+    def publish(self, user_id: int, events: List[Dict[str, Any]]):
+        """Publish committed changes as {"type": ..., "data": ...} deltas."""
+        if self._loop is None:
+            return
+        for event in events:
+            self.backend.publish({"id": self._next_id(), "user_id": user_id, "origin": self._origin, **event})
+
+    def _deliver(self, event: dict):
+        loop = self._loop
+        if loop is not None and not loop.is_closed():
+            loop.call_soon_threadsafe(self._fan_out, event)
+
+    def _fan_out(self, event: dict):
+        user_id = event.pop("user_id")
+        if event.pop("origin", self._origin) != self._origin:
+            for listener in self._remote_listeners:
+                try:
+                    listener(user_id, event)
+                except Exception as e:
+                    print(f"Remote event listener failed: {str(e)}")
+        history = self._history.get(user_id)
+        if history is None:
+            history = self._history[user_id] = deque(maxlen=self.history_size)
+            while len(self._history) > self.max_users:
+                self._history.popitem(last=False)
+        else:
+            self._history.move_to_end(user_id)
+        history.append(event)
+        for subscription in self._subscribers.get(user_id, ()):
+            subscription.offer(event)
+
+    def subscribe(self, user_id: int, last_event_id: Optional[int] = None) -> Subscription:
+        """Register a subscriber, queueing anything it missed after last_event_id."""
+        subscription = Subscription(user_id, self.max_queue)
+        if last_event_id is not None:
+            history = self._history.get(user_id, ())
+            if last_event_id < (history[0]["id"] if history else self._started_id):
+                # The last event the client saw is no longer retained (trimmed,
+                # evicted or from before a restart), so it may have missed some
+                subscription.overflowed = True
+            else:
+                for event in history:
+                    if event["id"] > last_event_id:
+                        subscription.offer(event)
+        self._subscribers.setdefault(user_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        subscribers = self._subscribers.get(subscription.user_id)
+        if subscribers is not None:
+            subscribers.discard(subscription)
+            if not subscribers:
+                del self._subscribers[subscription.user_id]
+
+    def connection_count(self) -> int:
+        return sum(len(s) for s in self._subscribers.values())
+
+
+def format_sse(event: dict) -> bytes:
+    lines = []
+    if event.get("id") is not None:
+        lines.append(f"id: {event['id']}")
+    lines.append(f"event: {event['type']}")
+    lines.append(f"data: {json.dumps(event.get('data', {}), separators=(',', ':'), default=str)}")
+    return ("\n".join(lines) + "\n\n").encode()
@@ -0,0 +1,114 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Any, Optional, Tuple
+
+from fastapi import HTTPException
+from sqlalchemy import delete
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+
+class IdempotencyStore:
+    """Idempotency-Key support for POST endpoints, backed by a DB table.
+
+    The key row is inserted in the same transaction as the write it protects,
+    and the table has a unique constraint on (user_id, key), so two workers
+    racing on the same key cannot both commit: the loser gets an
+    IntegrityError, rolls back and replays the winner's stored response.
+
+    `model` must have user_id, key, request_hash, response_body, created_at and
+    expires_at columns.
+    """
+
+    def __init__(self, model, ttl: timedelta = timedelta(hours=24), purge_interval: float = 600.0):
+        self.model = model
+        self.ttl = ttl
+        self.purge_interval = purge_interval
+        self._last_purge = float("-inf")
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls, model) -> "IdempotencyStore":
+        return cls(model, ttl=timedelta(hours=float(os.getenv("IDEMPOTENCY_TTL_HOURS", "24"))))
+
+    @staticmethod
+    def fingerprint(scope: str, payload: Any) -> str:
+        """Hash of the endpoint and canonicalised request body."""
+        body = json.dumps(payload, sort_keys=True, separators=(",", ":"), default=str)
+        return hashlib.sha256(f"{scope}\n{body}".encode()).hexdigest()
+
+    def _lookup(self, db: Session, user_id: int, key: str):
+        return db.query(self.model).filter(
+            self.model.user_id == user_id,
+            self.model.key == key
+        ).first()
+
+    def _replay(self, stored, request_hash: str) -> dict:
+        if stored.request_hash != request_hash:
+            raise HTTPException(
+                status_code=422,
+                detail="Idempotency-Key was already used with a different request"
+            )
+        return json.loads(stored.response_body)
+
+    def begin(self, db: Session, user_id: int, key: Optional[str], scope: str, payload: Any) -> Tuple[Optional[dict], Any]:
+        """Start an idempotent write.
+
+        Returns (stored_response, None) when the key was seen before, and
+        (None, reservation) for a first use; pass the reservation to `finish`
+        before committing. Without a key both are None and the caller proceeds
+        as usual.
+        """
+        if not key:
+            return None, None
+        if len(key) > 255:
+            raise HTTPException(status_code=400, detail="Idempotency-Key must be at most 255 characters")
+        self.maybe_purge(db)
+
+        request_hash = self.fingerprint(scope, payload)
+        now = datetime.utcnow()
+        stored = self._lookup(db, user_id, key)
+        if stored is not None:
+            if stored.expires_at > now:
+                return self._replay(stored, request_hash), None
+            db.delete(stored)
+            db.flush()
+
+        reservation = self.model(
+            user_id=user_id,
+            key=key,
+            request_hash=request_hash,
+            created_at=now,
+            expires_at=now + self.ttl,
+        )
+        db.add(reservation)
+        try:
+            db.flush()
+        except IntegrityError:
+            # Another worker committed the same key first
+            db.rollback()
+            stored = self._lookup(db, user_id, key)
+            if stored is None:
+                raise
+            return self._replay(stored, request_hash), None
+        return None, reservation
+
+    def finish(self, reservation, response: dict) -> dict:
+        """Attach the response to the reservation; it is committed with the write."""
+        if reservation is not None:
+            reservation.response_body = json.dumps(response, default=str)
+        return response
+
+    def maybe_purge(self, db: Session):
+        """Delete expired keys, at most once per purge interval per process."""
+        with self._lock:
+            if time.monotonic() - self._last_purge < self.purge_interval:
+                return
+            self._last_purge = time.monotonic()
+        bind = db.get_bind()
+        with bind.begin() as conn:
+            conn.execute(delete(self.model).where(self.model.expires_at <= datetime.utcnow()))
@@ -0,0 +1,348 @@
+"""Durable background jobs: a database job table, leases and a process pool.
+
+JobQueue is the table side. A job is enqueued as `queued`; a runner claims it
+by setting `running` together with a lease (owner and expiry) that it renews
+while the job runs. A runner that dies stops renewing, the lease expires and
+another runner claims the job again, up to `max_attempts` attempts in all.
+A job that raises is re-queued with exponential backoff on the same budget.
+
+Every claim is one conditional UPDATE, so runners in several processes can
+share the table. The same statement enforces the per-user cap: a job is only
+claimed while its user has fewer than `max_running_per_user` jobs holding a
+live lease. One heavy user therefore gets at most that many pool slots, and
+the rest stay free for everyone else. `max_pending_per_user` bounds how many
+unfinished jobs a user may have queued at all.
+
+JobRunner is the process side: a dispatcher thread that claims up to as many
+jobs as it has free slots in a bounded ProcessPoolExecutor, renews their
+leases, and records each result or error. Handlers run in spawned processes,
+so they must be importable module-level functions taking the job dict and
+returning a JSON-able result.
+"""
+import json
+import multiprocessing
+import os
+import socket
+import threading
+import time
+import uuid
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime, timedelta
+from functools import partial
+from typing import Any, Callable, Dict, List, Optional, Sequence
+
+from sqlalchemy import Table, and_, delete, func, insert, or_, select, update
+from sqlalchemy.engine import Engine
+
+QUEUED, RUNNING, SUCCEEDED, FAILED = "queued", "running", "succeeded", "failed"
+
+
+class JobLimitExceeded(Exception):
+    """The user already has `max_pending_per_user` unfinished jobs."""
+
+
+class JobQueue:
+    """Job rows in `jobs`: enqueue, claim under lease, renew, and finish."""
+
+    def __init__(self, engine: Engine, jobs: Table, lease_seconds: float = 60.0, max_attempts: int = 3,
+                 retry_seconds: float = 10.0, max_running_per_user: int = 1, max_pending_per_user: int = 5,
+                 retention_seconds: float = 86400.0):
+        self.engine = engine
+        self.jobs = jobs
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.retry_seconds = retry_seconds
+        self.max_running_per_user = max_running_per_user
+        self.max_pending_per_user = max_pending_per_user
+        self.retention_seconds = retention_seconds
+
+    @classmethod
+    def from_env(cls, engine: Engine, jobs: Table, prefix: str = "REPORTS") -> Optional["JobQueue"]:
+        if os.getenv(f"{prefix}_ENABLED", "true").lower() != "true":
+            return None
+        return cls(
+            engine,
+            jobs,
+            lease_seconds=float(os.getenv(f"{prefix}_LEASE_SECONDS", "60")),
+            max_attempts=int(os.getenv(f"{prefix}_MAX_ATTEMPTS", "3")),
+            retry_seconds=float(os.getenv(f"{prefix}_RETRY_SECONDS", "10")),
+            max_running_per_user=int(os.getenv(f"{prefix}_MAX_RUNNING_PER_USER", "1")),
+            max_pending_per_user=int(os.getenv(f"{prefix}_MAX_PENDING_PER_USER", "5")),
+            retention_seconds=float(os.getenv(f"{prefix}_RETENTION_HOURS", "24")) * 3600,
+        )
+
+    def enqueue(self, user_id: int, kind: str, params: Dict[str, Any]) -> Dict[str, Any]:
+        j = self.jobs.c
+        now = datetime.utcnow()
+        row = {
+            "id": uuid.uuid4().hex,
+            "user_id": user_id,
+            "kind": kind,
+            "params": json.dumps(params, sort_keys=True),
+            "status": QUEUED,
+            "attempts": 0,
+            "available_at": now,
+            "created_at": now,
+        }
+        with self.engine.begin() as conn:
+            pending = conn.execute(
+                select(func.count()).where(j.user_id == user_id, j.status.in_([QUEUED, RUNNING]))
+            ).scalar_one()
+            if pending >= self.max_pending_per_user:
+                raise JobLimitExceeded(f"At most {self.max_pending_per_user} unfinished jobs per user")
+            conn.execute(insert(self.jobs).values(**row))
+        return {**row, "params": params}
+
+    def get(self, job_id: str, user_id: Optional[int] = None) -> Optional[Dict[str, Any]]:
+        j = self.jobs.c
+        conditions = [j.id == job_id] if user_id is None else [j.id == job_id, j.user_id == user_id]
+        with self.engine.connect() as conn:
+            row = conn.execute(select(self.jobs).where(*conditions)).mappings().first()
+        return self._as_job(row) if row is not None else None
+
+    def list(self, user_id: int, limit: int = 50) -> List[Dict[str, Any]]:
+        j = self.jobs.c
+        with self.engine.connect() as conn:
+            rows = conn.execute(
+                select(self.jobs).where(j.user_id == user_id).order_by(j.created_at.desc()).limit(limit)
+            ).mappings().all()
+        return [self._as_job(row) for row in rows]
+
+    @staticmethod
+    def _as_job(row) -> Dict[str, Any]:
+        job = dict(row)
+        job["params"] = json.loads(job["params"] or "{}")
+        return job
+
+    # Runner side ----------------------------------------------------------
+
+    def claim(self, owner: str, limit: int) -> List[Dict[str, Any]]:
+        """Lease up to `limit` runnable jobs to `owner`, oldest first, within the per-user cap."""
+        if limit <= 0:
+            return []
+        j = self.jobs.c
+        now = datetime.utcnow()
+        expired = and_(j.status == RUNNING, j.lease_expires_at <= now)
+        runnable = or_(and_(j.status == QUEUED, j.available_at <= now), expired)
+        with self.engine.begin() as conn:
+            # A lease that expired on the last attempt ends the job instead of running it again
+            conn.execute(
+                update(self.jobs).where(expired, j.attempts >= self.max_attempts)
+                .values(status=FAILED, finished_at=now, lease_owner=None,
+                        error=f"Lease expired on attempt {self.max_attempts}")
+            )
+        with self.engine.connect() as conn:
+            candidates = conn.execute(
+                select(j.id).where(runnable).order_by(j.available_at).limit(max(limit * 4, 32))
+            ).scalars().all()
+
+        others = self.jobs.alias("running_jobs")
+        running = (
+            select(func.count())
+            .where(others.c.user_id == j.user_id, others.c.status == RUNNING, others.c.lease_expires_at > now)
+            .scalar_subquery()
+        )
+        claimed = []
+        for job_id in candidates:
+            with self.engine.begin() as conn:
+                # Claim and per-user cap in one statement, so concurrent runners cannot both win
+                result = conn.execute(
+                    update(self.jobs)
+                    .where(j.id == job_id, runnable, running < self.max_running_per_user)
+                    .values(status=RUNNING, lease_owner=owner, attempts=j.attempts + 1, started_at=now,
+                            lease_expires_at=now + timedelta(seconds=self.lease_seconds))
+                )
+            if result.rowcount:
+                claimed.append(job_id)
+                if len(claimed) >= limit:
+                    break
+        return [job for job in (self.get(job_id) for job_id in claimed) if job is not None]
+
+    def renew(self, owner: str, job_ids: Sequence[str]):
+        if not job_ids:
+            return
+        j = self.jobs.c
+        with self.engine.begin() as conn:
+            conn.execute(
+                update(self.jobs)
+                .where(j.id.in_(list(job_ids)), j.lease_owner == owner, j.status == RUNNING)
+                .values(lease_expires_at=datetime.utcnow() + timedelta(seconds=self.lease_seconds))
+            )
+
+    def succeed(self, job_id: str, owner: str, result: Dict[str, Any]) -> bool:
+        """Record the result; False if the lease was lost and another runner owns the job now."""
+        j = self.jobs.c
+        with self.engine.begin() as conn:
+            updated = conn.execute(
+                update(self.jobs)
+                .where(j.id == job_id, j.lease_owner == owner, j.status == RUNNING)
+                .values(status=SUCCEEDED, finished_at=datetime.utcnow(), lease_owner=None, error=None,
+                        result=json.dumps(result))
+            ).rowcount
+        return bool(updated)
+
+    def fail(self, job_id: str, owner: str, error: str) -> bool:
+        """Re-queue with backoff while attempts remain, else mark failed; False if the lease was lost."""
+        j = self.jobs.c
+        now = datetime.utcnow()
+        with self.engine.begin() as conn:
+            attempts = conn.execute(
+                select(j.attempts).where(j.id == job_id, j.lease_owner == owner, j.status == RUNNING)
+            ).scalar()
+            if attempts is None:
+                return False
+            if attempts >= self.max_attempts:
+                values = {"status": FAILED, "finished_at": now}
+            else:
+                delay = self.retry_seconds * 2 ** (attempts - 1)
+                values = {"status": QUEUED, "available_at": now + timedelta(seconds=delay)}
+            conn.execute(
+                update(self.jobs).where(j.id == job_id, j.lease_owner == owner)
+                .values(lease_owner=None, lease_expires_at=None, error=error[:2000], **values)
+            )
+        return True
+
+    def purge(self, remove: Optional[Callable[[Dict[str, Any]], None]] = None) -> int:
+        """Delete finished jobs older than the retention period, calling `remove` on each first."""
+        j = self.jobs.c
+        cutoff = datetime.utcnow() - timedelta(seconds=self.retention_seconds)
+        finished = and_(j.status.in_([SUCCEEDED, FAILED]), j.finished_at < cutoff)
+        with self.engine.begin() as conn:
+            rows = conn.execute(select(self.jobs).where(finished)).mappings().all()
+            for row in rows:
+                if remove is not None:
+                    remove(self._as_job(row))
+            if rows:
+                conn.execute(delete(self.jobs).where(j.id.in_([row["id"] for row in rows])))
+        return len(rows)
+
+
+class JobRunner:
+    """Claims jobs from a JobQueue into a bounded process pool and records the outcomes."""
+
+    def __init__(self, queue: JobQueue, handler: Callable[[Dict[str, Any]], Dict[str, Any]], workers: int = 1,
+                 poll_seconds: float = 2.0, initializer: Optional[Callable] = None, initargs: tuple = (),
+                 on_purge: Optional[Callable[[Dict[str, Any]], None]] = None, purge_seconds: float = 3600.0):
+        self.queue = queue
+        self.handler = handler
+        self.workers = workers
+        self.poll_seconds = poll_seconds
+        self.initializer = initializer
+        self.initargs = initargs
+        self.on_purge = on_purge
+        self.purge_seconds = purge_seconds
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._inflight: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._thread: Optional[threading.Thread] = None
+        self.completed = 0
+        self.failed = 0
+
+    @classmethod
+    def from_env(cls, queue: Optional[JobQueue], handler: Callable, prefix: str = "REPORTS", **kwargs) -> Optional["JobRunner"]:
+        """None when the queue is disabled or this process only enqueues ({prefix}_RUNNER, false by default)."""
+        if queue is None or os.getenv(f"{prefix}_RUNNER", "false").lower() != "true":
+            return None
+        workers = int(os.getenv(f"{prefix}_WORKERS") or max(1, (os.cpu_count() or 2) // 2))
+        return cls(queue, handler, workers=workers, poll_seconds=float(os.getenv(f"{prefix}_POLL_SECONDS", "2")), **kwargs)
+
+    def _new_pool(self) -> ProcessPoolExecutor:
+        # Spawned, not forked: the parent has live threads and database connections
+        return ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"),
+                                   initializer=self.initializer, initargs=self.initargs)
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._pool = self._new_pool()
+        self._thread = threading.Thread(target=self._loop, name="job-runner", daemon=True)
+        self._thread.start()
+
+    def wake(self):
+        """Claim now rather than at the next poll, e.g. right after an enqueue."""
+        self._wake.set()
+
+    def close(self):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+        if self._pool is not None:
+            # Unfinished jobs keep their lease until it expires, then another runner retries them,
+            # so the worker processes are stopped rather than left running past the server
+            processes = list((self._pool._processes or {}).values())
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            for process in processes:
+                process.terminate()
+            for process in processes:
+                process.join(timeout=5)
+
+    def run_forever(self):
+        """Foreground loop for a dedicated worker process."""
+        self._pool = self._new_pool()
+        try:
+            self._loop()
+        finally:
+            self._pool.shutdown(wait=True)
+
+    def _loop(self):
+        next_renew = next_purge = 0.0
+        while not self._stop.is_set():
+            try:
+                now = time.monotonic()
+                with self._lock:
+                    free = self.workers - len(self._inflight)
+                    inflight = list(self._inflight)
+                if inflight and now >= next_renew:
+                    self.queue.renew(self.owner, inflight)
+                    next_renew = now + self.queue.lease_seconds / 3
+                if free > 0:
+                    for job in self.queue.claim(self.owner, free):
+                        self._submit(job)
+                    next_renew = min(next_renew, now + self.queue.lease_seconds / 3)
+                if now >= next_purge:
+                    self.queue.purge(self.on_purge)
+                    next_purge = now + self.purge_seconds
+            except Exception as e:
+                print(f"Job runner error: {str(e)}")
+            self._wake.wait(self.poll_seconds)
+            self._wake.clear()
+
+    def _submit(self, job: Dict[str, Any]):
+        try:
+            future = self._pool.submit(self.handler, job)
+        except BrokenProcessPool:
+            # A worker process died (e.g. killed for memory); the pool is unusable, so replace it
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = self._new_pool()
+            future = self._pool.submit(self.handler, job)
+        with self._lock:
+            self._inflight[job["id"]] = future
+        future.add_done_callback(partial(self._finished, job["id"]))
+
+    def _finished(self, job_id: str, future: Future):
+        with self._lock:
+            self._inflight.pop(job_id, None)
+        if future.cancelled() or self._stop.is_set():
+            return
+        try:
+            error = future.exception()
+            if error is None:
+                self.queue.succeed(job_id, self.owner, future.result())
+                self.completed += 1
+            else:
+                self.queue.fail(job_id, self.owner, f"{type(error).__name__}: {error}")
+                self.failed += 1
+        except Exception as e:
+            print(f"Job {job_id} outcome not recorded: {str(e)}")
+        self._wake.set()
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            running = len(self._inflight)
+        return {"owner": self.owner, "workers": self.workers, "running": running,
+                "completed": self.completed, "failed": self.failed}
@@ -0,0 +1,418 @@
+"""Time-partitioned storage for the transactions table.
+
+Postgres: declarative RANGE partitioning on `date`, by month or by year. The
+planner prunes partitions by itself as long as queries filter on the raw
+`date` column, which search_transactions does.
+
+SQLite: cold years are moved out of the live table into per-year tables in an
+attached archive database (`archive.transactions_<year>`). TransactionPartitions
+knows which years are archived and builds a query source that only includes
+the archive tables overlapping the requested date range.
+
+Command line:
+    python -m app.utils.partitioning archive --before-year 2023
+    python -m app.utils.partitioning restore --year 2021
+    python -m app.utils.partitioning postgres-convert --granularity month
+    python -m app.utils.partitioning postgres-ensure --granularity month --months-ahead 3
+"""
+import argparse
+import os
+import threading
+import time
+from datetime import date, datetime
+from typing import Dict, List, Optional, Tuple
+
+from dotenv import load_dotenv
+from sqlalchemy import Column, Index, MetaData, Table, create_engine, event, func, inspect, select, text, union_all
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.orm import aliased
+from sqlalchemy.schema import CreateTable
+
+load_dotenv()
+
+ARCHIVE_SCHEMA = "archive"
+
+
+def attach_sqlite_archive(engine: Engine, path: Optional[str] = None) -> Optional[str]:
+    """Attach the archive database file on every new SQLite connection.
+
+    Uses SQLITE_ARCHIVE_PATH when no path is given; returns None (and attaches
+    nothing) when archiving is not configured or the engine is not SQLite.
+    """
+    path = path or os.getenv("SQLITE_ARCHIVE_PATH")
+    if not path or engine.dialect.name != "sqlite":
+        return None
+
+    @event.listens_for(engine, "connect")
+    def _attach_archive(dbapi_connection, connection_record):
+        dbapi_connection.execute(f"ATTACH DATABASE '{path}' AS {ARCHIVE_SCHEMA}")
+
+    return path
+
+
+def archive_table_name(year: int) -> str:
+    return f"transactions_{year}"
+
+
+def archive_table(source: Table, year: int, metadata: Optional[MetaData] = None) -> Table:
+    """Per-year archive table with the same columns as `source`, minus foreign keys."""
+    metadata = metadata or MetaData()
+    name = archive_table_name(year)
+    key = f"{ARCHIVE_SCHEMA}.{name}"
+    if key in metadata.tables:
+        return metadata.tables[key]
+    table = Table(
+        name,
+        metadata,
+        *[Column(c.name, c.type, primary_key=c.primary_key) for c in source.columns],
+        schema=ARCHIVE_SCHEMA,
+    )
+    Index(f"ix_{name}_user_date", table.c.user_id, table.c.date)
+    return table
+
+
+def archived_years(conn: Connection) -> List[int]:
+    """Years that currently have a table in the attached archive database."""
+    names = conn.exec_driver_sql(
+        f"SELECT name FROM {ARCHIVE_SCHEMA}.sqlite_master WHERE type = 'table' AND name LIKE 'transactions_%'"
+    ).scalars()
+    return sorted(int(name.rsplit("_", 1)[1]) for name in names if name.rsplit("_", 1)[1].isdigit())
+
+
+def add_missing_archive_columns(engine: Engine, source: Table) -> List[str]:
+    """Add columns that `source` gained after some years were archived.
+
+    Archive tables copy the live table's columns at the time they are created,
+    and the union in TransactionPartitions selects every current column, so a
+    schema change on the live table has to be applied to the archive too.
+    """
+    if engine.dialect.name != "sqlite" or not os.getenv("SQLITE_ARCHIVE_PATH"):
+        return []
+    added = []
+    with engine.begin() as conn:
+        for year in archived_years(conn):
+            name = archive_table_name(year)
+            existing = {row[1] for row in conn.exec_driver_sql(f"PRAGMA {ARCHIVE_SCHEMA}.table_info({name})")}
+            for column in source.columns:
+                if column.name not in existing:
+                    column_type = column.type.compile(dialect=engine.dialect)
+                    conn.exec_driver_sql(f"ALTER TABLE {ARCHIVE_SCHEMA}.{name} ADD COLUMN {column.name} {column_type}")
+                    added.append(f"{name}.{column.name}")
+    return added
+
+
+def ensure_sqlite_autoincrement(engine: Engine, source: Table) -> bool:
+    """Give the live table AUTOINCREMENT ids so archived ids are never handed out again.
+
+    Without AUTOINCREMENT SQLite reuses max(rowid) + 1, so once the newest
+    rows of a year are archived, a new transaction can get an archived row's
+    id, and tag links, audit entries and the UNION ALL read would mix the
+    two. A table created without it is rebuilt once (copy, drop, rename), and
+    sqlite_sequence is raised past every id in the archive. Returns True when
+    the table was rebuilt; does nothing unless archiving is configured.
+    """
+    if engine.dialect.name != "sqlite" or not os.getenv("SQLITE_ARCHIVE_PATH"):
+        return False
+    with engine.begin() as conn:
+        sql = conn.exec_driver_sql(
+            "SELECT sql FROM main.sqlite_master WHERE type = 'table' AND name = ?", (source.name,)
+        ).scalar()
+        rebuilt = sql is not None and "AUTOINCREMENT" not in sql.upper()
+        if rebuilt:
+            # Built under a temporary name in the same MetaData, so its foreign keys resolve
+            table = source.to_metadata(source.metadata, name=f"{source.name}_rebuild")
+            try:
+                table.dialect_kwargs["sqlite_autoincrement"] = True
+                conn.execute(CreateTable(table))
+                columns = ", ".join(c.name for c in table.columns)
+                conn.exec_driver_sql(f"INSERT INTO main.{table.name} ({columns}) SELECT {columns} FROM main.{source.name}")
+                conn.exec_driver_sql(f"DROP TABLE main.{source.name}")
+                conn.exec_driver_sql(f"ALTER TABLE main.{table.name} RENAME TO {source.name}")
+            finally:
+                source.metadata.remove(table)
+            # The old indexes went with the old table; recreate them under their own names
+            for index in source.indexes:
+                index.create(conn, checkfirst=True)
+        highest = max([conn.execute(select(func.max(source.c.id))).scalar() or 0] + [
+            conn.execute(select(func.max(archive_table(source, year).c.id))).scalar() or 0
+            for year in archived_years(conn)
+        ])
+        if highest:
+            current = conn.exec_driver_sql(
+                "SELECT seq FROM main.sqlite_sequence WHERE name = ?", (source.name,)
+            ).scalar()
+            if current is None:
+                conn.exec_driver_sql("INSERT INTO main.sqlite_sequence (name, seq) VALUES (?, ?)", (source.name, highest))
+            elif current < highest:
+                conn.exec_driver_sql("UPDATE main.sqlite_sequence SET seq = ? WHERE name = ?", (highest, source.name))
+    return rebuilt
+
+
+def archive_years_before(engine: Engine, source: Table, before_year: int, batch_years: Optional[List[int]] = None) -> Dict[int, int]:
+    """Move every transaction dated before `before_year` into per-year archive tables.
+
+    Each year is copied and deleted in its own transaction. With the default
+    rollback journal the attached databases commit atomically; in WAL mode
+    SQLite only guarantees atomicity per file, so a crash between the two can
+    leave a year in both places. Re-running is safe: rows already in the
+    archive are skipped by primary key before the live copy is deleted.
+    The live table is switched to AUTOINCREMENT first, so archived ids stay
+    unique (see ensure_sqlite_autoincrement).
+    """
+    ensure_sqlite_autoincrement(engine, source)
+    with engine.connect() as conn:
+        years = batch_years or [
+            int(year)
+            for (year,) in conn.execute(
+                select(func.strftime("%Y", source.c.date).label("year"))
+                .where(source.c.date < datetime(before_year, 1, 1))
+                .group_by(text("year"))
+            )
+            if year is not None
+        ]
+
+    moved = {}
+    metadata = MetaData()
+    for year in sorted(years):
+        table = archive_table(source, year, metadata)
+        start, end = datetime(year, 1, 1), datetime(year + 1, 1, 1)
+        columns = [c.name for c in source.columns]
+        with engine.begin() as conn:
+            table.create(conn, checkfirst=True)
+            conn.execute(
+                table.insert().from_select(
+                    columns,
+                    select(*source.columns)
+                    .where(source.c.date >= start, source.c.date < end)
+                    .where(source.c.id.not_in(select(table.c.id))),
+                )
+            )
+            result = conn.execute(source.delete().where(source.c.date >= start, source.c.date < end))
+            moved[year] = result.rowcount
+    return moved
+
+
+def restore_year(engine: Engine, source: Table, year: int) -> int:
+    """Move an archived year back into the live table and drop its archive table."""
+    table = archive_table(source, year)
+    with engine.begin() as conn:
+        conn.execute(source.insert().from_select([c.name for c in table.columns], select(*table.columns)))
+        count = conn.execute(select(func.count()).select_from(table)).scalar()
+        table.drop(conn)
+    return count
+
+
+def partition_union(source: Table, years: List[int], user_id: int, start: Optional[datetime] = None,
+                    end: Optional[datetime] = None, metadata: Optional[MetaData] = None):
+    """UNION ALL subquery of `source` and the given archive years, each branch restricted to the user and range."""
+    branches = []
+    for table in [source] + [archive_table(source, year, metadata) for year in years]:
+        branch = select(*[table.c[c.name] for c in source.columns]).where(table.c.user_id == user_id)
+        if start is not None:
+            branch = branch.where(table.c.date >= start)
+        if end is not None:
+            branch = branch.where(table.c.date <= end)
+        branches.append(branch)
+    return union_all(*branches).subquery("transactions")
+
+
+class TransactionPartitions:
+    """Partition-aware query source for the transactions model.
+
+    `model_for(user_id, start, end)` returns the mapped class itself when no
+    archived year overlaps the range (the common case: the query is unchanged
+    and only touches the live table), otherwise an aliased UNION ALL of the
+    live table and just the overlapping archive tables, each branch already
+    restricted to the user and the date range.
+    """
+
+    def __init__(self, engine: Engine, model, refresh_seconds: float = 60.0):
+        self.engine = engine
+        self.model = model
+        self.enabled = engine.dialect.name == "sqlite" and bool(os.getenv("SQLITE_ARCHIVE_PATH"))
+        self.refresh_seconds = refresh_seconds
+        self._metadata = MetaData()
+        self._years: List[int] = []
+        self._loaded_at = float("-inf")
+        self._lock = threading.Lock()
+
+    def years(self) -> List[int]:
+        if not self.enabled:
+            return []
+        with self._lock:
+            if time.monotonic() - self._loaded_at > self.refresh_seconds:
+                with self.engine.connect() as conn:
+                    self._years = archived_years(conn)
+                self._loaded_at = time.monotonic()
+            return self._years
+
+    def invalidate(self):
+        with self._lock:
+            self._loaded_at = float("-inf")
+
+    def years_for(self, start: Optional[datetime], end: Optional[datetime]) -> List[int]:
+        return [
+            year for year in self.years()
+            if (start is None or year >= start.year) and (end is None or year <= end.year)
+        ]
+
+    def tables_for(self, start: Optional[datetime] = None, end: Optional[datetime] = None) -> List[Table]:
+        """The live table plus the archive tables overlapping the range, for set-based writes."""
+        source = self.model.__table__
+        return [source] + [archive_table(source, year, self._metadata) for year in self.years_for(start, end)]
+
+    def unarchive(self, conn: Connection, user_id: int, row_id: int) -> bool:
+        """Move one of the user's archived rows back into the live table, in the caller's transaction.
+
+        Edits and deletes go through the ORM and its flush hooks on the live
+        table, so an archived row is pulled back first; a later archive run
+        moves it out again if it is still old enough. Returns False when no
+        archive year holds the row. Same caveat as archive_years_before: in
+        WAL mode a crash can leave the row in both files.
+        """
+        source = self.model.__table__
+        for table in self.tables_for()[1:]:
+            condition = (table.c.id == row_id) & (table.c.user_id == user_id)
+            moved = conn.execute(source.insert().from_select(
+                [c.name for c in source.columns], select(*[table.c[c.name] for c in source.columns]).where(condition)
+            )).rowcount
+            if moved:
+                conn.execute(table.delete().where(condition))
+                return True
+        return False
+
+    def archived_duplicate(self, conn: Connection, user_id: int, fingerprint: str, start: datetime,
+                           end: datetime) -> Optional[int]:
+        """Lowest id of an archived row with this fingerprint dated in [start, end] (via the user/date index)."""
+        ids = [
+            conn.execute(
+                select(func.min(table.c.id))
+                .where(table.c.user_id == user_id, table.c.date >= start, table.c.date <= end,
+                       table.c.fingerprint == fingerprint)
+            ).scalar()
+            for table in self.tables_for(start, end)[1:]
+        ]
+        ids = [row_id for row_id in ids if row_id is not None]
+        return min(ids) if ids else None
+
+    def model_for(self, user_id: int, start: Optional[datetime] = None, end: Optional[datetime] = None):
+        years = self.years_for(start, end)
+        if not years:
+            return self.model
+        union = partition_union(self.model.__table__, years, user_id, start, end, self._metadata)
+        return aliased(self.model, union, adapt_on_names=True)
+
+    def selectable_for(self, user_id: int, start: Optional[datetime] = None, end: Optional[datetime] = None):
+        """Core counterpart of model_for: the table itself or the union subquery."""
+        return inspect(self.model_for(user_id, start, end)).selectable
+
+
+def _month_floor(value: date) -> date:
+    return date(value.year, value.month, 1)
+
+
+def _add_months(value: date, months: int) -> date:
+    month = value.month - 1 + months
+    return date(value.year + month // 12, month % 12 + 1, 1)
+
+
+def partition_bounds(granularity: str, start: date, end: date) -> List[Tuple[str, date, date]]:
+    """(name, lower, upper) for each partition covering [start, end]."""
+    bounds = []
+    if granularity == "year":
+        for year in range(start.year, end.year + 1):
+            bounds.append((f"transactions_y{year}", date(year, 1, 1), date(year + 1, 1, 1)))
+    elif granularity == "month":
+        current = _month_floor(start)
+        while current <= end:
+            upper = _add_months(current, 1)
+            bounds.append((f"transactions_m{current.year}_{current.month:02d}", current, upper))
+            current = upper
+    else:
+        raise ValueError(f"Unknown partition granularity: {granularity}")
+    return bounds
+
+
+def ensure_postgres_partitions(conn: Connection, granularity: str, start: date, end: date, parent: str = "transactions") -> List[str]:
+    """Create any missing range partitions of `parent` covering [start, end]."""
+    existing = set(inspect(conn).get_table_names())
+    created = []
+    for name, lower, upper in partition_bounds(granularity, start, end):
+        if name in existing:
+            continue
+        conn.execute(text(
+            f"CREATE TABLE {name} PARTITION OF {parent} "
+            f"FOR VALUES FROM ('{lower.isoformat()}') TO ('{upper.isoformat()}')"
+        ))
+        created.append(name)
+    return created
+
+
+def convert_postgres_to_partitioned(engine: Engine, granularity: str, months_ahead: int = 3) -> int:
+    """Rebuild `transactions` as a table partitioned by RANGE (date).
+
+    The primary key of a partitioned table must contain the partition key, so
+    it becomes (id, date) and rows without a date take their created_at.
+    Ids keep coming from the original sequence, and dates outside the
+    created ranges land in the default partition.
+    """
+    with engine.begin() as conn:
+        lower, upper = conn.execute(text("SELECT min(date), max(date) FROM transactions")).one()
+        today = date.today()
+        lower = (lower.date() if lower else today)
+        upper = max(upper.date() if upper else today, _add_months(today, months_ahead))
+
+        conn.execute(text("UPDATE transactions SET date = COALESCE(created_at, now()) WHERE date IS NULL"))
+        conn.execute(text("ALTER TABLE transactions RENAME TO transactions_unpartitioned"))
+        conn.execute(text(
+            "CREATE TABLE transactions (LIKE transactions_unpartitioned INCLUDING DEFAULTS) "
+            "PARTITION BY RANGE (date)"
+        ))
+        conn.execute(text("ALTER TABLE transactions ADD PRIMARY KEY (id, date)"))
+        conn.execute(text("CREATE INDEX ix_transactions_user_date ON transactions (user_id, date)"))
+        conn.execute(text("CREATE TABLE transactions_default PARTITION OF transactions DEFAULT"))
+        ensure_postgres_partitions(conn, granularity, lower, upper)
+        conn.execute(text("INSERT INTO transactions SELECT * FROM transactions_unpartitioned"))
+        count = conn.execute(text("SELECT count(*) FROM transactions")).scalar()
+        conn.execute(text("ALTER SEQUENCE transactions_id_seq OWNED BY transactions.id"))
+        conn.execute(text("DROP TABLE transactions_unpartitioned"))
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Partition or archive the transactions table")
+    parser.add_argument("--database-url", default=os.getenv("DATABASE_URL", "sqlite:///./finance_app.db"))
+    sub = parser.add_subparsers(dest="command", required=True)
+    archive = sub.add_parser("archive", help="SQLite: move years before --before-year to the archive file")
+    archive.add_argument("--before-year", type=int, required=True)
+    restore = sub.add_parser("restore", help="SQLite: move an archived year back to the live table")
+    restore.add_argument("--year", type=int, required=True)
+    convert = sub.add_parser("postgres-convert", help="Postgres: rebuild transactions as a partitioned table")
+    convert.add_argument("--granularity", choices=["month", "year"], default="month")
+    convert.add_argument("--months-ahead", type=int, default=3)
+    ensure = sub.add_parser("postgres-ensure", help="Postgres: create upcoming partitions (run from cron)")
+    ensure.add_argument("--granularity", choices=["month", "year"], default="month")
+    ensure.add_argument("--months-ahead", type=int, default=3)
+    args = parser.parse_args()
+
+    engine = create_engine(args.database_url)
+    if args.command in ("archive", "restore"):
+        if not attach_sqlite_archive(engine):
+            parser.error("SQLITE_ARCHIVE_PATH must be set and the database must be SQLite")
+        source = Table("transactions", MetaData(), autoload_with=engine)
+        if args.command == "archive":
+            for year, count in archive_years_before(engine, source, args.before_year).items():
+                print(f"Archived {count} transactions from {year}")
+        else:
+            print(f"Restored {restore_year(engine, source, args.year)} transactions from {args.year}")
+    elif args.command == "postgres-convert":
+        print(f"Partitioned {convert_postgres_to_partitioned(engine, args.granularity, args.months_ahead)} transactions")
+    else:
+        today = date.today()
+        with engine.begin() as conn:
+            created = ensure_postgres_partitions(conn, args.granularity, today, _add_months(today, args.months_ahead))
+        print(f"Created partitions: {', '.join(created) or 'none'}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,463 @@
+"""Opt-in per-request profiling with speedscope output.
+
+A request is profiled when it carries a valid signed X-Profile header or is
+picked at random with probability PROFILING_SAMPLE_RATE. Header values are
+"<expiry>.<hmac>" tokens minted with
+
+    python -m app.utils.profiling token --minutes 15
+
+and signed with PROFILING_SECRET (SECRET_KEY when empty). A token is refused
+once expired or if it claims to live longer than a day.
+
+While at least one profiled request runs, a sampler thread records the Python
+stack of every busy thread in the worker every PROFILING_INTERVAL_MS. SQL
+statements run on behalf of the request are timed through engine events. The
+request's context follows it into the threadpool, so the SQL track belongs to
+that request alone. Stack samples cover the whole worker, so the capture
+counts how many other requests overlapped it.
+
+Each capture becomes a speedscope file (https://www.speedscope.app) holding
+one sampled profile and one SQL timeline per thread. A .meta.json summary
+sits next to it, with time split into sql / orm / serialisation / app and the
+slowest statements. PROFILING_DIR is a ring: captures beyond
+PROFILING_MAX_FILES are deleted oldest first. Profiled responses carry
+X-Profile-Id.
+
+With PROFILING_ENABLED=false, the default, main.py installs neither the
+middleware nor the engine listeners, so requests pay nothing.
+
+Configuration (.env):
+    PROFILING_ENABLED, PROFILING_SAMPLE_RATE, PROFILING_SECRET
+    PROFILING_DIR, PROFILING_MAX_FILES, PROFILING_INTERVAL_MS
+    PROFILING_MAX_SECONDS, PROFILING_MAX_CONCURRENT, PROFILING_EXCLUDE_PATHS
+"""
+import argparse
+import asyncio
+import hashlib
+import hmac
+import itertools
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+from collections import defaultdict
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+from dotenv import load_dotenv
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+load_dotenv()
+
+PROFILE_HEADER = b"x-profile"
+MAX_TOKEN_SECONDS = 24 * 3600
+
+_APP_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+_CAPTURE_ID = re.compile(r"^\d{13}-\d+-\d+$")
+
+# Leaf frames of a thread that is parked rather than working: the event loop in
+# select, threadpool workers waiting for a job
+_IDLE_LEAVES = {("selectors.py", "select"), ("threading.py", "wait"), ("queue.py", "get")}
+
+# Where a sample's time goes, decided by the innermost frame that matches
+_CATEGORIES = [
+    ("sql", ("/sqlalchemy/engine/", "/sqlalchemy/pool/", "/sqlalchemy/dialects/", "/sqlite3/")),
+    ("orm", ("/sqlalchemy/orm/", "/sqlalchemy/sql/")),
+    ("serialisation", ("/json/", "/fastapi/encoders.py", "/pydantic", "/starlette/responses.py")),
+]
+
+_current: ContextVar[Optional["Capture"]] = ContextVar("profile_capture", default=None)
+
+Frame = Tuple[str, str, int]
+
+
+@dataclass
+class Capture:
+    id: str
+    method: str
+    path: str
+    query: str
+    reason: str
+    started: float
+    started_at: datetime
+    status: Optional[int] = None
+    duration: float = 0.0
+    # Other requests that ran while this one did
+    concurrent: int = 0
+    truncated: bool = False
+    # (thread name, root-to-leaf stack, weight in seconds)
+    samples: List[Tuple[str, Tuple[Frame, ...], float]] = field(default_factory=list)
+    # (thread name, start, end, statement), times relative to `started`
+    sql: List[Tuple[str, float, float, str]] = field(default_factory=list)
+
+
+def _category(stack: Tuple[Frame, ...]) -> str:
+    for _, filename, _ in reversed(stack):
+        path = filename.replace("\\", "/")
+        for name, markers in _CATEGORIES:
+            if any(marker in path for marker in markers):
+                return name
+        if filename.startswith(_APP_ROOT) and "site-packages" not in path:
+            return "app"
+    return "other"
+
+
+def _statement_label(statement: str) -> str:
+    return "SQL " + " ".join(statement.split())[:160]
+
+
+class Profiler:
+    """Capture bookkeeping and the shared sampler thread for one worker."""
+
+    def __init__(self, directory: str = "./profiles", secret: str = "", sample_rate: float = 0.0,
+                 max_files: int = 50, interval: float = 0.005, max_seconds: float = 30.0,
+                 max_concurrent: int = 2, exclude_paths: Tuple[str, ...] = ("/api/events", "/api/admin/")):
+        self.directory = directory
+        self.secret = secret.encode()
+        self.sample_rate = sample_rate
+        self.max_files = max_files
+        self.interval = interval
+        self.max_seconds = max_seconds
+        self.max_concurrent = max_concurrent
+        self.exclude_paths = exclude_paths
+        self.captured = 0
+        self.skipped = 0
+        self._in_flight = 0
+        self._active: List[Capture] = []
+        self._lock = threading.Lock()
+        self._sampler: Optional[threading.Thread] = None
+        self._ids = itertools.count(1)
+
+    @classmethod
+    def from_env(cls) -> Optional["Profiler"]:
+        if os.getenv("PROFILING_ENABLED", "false").lower() != "true":
+            return None
+        exclude = os.getenv("PROFILING_EXCLUDE_PATHS", "/api/events,/api/admin/")
+        return cls(
+            directory=os.getenv("PROFILING_DIR") or "./profiles",
+            secret=os.getenv("PROFILING_SECRET") or os.getenv("SECRET_KEY", "your-secret-key-here"),
+            sample_rate=float(os.getenv("PROFILING_SAMPLE_RATE") or 0),
+            max_files=int(os.getenv("PROFILING_MAX_FILES", "50")),
+            interval=float(os.getenv("PROFILING_INTERVAL_MS", "5")) / 1000,
+            max_seconds=float(os.getenv("PROFILING_MAX_SECONDS", "30")),
+            max_concurrent=int(os.getenv("PROFILING_MAX_CONCURRENT", "2")),
+            exclude_paths=tuple(p.strip() for p in exclude.split(",") if p.strip()),
+        )
+
+    # Signed header
+
+    def sign(self, expires: int) -> str:
+        return hmac.new(self.secret, f"profile:{expires}".encode(), hashlib.sha256).hexdigest()
+
+    def token(self, seconds: int) -> str:
+        expires = int(time.time()) + seconds
+        return f"{expires}.{self.sign(expires)}"
+
+    def verify(self, token: str) -> bool:
+        expires, _, signature = token.strip().partition(".")
+        if not expires.isdigit():
+            return False
+        remaining = int(expires) - time.time()
+        if remaining <= 0 or remaining > MAX_TOKEN_SECONDS:
+            return False
+        return hmac.compare_digest(signature, self.sign(int(expires)))
+
+    def select(self, scope) -> Optional[str]:
+        """Why this request should be profiled ("header" or "sampled"), or None."""
+        if scope["path"].startswith(self.exclude_paths):
+            return None
+        for name, value in scope["headers"]:
+            if name == PROFILE_HEADER and self.verify(value.decode("latin-1")):
+                return "header"
+        if self.sample_rate > 0 and random.random() < self.sample_rate:
+            return "sampled"
+        return None
+
+    # Capture lifecycle
+
+    def request_started(self):
+        with self._lock:
+            self._in_flight += 1
+            for capture in self._active:
+                capture.concurrent += 1
+
+    def request_finished(self):
+        with self._lock:
+            self._in_flight -= 1
+
+    def start(self, scope, reason: str) -> Optional[Capture]:
+        with self._lock:
+            if len(self._active) >= self.max_concurrent:
+                # Bounds the sampler's cost when many requests qualify at once
+                self.skipped += 1
+                return None
+            now = time.time()
+            capture = Capture(
+                id=f"{int(now * 1000):013d}-{os.getpid()}-{next(self._ids)}",
+                method=scope["method"],
+                path=scope["path"],
+                query=scope.get("query_string", b"").decode("latin-1"),
+                reason=reason,
+                started=time.perf_counter(),
+                started_at=datetime.utcfromtimestamp(now),
+                concurrent=self._in_flight - 1,
+            )
+            self._active.append(capture)
+            if self._sampler is None:
+                self._sampler = threading.Thread(target=self._sample_loop, name="profiler-sampler", daemon=True)
+                self._sampler.start()
+        return capture
+
+    def finish(self, capture: Capture, status: int):
+        capture.duration = time.perf_counter() - capture.started
+        capture.status = status
+        with self._lock:
+            self._active.remove(capture)
+            self.captured += 1
+
+    def _sample_loop(self):
+        own = threading.get_ident()
+        last = time.perf_counter()
+        while True:
+            with self._lock:
+                if not self._active:
+                    self._sampler = None
+                    return
+            time.sleep(self.interval)
+            now = time.perf_counter()
+            weight, last = now - last, now
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            stacks = []
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append((code.co_name, code.co_filename, code.co_firstlineno))
+                    frame = frame.f_back
+                if not stack or (os.path.basename(stack[0][1]), stack[0][0]) in _IDLE_LEAVES:
+                    continue
+                stacks.append((names.get(ident, str(ident)), tuple(reversed(stack))))
+            with self._lock:
+                captures = list(self._active)
+            for capture in captures:
+                elapsed = now - capture.started
+                if elapsed > self.max_seconds:
+                    capture.truncated = True
+                    continue
+                for thread, stack in stacks:
+                    capture.samples.append((thread, stack, min(weight, elapsed)))
+
+    # SQL timing
+
+    def install(self):
+        """Time cursor executions for whichever request's context they run in (all engines)."""
+        event.listen(Engine, "before_cursor_execute", _before_cursor_execute)
+        event.listen(Engine, "after_cursor_execute", _after_cursor_execute)
+
+    # Ring on disk
+
+    def write(self, capture: Capture):
+        os.makedirs(self.directory, exist_ok=True)
+        base = os.path.join(self.directory, capture.id)
+        for suffix, document in ((".speedscope.json", _speedscope(capture)), (".meta.json", _summary(capture))):
+            partial = f"{base}{suffix}.tmp"
+            with open(partial, "w") as out:
+                json.dump(document, out)
+            os.replace(partial, base + suffix)
+        self._prune()
+
+    def _prune(self):
+        ids = sorted(name[:-len(".meta.json")] for name in os.listdir(self.directory) if name.endswith(".meta.json"))
+        for stale in ids[:max(0, len(ids) - self.max_files)]:
+            for suffix in (".meta.json", ".speedscope.json"):
+                try:
+                    os.remove(os.path.join(self.directory, stale + suffix))
+                except FileNotFoundError:
+                    # Another worker pruned it first
+                    pass
+
+    def captures(self, limit: int = 50) -> List[dict]:
+        """Summaries of the captures on disk, newest first (all workers)."""
+        if not os.path.isdir(self.directory):
+            return []
+        names = sorted((n for n in os.listdir(self.directory) if n.endswith(".meta.json")), reverse=True)
+        summaries = []
+        for name in names[:limit]:
+            try:
+                with open(os.path.join(self.directory, name)) as meta:
+                    summaries.append(json.load(meta))
+            except (FileNotFoundError, ValueError):
+                continue
+        return summaries
+
+    def path_for(self, capture_id: str) -> Optional[str]:
+        if not _CAPTURE_ID.match(capture_id):
+            return None
+        path = os.path.join(self.directory, capture_id + ".speedscope.json")
+        return path if os.path.exists(path) else None
+
+    def snapshot(self) -> Dict[str, object]:
+        return {
+            "captured": self.captured, "skipped": self.skipped, "active": len(self._active),
+            "sample_rate": self.sample_rate,
+        }
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _current.get() is not None:
+        conn.info["profile_started"] = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    capture = _current.get()
+    started = conn.info.pop("profile_started", None)
+    if capture is not None and started is not None:
+        capture.sql.append((
+            threading.current_thread().name, started - capture.started,
+            time.perf_counter() - capture.started, statement,
+        ))
+
+
+def _speedscope(capture: Capture) -> dict:
+    frames: List[dict] = []
+    index: Dict[Frame, int] = {}
+
+    def frame_id(key: Frame) -> int:
+        if key not in index:
+            name, filename, line = key
+            index[key] = len(frames)
+            frames.append({"name": name, "file": filename, "line": line} if filename else {"name": name})
+        return index[key]
+
+    end = capture.duration * 1000
+    profiles = []
+    by_thread = defaultdict(list)
+    for thread, stack, weight in capture.samples:
+        by_thread[thread].append((stack, weight))
+    for thread, samples in sorted(by_thread.items(), key=lambda item: -len(item[1])):
+        profiles.append({
+            "type": "sampled", "name": thread, "unit": "milliseconds", "startValue": 0, "endValue": end,
+            "samples": [[frame_id(key) for key in stack] for stack, _ in samples],
+            "weights": [weight * 1000 for _, weight in samples],
+        })
+    sql_by_thread = defaultdict(list)
+    for thread, started, finished, statement in capture.sql:
+        sql_by_thread[thread].append((started, finished, statement))
+    for thread, statements in sql_by_thread.items():
+        events, cursor = [], 0.0
+        # Statements on one thread run one after another; clamp clock jitter so events nest
+        for started, finished, statement in sorted(statements):
+            opened = max(started * 1000, cursor)
+            cursor = max(finished * 1000, opened)
+            fid = frame_id((_statement_label(statement), "", 0))
+            events += [{"type": "O", "frame": fid, "at": opened}, {"type": "C", "frame": fid, "at": cursor}]
+        profiles.append({
+            "type": "evented", "name": f"{thread} SQL", "unit": "milliseconds",
+            "startValue": 0, "endValue": max(end, cursor), "events": events,
+        })
+    return {
+        "$schema": "https://www.speedscope.app/file-format-schema.json",
+        "name": f"{capture.method} {capture.path} ({end:.0f} ms)",
+        "exporter": "finance-app profiler",
+        "activeProfileIndex": 0,
+        "shared": {"frames": frames},
+        "profiles": profiles,
+    }
+
+
+def _summary(capture: Capture) -> dict:
+    breakdown: Dict[str, float] = defaultdict(float)
+    categories: Dict[Tuple[Frame, ...], str] = {}
+    for _, stack, weight in capture.samples:
+        if stack not in categories:
+            categories[stack] = _category(stack)
+        breakdown[categories[stack]] += weight * 1000
+    statements: Dict[str, List[float]] = defaultdict(lambda: [0, 0.0])
+    for _, started, finished, statement in capture.sql:
+        totals = statements[_statement_label(statement)]
+        totals[0] += 1
+        totals[1] += (finished - started) * 1000
+    slowest = sorted(statements.items(), key=lambda item: -item[1][1])[:5]
+    return {
+        "id": capture.id,
+        "method": capture.method,
+        "path": capture.path,
+        "query": capture.query,
+        "reason": capture.reason,
+        "status": capture.status,
+        "started_at": capture.started_at.isoformat(),
+        "duration_ms": round(capture.duration * 1000, 2),
+        "concurrent": capture.concurrent,
+        "truncated": capture.truncated,
+        "samples": len(capture.samples),
+        "sql_count": len(capture.sql),
+        "sql_ms": round(sum(finished - started for _, started, finished, _ in capture.sql) * 1000, 2),
+        "breakdown_ms": {name: round(ms, 2) for name, ms in sorted(breakdown.items(), key=lambda item: -item[1])},
+        "slowest_sql": [
+            {"statement": label[4:], "count": count, "total_ms": round(total, 2)} for label, (count, total) in slowest
+        ],
+    }
+
+
+class ProfilingMiddleware:
+    """Pure ASGI middleware; requests that are not picked only pay the header check."""
+
+    def __init__(self, app, profiler: Profiler):
+        self.app = app
+        self.profiler = profiler
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        profiler = self.profiler
+        profiler.request_started()
+        try:
+            reason = profiler.select(scope)
+            capture = profiler.start(scope, reason) if reason else None
+            if capture is None:
+                return await self.app(scope, receive, send)
+
+            status_code = 500
+
+            async def send_with_id(message):
+                nonlocal status_code
+                if message["type"] == "http.response.start":
+                    status_code = message["status"]
+                    message = {**message, "headers": [*message.get("headers", []), (b"x-profile-id", capture.id.encode())]}
+                await send(message)
+
+            token = _current.set(capture)
+            try:
+                await self.app(scope, receive, send_with_id)
+            finally:
+                _current.reset(token)
+                profiler.finish(capture, status_code)
+                # Serialising the capture is the profiler's cost, not the request's
+                asyncio.get_running_loop().run_in_executor(None, profiler.write, capture)
+        finally:
+            profiler.request_finished()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Per-request profiler tools")
+    sub = parser.add_subparsers(dest="command", required=True)
+    token = sub.add_parser("token", help="print an X-Profile header value")
+    token.add_argument("--minutes", type=int, default=15)
+    args = parser.parse_args()
+    if args.command == "token":
+        if args.minutes * 60 > MAX_TOKEN_SECONDS:
+            parser.error("tokens live at most a day")
+        profiler = Profiler(secret=os.getenv("PROFILING_SECRET") or os.getenv("SECRET_KEY", "your-secret-key-here"))
+        print(profiler.token(args.minutes * 60))
+
+
+if __name__ == "__main__":
+    main()
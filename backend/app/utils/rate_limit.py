@@ -0,0 +1,122 @@
+"""Token-bucket rate limiting for the credential endpoints.
+
+Every key (a client IP, or a normalised email) has a bucket holding up to
+`burst` tokens that refills at `per_minute` tokens a minute. An attempt costs
+one token from the IP bucket and one from the account bucket, and is refused
+unless both have one, so a single address cannot spray many accounts and many
+addresses cannot hammer one account. Refused attempts take no tokens.
+
+Buckets live in a bounded LRU per worker; with several workers each enforces
+its own share of the limit.
+
+The client IP is the socket peer unless that peer is one of TRUSTED_PROXIES
+(comma-separated addresses or CIDR ranges); then it is the right-most
+X-Forwarded-For entry that is not itself a trusted proxy. Entries further
+left are client-supplied and never used. Behind a proxy that is not listed,
+every client shares the proxy's bucket.
+
+Configuration (.env): AUTH_RATE_LIMIT_ENABLED, AUTH_RATE_IP_PER_MINUTE,
+AUTH_RATE_IP_BURST, AUTH_RATE_ACCOUNT_PER_MINUTE, AUTH_RATE_ACCOUNT_BURST,
+TRUSTED_PROXIES.
+"""
+import ipaddress
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Hashable, List, Optional
+
+
+class TokenBuckets:
+    """Bounded LRU of (tokens, last refill) per key."""
+
+    def __init__(self, per_minute: float, burst: float, max_keys: int = 100_000):
+        self.rate = per_minute / 60.0
+        self.burst = burst
+        self.max_keys = max_keys
+        self._buckets: "OrderedDict[Hashable, list]" = OrderedDict()
+
+    def _refilled(self, key: Hashable, now: float) -> list:
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = [self.burst, now]
+            self._buckets[key] = bucket
+            if len(self._buckets) > self.max_keys:
+                # The oldest untouched bucket has long since refilled, so dropping it loses nothing
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+        return bucket
+
+    def wait_time(self, key: Hashable, now: float) -> float:
+        """Seconds until the key has a whole token (0 when it has one now)."""
+        tokens = self._refilled(key, now)[0]
+        if tokens >= 1:
+            return 0.0
+        return (1 - tokens) / self.rate if self.rate > 0 else math.inf
+
+    def take(self, key: Hashable):
+        self._buckets[key][0] -= 1
+
+
+def _parse_networks(value: str) -> List[ipaddress._BaseNetwork]:
+    return [ipaddress.ip_network(part.strip(), strict=False) for part in value.split(",") if part.strip()]
+
+
+class AuthRateLimiter:
+    def __init__(self, ip_per_minute: float = 20, ip_burst: float = 10,
+                 account_per_minute: float = 5, account_burst: float = 5, trusted_proxies: str = ""):
+        self.by_ip = TokenBuckets(ip_per_minute, ip_burst)
+        self.by_account = TokenBuckets(account_per_minute, account_burst)
+        self.trusted_proxies = _parse_networks(trusted_proxies)
+        self.refused = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls) -> Optional["AuthRateLimiter"]:
+        if os.getenv("AUTH_RATE_LIMIT_ENABLED", "true").lower() != "true":
+            return None
+        return cls(
+            ip_per_minute=float(os.getenv("AUTH_RATE_IP_PER_MINUTE", "20")),
+            ip_burst=float(os.getenv("AUTH_RATE_IP_BURST", "10")),
+            account_per_minute=float(os.getenv("AUTH_RATE_ACCOUNT_PER_MINUTE", "5")),
+            account_burst=float(os.getenv("AUTH_RATE_ACCOUNT_BURST", "5")),
+            trusted_proxies=os.getenv("TRUSTED_PROXIES", ""),
+        )
+
+    def _trusted(self, address: str) -> bool:
+        try:
+            ip = ipaddress.ip_address(address)
+        except ValueError:
+            return False
+        return any(ip in network for network in self.trusted_proxies)
+
+    def client_ip(self, peer: Optional[str], forwarded_for: Optional[str]) -> Optional[str]:
+        """The address to rate-limit: `peer`, or what trusted proxies in front of it say the client was."""
+        if peer is None or not forwarded_for or not self._trusted(peer):
+            return peer
+        hops = [hop.strip() for hop in forwarded_for.split(",") if hop.strip()]
+        for hop in reversed(hops):
+            if not self._trusted(hop):
+                return hop
+        # Every hop is a proxy of ours; the left-most is as close to the client as we can get
+        return hops[0] if hops else peer
+
+    def check(self, ip: Optional[str], account: Optional[str]) -> int:
+        """Take a token for this attempt; returns 0 when allowed, else a Retry-After in seconds."""
+        account = account.strip().lower() if isinstance(account, str) and account.strip() else None
+        now = time.monotonic()
+        with self._lock:
+            wait = self.by_ip.wait_time(ip, now)
+            if account is not None:
+                wait = max(wait, self.by_account.wait_time(account, now))
+            if wait > 0:
+                self.refused += 1
+                return max(1, math.ceil(wait)) if math.isfinite(wait) else 3600
+            self.by_ip.take(ip)
+            if account is not None:
+                self.by_account.take(account)
+            return 0
@@ -0,0 +1,167 @@
+"""Rotating refresh tokens, so a session renews without re-verifying the password.
+
+A login (Argon2, tens of milliseconds of CPU) issues a short-lived access JWT
+and an opaque refresh token. When the access token expires the client trades
+the refresh token at /api/auth/refresh for a new pair: one lookup by the
+token's SHA-256 on a unique index, one conditional UPDATE and one INSERT.
+
+Tokens are 256 random bits, so a fast hash is enough: there is nothing to
+brute-force, and a leaked table does not reveal usable tokens. Each token
+belongs to a family started by one login; every refresh marks the presented
+token used and issues its successor in the same family. Presenting a token
+that was already used means two parties hold the same chain (a stolen copy,
+or the legitimate client after the thief refreshed first), so the whole family
+is revoked and both have to log in again.
+
+`tokens` must have id, token_hash, family_id, user_id, created_at,
+expires_at, used_at, replaced_by and revoked_at columns; `users` must have
+id, email and is_active.
+"""
+import hashlib
+import os
+import secrets
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+from typing import Dict, Optional, Tuple
+
+from sqlalchemy import Table, delete, insert, select, update
+from sqlalchemy.engine import Connection, Engine
+
+TOKEN_PREFIX = "rt_"
+
+
+class RefreshTokenError(Exception):
+    """The refresh token is unknown, expired, revoked or belongs to an inactive user."""
+
+
+class RefreshTokenReused(RefreshTokenError):
+    """An already rotated token was presented again; its family has been revoked."""
+
+
+def hash_token(token: str) -> str:
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+class RefreshTokenStore:
+    """Issue, rotate and revoke refresh tokens in `tokens`."""
+
+    def __init__(self, engine: Engine, tokens: Table, users: Table, ttl: timedelta = timedelta(days=30),
+                 purge_interval: float = 3600.0):
+        self.engine = engine
+        self.tokens = tokens
+        self.users = users
+        self.ttl = ttl
+        self.purge_interval = purge_interval
+        self._last_purge = float("-inf")
+        self._lock = threading.Lock()
+        self._counts: Dict[str, int] = {"issued": 0, "rotated": 0, "rejected": 0, "reused": 0, "revoked": 0}
+
+    @classmethod
+    def from_env(cls, engine: Engine, tokens: Table, users: Table) -> Optional["RefreshTokenStore"]:
+        if os.getenv("REFRESH_TOKEN_ENABLED", "true").lower() != "true":
+            return None
+        return cls(engine, tokens, users, ttl=timedelta(days=float(os.getenv("REFRESH_TOKEN_EXPIRE_DAYS", "30"))))
+
+    @property
+    def expires_in(self) -> int:
+        return int(self.ttl.total_seconds())
+
+    def _count(self, name: str):
+        with self._lock:
+            self._counts[name] += 1
+
+    def _insert(self, conn: Connection, user_id: int, family_id: str, now: datetime) -> Tuple[int, str]:
+        token = TOKEN_PREFIX + secrets.token_urlsafe(32)
+        token_id = conn.execute(
+            insert(self.tokens).returning(self.tokens.c.id),
+            {
+                "token_hash": hash_token(token),
+                "family_id": family_id,
+                "user_id": user_id,
+                "created_at": now,
+                "expires_at": now + self.ttl,
+            },
+        ).scalar_one()
+        return token_id, token
+
+    def issue(self, user_id: int) -> str:
+        """A refresh token starting a new family (one per login)."""
+        self.purge()
+        with self.engine.begin() as conn:
+            _, token = self._insert(conn, user_id, uuid.uuid4().hex, datetime.utcnow())
+        self._count("issued")
+        return token
+
+    def rotate(self, token: str) -> Tuple[int, str, str]:
+        """Spend `token` for its successor: (user id, user email, new refresh token).
+
+        Raises RefreshTokenReused (after revoking the family) if the token was
+        already spent, RefreshTokenError if it is otherwise unusable.
+        """
+        t, u = self.tokens.c, self.users.c
+        now = datetime.utcnow()
+        with self.engine.begin() as conn:
+            row = conn.execute(
+                select(t.id, t.family_id, t.user_id, t.expires_at, t.used_at, t.revoked_at, u.email, u.is_active)
+                .join_from(self.tokens, self.users, t.user_id == u.id)
+                .where(t.token_hash == hash_token(token))
+            ).first()
+            if row is None or row.revoked_at is not None or row.expires_at <= now or row.is_active is False:
+                self._count("rejected")
+                raise RefreshTokenError("Invalid refresh token")
+            # The used_at guard makes two concurrent refreshes with the same token a reuse, not two successors
+            spent = row.used_at is not None or conn.execute(
+                update(self.tokens).where(t.id == row.id, t.used_at.is_(None)).values(used_at=now)
+            ).rowcount == 0
+            if not spent:
+                new_id, new_token = self._insert(conn, row.user_id, row.family_id, now)
+                conn.execute(update(self.tokens).where(t.id == row.id).values(replaced_by=new_id))
+        if spent:
+            # In its own transaction: the revocation must stick even though the request fails
+            with self.engine.begin() as conn:
+                self._revoke(conn, t.family_id == row.family_id, now)
+            self._count("reused")
+            raise RefreshTokenReused("Refresh token reuse detected; all sessions from that login were signed out")
+        self._count("rotated")
+        return row.user_id, row.email, new_token
+
+    def _revoke(self, conn: Connection, condition, now: datetime) -> int:
+        t = self.tokens.c
+        return conn.execute(update(self.tokens).where(condition, t.revoked_at.is_(None)).values(revoked_at=now)).rowcount
+
+    def revoke(self, token: str) -> bool:
+        """Log out: revoke the token's whole family. False if the token is unknown."""
+        t = self.tokens.c
+        with self.engine.begin() as conn:
+            family_id = conn.execute(select(t.family_id).where(t.token_hash == hash_token(token))).scalar()
+            if family_id is None:
+                return False
+            self._revoke(conn, t.family_id == family_id, datetime.utcnow())
+        self._count("revoked")
+        return True
+
+    def revoke_user(self, user_id: int) -> int:
+        """Log out everywhere: revoke every live token of the user. Returns how many were revoked."""
+        t = self.tokens.c
+        now = datetime.utcnow()
+        with self.engine.begin() as conn:
+            revoked = self._revoke(conn, (t.user_id == user_id) & (t.expires_at > now), now)
+        self._count("revoked")
+        return revoked
+
+    def purge(self):
+        """Drop expired tokens, at most once per purge_interval."""
+        with self._lock:
+            if time.monotonic() - self._last_purge < self.purge_interval:
+                return
+            self._last_purge = time.monotonic()
+        t = self.tokens.c
+        with self.engine.begin() as conn:
+            # Spent tokens stay until they expire so that replaying one is still detected as reuse
+            conn.execute(delete(self.tokens).where(t.expires_at <= datetime.utcnow()))
+
+    def snapshot(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._counts)
@@ -0,0 +1,179 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, Hashable, Optional, Tuple
+
+
+@dataclass
+class _Entry:
+    value: bytes
+    generation: int
+    stored_at: float
+    stale: bool = False
+    refreshing: bool = False
+
+
+@dataclass
+class CacheStats:
+    hits: int = 0
+    stale_hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+    invalidations: int = 0
+    refreshes: int = 0
+
+
+class MemoCache:
+    """Bounded LRU of serialised responses with byte-size accounting.
+
+    Entries are invalidated by writes rather than expired by time alone:
+    `invalidate(key)` bumps the key's generation and marks the entry stale but
+    keeps its bytes, so the next reader can be served the stale value while a
+    single background refresh recomputes it (stale-while-revalidate). A
+    recompute that started before an invalidation is stored as stale, never as
+    fresh, so a write that lands mid-refresh is not lost.
+
+    `ttl` bounds how long an entry counts as fresh without an invalidation,
+    which covers writes made by other worker processes when nothing relays
+    their invalidations. Past `max_stale` a stale entry is no longer served and
+    the reader recomputes inline.
+    """
+
+    def __init__(self, max_bytes: int = 32 * 1024 * 1024, ttl: float = 10.0, max_stale: float = 60.0):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.max_stale = max_stale
+        self.current_bytes = 0
+        self.stats = CacheStats()
+        self._entries: "OrderedDict[Hashable, _Entry]" = OrderedDict()
+        self._generations: Dict[Hashable, int] = {}
+        self._stale_since: Dict[Hashable, float] = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls, prefix: str) -> "MemoCache":
+        return cls(
+            max_bytes=int(os.getenv(f"{prefix}_MAX_BYTES", str(32 * 1024 * 1024))),
+            ttl=float(os.getenv(f"{prefix}_TTL_SECONDS", "10")),
+            max_stale=float(os.getenv(f"{prefix}_MAX_STALE_SECONDS", "60")),
+        )
+
+    @staticmethod
+    def _size(key: Hashable, value: bytes) -> int:
+        # Value bytes plus a rough allowance for the key and bookkeeping objects
+        return len(value) + len(repr(key)) + 200
+
+    def generation(self, key: Hashable) -> int:
+        with self._lock:
+            return self._generations.get(key, 0)
+
+    def lookup(self, key: Hashable) -> Tuple[Optional[bytes], bool, bool]:
+        """Return (value, fresh, should_refresh) for a key.
+
+        should_refresh is True for exactly one caller per stale period; that
+        caller is responsible for recomputing and calling `put`.
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.stats.misses += 1
+                return None, False, False
+            if not entry.stale and now - entry.stored_at > self.ttl:
+                entry.stale = True
+                self._stale_since.setdefault(key, now)
+            if not entry.stale:
+                self._entries.move_to_end(key)
+                self.stats.hits += 1
+                return entry.value, True, False
+            if now - self._stale_since.get(key, now) > self.max_stale:
+                self.stats.misses += 1
+                return None, False, False
+            self._entries.move_to_end(key)
+            self.stats.stale_hits += 1
+            should_refresh = not entry.refreshing
+            entry.refreshing = True
+            return entry.value, False, should_refresh
+
+    def put(self, key: Hashable, value: bytes, generation: int):
+        """Store a computed value; it is fresh only if no invalidation raced it."""
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.current_bytes -= self._size(key, old.value)
+            fresh = generation == self._generations.get(key, 0)
+            entry = _Entry(value=value, generation=generation, stored_at=time.monotonic(), stale=not fresh)
+            size = self._size(key, value)
+            if size > self.max_bytes:
+                return
+            self._entries[key] = entry
+            self.current_bytes += size
+            if fresh:
+                self._stale_since.pop(key, None)
+            else:
+                self._stale_since.setdefault(key, time.monotonic())
+            while self.current_bytes > self.max_bytes:
+                evicted_key, evicted = self._entries.popitem(last=False)
+                self.current_bytes -= self._size(evicted_key, evicted.value)
+                self._stale_since.pop(evicted_key, None)
+                self.stats.evictions += 1
+
+    def refresh_failed(self, key: Hashable):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry.refreshing = False
+
+    def invalidate(self, key: Hashable):
+        """Mark a key stale after a write; its bytes stay for stale-while-revalidate."""
+        with self._lock:
+            self._generations[key] = self._generations.get(key, 0) + 1
+            self.stats.invalidations += 1
+            entry = self._entries.get(key)
+            if entry is not None and not entry.stale:
+                entry.stale = True
+                self._stale_since[key] = time.monotonic()
+
+    def get_or_compute(
+        self,
+        key: Hashable,
+        compute: Callable[[], bytes],
+        schedule_refresh: Callable[[Callable[[], Any]], Any],
+        refresh_compute: Optional[Callable[[], bytes]] = None,
+    ) -> bytes:
+        """Serve from cache, recomputing inline on a miss and in the background when stale.
+
+        `refresh_compute` runs after the response is sent, so it must not rely
+        on request-scoped resources such as the request's DB session.
+        """
+        value, fresh, should_refresh = self.lookup(key)
+        if value is not None:
+            if should_refresh:
+                schedule_refresh(lambda: self._refresh(key, refresh_compute or compute))
+            return value
+        generation = self.generation(key)
+        value = compute()
+        self.put(key, value, generation)
+        return value
+
+    def _refresh(self, key: Hashable, compute: Callable[[], bytes]):
+        generation = self.generation(key)
+        try:
+            value = compute()
+        except Exception as e:
+            print(f"Background refresh failed for {key!r}: {str(e)}")
+            self.refresh_failed(key)
+            return
+        self.stats.refreshes += 1
+        self.put(key, value, generation)
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self.current_bytes,
+                "max_bytes": self.max_bytes,
+                **self.stats.__dict__,
+            }
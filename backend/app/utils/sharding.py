@@ -0,0 +1,446 @@
+"""Per-user sharding across SQLite database files.
+
+The users table (accounts, password hashes) stays in the global database,
+the file DATABASE_URL points at. Everything a user owns lives in one of the
+DATABASE_SHARD_URLS files. This covers transactions, categories, tags,
+idempotency keys and snapshots. Each shard has its own write lock, so
+concurrent writers for different users stop queueing behind each other.
+
+Users are placed on a consistent-hash ring with SHARD_VNODES points per shard.
+Adding a shard moves only the users whose ring segment it takes over, about
+1/N of them. Moving them is an offline step: stop the app, then run
+
+    python -m app.utils.sharding rebalance --from "<old urls>" --to "<new urls>"
+
+The rebalance tool copies each moving user's rows to the new shard and then
+deletes them from the old one. Ids are reassigned on the way, because every
+shard numbers its own rows. What refers to the old ids is rewritten: the
+transaction ids in stored idempotent responses as they are copied, and the
+user's audit entries in the global database (entries for rows that no longer
+exist lose their entity_id). The forecast snapshot, the categoriser model and
+the spend sketches are dropped and rebuilt on next use. A rerun after a crash
+first clears any partial copy and then moves the user again.
+
+With DATABASE_SHARD_URLS empty (the default) there is a single shard, the
+global database itself, and nothing changes. Shards pay off only when writers
+queue on the write lock, i.e. with spare cores or commits that wait on the
+device; a single CPU-bound core gains nothing (benchmarks/shard_write_scaling.py). Sharding cannot be combined with read replicas
+or the SQLite year archive, since both assume one database file.
+"""
+import argparse
+import bisect
+import hashlib
+import json
+import os
+from typing import Callable, Dict, Iterable, List, Optional
+
+from dotenv import load_dotenv
+from sqlalchemy import (Column, Integer, MetaData, String, Table, bindparam, column, create_engine, delete, insert, inspect, select,
+                        text, update)
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.orm import Session, sessionmaker
+
+from .sqlite_profile import apply_sqlite_profile
+
+load_dotenv()
+
+# Tables whose rows belong to one user and move with them, parents before children
+USER_TABLES = ["categories", "tags", "transactions", "transaction_tags", "idempotency_keys"]
+# Derived per-user state that refers to old ids; dropped on a move and rebuilt on demand
+DERIVED_TABLES = [
+    "forecast_snapshots", "categoriser_models", "category_distributions", "balance_checkpoints", "insight_snapshots",
+]
+# Moved tables whose ids the audit log refers to, with the entity name it uses
+AUDITED_TABLES = {"transactions": "transaction", "categories": "category"}
+
+# old -> new ids of a move in progress, kept in the global database until the
+# source copy is deleted so that a rerun can tell which ids the audit log holds
+id_remaps = Table(
+    "shard_id_remaps", MetaData(),
+    Column("user_id", Integer, primary_key=True),
+    Column("source", String(255), primary_key=True),
+    Column("entity", String(32), primary_key=True),
+    Column("old_id", Integer, primary_key=True),
+    Column("new_id", Integer, nullable=False),
+)
+
+
+def _ring_hash(value: str) -> int:
+    return int.from_bytes(hashlib.sha1(value.encode()).digest()[:8], "big")
+
+
+class HashRing:
+    """Consistent-hash ring of shard names with `vnodes` points per shard."""
+
+    def __init__(self, names: Iterable[str], vnodes: int = 64):
+        points = sorted((_ring_hash(f"{name}#{i}"), name) for name in names for i in range(vnodes))
+        self._hashes = [h for h, _ in points]
+        self._names = [name for _, name in points]
+
+    def shard_for(self, user_id: int) -> str:
+        index = bisect.bisect(self._hashes, _ring_hash(str(user_id))) % len(self._hashes)
+        return self._names[index]
+
+
+class ShardRouter:
+    """Map user ids to shard engines and hand out sessions bound to them."""
+
+    def __init__(self, global_engine: Engine, shards: Optional[Dict[str, Engine]] = None, vnodes: int = 64,
+                 session_factory: Optional[sessionmaker] = None):
+        self.global_engine = global_engine
+        self.shards = shards or {}
+        self.ring = HashRing(self.shards, vnodes) if self.shards else None
+        self._sessions = session_factory or sessionmaker(autocommit=False, autoflush=False, bind=global_engine)
+
+    @classmethod
+    def from_env(cls, global_engine: Engine, session_factory: Optional[sessionmaker] = None,
+                 **engine_kwargs) -> "ShardRouter":
+        """Build a router from DATABASE_SHARD_URLS (comma-separated) and SHARD_VNODES."""
+        urls = [url.strip() for url in os.getenv("DATABASE_SHARD_URLS", "").split(",") if url.strip()]
+        if urls and (os.getenv("DATABASE_REPLICA_URLS", "").strip() or os.getenv("SQLITE_ARCHIVE_PATH")):
+            raise RuntimeError("DATABASE_SHARD_URLS cannot be combined with DATABASE_REPLICA_URLS or SQLITE_ARCHIVE_PATH")
+        shards = {}
+        for url in urls:
+            shard = create_engine(url, **engine_kwargs)
+            apply_sqlite_profile(shard)
+            shards[url] = shard
+        return cls(global_engine, shards, vnodes=int(os.getenv("SHARD_VNODES", "64")), session_factory=session_factory)
+
+    @property
+    def sharded(self) -> bool:
+        return bool(self.shards)
+
+    @property
+    def engines(self) -> List[Engine]:
+        """Every engine that holds per-user data."""
+        return list(self.shards.values()) if self.shards else [self.global_engine]
+
+    def engine_for(self, user_id: int) -> Engine:
+        if not self.shards:
+            return self.global_engine
+        return self.shards[self.ring.shard_for(user_id)]
+
+    def bind(self, session: Session, user_id: int):
+        """Point an existing session's default bind at the user's shard (mapped global tables keep theirs)."""
+        session.bind = self.engine_for(user_id)
+
+    def session(self, user_id: int) -> Session:
+        return self._sessions(bind=self.engine_for(user_id))
+
+    def create_all(self, metadata: MetaData, global_tables: Iterable[str]):
+        """Create the per-user tables on every shard."""
+        skip = set(global_tables)
+        tables = [table for table in metadata.sorted_tables if table.name not in skip]
+        for shard in self.shards.values():
+            metadata.create_all(bind=shard, tables=tables)
+
+
+def _insert_returning_ids(conn: Connection, table: Table, rows: List[dict]) -> List[int]:
+    if not rows:
+        return []
+    stmt = insert(table).returning(table.c.id, sort_by_parameter_order=True)
+    return [row_id for (row_id,) in conn.execute(stmt, rows)]
+
+
+def _clear_user(conn: Connection, tables: Dict[str, Table], user_id: int):
+    if "transaction_tags" in tables and "transactions" in tables:
+        links, t = tables["transaction_tags"], tables["transactions"]
+        conn.execute(delete(links).where(links.c.transaction_id.in_(select(t.c.id).where(t.c.user_id == user_id))))
+    for name in reversed(USER_TABLES + DERIVED_TABLES):
+        if name in tables and "user_id" in tables[name].c:
+            conn.execute(delete(tables[name]).where(tables[name].c.user_id == user_id))
+
+
+def _remap_response(body: Optional[str], transaction_ids: Dict[int, int]) -> Optional[str]:
+    """A stored idempotent response with its transaction ids moved; an id whose row is gone becomes null."""
+    if not body:
+        return body
+    try:
+        response = json.loads(body)
+    except ValueError:
+        return body
+    if not isinstance(response, dict):
+        return body
+    for key in ("id", "duplicate_of"):
+        if isinstance(response.get(key), int):
+            response[key] = transaction_ids.get(response[key])
+    return json.dumps(response, default=str)
+
+
+def move_user(source: Connection, target: Connection, source_tables: Dict[str, Table],
+              target_tables: Dict[str, Table], user_id: int, batch_size: int = 5000,
+              id_maps: Optional[Dict[str, Dict[int, int]]] = None) -> Dict[str, int]:
+    """Copy one user's rows from `source` to `target` with new ids, then delete them from `source`.
+
+    Both connections should be in a transaction; commit the target before the
+    source so a crash never leaves the user with no copy at all. A user with
+    nothing left in `source` is skipped, which makes reruns safe. Pass a dict
+    as `id_maps` to get the old -> new ids per table back (see remap_audit).
+    """
+    owned = [source_tables[name] for name in USER_TABLES if name in source_tables and "user_id" in source_tables[name].c]
+    if not any(source.execute(select(table.c.id).where(table.c.user_id == user_id).limit(1)).first() for table in owned):
+        # Already moved by an earlier run; clearing the target now would delete the real copy
+        return {}
+    _clear_user(target, target_tables, user_id)
+    moved: Dict[str, int] = {}
+    id_maps = {} if id_maps is None else id_maps
+
+    def copy_rows(name: str, transform: Callable[[dict], dict] = lambda row: row):
+        src, dst = source_tables[name], target_tables[name]
+        mapping = id_maps.setdefault(name, {})
+        last_id = 0
+        while True:
+            rows = source.execute(
+                select(src).where(src.c.user_id == user_id, src.c.id > last_id).order_by(src.c.id).limit(batch_size)
+            ).mappings().all()
+            if not rows:
+                break
+            payload = [transform({k: v for k, v in row.items() if k != "id" and k in dst.c}) for row in rows]
+            for row, new_id in zip(rows, _insert_returning_ids(target, dst, payload)):
+                mapping[row["id"]] = new_id
+            last_id = rows[-1]["id"]
+        moved[name] = len(mapping)
+
+    if "categories" in source_tables:
+        categories = source_tables["categories"]
+
+        def predefined(tables, conn):
+            # Predefined categories exist in every shard but not necessarily under the same ids
+            table = tables["categories"]
+            return {row.id: (row.name, row.type) for row in conn.execute(select(table).where(table.c.user_id.is_(None)))}
+
+        target_predefined = {key: row_id for row_id, key in predefined(target_tables, target).items()}
+        predefined_map = {
+            old_id: target_predefined[key]
+            for old_id, key in predefined(source_tables, source).items() if key in target_predefined
+        }
+        copy_rows("categories", lambda row: {**row, "parent_id": None})
+        mapping = id_maps["categories"]
+        for old_id, parent_id in source.execute(
+            select(categories.c.id, categories.c.parent_id)
+            .where(categories.c.user_id == user_id, categories.c.parent_id.is_not(None))
+        ):
+            new_parent = mapping.get(parent_id, predefined_map.get(parent_id))
+            target.execute(
+                update(target_tables["categories"])
+                .where(target_tables["categories"].c.id == mapping[old_id])
+                .values(parent_id=new_parent)
+            )
+    for name in ("tags", "transactions"):
+        if name in source_tables and name in target_tables:
+            copy_rows(name)
+    if "idempotency_keys" in source_tables and "idempotency_keys" in target_tables:
+        # A replayed response must name the rows as they are numbered on the new shard
+        transaction_ids = id_maps.get("transactions", {})
+        copy_rows("idempotency_keys", lambda row: {
+            **row, "response_body": _remap_response(row.get("response_body"), transaction_ids)
+        })
+
+    if "transaction_tags" in source_tables and "transactions" in id_maps and "tags" in id_maps:
+        links = source_tables["transaction_tags"]
+        transaction_ids = list(id_maps["transactions"])
+        moved["transaction_tags"] = 0
+        for i in range(0, len(transaction_ids), batch_size):
+            rows = source.execute(
+                select(links.c.transaction_id, links.c.tag_id)
+                .where(links.c.transaction_id.in_(transaction_ids[i:i + batch_size]))
+            ).all()
+            payload = [
+                {"transaction_id": id_maps["transactions"][transaction_id], "tag_id": id_maps["tags"][tag_id]}
+                for transaction_id, tag_id in rows if tag_id in id_maps["tags"]
+            ]
+            if payload:
+                target.execute(insert(target_tables["transaction_tags"]), payload)
+            moved["transaction_tags"] += len(payload)
+
+    _clear_user(source, source_tables, user_id)
+    return moved
+
+
+def _remap_image(image: Optional[str], ids: Dict[int, int]) -> Optional[str]:
+    if not image:
+        return image
+    values = json.loads(image)
+    if isinstance(values.get("id"), int) and values["id"] in ids:
+        values["id"] = ids[values["id"]]
+    return json.dumps(values, separators=(",", ":"))
+
+
+def remap_audit(conn: Connection, audit: Table, user_id: int, source_url: str,
+                id_maps: Dict[str, Dict[int, int]], batch_size: int = 5000):
+    """Point the user's audit entries (and the ids in their images) at the ids a move assigned.
+
+    Run in a global-database transaction committed after the target shard and
+    before the source. The mapping is recorded in shard_id_remaps; if the
+    source commit never happens, the rerun copies the rows again under fresh
+    ids and translates from the ids this attempt wrote rather than the source
+    ids. Call clear_remaps once the source copy is gone.
+    """
+    remaps = id_remaps.c
+    for table_name, entity in AUDITED_TABLES.items():
+        mapping = id_maps.get(table_name, {})
+        condition = (remaps.user_id == user_id, remaps.source == source_url, remaps.entity == entity)
+        previous = dict(conn.execute(select(remaps.old_id, remaps.new_id).where(*condition)).all())
+        # The audit log holds the ids of an earlier attempt if there was one, else the source's
+        translate = {previous.get(old_id, old_id): new_id for old_id, new_id in mapping.items()}
+        if previous:
+            translate.update({written: None for old_id, written in previous.items() if old_id not in mapping})
+        a = audit.c
+        last_id = 0
+        while True:
+            rows = conn.execute(
+                select(a.id, a.entity_id, a.before, a.after)
+                .where(a.user_id == user_id, a.entity == entity, a.entity_id.is_not(None), a.id > last_id)
+                .order_by(a.id).limit(batch_size)
+            ).all()
+            if not rows:
+                break
+            # No new id: the row was deleted before the move, so the old id would name some other row here
+            conn.execute(
+                update(audit).where(a.id == bindparam("entry_id"))
+                .values(entity_id=bindparam("new_entity_id"), before=bindparam("new_before"), after=bindparam("new_after")),
+                [{"entry_id": row.id, "new_entity_id": translate.get(row.entity_id),
+                  "new_before": _remap_image(row.before, translate), "new_after": _remap_image(row.after, translate)}
+                 for row in rows],
+            )
+            last_id = rows[-1].id
+        conn.execute(delete(id_remaps).where(*condition))
+        if mapping:
+            conn.execute(insert(id_remaps), [
+                {"user_id": user_id, "source": source_url, "entity": entity, "old_id": old_id, "new_id": new_id}
+                for old_id, new_id in mapping.items()
+            ])
+
+
+def clear_remaps(conn: Connection, user_id: Optional[int] = None, source_url: Optional[str] = None):
+    """Forget finished moves: one user's from one source, or (no arguments) every recorded one."""
+    conditions = []
+    if user_id is not None:
+        conditions += [id_remaps.c.user_id == user_id, id_remaps.c.source == source_url]
+    conn.execute(delete(id_remaps).where(*conditions))
+
+
+def _reflect(engine: Engine, names: Iterable[str]) -> Dict[str, Table]:
+    metadata = MetaData()
+    existing = set(inspect(engine).get_table_names())
+    # Shards have no users table, so foreign keys to it cannot be followed
+    return {name: Table(name, metadata, autoload_with=engine, resolve_fks=False) for name in names if name in existing}
+
+
+def _ensure_tables(source: Engine, target: Engine, names: Iterable[str]):
+    """Create tables missing on a brand-new shard by replaying their DDL from an existing one."""
+    existing = set(inspect(target).get_table_names())
+    missing = [name for name in names if name not in existing]
+    if not missing:
+        return
+    with source.connect() as conn:
+        statements = conn.execute(
+            select(text("sql")).select_from(text("sqlite_master"))
+            .where(text("sql IS NOT NULL"), column("tbl_name").in_(missing))
+            # Tables before their indexes
+            .order_by(column("type").desc())
+        ).scalars().all()
+    with target.begin() as conn:
+        for statement in statements:
+            conn.exec_driver_sql(statement)
+
+
+def _ensure_predefined_categories(source: Engine, target: Engine, source_table: Table, target_table: Table):
+    """Give a new shard the shared predefined categories, with the same ids as the reference shard."""
+    with target.connect() as conn:
+        if conn.execute(select(target_table.c.id).where(target_table.c.user_id.is_(None)).limit(1)).first():
+            return
+    with source.connect() as conn:
+        rows = conn.execute(select(source_table).where(source_table.c.user_id.is_(None))).mappings().all()
+    if rows:
+        with target.begin() as conn:
+            conn.execute(insert(target_table), [dict(row) for row in rows])
+
+
+def rebalance(global_engine: Engine, old_urls: List[str], new_urls: List[str], vnodes: int = 64,
+              dry_run: bool = False) -> Dict[str, int]:
+    """Move every user whose shard differs between the old and the new ring. Run with the app stopped."""
+    old_ring, new_ring = HashRing(old_urls, vnodes), HashRing(new_urls, vnodes)
+    engines = {url: create_engine(url) for url in set(old_urls) | set(new_urls)}
+    names = USER_TABLES + DERIVED_TABLES
+    users = Table("users", MetaData(), autoload_with=global_engine)
+    with global_engine.connect() as conn:
+        user_ids = conn.execute(select(users.c.id).order_by(users.c.id)).scalars().all()
+    moves = [(user_id, old_ring.shard_for(user_id), new_ring.shard_for(user_id)) for user_id in user_ids]
+    moves = [move for move in moves if move[1] != move[2]]
+    audit = Table("audit_entries", MetaData(), autoload_with=global_engine) if inspect(global_engine).has_table("audit_entries") else None
+    summary = {"users": len(user_ids), "moving": len(moves), "moved": 0, "rows": 0}
+    if dry_run:
+        return summary
+
+    reference = engines[old_urls[0]]
+    if not inspect(reference).has_table("transactions"):
+        raise ValueError(f"{old_urls[0]} has no transactions table; --from must list the shards in use")
+    for url in new_urls:
+        _ensure_tables(reference, engines[url], names)
+    tables = {url: _reflect(engine, names) for url, engine in engines.items()}
+    for url in new_urls:
+        _ensure_predefined_categories(reference, engines[url], tables[old_urls[0]]["categories"], tables[url]["categories"])
+    id_remaps.create(global_engine, checkfirst=True)
+    with global_engine.begin() as conn:
+        # Rows left by a crashed run belong to a move this run repeats; anything else is from a finished move
+        pending = {(user_id, old_url) for user_id, old_url, _ in moves}
+        for user_id, source_url in conn.execute(select(id_remaps.c.user_id, id_remaps.c.source).distinct()).all():
+            if (user_id, source_url) not in pending:
+                clear_remaps(conn, user_id, source_url)
+    for user_id, old_url, new_url in moves:
+        with engines[old_url].connect() as source, engines[new_url].connect() as target:
+            source.begin()
+            target.begin()
+            id_maps: Dict[str, Dict[int, int]] = {}
+            moved = move_user(source, target, tables[old_url], tables[new_url], user_id, id_maps=id_maps)
+            target.commit()
+            if moved and audit is not None:
+                with global_engine.begin() as conn:
+                    remap_audit(conn, audit, user_id, old_url, id_maps)
+            source.commit()
+        if moved:
+            with global_engine.begin() as conn:
+                clear_remaps(conn, user_id, old_url)
+        if not moved:
+            continue
+        summary["moved"] += 1
+        summary["rows"] += sum(moved.values())
+        print(f"user {user_id}: {old_url} -> {new_url} ({moved.get('transactions', 0)} transactions)")
+    for engine in engines.values():
+        engine.dispose()
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Per-user SQLite shard maintenance")
+    sub = parser.add_subparsers(dest="command", required=True)
+    locate = sub.add_parser("locate", help="print the shard a user id maps to")
+    locate.add_argument("user_id", type=int)
+    locate.add_argument("--shards", default=os.getenv("DATABASE_SHARD_URLS", ""))
+    move = sub.add_parser("rebalance", help="move users between shard layouts (stop the app first)")
+    move.add_argument("--from", dest="old", required=True, help="comma-separated shard URLs currently in use")
+    move.add_argument("--to", dest="new", required=True, help="comma-separated shard URLs to move to")
+    move.add_argument("--global-url", default=os.getenv("DATABASE_URL", "sqlite:///./finance_app.db"))
+    move.add_argument("--dry-run", action="store_true", help="only count the users that would move")
+    args = parser.parse_args()
+    vnodes = int(os.getenv("SHARD_VNODES", "64"))
+
+    def split(value):
+        return [url.strip() for url in value.split(",") if url.strip()]
+
+    if args.command == "locate":
+        if not split(args.shards):
+            parser.error("no shards configured (DATABASE_SHARD_URLS or --shards)")
+        print(HashRing(split(args.shards), vnodes).shard_for(args.user_id))
+        return
+    summary = rebalance(create_engine(args.global_url), split(args.old), split(args.new), vnodes, args.dry_run)
+    if args.dry_run:
+        print(f"{summary['moving']} of {summary['users']} users would move")
+    else:
+        print(f"{summary['moved']} of {summary['users']} users moved ({summary['moving'] - summary['moved']} already in place), "
+              f"{summary['rows']} rows copied")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""Single-flight coalescing of identical concurrent reads.
+
+A client that opens several widgets at once fires the same GET several times
+in parallel. The first request for a key starts the computation as its own
+task; identical requests that arrive while it is running await that task and
+get the same serialised bytes, so N parallel calls cost one DB round.
+
+Keys are (user, write generation, route, normalised query string). Every
+committed write for a user bumps that user's generation, so a request that
+arrives after a write never joins a computation that started before it.
+
+The computation is not tied to the request that started it: if that client
+disconnects the others still get their answer.
+
+READ_COALESCING=false turns the layer into a pass-through (for comparisons).
+"""
+import asyncio
+import os
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Dict, Hashable, Tuple
+
+
+@dataclass
+class SingleFlightStats:
+    calls: int = 0
+    computations: int = 0
+    coalesced: int = 0
+    in_flight: int = 0
+
+
+class SingleFlight:
+    """In-flight computations per key, for one event loop."""
+
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self.stats = SingleFlightStats()
+        self._in_flight: Dict[Hashable, asyncio.Task] = {}
+        self._generations: Dict[int, int] = {}
+
+    @classmethod
+    def from_env(cls) -> "SingleFlight":
+        return cls(enabled=os.getenv("READ_COALESCING", "true").lower() == "true")
+
+    def invalidate(self, user_id: int):
+        """Called after a user's write commits; may run on any thread, a plain int bump is enough."""
+        self._generations[user_id] = self._generations.get(user_id, 0) + 1
+
+    def key_for(self, user_id: int, path: str, query_params) -> Tuple:
+        # Parameter order and repeated names should not split otherwise identical calls
+        params = tuple(sorted(query_params.multi_items()))
+        return (user_id, self._generations.get(user_id, 0), path, params)
+
+    async def run(self, key: Hashable, compute: Callable[[], Awaitable[Any]]) -> Any:
+        self.stats.calls += 1
+        if not self.enabled:
+            self.stats.computations += 1
+            return await compute()
+        task = self._in_flight.get(key)
+        if task is None:
+            self.stats.computations += 1
+            task = asyncio.ensure_future(compute())
+            self._in_flight[key] = task
+            self.stats.in_flight = len(self._in_flight)
+            task.add_done_callback(lambda done: self._finished(key, done))
+        else:
+            self.stats.coalesced += 1
+        # A cancelled caller must not cancel the shared computation
+        return await asyncio.shield(task)
+
+    def _finished(self, key: Hashable, task: asyncio.Task):
+        if self._in_flight.get(key) is task:
+            del self._in_flight[key]
+        self.stats.in_flight = len(self._in_flight)
+        if not task.cancelled():
+            # Mark the exception as retrieved when every caller has gone away
+            task.exception()
+
+    def snapshot(self) -> Dict[str, int]:
+        return dict(self.stats.__dict__)
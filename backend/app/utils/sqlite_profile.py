@@ -0,0 +1,222 @@
+import asyncio
+import os
+import sqlite3
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from dotenv import load_dotenv
+from sqlalchemy import event, insert, Table
+from sqlalchemy.engine import Connection, Engine
+
+load_dotenv()
+
+
+@dataclass
+class SQLiteProfile:
+    """PRAGMA settings applied to every new SQLite connection."""
+    journal_mode: str = "WAL"
+    synchronous: str = "NORMAL"
+    mmap_size: int = 256 * 1024 * 1024
+    # Negative values are KiB, so this is a 64 MiB page cache per connection
+    cache_size: int = -64 * 1024
+    busy_timeout_ms: int = 5000
+    temp_store: str = "MEMORY"
+    foreign_keys: bool = False
+
+    @classmethod
+    def from_env(cls) -> "SQLiteProfile":
+        """Build a profile from SQLITE_* environment variables."""
+        defaults = cls()
+        return cls(
+            journal_mode=os.getenv("SQLITE_JOURNAL_MODE", defaults.journal_mode),
+            synchronous=os.getenv("SQLITE_SYNCHRONOUS", defaults.synchronous),
+            mmap_size=int(os.getenv("SQLITE_MMAP_SIZE", defaults.mmap_size)),
+            cache_size=int(os.getenv("SQLITE_CACHE_SIZE", defaults.cache_size)),
+            busy_timeout_ms=int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", defaults.busy_timeout_ms)),
+            temp_store=os.getenv("SQLITE_TEMP_STORE", defaults.temp_store),
+            foreign_keys=os.getenv("SQLITE_FOREIGN_KEYS", "false").lower() == "true",
+        )
+
+    def pragmas(self) -> List[Tuple[str, Any]]:
+        """Return the PRAGMA statements in the order they must run."""
+        return [
+            # busy_timeout first so the journal_mode switch itself can wait for a lock
+            ("busy_timeout", self.busy_timeout_ms),
+            ("journal_mode", self.journal_mode),
+            ("synchronous", self.synchronous),
+            ("mmap_size", self.mmap_size),
+            ("cache_size", self.cache_size),
+            ("temp_store", self.temp_store),
+            ("foreign_keys", "ON" if self.foreign_keys else "OFF"),
+        ]
+
+
+def apply_sqlite_profile(engine: Engine, profile: Optional[SQLiteProfile] = None) -> Optional[SQLiteProfile]:
+    """Register a connect hook that applies the profile to each pooled connection.
+
+    Does nothing for non-SQLite engines so callers can apply it unconditionally.
+    """
+    if engine.dialect.name != "sqlite":
+        return None
+    profile = profile or SQLiteProfile.from_env()
+
+    @event.listens_for(engine, "connect")
+    def _set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            for name, value in profile.pragmas():
+                cursor.execute(f"PRAGMA {name}={value}")
+        finally:
+            cursor.close()
+
+    return profile
+
+
+def sqlite_pragma_values(engine: Engine) -> Dict[str, Any]:
+    """Read back the effective PRAGMA values, mostly for diagnostics."""
+    names = ["journal_mode", "synchronous", "mmap_size", "cache_size", "busy_timeout", "temp_store"]
+    with engine.connect() as conn:
+        return {name: conn.exec_driver_sql(f"PRAGMA {name}").scalar() for name in names}
+
+
+class GroupCommitQueue:
+    """Single-writer queue that coalesces small writes into group commits.
+
+    Callers `await submit(row)` and get the generated primary key back, or
+    `await submit_job(fn)` to run a whole unit of work - `fn(conn)` on the
+    writer's connection, e.g. an insert plus the rows derived from it - and
+    get its return value. One background task drains the queue, waits up to
+    `max_delay` seconds for more work (or until `max_batch` items are pending)
+    and writes the whole batch inside a single transaction: the rows with one
+    multi-row INSERT ... RETURNING, each job in its own SAVEPOINT, so a failing
+    item rolls back alone. Results are handed out only once the batch has
+    committed. Only this task ever writes through the queue, so SQLite never
+    sees two writers fighting over the database lock for this work.
+    """
+
+    def __init__(self, engine: Engine, table: Table, max_batch: int = 64, max_delay: float = 0.002):
+        self.engine = engine
+        self.table = table
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.batches_committed = 0
+        self.rows_committed = 0
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+
+    @classmethod
+    def from_env(cls, engine: Engine, table: Table) -> Optional["GroupCommitQueue"]:
+        """Create the queue when SQLITE_WRITE_QUEUE is enabled, otherwise return None."""
+        if engine.dialect.name != "sqlite":
+            return None
+        if os.getenv("SQLITE_WRITE_QUEUE", "false").lower() != "true":
+            return None
+        return cls(
+            engine,
+            table,
+            max_batch=int(os.getenv("SQLITE_WRITE_QUEUE_MAX_BATCH", "64")),
+            max_delay=float(os.getenv("SQLITE_WRITE_QUEUE_MAX_DELAY_MS", "2")) / 1000,
+        )
+
+    def _ensure_worker(self):
+        if self._worker is None or self._worker.done():
+            self._queue = asyncio.Queue()
+            self._worker = asyncio.get_running_loop().create_task(self._run())
+
+    async def _put(self, kind: str, payload) -> Any:
+        self._ensure_worker()
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((kind, payload, future))
+        return await future
+
+    async def submit(self, row: Dict[str, Any]) -> int:
+        """Queue one row for insertion and wait for its primary key."""
+        return await self._put("row", row)
+
+    async def submit_job(self, job: Callable[[Connection], Any]) -> Any:
+        """Queue `job(conn)` to run in the writer's transaction and wait for its result after the commit."""
+        return await self._put("job", job)
+
+    async def _run(self):
+        stopping = False
+        while not stopping:
+            item = await self._queue.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = asyncio.get_running_loop().time() + self.max_delay
+            while len(batch) < self.max_batch:
+                timeout = deadline - asyncio.get_running_loop().time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            await self._commit_batch(batch)
+
+    async def _commit_batch(self, batch):
+        try:
+            outcomes = await asyncio.to_thread(self._write_batch, [(kind, payload) for kind, payload, _ in batch])
+        except Exception as e:
+            # The commit itself failed, so nothing in the batch landed
+            outcomes = [e] * len(batch)
+        for (_, _, future), outcome in zip(batch, outcomes):
+            if future.done():
+                continue
+            if isinstance(outcome, Exception):
+                future.set_exception(outcome)
+            else:
+                future.set_result(outcome)
+
+    def _write_batch(self, items: List[Tuple[str, Any]]) -> List[Any]:
+        """One transaction for the batch; returns each item's result, or the exception that rolled it back."""
+        outcomes: List[Any] = [None] * len(items)
+        rows = [(index, payload) for index, (kind, payload) in enumerate(items) if kind == "row"]
+        with self.engine.begin() as conn:
+            if rows:
+                try:
+                    with conn.begin_nested():
+                        ids = self._insert_rows(conn, [row for _, row in rows])
+                    for (index, _), row_id in zip(rows, ids):
+                        outcomes[index] = row_id
+                except Exception:
+                    # One bad row must not fail its neighbours, so retry them one by one
+                    for index, row in rows:
+                        outcomes[index] = self._attempt(conn, lambda conn, row=row: self._insert_rows(conn, [row])[0])
+            for index, (kind, job) in enumerate(items):
+                if kind == "job":
+                    outcomes[index] = self._attempt(conn, job)
+        self.batches_committed += 1
+        self.rows_committed += sum(not isinstance(outcome, Exception) for outcome in outcomes)
+        return outcomes
+
+    @staticmethod
+    def _attempt(conn: Connection, job: Callable[[Connection], Any]) -> Any:
+        try:
+            with conn.begin_nested():
+                return job(conn)
+        except Exception as e:
+            return e
+
+    def _insert_rows(self, conn: Connection, rows: List[Dict[str, Any]]) -> List[int]:
+        stmt = insert(self.table).returning(self.table.c.id, sort_by_parameter_order=True)
+        return [row_id for (row_id,) in conn.execute(stmt, rows)]
+
+    async def close(self):
+        """Commit everything already queued, then stop the writer task."""
+        if self._worker is None:
+            return
+        await self._queue.put(None)
+        await self._worker
+        self._worker = None
+
+
+def is_lock_error(exc: BaseException) -> bool:
+    """True when an exception (or the DBAPI error it wraps) is SQLite's lock error."""
+    orig = getattr(exc, "orig", exc)
+    return isinstance(orig, sqlite3.OperationalError) and "locked" in str(orig)
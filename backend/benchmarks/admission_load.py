@@ -0,0 +1,173 @@
+"""Overload test for admission control and the login rate limiter.
+
+Starts one uvicorn worker on a scratch database seeded with --rows
+transactions, then for --seconds runs three client populations at once:
+
+  cheap     - GET /api/categories, the latency we want to protect
+  analytics - GET /api/transactions/duplicates over the whole ledger
+  login     - POST /api/auth/login (Argon2 verify)
+
+and reports status counts and latency percentiles per population. The run is
+repeated with ADMISSION_ENABLED=false for comparison. The login rate limiter is
+off for those two runs (every client shares 127.0.0.1) and exercised on its own
+at the end.
+
+Usage:
+    python benchmarks/admission_load.py --rows 50000 --seconds 15
+"""
+import argparse
+import asyncio
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+
+import httpx
+
+BACKEND = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+EMAIL, PASSWORD = "load@example.com", "load-test-pw"
+
+
+def seed(db_path, rows):
+    from sqlalchemy import MetaData, Table, create_engine, insert, select
+
+    engine = create_engine(f"sqlite:///{db_path}")
+    transactions = Table("transactions", MetaData(), autoload_with=engine)
+    users = Table("users", MetaData(), autoload_with=engine)
+    rng = random.Random(1)
+    origin = datetime(2024, 1, 1)
+    with engine.begin() as conn:
+        user_id = conn.execute(select(users.c.id).where(users.c.email == EMAIL)).scalar_one()
+        for offset in range(0, rows, 50000):
+            conn.execute(insert(transactions), [
+                {
+                    "user_id": user_id,
+                    "title": f"Shop {rng.randrange(500)}",
+                    "amount": -round(rng.uniform(1, 100), 2),
+                    "category": "Food",
+                    "type": "expense",
+                    "date": origin + timedelta(days=rng.randrange(700)),
+                    "fingerprint": f"{rng.randrange(rows // 2):032x}",
+                }
+                for _ in range(min(50000, rows - offset))
+            ])
+    engine.dispose()
+
+
+def stop_server(server):
+    server.terminate()
+    try:
+        server.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        # Graceful shutdown waits for every in-flight request; an overloaded worker may never get there
+        server.kill()
+        server.wait()
+
+
+def start_server(tmp, port, extra_env):
+    env = {**os.environ, "PYTHONPATH": BACKEND, "AUTH_RATE_LIMIT_ENABLED": "false", **extra_env}
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(port), "--log-level", "warning"],
+        cwd=tmp, env=env, stdout=subprocess.DEVNULL,
+    )
+    for _ in range(200):
+        try:
+            httpx.get(f"http://127.0.0.1:{port}/")
+            return server
+        except httpx.TransportError:
+            time.sleep(0.1)
+    raise RuntimeError("server did not start")
+
+
+async def client(http, method, url, results, deadline, **kwargs):
+    while time.perf_counter() < deadline:
+        started = time.perf_counter()
+        try:
+            response = await http.request(method, url, **kwargs)
+            outcome = response.status_code
+        except httpx.TimeoutException:
+            outcome = "timeout"
+        except httpx.TransportError:
+            outcome = "error"
+        results.append((outcome, time.perf_counter() - started))
+        if outcome in (429, 503):
+            # Well-behaved clients honour Retry-After
+            await asyncio.sleep(float(response.headers.get("retry-after", 1)))
+
+
+def report(name, results):
+    counts = Counter(outcome for outcome, _ in results)
+    ok = sorted(elapsed for outcome, elapsed in results if outcome == 200)
+    shed = sorted(elapsed for outcome, elapsed in results if outcome == 503)
+
+    def pct(values, q):
+        return f"{values[min(len(values) - 1, int(len(values) * q))] * 1000:7.1f}" if values else "      -"
+
+    print(f"  {name:<10} {dict(counts)}")
+    print(f"  {'':<10} 200 p50 {pct(ok, 0.5)} ms  p99 {pct(ok, 0.99)} ms"
+          f"   503 p50 {pct(shed, 0.5)} ms")
+
+
+async def overload(base, token, seconds, cheap, analytics, logins):
+    headers = {"Authorization": f"Bearer {token}"}
+    deadline = time.perf_counter() + seconds
+    results = {"cheap": [], "analytics": [], "login": []}
+    limits = httpx.Limits(max_connections=cheap + analytics + logins + 10)
+    async with httpx.AsyncClient(base_url=base, timeout=30, limits=limits) as http:
+        tasks = (
+            [client(http, "GET", "/api/categories", results["cheap"], deadline, headers=headers) for _ in range(cheap)]
+            + [client(http, "GET", "/api/transactions/duplicates", results["analytics"], deadline,
+                      headers=headers, params={"limit": 1000}) for _ in range(analytics)]
+            + [client(http, "POST", "/api/auth/login", results["login"], deadline,
+                      json={"email": EMAIL, "password": PASSWORD}) for _ in range(logins)]
+        )
+        await asyncio.gather(*tasks)
+    for name, values in results.items():
+        report(name, values)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=50_000)
+    parser.add_argument("--seconds", type=float, default=15)
+    parser.add_argument("--cheap", type=int, default=8)
+    parser.add_argument("--analytics", type=int, default=48)
+    parser.add_argument("--logins", type=int, default=32)
+    parser.add_argument("--port", type=int, default=8766)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        base = f"http://127.0.0.1:{args.port}"
+        server = start_server(tmp, args.port, {})
+        try:
+            httpx.post(base + "/api/auth/register", json={"email": EMAIL, "password": PASSWORD})
+        finally:
+            stop_server(server)
+        seed(os.path.join(tmp, "finance_app.db"), args.rows)
+
+        for enabled in ("false", "true"):
+            server = start_server(tmp, args.port, {"ADMISSION_ENABLED": enabled})
+            try:
+                token = httpx.post(base + "/api/auth/login", json={"email": EMAIL, "password": PASSWORD}).json()["access_token"]
+                print(f"admission {'on' if enabled == 'true' else 'off'}:")
+                asyncio.run(overload(base, token, args.seconds, args.cheap, args.analytics, args.logins))
+            finally:
+                stop_server(server)
+
+        server = start_server(tmp, args.port, {"AUTH_RATE_LIMIT_ENABLED": "true"})
+        try:
+            statuses = Counter(
+                httpx.post(base + "/api/auth/login", json={"email": EMAIL, "password": "wrong"}).status_code
+                for _ in range(20)
+            )
+            print(f"rate limiter, 20 bad logins for one account: {dict(statuses)}")
+        finally:
+            stop_server(server)
+
+
+if __name__ == "__main__":
+    main()
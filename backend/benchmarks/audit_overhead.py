@@ -0,0 +1,122 @@
+"""Write-path cost of the audit log in each durability mode.
+
+Each mode runs in its own process with a fresh app database (AUDIT_LOG_MODE
+set before `import main`) and does write cycles through the app's session and
+its flush/commit hooks: create a transaction, edit it, and delete every fourth
+one, one session and commit per write like a request. Inside the process,
+--pairs pairs of --block cycles run once with the log switched on and once
+off (the hooks read `main.audit_log`), alternating which goes first, so
+database growth and machine noise hit both sides alike. Every "on" block ends
+with a synchronous flush, which charges the batched inserts the background
+thread would do to the block that produced them (in smaller batches than
+AUDIT_LOG_MAX_BATCH, so slightly overstated). Reported per write: median wall
+time and process CPU time (all threads) of each side, and the median of the
+per-pair on/off ratios as the overhead.
+
+Usage:
+    python benchmarks/audit_overhead.py --pairs 40 --block 100
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+BACKEND = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MODES = ["async", "spool", "transactional"]
+
+
+def worker(pairs, block, warmup):
+    sys.path.insert(0, BACKEND)
+    import main
+    from main import SessionLocal, Transaction, User
+
+    log = main.audit_log
+    db = SessionLocal()
+    user = User(email="bench@example.com", hashed_password="-")
+    db.add(user)
+    db.commit()
+    user_id = user.id
+    db.close()
+
+    def cycle(i):
+        db = SessionLocal()
+        db.info["user_id"] = user_id
+        writes = 2
+        transaction = Transaction(user_id=user_id, title=f"Payment {i}", amount=-12.5, category="Food", type="expense",
+                                  currency="USD", date=datetime(2026, 1, 1) + timedelta(minutes=i))
+        db.add(transaction)
+        db.commit()
+        transaction.amount = -13.0
+        transaction.title = f"Payment {i} (edited)"
+        db.commit()
+        if i % 4 == 0:
+            db.delete(transaction)
+            db.commit()
+            writes += 1
+        db.close()
+        return writes
+
+    for i in range(warmup):
+        cycle(i)
+    log.flush()
+    samples = {"off": [], "on": []}
+    i = warmup
+    for pair in range(pairs):
+        for side in (("off", "on") if pair % 2 == 0 else ("on", "off")):
+            main.audit_log = log if side == "on" else None
+            writes = 0
+            wall, cpu = time.perf_counter(), time.process_time()
+            for _ in range(block):
+                writes += cycle(i)
+                i += 1
+            if side == "on":
+                log.flush()
+            samples[side].append(((time.perf_counter() - wall) / writes * 1e6, (time.process_time() - cpu) / writes * 1e6))
+    log.close()
+    result = {"audit": log.snapshot()}
+    for index, name in enumerate(("wall", "cpu")):
+        off = [sample[index] for sample in samples["off"]]
+        on = [sample[index] for sample in samples["on"]]
+        result[name] = {
+            "off_us": statistics.median(off),
+            "on_us": statistics.median(on),
+            "overhead": statistics.median(b / a - 1 for a, b in zip(off, on)),
+        }
+    print(json.dumps(result))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pairs", type=int, default=40)
+    parser.add_argument("--block", type=int, default=100)
+    parser.add_argument("--warmup", type=int, default=200)
+    parser.add_argument("--worker", choices=MODES, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.worker:
+        worker(args.pairs, args.block, args.warmup)
+        return
+
+    print(f"{'mode':<14} {'off wall':>9} {'on wall':>9} {'overhead':>9} {'off cpu':>9} {'on cpu':>9} {'overhead':>9} {'entries':>8}")
+    for mode in MODES:
+        with tempfile.TemporaryDirectory() as tmp:
+            env = {**os.environ, "AUDIT_LOG_MODE": mode, "AUDIT_LOG_SPOOL_PATH": os.path.join(tmp, "audit_log.spool"),
+                   "REPORTS_ENABLED": "false", "BACKUP_ENABLED": "false"}
+            output = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), "--worker", mode, "--pairs", str(args.pairs),
+                 "--block", str(args.block), "--warmup", str(args.warmup)],
+                cwd=tmp, env=env, check=True, capture_output=True, text=True,
+            ).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        wall, cpu, audit = result["wall"], result["cpu"], result["audit"]
+        assert not audit["dropped"] and not audit["failures"], audit
+        print(f"{mode:<14} {wall['off_us']:7.0f}us {wall['on_us']:7.0f}us {wall['overhead'] * 100:8.1f}% "
+              f"{cpu['off_us']:7.0f}us {cpu['on_us']:7.0f}us {cpu['overhead'] * 100:8.1f}% {audit['written']:8}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+"""Balance-as-of-date from monthly checkpoints against summing the ledger.
+
+Seeds a scratch SQLite database with --rows transactions for one user over
+--months months, builds the checkpoints in one rebuild pass, then:
+
+  - for --queries random moments, times SUM(amount) over every earlier row
+    against balance_as_of (one checkpoint seek plus a tail scan of the month)
+    and checks that both agree;
+  - times single-row insert commits without and with apply_deltas, for rows
+    dated today and rows back-dated to the first month (which roll forward
+    through every later checkpoint).
+
+Usage:
+    python benchmarks/balance_checkpoints.py --rows 200000 --months 60 --queries 200
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import Column, DateTime, Float, Index, Integer, MetaData, String, Table, create_engine, func, insert, select
+
+from app.services.balances import apply_deltas, balance_as_of, checkpoint_deltas, rebuild
+from app.utils.sqlite_profile import apply_sqlite_profile
+
+metadata = MetaData()
+transactions = Table(
+    "transactions", metadata,
+    Column("id", Integer, primary_key=True),
+    Column("user_id", Integer),
+    Column("title", String),
+    Column("amount", Float),
+    Column("currency", String(3)),
+    Column("date", DateTime),
+    Index("ix_transactions_user_date", "user_id", "date"),
+)
+checkpoints = Table(
+    "balance_checkpoints", metadata,
+    Column("user_id", Integer, primary_key=True),
+    Column("currency", String(3), primary_key=True, default=""),
+    Column("month", String(7), primary_key=True),
+    Column("balance", Float, nullable=False),
+    Column("transaction_count", Integer, nullable=False),
+    Column("updated_at", DateTime),
+)
+
+ORIGIN = datetime(2020, 1, 1)
+
+
+def seed(engine, rows, months):
+    rng = np.random.default_rng(1)
+    span = months * 30 * 86400
+    with engine.begin() as conn:
+        for offset in range(0, rows, 50_000):
+            batch = min(50_000, rows - offset)
+            amounts = np.round(rng.normal(-20, 40, batch), 2)
+            seconds = rng.integers(0, span, batch)
+            conn.execute(insert(transactions), [
+                {"user_id": 1, "title": "Shop", "amount": float(a), "date": ORIGIN + timedelta(seconds=int(s))}
+                for a, s in zip(amounts.tolist(), seconds.tolist())
+            ])
+
+
+def timed_inserts(engine, rows, with_checkpoints):
+    started = time.perf_counter()
+    for when, amount in rows:
+        with engine.begin() as conn:
+            conn.execute(insert(transactions).values(user_id=1, title="Shop", amount=amount, date=when))
+            if with_checkpoints:
+                apply_deltas(conn, checkpoints, checkpoint_deltas([(1, None, when, amount, 1)]))
+    return (time.perf_counter() - started) / len(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=200_000)
+    parser.add_argument("--months", type=int, default=60)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--inserts", type=int, default=1000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        engine = create_engine(f"sqlite:///{os.path.join(tmp, 'bench.db')}")
+        apply_sqlite_profile(engine)
+        metadata.create_all(engine)
+        seed(engine, args.rows, args.months)
+
+        started = time.perf_counter()
+        with engine.begin() as conn:
+            count = rebuild(conn, checkpoints, transactions, 1)
+        print(f"rebuild: {count} checkpoints from {args.rows} rows in {time.perf_counter() - started:.2f} s")
+
+        rng = random.Random(2)
+        t = transactions.c
+        scan_times, checkpoint_times = [], []
+        for _ in range(args.queries):
+            moment = ORIGIN + timedelta(seconds=rng.randrange(args.months * 30 * 86400))
+            with engine.connect() as conn:
+                started = time.perf_counter()
+                want, rows = conn.execute(
+                    select(func.coalesce(func.sum(t.amount), 0.0), func.count()).where(t.user_id == 1, t.date <= moment)
+                ).one()
+                scan_times.append(time.perf_counter() - started)
+                started = time.perf_counter()
+                got, got_rows = balance_as_of(conn, checkpoints, transactions, 1, moment)[""]
+                checkpoint_times.append(time.perf_counter() - started)
+            assert got_rows == rows and abs(got - want) < 0.01, (moment, got, want)
+        print(f"{args.queries} balances: full sum {np.median(scan_times) * 1e3:.2f} ms median, "
+              f"checkpoints {np.median(checkpoint_times) * 1e3:.2f} ms median")
+
+        amounts = [round(rng.uniform(-100, 100), 2) for _ in range(args.inserts)]
+        recent = [(ORIGIN + timedelta(days=args.months * 30 - 1), a) for a in amounts]
+        backdated = [(ORIGIN + timedelta(days=3), a) for a in amounts]
+        print(f"insert commit: {timed_inserts(engine, recent, False) * 1e3:.3f} ms plain, "
+              f"{timed_inserts(engine, recent, True) * 1e3:.3f} ms with checkpoints (latest month), "
+              f"{timed_inserts(engine, backdated, True) * 1e3:.3f} ms back-dated to month 1")
+
+
+if __name__ == "__main__":
+    main()
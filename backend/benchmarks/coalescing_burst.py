@@ -0,0 +1,87 @@
+"""Burst of identical reads with and without single-flight coalescing.
+
+Starts one uvicorn worker on a scratch database seeded with --rows
+transactions. Each round adds one expense (which invalidates the stats cache)
+and then fires --parallel identical GET /api/categories/stats and GET
+/api/transactions calls at once, the way the app does when it opens. Reports,
+per mode, wall time per burst, worker CPU time and how many computations the
+worker actually ran (from /api/metrics).
+
+Usage:
+    python benchmarks/coalescing_burst.py --rows 20000 --parallel 8 --rounds 10
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from admission_load import EMAIL, PASSWORD, seed, start_server, stop_server
+
+
+def cpu_seconds(pid):
+    with open(f"/proc/{pid}/stat") as stat:
+        fields = stat.read().rsplit(")", 1)[1].split()
+    # utime and stime, in clock ticks
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+async def bursts(base, token, parallel, rounds):
+    headers = {"Authorization": f"Bearer {token}"}
+    elapsed = []
+    async with httpx.AsyncClient(base_url=base, headers=headers, timeout=120,
+                                 limits=httpx.Limits(max_connections=parallel * 2 + 4)) as http:
+        for i in range(rounds):
+            await http.post("/api/transactions/expense", json={
+                "title": f"Coffee {i}", "amount": 3.5, "category": "Food", "date": "2025-06-01",
+            })
+            started = time.perf_counter()
+            responses = await asyncio.gather(*(
+                [http.get("/api/categories/stats") for _ in range(parallel)]
+                + [http.get("/api/transactions") for _ in range(parallel)]
+            ))
+            elapsed.append(time.perf_counter() - started)
+            assert all(r.status_code == 200 for r in responses), {r.status_code for r in responses}
+        metrics = (await http.get("/api/metrics")).json()["single_flight"]
+    return sum(elapsed) / len(elapsed), metrics
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=20_000)
+    parser.add_argument("--parallel", type=int, default=8)
+    parser.add_argument("--rounds", type=int, default=10)
+    parser.add_argument("--port", type=int, default=8767)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        base = f"http://127.0.0.1:{args.port}"
+        server = start_server(tmp, args.port, {})
+        try:
+            httpx.post(base + "/api/auth/register", json={"email": EMAIL, "password": PASSWORD})
+        finally:
+            stop_server(server)
+        seed(os.path.join(tmp, "finance_app.db"), args.rows)
+
+        for enabled in ("false", "true"):
+            # Admission control would queue part of the burst and hide the difference
+            server = start_server(tmp, args.port, {"READ_COALESCING": enabled, "ADMISSION_ENABLED": "false"})
+            try:
+                token = httpx.post(base + "/api/auth/login", json={"email": EMAIL, "password": PASSWORD}).json()["access_token"]
+                cpu_before = cpu_seconds(server.pid)
+                per_burst, metrics = asyncio.run(bursts(base, token, args.parallel, args.rounds))
+                cpu = cpu_seconds(server.pid) - cpu_before
+                print(f"coalescing {'on ' if enabled == 'true' else 'off'}: {per_burst * 1000:7.1f} ms per burst, "
+                      f"worker CPU {cpu:5.2f} s, {metrics['computations']} computations for {metrics['calls']} calls "
+                      f"({metrics['coalesced']} coalesced)")
+            finally:
+                stop_server(server)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,186 @@
+"""Sketch-based category distributions against exact quantiles.
+
+Seeds a scratch SQLite database with --rows transactions for one user,
+spread over --months months and six categories with log-normal amounts. Then:
+
+  - builds the per-(category, month) t-digests in one rebuild pass and times
+    the incremental write path (record_additions) per inserted row;
+  - for --ranges random date ranges, computes p50/p90/p99 per category
+    exactly (fetch the amounts, np.percentile) and from the merged sketches
+    (category_distributions), and reports latency and both relative and rank
+    error.
+
+Usage:
+    python benchmarks/distribution_accuracy.py --rows 200000 --months 36 --ranges 50
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import (Boolean, Column, DateTime, Float, Index, Integer, LargeBinary, MetaData, String, Table,
+                        create_engine, insert, select)
+
+from app.services.distributions import DEFAULT_COMPRESSION, category_distributions, rebuild, record_additions
+from app.services.fx import FxRates
+from app.utils.sqlite_profile import apply_sqlite_profile
+
+metadata = MetaData()
+transactions = Table(
+    "transactions", metadata,
+    Column("id", Integer, primary_key=True),
+    Column("user_id", Integer),
+    Column("title", String),
+    Column("amount", Float),
+    Column("category", String),
+    Column("currency", String(3)),
+    Column("date", DateTime),
+    Index("ix_transactions_user_date", "user_id", "date"),
+)
+sketches = Table(
+    "category_distributions", metadata,
+    Column("user_id", Integer, primary_key=True),
+    Column("category", String, primary_key=True),
+    Column("month", String(7), primary_key=True),
+    Column("currency", String(3), primary_key=True, default=""),
+    Column("transaction_count", Integer, nullable=False),
+    Column("total_amount", Float, nullable=False),
+    Column("min_amount", Float),
+    Column("max_amount", Float),
+    Column("centroids", LargeBinary, nullable=False),
+    Column("stale", Boolean, default=False, nullable=False),
+    Column("updated_at", DateTime),
+)
+
+# (category, log-mean, log-sigma)
+CATEGORIES = [("Food", 3.0, 0.6), ("Transportation", 2.5, 0.9), ("Housing", 7.0, 0.2),
+              ("Entertainment", 3.5, 1.1), ("Salary", 8.0, 0.1), ("Business", 5.0, 1.5)]
+LEVELS = [0.5, 0.9, 0.99]
+ORIGIN = datetime(2022, 1, 1)
+
+
+def seed(engine, rows, months):
+    rng = np.random.default_rng(1)
+    span = months * 30 * 86400
+    with engine.begin() as conn:
+        for offset in range(0, rows, 50_000):
+            batch = min(50_000, rows - offset)
+            picks = rng.integers(0, len(CATEGORIES), batch)
+            seconds = rng.integers(0, span, batch)
+            conn.execute(insert(transactions), [
+                {
+                    "user_id": 1,
+                    "title": "Shop",
+                    "amount": -float(rng.lognormal(CATEGORIES[c][1], CATEGORIES[c][2])),
+                    "category": CATEGORIES[c][0],
+                    "date": ORIGIN + timedelta(seconds=int(s)),
+                }
+                for c, s in zip(picks.tolist(), seconds.tolist())
+            ])
+
+
+def exact(engine, start, end):
+    t = transactions.c
+    with engine.connect() as conn:
+        rows = conn.execute(
+            select(t.category, t.amount).where(t.user_id == 1, t.date >= start, t.date <= end)
+        ).all()
+    values = {}
+    for category, amount in rows:
+        values.setdefault(category, []).append(abs(amount))
+    return {category: np.asarray(amounts) for category, amounts in values.items()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=200_000)
+    parser.add_argument("--months", type=int, default=36)
+    parser.add_argument("--ranges", type=int, default=50)
+    parser.add_argument("--inserts", type=int, default=2000)
+    parser.add_argument("--compression", type=float, default=DEFAULT_COMPRESSION)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        engine = create_engine(f"sqlite:///{os.path.join(tmp, 'bench.db')}")
+        apply_sqlite_profile(engine)
+        metadata.create_all(engine)
+        seed(engine, args.rows, args.months)
+
+        started = time.perf_counter()
+        with engine.begin() as conn:
+            buckets = rebuild(conn, sketches, transactions, 1, compression=args.compression)
+        print(f"rebuild: {buckets} buckets from {args.rows} rows in {time.perf_counter() - started:.2f} s")
+        with engine.connect() as conn:
+            stored = sum(len(blob) for (blob,) in conn.execute(select(sketches.c.centroids)))
+        print(f"stored centroids: {stored / 1024:.0f} kB ({stored / buckets:.0f} B per bucket)")
+
+        rng = random.Random(2)
+        new_rows = []
+        for _ in range(args.inserts):
+            name, mu, sigma = rng.choice(CATEGORIES)
+            new_rows.append((1, name, ORIGIN + timedelta(days=rng.randrange(args.months * 30)), None,
+                             -rng.lognormvariate(mu, sigma)))
+        started = time.perf_counter()
+        for row in new_rows:
+            with engine.begin() as conn:
+                conn.execute(insert(transactions).values(
+                    user_id=1, title="Shop", category=row[1], date=row[2], amount=row[4]
+                ))
+                record_additions(conn, sketches, [row], args.compression)
+        with_sketch = (time.perf_counter() - started) / args.inserts
+        started = time.perf_counter()
+        for row in new_rows:
+            with engine.begin() as conn:
+                conn.execute(insert(transactions).values(
+                    user_id=1, title="Shop", category=row[1], date=row[2], amount=row[4]
+                ))
+        without = (time.perf_counter() - started) / args.inserts
+        print(f"insert commit: {without * 1e3:.3f} ms plain, {with_sketch * 1e3:.3f} ms with sketch update")
+        # The second batch went in without sketch updates, so bring the sketches back in line
+        with engine.begin() as conn:
+            rebuild(conn, sketches, transactions, 1, compression=args.compression)
+
+        fx = FxRates()
+        exact_times, sketch_times = [], []
+        relative = {q: [] for q in LEVELS}
+        rank = {q: [] for q in LEVELS}
+        for _ in range(args.ranges):
+            first = rng.randrange(args.months * 30 - 1)
+            last = rng.randrange(first + 1, args.months * 30)
+            start = ORIGIN + timedelta(days=first, hours=rng.randrange(24))
+            end = ORIGIN + timedelta(days=last, hours=rng.randrange(24))
+
+            started = time.perf_counter()
+            truth = exact(engine, start, end)
+            expected = {c: np.percentile(v, [q * 100 for q in LEVELS]) for c, v in truth.items()}
+            exact_times.append(time.perf_counter() - started)
+
+            started = time.perf_counter()
+            result = category_distributions(engine, sketches, transactions, 1, start, end, None, "USD", fx, LEVELS,
+                                            compression=args.compression)
+            sketch_times.append(time.perf_counter() - started)
+
+            for entry in result["categories"]:
+                values = np.sort(truth[entry["category"]])
+                assert entry["transaction_count"] == len(values)
+                for q, want in zip(LEVELS, expected[entry["category"]]):
+                    got = entry["quantiles"][f"{q:g}"]
+                    relative[q].append(abs(got - want) / want)
+                    rank[q].append(abs(np.searchsorted(values, got) / len(values) - q))
+
+        print(f"{args.ranges} ranges: exact {np.median(exact_times) * 1e3:.1f} ms median, "
+              f"sketches {np.median(sketch_times) * 1e3:.1f} ms median")
+        for q in LEVELS:
+            print(f"  p{q * 100:g}: relative error median {np.median(relative[q]):.4%} max {np.max(relative[q]):.4%}, "
+                  f"rank error max {np.max(rank[q]):.4f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+"""Idle /api/events connections held by one worker, and fan-out latency.
+
+Starts one uvicorn worker on a scratch database, registers a user, opens
+--connections SSE streams for that user, then reports the worker's resident
+memory before and after and how long one committed expense takes to reach
+every stream.
+
+Usage:
+    python benchmarks/event_feed_load.py --connections 5000
+"""
+import argparse
+import asyncio
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+BACKEND = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def rss_mb(pid):
+    with open(f"/proc/{pid}/status") as status:
+        for line in status:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+def post_json(url, payload, token=None):
+    request = urllib.request.Request(url, data=json.dumps(payload).encode(), method="POST")
+    request.add_header("Content-Type", "application/json")
+    if token:
+        request.add_header("Authorization", f"Bearer {token}")
+    with urllib.request.urlopen(request) as response:
+        return json.loads(response.read())
+
+
+async def open_stream(port, token):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(
+        f"GET /api/events HTTP/1.1\r\nHost: localhost\r\nAuthorization: Bearer {token}\r\n"
+        f"Accept: text/event-stream\r\n\r\n".encode()
+    )
+    await writer.drain()
+    status = await reader.readline()
+    if b" 200 " not in status:
+        raise RuntimeError(f"stream rejected: {status!r}")
+    return reader, writer
+
+
+async def wait_for_event(reader, name):
+    while True:
+        line = await reader.readline()
+        if not line:
+            raise RuntimeError("stream closed")
+        if line.strip() == f"event: {name}".encode():
+            return time.perf_counter()
+
+
+async def run(port, token, connections, batch):
+    streams = []
+    started = time.perf_counter()
+    for i in range(0, connections, batch):
+        streams += await asyncio.gather(*(open_stream(port, token) for _ in range(min(batch, connections - i))))
+    print(f"opened {len(streams)} streams in {time.perf_counter() - started:.1f}s")
+    return streams
+
+
+async def fan_out(port, token, streams):
+    waiters = [asyncio.ensure_future(wait_for_event(reader, "transaction.created")) for reader, _ in streams]
+    await asyncio.sleep(0.2)
+    sent = time.perf_counter()
+    await asyncio.to_thread(post_json, f"http://127.0.0.1:{port}/api/transactions/expense", {
+        "title": "Coffee", "amount": 3.5, "category": "Food", "date": "2026-01-01",
+    }, token)
+    arrivals = sorted(t - sent for t in await asyncio.gather(*waiters))
+    print(f"fan-out to {len(arrivals)} streams: "
+          f"p50 {arrivals[len(arrivals) // 2] * 1000:.1f} ms, last {arrivals[-1] * 1000:.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--connections", type=int, default=5000)
+    parser.add_argument("--batch", type=int, default=500)
+    parser.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args()
+
+    # Both this process and the worker it spawns need a descriptor per connection
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (min(hard, max(soft, args.connections * 2 + 256)), hard))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # main.py keeps its SQLite file in the working directory, so this runs on a scratch ledger
+        env = {**os.environ, "PYTHONPATH": BACKEND, "EVENTS_HEARTBEAT_SECONDS": "15"}
+        server = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "main:app", "--port", str(args.port),
+             "--log-level", "warning", "--backlog", "4096"],
+            cwd=tmp, env=env, stdout=subprocess.DEVNULL,
+        )
+        try:
+            base = f"http://127.0.0.1:{args.port}"
+            for _ in range(100):
+                try:
+                    urllib.request.urlopen(base + "/")
+                    break
+                except OSError:
+                    time.sleep(0.1)
+            post_json(base + "/api/auth/register", {"email": "load@example.com", "password": "load-test-pw"})
+            token = post_json(base + "/api/auth/login", {"email": "load@example.com", "password": "load-test-pw"})["access_token"]
+
+            idle_rss = rss_mb(server.pid)
+
+            async def scenario():
+                streams = await run(args.port, token, args.connections, args.batch)
+                await asyncio.sleep(1.0)
+                loaded_rss = rss_mb(server.pid)
+                print(f"worker RSS {idle_rss:.0f} MB idle -> {loaded_rss:.0f} MB with {len(streams)} streams "
+                      f"({(loaded_rss - idle_rss) * 1024 / len(streams):.1f} KB per connection)")
+                await fan_out(args.port, token, streams)
+                for _, writer in streams:
+                    writer.close()
+
+            asyncio.run(scenario())
+        finally:
+            server.terminate()
+            server.wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+"""Converting a multi-currency ledger into one reporting currency (SQLite).
+
+Builds --rows transactions for one user over --years years in five
+currencies and a daily rate file, then times per-category totals in USD:
+
+  per-row   - fetch every row and convert each with a bisect rate lookup
+  set-based - converted_totals: SQL sums per (category, currency, day) and
+              NumPy converts the collapsed rows
+
+Usage:
+    python benchmarks/fx_conversion.py --rows 1000000
+"""
+import argparse
+import csv
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import date, datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import Column, DateTime, Float, Index, Integer, MetaData, String, Table, create_engine, insert, select
+
+from app.services.fx import FxRates, converted_totals
+
+CURRENCIES = ["USD", "EUR", "GBP", "JPY", "CHF"]
+CATEGORIES = ["Food", "Transportation", "Housing", "Entertainment", "Salary", "Business"]
+
+
+def write_rates(path, start, days):
+    rng = random.Random(7)
+    level = {"USD": 1.1, "GBP": 0.85, "JPY": 160.0, "CHF": 0.95}
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["date", "currency", "rate"])
+        for offset in range(days):
+            day = start + timedelta(days=offset)
+            if day.weekday() >= 5:
+                continue
+            for currency in level:
+                level[currency] *= 1 + rng.gauss(0, 0.004)
+                writer.writerow([day.isoformat(), currency, f"{level[currency]:.5f}"])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--years", type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        start = date.today() - timedelta(days=365 * args.years)
+        rates_path = os.path.join(tmp, "rates.csv")
+        write_rates(rates_path, start, 365 * args.years + 1)
+        fx = FxRates(base="EUR", path=rates_path)
+
+        engine = create_engine(f"sqlite:///{os.path.join(tmp, 'ledger.db')}")
+        metadata = MetaData()
+        transactions = Table(
+            "transactions", metadata,
+            Column("id", Integer, primary_key=True),
+            Column("user_id", Integer),
+            Column("amount", Float),
+            Column("currency", String(3)),
+            Column("category", String),
+            Column("date", DateTime),
+            Index("ix_transactions_user_date", "user_id", "date"),
+        )
+        metadata.create_all(engine)
+        rng = random.Random(42)
+        span = 365 * args.years * 86400
+        origin = datetime.combine(start, datetime.min.time())
+        started = time.perf_counter()
+        with engine.begin() as conn:
+            for offset in range(0, args.rows, 50000):
+                conn.execute(insert(transactions), [
+                    {
+                        "user_id": 1,
+                        "amount": round(rng.uniform(-200, 200), 2),
+                        "currency": rng.choice(CURRENCIES),
+                        "category": rng.choice(CATEGORIES),
+                        "date": origin + timedelta(seconds=rng.randrange(span)),
+                    }
+                    for _ in range(min(50000, args.rows - offset))
+                ])
+        print(f"generated {args.rows} rows in {time.perf_counter() - started:.1f}s")
+
+        t = transactions.c
+        with engine.connect() as conn:
+            started = time.perf_counter()
+            naive = {}
+            for category, amount, currency, day in conn.execute(
+                select(t.category, t.amount, t.currency, t.date).where(t.user_id == 1)
+            ):
+                naive[category] = naive.get(category, 0.0) + fx.convert_one(amount, currency, day, "USD")
+            per_row = time.perf_counter() - started
+
+            started = time.perf_counter()
+            totals = converted_totals(conn, transactions, [t.user_id == 1], "USD", fx, group_by=t.category)
+            set_based = time.perf_counter() - started
+
+        drift = max(abs(naive[c] - totals[c][0]) for c in naive)
+        print(f"per-row    {per_row:7.2f} s")
+        print(f"set-based  {set_based:7.2f} s  (max difference {drift:.6f})")
+        engine.dispose()
+
+
+if __name__ == "__main__":
+    main()
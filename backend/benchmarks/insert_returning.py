@@ -0,0 +1,102 @@
+"""Per-write cost of the old add/commit/refresh pattern against INSERT ... RETURNING.
+
+Times --writes single-row transaction inserts, each in its own commit, on a
+scratch SQLite database with the app's profile (WAL, synchronous=NORMAL):
+
+  add/commit/refresh  session.add, commit, then refresh for the generated id
+                      (what create_category and register did)
+  add/flush/commit    the id from the flush, response built before commit
+  insert returning    one Core INSERT ... RETURNING id (the shared
+                      transaction create pipeline)
+
+and counts the SQL statements each write sends, which is where the saved
+round trip shows up.
+
+Usage:
+    python benchmarks/insert_returning.py --writes 5000
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import Column, DateTime, Float, Integer, String, create_engine, event, insert
+from sqlalchemy.orm import Session, declarative_base
+
+from app.utils.sqlite_profile import apply_sqlite_profile
+
+Base = declarative_base()
+
+
+class Transaction(Base):
+    __tablename__ = "transactions"
+
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, index=True)
+    title = Column(String)
+    amount = Column(Float)
+    category = Column(String)
+    date = Column(DateTime)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+
+INSERT_RETURNING = insert(Transaction.__table__).returning(Transaction.__table__.c.id)
+
+
+def values(i):
+    return {"user_id": 1, "title": f"Coffee {i % 50}", "amount": -3.5, "category": "Food", "date": datetime(2024, 5, 1)}
+
+
+def add_commit_refresh(session, i):
+    row = Transaction(**values(i))
+    session.add(row)
+    session.commit()
+    session.refresh(row)
+    return row.id
+
+
+def add_flush_commit(session, i):
+    row = Transaction(**values(i))
+    session.add(row)
+    session.flush()
+    row_id = row.id
+    session.commit()
+    return row_id
+
+
+def insert_returning(session, i):
+    row_id = session.execute(INSERT_RETURNING, values(i)).scalar_one()
+    session.commit()
+    return row_id
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--writes", type=int, default=5000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        engine = create_engine(f"sqlite:///{os.path.join(tmp, 'bench.db')}")
+        apply_sqlite_profile(engine)
+        Base.metadata.create_all(engine)
+        statements = []
+        event.listen(engine, "before_cursor_execute", lambda *a: statements.append(a[2]))
+
+        for name, write in (("add/commit/refresh", add_commit_refresh), ("add/flush/commit", add_flush_commit),
+                            ("insert returning", insert_returning)):
+            with Session(engine) as session:
+                write(session, 0)  # warm the statement cache
+                statements.clear()
+                started = time.perf_counter()
+                for i in range(args.writes):
+                    write(session, i)
+                elapsed = (time.perf_counter() - started) / args.writes
+            print(f"{name:<20} {elapsed * 1e6:7.0f} us/write  {len(statements) / args.writes:.1f} statements/write")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+"""Throughput and resumability of the nightly insights batch.
+
+Creates the app schema in a scratch SQLite database, seeds --users users with
+--rows-per-user transactions each over the run's window, then:
+
+  1. starts the batch command and kills it (process pool included) once the
+     first chunk is recorded as finished, like a crash mid-run,
+  2. runs again, which resumes the same run with the chunks not yet finished,
+  3. checks a sample of snapshots against SQL sums, and
+  4. projects the measured users/second onto --target-users users at the same
+     rows per user and --processes, against --window-minutes.
+
+Usage:
+    python benchmarks/insights_batch.py --users 20000 --rows-per-user 60 --processes 4
+"""
+import argparse
+import json
+import os
+import random
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import date, datetime, timedelta
+
+BACKEND = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND)
+
+from sqlalchemy import MetaData, Table, create_engine, func, insert, select
+
+from app.services.insights import run_insights, window
+
+CATEGORIES = ["Food", "Rent", "Transport", "Fun", "Health", "Travel", "Bills", "Shopping", "Gifts", "Pets", None]
+
+
+def seed(url, users, rows_per_user, as_of):
+    engine = create_engine(url)
+    metadata = MetaData()
+    users_table = Table("users", metadata, autoload_with=engine)
+    transactions = Table("transactions", metadata, autoload_with=engine)
+    start, end = window(as_of)
+    span = int((end - start).total_seconds())
+    rng = random.Random(1)
+    with engine.begin() as conn:
+        conn.execute(insert(users_table), [
+            {"email": f"user{i}@example.com", "hashed_password": "-", "is_active": True, "default_currency": "USD"}
+            for i in range(users)
+        ])
+        user_ids = conn.execute(select(users_table.c.id).order_by(users_table.c.id)).scalars().all()
+        batch = []
+        for user_id in user_ids:
+            for _ in range(rows_per_user):
+                income = rng.random() < 0.1
+                batch.append({
+                    "user_id": user_id,
+                    "title": "Seed",
+                    "amount": round(rng.uniform(500, 3000) if income else -rng.uniform(1, 120), 2),
+                    "category": "Salary" if income else rng.choice(CATEGORIES),
+                    "type": "income" if income else "expense",
+                    "date": start + timedelta(seconds=rng.randrange(span)),
+                })
+            if len(batch) >= 50_000:
+                conn.execute(insert(transactions), batch)
+                batch = []
+        if batch:
+            conn.execute(insert(transactions), batch)
+    return engine, transactions
+
+
+def check(engine, transactions, as_of, sample):
+    snapshots = Table("insight_snapshots", MetaData(), autoload_with=engine)
+    t = transactions.c
+    month_start = datetime(as_of.year, as_of.month, 1)
+    month = (month_start - timedelta(days=1)).replace(day=1)
+    with engine.connect() as conn:
+        rows = conn.execute(select(snapshots.c.user_id, snapshots.c.payload).order_by(func.random()).limit(sample)).all()
+        for user_id, payload in rows:
+            want = -conn.execute(select(func.coalesce(func.sum(t.amount), 0.0)).where(
+                t.user_id == user_id, t.amount < 0, t.date >= month, t.date < month_start,
+            )).scalar_one()
+            got = json.loads(payload)["month_over_month"]["expenses"]["current"]
+            assert abs(got - want) < 0.01, (user_id, got, want)
+    return len(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=20_000)
+    parser.add_argument("--rows-per-user", type=int, default=60)
+    parser.add_argument("--processes", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--chunk-users", type=int, default=1000)
+    parser.add_argument("--target-users", type=int, default=1_000_000)
+    parser.add_argument("--window-minutes", type=float, default=240)
+    args = parser.parse_args()
+
+    as_of = date(2024, 6, 15)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "finance_app.db")
+        url = f"sqlite:///{path}"
+        # The app creates its schema in the working directory on import
+        subprocess.run([sys.executable, "-c", "import main"], cwd=tmp, check=True, stdout=subprocess.DEVNULL,
+                       env={**os.environ, "PYTHONPATH": BACKEND})
+        started = time.perf_counter()
+        engine, transactions = seed(url, args.users, args.rows_per_user, as_of)
+        print(f"seeded {args.users} users x {args.rows_per_user} rows in {time.perf_counter() - started:.1f} s")
+
+        runs = Table("insight_runs", MetaData(), autoload_with=engine)
+        started = time.perf_counter()
+        batch = subprocess.Popen(
+            [sys.executable, "-m", "app.services.insights", "run", "--database-url", url, "--as-of", as_of.isoformat(),
+             "--processes", str(args.processes), "--chunk-users", str(args.chunk_users)],
+            cwd=BACKEND, stdout=subprocess.DEVNULL, start_new_session=True,
+        )
+        done = 0
+        while not done and batch.poll() is None:
+            time.sleep(0.05)
+            with engine.connect() as conn:
+                done = conn.execute(select(func.coalesce(func.max(runs.c.chunks_done), 0))).scalar_one()
+        os.killpg(batch.pid, signal.SIGKILL)
+        batch.wait()
+        killed_after = time.perf_counter() - started
+        with engine.connect() as conn:
+            done, total = conn.execute(select(runs.c.chunks_done, runs.c.chunks_total)).one()
+        print(f"run killed after {killed_after:.2f} s with {done}/{total} chunks finished")
+
+        resumed = run_insights(url, as_of, args.processes, args.chunk_users, window_minutes=args.window_minutes)
+        print(f"resumed: {resumed}")
+        assert resumed["resumed"] and resumed["status"] == "complete" and resumed["chunks"] == total - done
+        print(f"checked {check(engine, transactions, as_of, 200)} snapshots against SQL sums")
+
+        with engine.connect() as conn:
+            users_done = conn.execute(select(runs.c.users_done)).scalar_one()
+        assert users_done == args.users
+
+    rate = resumed["users"] / resumed["seconds"]
+    projected = args.target_users / rate / 60
+    print(f"\n{rate:,.0f} users/s ({rate * args.rows_per_user:,.0f} rows/s) with {args.processes} processes")
+    print(f"{args.target_users:,} users: {projected:,.1f} min projected "
+          f"({'within' if projected <= args.window_minutes else 'over'} the {args.window_minutes:g} min window)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+"""Writer latency during online backups, incremental size and restore time.
+
+Seeds a scratch SQLite database (the app's WAL profile) with --rows
+transactions, starts a writer process that commits single-row inserts as
+fast as it can, and while it runs takes:
+
+  idle          no backup (baseline writer latency)
+  full stepped  BackupManager full backup, --pages pages per step
+  full 1 step   the same in one backup step
+  incremental   after the writer has run for a while, only the changed pages
+
+then verifies the last backup (checksum and PRAGMA integrity_check) and times
+a restore of the full + incremental chain. Writer commit latency is reported
+per phase.
+
+Usage:
+    python benchmarks/online_backup.py --rows 300000 --pages 256
+"""
+import argparse
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import Column, DateTime, Float, Index, Integer, MetaData, String, Table, create_engine, func, insert, select
+
+from app.utils.backup import BackupManager
+from app.utils.sqlite_profile import apply_sqlite_profile
+
+metadata = MetaData()
+transactions = Table(
+    "transactions", metadata,
+    Column("id", Integer, primary_key=True),
+    Column("user_id", Integer),
+    Column("title", String),
+    Column("amount", Float),
+    Column("date", DateTime),
+    Index("ix_transactions_user_date", "user_id", "date"),
+)
+
+
+def seed(engine, rows):
+    rng = np.random.default_rng(1)
+    with engine.begin() as conn:
+        for offset in range(0, rows, 50_000):
+            batch = min(50_000, rows - offset)
+            conn.execute(insert(transactions), [
+                {"user_id": int(u), "title": f"Payment reference {u:08d} " * 3, "amount": float(a), "date": datetime(2024, 1, 1)}
+                for u, a in zip(rng.integers(1, 1000, batch).tolist(), np.round(rng.normal(-20, 40, batch), 2).tolist())
+            ])
+
+
+def writer(path, stop, results):
+    engine = create_engine(f"sqlite:///{path}")
+    apply_sqlite_profile(engine)
+    samples = []
+    while not stop.is_set():
+        started = time.time()
+        with engine.begin() as conn:
+            conn.execute(insert(transactions).values(user_id=1, title="Live write", amount=-1.0, date=datetime.utcnow()))
+        samples.append((started, time.time() - started))
+    results.put(samples)
+
+
+def summarise(name, samples, start, end, extra=""):
+    latencies = np.array([latency for at, latency in samples if start <= at < end]) * 1e3
+    if not len(latencies):
+        print(f"  {name:<13} no writes")
+        return
+    print(f"  {name:<13} {len(latencies) / (end - start):6.0f} writes/s  p50 {np.percentile(latencies, 50):6.2f} ms  "
+          f"p99 {np.percentile(latencies, 99):6.2f} ms  max {latencies.max():7.2f} ms  {extra}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=300_000)
+    parser.add_argument("--pages", type=int, default=256)
+    parser.add_argument("--idle-seconds", type=float, default=2.0)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "finance_app.db")
+        engine = create_engine(f"sqlite:///{path}")
+        apply_sqlite_profile(engine)
+        metadata.create_all(engine)
+        seed(engine, args.rows)
+        print(f"database: {os.path.getsize(path) / 1e6:.1f} MB, {args.rows} rows")
+
+        stepped = BackupManager(f"sqlite:///{path}", os.path.join(tmp, "backups"), pages_per_step=args.pages)
+        one_step = BackupManager(f"sqlite:///{path}", os.path.join(tmp, "backups-1"), pages_per_step=-1)
+        stop, results = multiprocessing.Event(), multiprocessing.Queue()
+        process = multiprocessing.Process(target=writer, args=(path, stop, results))
+        process.start()
+        phases = []
+
+        def phase(name, action):
+            started = time.time()
+            outcome = action()
+            phases.append((name, started, time.time(), outcome))
+            return outcome
+
+        time.sleep(0.5)
+        phase("idle", lambda: time.sleep(args.idle_seconds))
+        phase("full stepped", lambda: stepped.backup())
+        phase("full 1 step", lambda: one_step.backup())
+        time.sleep(args.idle_seconds)
+        phase("incremental", lambda: stepped.backup(incremental=True))
+        stop.set()
+        samples = results.get()
+        process.join()
+
+        print("writer commit latency while:")
+        for name, start, end, manifest in phases:
+            extra = ""
+            if manifest:
+                extra = (f"backup {end - start:5.2f} s, {manifest['bytes'] / 1e6:6.2f} MB, "
+                         f"{manifest['changed_pages']}/{manifest['page_count']} pages, {manifest['restarts']} restarts"
+                         f"{' (finished in one step)' if manifest['single_step'] else ''}")
+            summarise(name, samples, start, end, extra)
+
+        incremental = phases[-1][3]
+        verified = stepped.verify(incremental["seq"])
+        print(f"verify #{incremental['seq']}: ok={verified['ok']} integrity={verified['integrity']} "
+              f"chain={verified['chain']}")
+        target = os.path.join(tmp, "restored.db")
+        restored = stepped.restore(incremental["seq"], target)
+        print(f"restore #{incremental['seq']}: {restored['seconds']:.2f} s "
+              f"(apply {restored['apply_seconds']:.2f} s, checks {restored['check_seconds']:.2f} s, "
+              f"{restored['pages_applied']} incremental pages)")
+        restored_engine = create_engine(f"sqlite:///{target}")
+        with restored_engine.connect() as conn:
+            count = conn.execute(select(func.count()).select_from(transactions)).scalar_one()
+        print(f"restored database has {count} rows ({count - args.rows} written during the run)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+"""Date-bounded search before and after archiving cold years (SQLite).
+
+Builds a ledger of --rows transactions spread over --years years for --users
+users, then times the search_transactions query shape for one recent month
+and one whole-history listing:
+
+  live      - every row in the single transactions table
+  archived  - years before the current one moved to the attached archive file
+
+Usage (10M rows takes a few minutes to generate):
+    python benchmarks/partitioned_search.py --rows 10000000
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import Column, DateTime, Float, Index, Integer, String, Boolean, create_engine, insert
+from sqlalchemy.orm import declarative_base, sessionmaker
+
+from app.utils.partitioning import TransactionPartitions, archive_years_before, attach_sqlite_archive
+from app.utils.sqlite_profile import apply_sqlite_profile
+
+Base = declarative_base()
+
+
+class Transaction(Base):
+    __tablename__ = "transactions"
+
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer)
+    title = Column(String)
+    amount = Column(Float)
+    category = Column(String)
+    date = Column(DateTime)
+    created_at = Column(DateTime)
+    is_recurring = Column(Boolean, default=False)
+    recurrence_frequency = Column(String(50))
+    next_recurrence_date = Column(DateTime)
+    type = Column(String(10))
+
+    __table_args__ = (Index("ix_transactions_user_date", "user_id", "date"),)
+
+
+CATEGORIES = ["Food", "Transportation", "Housing", "Entertainment", "Salary", "Business"]
+
+
+def populate(engine, rows, users, years):
+    now = datetime.utcnow()
+    span = timedelta(days=365 * years).total_seconds()
+    rng = random.Random(42)
+    batch = []
+    with engine.begin() as conn:
+        for i in range(rows):
+            when = now - timedelta(seconds=rng.random() * span)
+            batch.append({
+                "user_id": rng.randint(1, users),
+                "title": f"Transaction {i}",
+                "amount": round(rng.uniform(-200, 200), 2),
+                "category": rng.choice(CATEGORIES),
+                "date": when,
+                "created_at": when,
+                "type": "expense",
+            })
+            if len(batch) == 50000:
+                conn.execute(insert(Transaction), batch)
+                batch = []
+        if batch:
+            conn.execute(insert(Transaction), batch)
+
+
+def time_search(session_factory, partitions, user_id, start, end, repeat):
+    timings = []
+    for _ in range(repeat):
+        session = session_factory()
+        started = time.perf_counter()
+        T = partitions.model_for(user_id, start, end)
+        query = session.query(T).filter(T.user_id == user_id)
+        if start:
+            query = query.filter(T.date >= start)
+        if end:
+            query = query.filter(T.date <= end)
+        rows = query.order_by(T.date.desc()).all()
+        timings.append(time.perf_counter() - started)
+        session.close()
+    return statistics.median(timings) * 1000, len(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=10_000_000)
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--years", type=int, default=10)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        archive_path = os.path.join(tmp, "archive.db")
+        os.environ["SQLITE_ARCHIVE_PATH"] = archive_path
+        engine = create_engine(f"sqlite:///{os.path.join(tmp, 'ledger.db')}")
+        apply_sqlite_profile(engine)
+        attach_sqlite_archive(engine, archive_path)
+        Base.metadata.create_all(engine)
+        started = time.perf_counter()
+        populate(engine, args.rows, args.users, args.years)
+        print(f"generated {args.rows} rows in {time.perf_counter() - started:.1f}s")
+
+        sessions = sessionmaker(bind=engine)
+        partitions = TransactionPartitions(engine, Transaction)
+        now = datetime.utcnow()
+        recent = (now - timedelta(days=30), now)
+        cold = (datetime(now.year - 3, 3, 1), datetime(now.year - 3, 3, 31))
+        user_id = 1
+
+        def run(label):
+            partitions.invalidate()
+            for name, (start, end) in (("recent month", recent), ("cold month", cold), ("all history", (None, None))):
+                ms, count = time_search(sessions, partitions, user_id, start, end, args.repeat)
+                print(f"{label:9s} {name:13s} {ms:8.2f} ms  ({count} rows)")
+
+        run("live")
+        started = time.perf_counter()
+        moved = archive_years_before(engine, Transaction.__table__, now.year)
+        print(f"archived {sum(moved.values())} rows from {len(moved)} years in {time.perf_counter() - started:.1f}s")
+        with engine.begin() as conn:
+            conn.exec_driver_sql("ANALYZE")
+        run("archived")
+        engine.dispose()
+
+
+if __name__ == "__main__":
+    main()
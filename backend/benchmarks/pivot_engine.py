@@ -0,0 +1,155 @@
+"""Pivot latency from the columnar cache against SQL GROUP BY.
+
+Seeds a scratch SQLite database with --rows transactions for one user, loads
+them once into a ColumnarFrame (timed: this is the cache-miss cost), then
+runs each pivot --repeat times and reports the median, next to the equivalent
+GROUP BY where SQL can express it directly. Category x month sums are checked
+against SQL. Finally it times the write path: a commit's worth of created,
+edited and deleted rows patched into the cached frame, checked against SQL
+again.
+
+Usage:
+    python benchmarks/pivot_engine.py --rows 1000000
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import Boolean, Column, DateTime, Float, Index, Integer, MetaData, String, Table, create_engine, func, insert, select
+
+from app.services.fx import FxRates
+from app.services.pivot import PivotCache, load_frame, pivot
+from app.utils.sqlite_profile import apply_sqlite_profile
+
+metadata = MetaData()
+transactions = Table(
+    "transactions", metadata,
+    Column("id", Integer, primary_key=True),
+    Column("user_id", Integer),
+    Column("title", String),
+    Column("amount", Float),
+    Column("category", String),
+    Column("type", String(10)),
+    Column("currency", String(3)),
+    Column("is_recurring", Boolean),
+    Column("date", DateTime),
+    Index("ix_transactions_user_date", "user_id", "date"),
+)
+
+CATEGORIES = [f"Category {i:02d}" for i in range(40)]
+
+PIVOTS = [
+    ("category x month", dict(dimensions=["category", "month"], measures=["sum", "count"])),
+    ("type x weekday", dict(dimensions=["type", "weekday"], measures=["sum", "mean"])),
+    ("amount band", dict(dimensions=["amount_band"], measures=["count", "expenses", "income"])),
+    ("category, min/max", dict(dimensions=["category"], measures=["min", "max", "mean"])),
+    ("day, 1 year filtered", dict(dimensions=["day"], measures=["expenses"],
+                                 filters={"start_date": "2023-01-01", "end_date": "2023-12-31",
+                                          "categories": CATEGORIES[:10]})),
+    ("category x quarter x type", dict(dimensions=["category", "quarter", "type"], measures=["sum"],
+                                       sort="-sum", limit=50)),
+]
+
+
+def seed(engine, rows):
+    rng = np.random.default_rng(1)
+    origin = datetime(2019, 1, 1)
+    with engine.begin() as conn:
+        for offset in range(0, rows, 100_000):
+            batch = min(100_000, rows - offset)
+            amounts = np.round(np.where(rng.random(batch) < 0.1, rng.uniform(500, 3000, batch), -rng.lognormal(3, 1, batch)), 2)
+            seconds = rng.integers(0, 6 * 365 * 86400, batch)
+            categories = rng.integers(0, len(CATEGORIES), batch)
+            conn.execute(insert(transactions), [
+                {"user_id": 1, "title": "Row", "amount": a, "category": CATEGORIES[c], "type": "income" if a > 0 else "expense",
+                 "currency": None, "is_recurring": c < 3, "date": origin + timedelta(seconds=s)}
+                for a, c, s in zip(amounts.tolist(), categories.tolist(), seconds.tolist())
+            ])
+
+
+def median_ms(action, repeat):
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        action()
+        times.append(time.perf_counter() - started)
+    return np.median(times) * 1e3
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        engine = create_engine(f"sqlite:///{os.path.join(tmp, 'bench.db')}")
+        apply_sqlite_profile(engine)
+        metadata.create_all(engine)
+        seed(engine, args.rows)
+
+        fx = FxRates()
+        cache = PivotCache(fx, max_bytes=256 * 1024 * 1024)
+        with engine.connect() as conn:
+            started = time.perf_counter()
+            frame = cache.get(1, "USD", lambda: load_frame(conn, transactions, 1, "USD", fx))
+            load = time.perf_counter() - started
+        print(f"{args.rows:,} rows loaded in {load:.2f} s, frame {frame.nbytes / 1e6:.1f} MB "
+              f"({frame.nbytes / max(frame.rows, 1):.0f} bytes/row)")
+
+        print(f"{'pivot':<28} {'groups':>7} {'cache':>9}")
+        for name, spec in PIVOTS:
+            result = pivot(frame, **spec)
+            elapsed = median_ms(lambda: pivot(cache.get(1, "USD", None), **spec), args.repeat)
+            print(f"{name:<28} {result['groups']:>7} {elapsed:7.1f} ms")
+
+        t = transactions.c
+        month = func.strftime("%Y-%m", t.date)
+        query = (select(t.category, month, func.sum(t.amount), func.count())
+                 .where(t.user_id == 1).group_by(t.category, month))
+        with engine.connect() as conn:
+            sql_ms = median_ms(lambda: conn.execute(query).all(), max(3, args.repeat // 5))
+            expected = {(c, m): (s, n) for c, m, s, n in conn.execute(query).all()}
+        print(f"{'category x month (SQL)':<28} {len(expected):>7} {sql_ms:7.1f} ms")
+
+        check(cache.get(1, "USD", None), expected)
+        print("category x month matches SQL")
+
+        # The write path: each commit patches its rows into a copy of the frame
+        patch_times = []
+        for i in range(args.repeat):
+            created = {"user_id": 1, "title": "New", "amount": -12.5, "category": "New category" if i == 0 else CATEGORIES[i],
+                       "type": "expense", "currency": None, "is_recurring": False, "date": datetime(2024, 6, 1 + i)}
+            with engine.begin() as conn:
+                created["id"] = conn.execute(insert(transactions).returning(t.id), created).scalar_one()
+                conn.execute(transactions.update().where(t.id == i + 1).values(amount=99.0, category=CATEGORIES[0]))
+                conn.execute(transactions.delete().where(t.id == i + 1000))
+                edited = conn.execute(select(transactions).where(t.id == i + 1)).mappings().one()
+            started = time.perf_counter()
+            cache.apply(1, [("created", created), ("updated", dict(edited)), ("deleted", {"id": i + 1000})])
+            patch_times.append(time.perf_counter() - started)
+        with engine.connect() as conn:
+            expected = {(c, m): (s, n) for c, m, s, n in conn.execute(query).all()}
+        check(cache.get(1, "USD", None), expected)
+        print(f"patch of 1 insert, 1 edit, 1 delete: {np.median(patch_times) * 1e3:.1f} ms (median of {args.repeat}); "
+              f"matches SQL")
+        print(cache.snapshot())
+
+
+def check(frame, expected):
+    got = pivot(frame, ["category", "month"], ["sum", "count"], limit=10000)["rows"]
+    assert len(got) == len(expected)
+    for row in got:
+        total, count = expected[(row["category"], row["month"])]
+        assert count == row["count"] and abs(total - row["sum"]) < 0.01, row
+
+
+if __name__ == "__main__":
+    main()
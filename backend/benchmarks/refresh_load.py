@@ -0,0 +1,114 @@
+"""Server CPU per session renewal: Argon2 login against /api/auth/refresh.
+
+Starts the API on a scratch database, registers one account and sends
+--requests logins, then --requests refreshes (each spending the previous
+refresh token), from --concurrency clients. The server's own CPU time (user +
+system, from /proc) over each phase gives the cost of one renewal either way.
+
+The costs are then projected onto a day of traffic: --sessions active sessions
+a day, each open for --session-hours, renewing every ACCESS_TOKEN_EXPIRE_MINUTES.
+Without refresh tokens every renewal is a password login; with them a session
+logs in once and refreshes from then on (refresh tokens outlive a day, so this
+overstates the logins). --peak-factor scales the daily average to the busiest
+hour.
+
+Linux only (reads /proc/<pid>/stat).
+
+Usage:
+    python benchmarks/refresh_load.py --requests 200 --sessions 20000 --session-hours 8
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from admission_load import EMAIL, PASSWORD, start_server, stop_server
+
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+
+
+def cpu_seconds(pid):
+    with open(f"/proc/{pid}/stat") as handle:
+        # The command name may contain spaces; fields after it are fixed
+        fields = handle.read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+
+
+async def logins(http, count):
+    for _ in range(count):
+        response = await http.post("/api/auth/login", json={"email": EMAIL, "password": PASSWORD})
+        response.raise_for_status()
+
+
+async def refreshes(http, token, count):
+    for _ in range(count):
+        response = await http.post("/api/auth/refresh", json={"refresh_token": token})
+        response.raise_for_status()
+        token = response.json()["refresh_token"]
+
+
+async def phase(server, base, name, requests, concurrency, make_client):
+    per_client = max(1, requests // concurrency)
+    async with httpx.AsyncClient(base_url=base, timeout=60) as http:
+        clients = [await make_client(http) for _ in range(concurrency)]
+        cpu_started, started = cpu_seconds(server.pid), time.perf_counter()
+        await asyncio.gather(*(client(per_client) for client in clients))
+        wall = time.perf_counter() - started
+        cpu = cpu_seconds(server.pid) - cpu_started
+    total = per_client * concurrency
+    print(f"  {name:<8} {total} requests in {wall:5.2f} s: {total / wall:7.1f}/s, "
+          f"server CPU {cpu / total * 1e3:6.2f} ms per request")
+    return cpu / total
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--sessions", type=int, default=20_000)
+    parser.add_argument("--session-hours", type=float, default=8.0)
+    parser.add_argument("--access-minutes", type=float, default=30.0)
+    parser.add_argument("--peak-factor", type=float, default=3.0)
+    parser.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        server = start_server(tmp, args.port, {"ADMISSION_ENABLED": "false"})
+        base = f"http://127.0.0.1:{args.port}"
+        try:
+            httpx.post(f"{base}/api/auth/register", json={"email": EMAIL, "password": PASSWORD}).raise_for_status()
+
+            async def login_client(http):
+                return lambda count: logins(http, count)
+
+            async def refresh_client(http):
+                response = await http.post("/api/auth/login", json={"email": EMAIL, "password": PASSWORD})
+                token = response.json()["refresh_token"]
+                return lambda count: refreshes(http, token, count)
+
+            print(f"Per renewal ({args.concurrency} clients):")
+            login_cpu = asyncio.run(phase(server, base, "login", args.requests, args.concurrency, login_client))
+            refresh_cpu = asyncio.run(phase(server, base, "refresh", args.requests, args.concurrency, refresh_client))
+        finally:
+            stop_server(server)
+
+    renewals = args.sessions * args.session_hours * 60 / args.access_minutes
+    before = renewals * login_cpu
+    after = args.sessions * login_cpu + max(0.0, renewals - args.sessions) * refresh_cpu
+    print(f"\n{args.sessions} sessions/day x {args.session_hours:g} h, access token {args.access_minutes:g} min: "
+          f"{renewals:,.0f} renewals/day")
+    for name, seconds in (("logins only", before), ("refresh tokens", after)):
+        average = seconds / 86400
+        print(f"  {name:<15} {seconds / 3600:7.2f} CPU-hours/day  {average:5.3f} cores average  "
+              f"{average * args.peak_factor:5.3f} cores at peak")
+    print(f"  saved           {(before - after) / 3600:7.2f} CPU-hours/day ({(1 - after / before) * 100:.0f}%)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+"""Write throughput against 1, 2, 4 ... SQLite shards.
+
+--writers processes each commit single-row transaction inserts, the shape of
+POST /api/transactions/expense, for users drawn at random from --users.
+Rows go to the user's shard through ShardRouter, with the same SQLite
+profile as the app (WAL, synchronous=NORMAL, busy_timeout). One file
+serialises every commit behind its write lock. With N files, writers for
+users on different shards commit in parallel. The gain needs the write lock
+to be the bottleneck: with spare cores, or while a commit waits on the device
+rather than the CPU. On a single CPU with a fast disk the writers are
+CPU-bound and the curve stays flat. --hold-ms keeps each write transaction
+open that much longer without using CPU, which emulates a device where the
+commit's fsync takes that long (synchronous=FULL on network or cloud block
+storage); that is the case sharding is for.
+
+Usage:
+    python benchmarks/shard_write_scaling.py --writers 8 --seconds 5 --shards 1,2,4,8
+    python benchmarks/shard_write_scaling.py --writers 8 --seconds 5 --shards 1,2,4,8 --hold-ms 2
+"""
+import argparse
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import Column, DateTime, Float, Index, Integer, MetaData, String, Table, create_engine, insert
+
+from app.utils.sharding import ShardRouter
+from app.utils.sqlite_profile import apply_sqlite_profile
+
+metadata = MetaData()
+transactions = Table(
+    "transactions", metadata,
+    Column("id", Integer, primary_key=True),
+    Column("user_id", Integer),
+    Column("title", String),
+    Column("amount", Float),
+    Column("category", String),
+    Column("date", DateTime),
+    Index("ix_transactions_user_date", "user_id", "date"),
+)
+
+
+def build_router(tmp, shard_count):
+    global_engine = create_engine(f"sqlite:///{os.path.join(tmp, 'global.db')}")
+    shards = {}
+    for i in range(shard_count):
+        shard = create_engine(f"sqlite:///{os.path.join(tmp, f'shard{i}.db')}")
+        apply_sqlite_profile(shard)
+        shards[f"shard{i}"] = shard
+    return ShardRouter(global_engine, shards)
+
+
+def writer(tmp, shard_count, users, seconds, seed, counts, hold):
+    router = build_router(tmp, shard_count)
+    rng = random.Random(seed)
+    committed = 0
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        user_id = rng.randrange(1, users + 1)
+        with router.engine_for(user_id).begin() as conn:
+            conn.execute(insert(transactions).values(
+                user_id=user_id, title="Coffee", amount=-3.5, category="Food", date=datetime.utcnow(),
+            ))
+            if hold:
+                time.sleep(hold)
+        committed += 1
+    counts.put(committed)
+
+
+def run(shard_count, writers, users, seconds, hold=0.0):
+    with tempfile.TemporaryDirectory() as tmp:
+        router = build_router(tmp, shard_count)
+        router.create_all(metadata, global_tables=[])
+        for shard in router.engines:
+            with shard.connect() as conn:
+                conn.exec_driver_sql("PRAGMA journal_mode=WAL")
+            shard.dispose()
+        counts = multiprocessing.Queue()
+        processes = [
+            multiprocessing.Process(target=writer, args=(tmp, shard_count, users, seconds, seed, counts, hold))
+            for seed in range(writers)
+        ]
+        for process in processes:
+            process.start()
+        total = sum(counts.get() for _ in processes)
+        for process in processes:
+            process.join()
+        return total / seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--writers", type=int, default=8)
+    parser.add_argument("--users", type=int, default=10_000)
+    parser.add_argument("--seconds", type=float, default=5)
+    parser.add_argument("--shards", default="1,2,4,8")
+    parser.add_argument("--hold-ms", type=float, default=0, help="idle time inside each write transaction")
+    args = parser.parse_args()
+
+    baseline = None
+    for shard_count in [int(n) for n in args.shards.split(",")]:
+        rate = run(shard_count, args.writers, args.users, args.seconds, args.hold_ms / 1000)
+        baseline = baseline or rate
+        print(f"{shard_count:3d} shard(s): {rate:9.0f} commits/s  ({rate / baseline:4.2f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,185 @@
+"""Concurrent write benchmark for the SQLite tuning profile.
+
+Runs the same mixed workload (writers doing a user lookup plus an insert and
+commit, like create_transaction, and readers doing a stats-style aggregate)
+against three configurations:
+
+  baseline  - the old engine: check_same_thread=False and no pragmas
+  tuned     - apply_sqlite_profile (WAL, synchronous=NORMAL, mmap, cache, busy_timeout)
+  queued    - tuned, with inserts going through GroupCommitQueue
+
+Usage:
+    python benchmarks/sqlite_write_concurrency.py --writers 16 --readers 4 --seconds 5
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import create_engine, Column, Integer, String, Float, DateTime, MetaData, Table, insert, select, func
+
+from app.utils.sqlite_profile import apply_sqlite_profile, GroupCommitQueue, SQLiteProfile, is_lock_error
+
+metadata = MetaData()
+users = Table("users", metadata, Column("id", Integer, primary_key=True), Column("email", String))
+transactions = Table(
+    "transactions", metadata,
+    Column("id", Integer, primary_key=True),
+    Column("user_id", Integer, index=True),
+    Column("title", String),
+    Column("amount", Float),
+    Column("category", String),
+    Column("date", DateTime),
+)
+
+
+def make_engine(path, tuned, busy_timeout_s):
+    engine = create_engine(
+        f"sqlite:///{path}",
+        connect_args={"check_same_thread": False, "timeout": busy_timeout_s},
+        pool_size=64,
+        max_overflow=64,
+    )
+    if tuned:
+        apply_sqlite_profile(engine, SQLiteProfile(busy_timeout_ms=int(busy_timeout_s * 1000)))
+    metadata.create_all(engine)
+    with engine.begin() as conn:
+        conn.execute(insert(users), [{"email": f"user{i}@example.com"} for i in range(1, 101)])
+    return engine
+
+
+def row(i):
+    return {"user_id": i % 100 + 1, "title": f"tx {i}", "amount": -12.5, "category": "Food", "date": datetime.utcnow()}
+
+
+def run_threads(engine, writers, readers, seconds):
+    stop = time.monotonic() + seconds
+    counters = {"writes": 0, "write_errors": 0, "lock_errors": 0, "reads": 0, "latencies": []}
+    lock = threading.Lock()
+
+    def writer(n):
+        i = n
+        while time.monotonic() < stop:
+            started = time.perf_counter()
+            try:
+                with engine.begin() as conn:
+                    conn.execute(select(users.c.id).where(users.c.id == i % 100 + 1)).first()
+                    conn.execute(insert(transactions), [row(i)])
+                with lock:
+                    counters["writes"] += 1
+                    counters["latencies"].append(time.perf_counter() - started)
+            except Exception as e:
+                with lock:
+                    counters["write_errors"] += 1
+                    counters["lock_errors"] += is_lock_error(e)
+            i += writers
+
+    def reader():
+        while time.monotonic() < stop:
+            try:
+                with engine.connect() as conn:
+                    conn.execute(
+                        select(transactions.c.category, func.sum(transactions.c.amount))
+                        .where(transactions.c.user_id == 1)
+                        .group_by(transactions.c.category)
+                    ).all()
+                with lock:
+                    counters["reads"] += 1
+            except Exception:
+                pass
+
+    threads = [threading.Thread(target=writer, args=(n,)) for n in range(writers)]
+    threads += [threading.Thread(target=reader) for _ in range(readers)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return counters
+
+
+def run_queued(engine, writers, readers, seconds):
+    counters = {"writes": 0, "write_errors": 0, "lock_errors": 0, "reads": 0, "latencies": []}
+    stop_readers = threading.Event()
+
+    def reader():
+        while not stop_readers.is_set():
+            with engine.connect() as conn:
+                conn.execute(
+                    select(transactions.c.category, func.sum(transactions.c.amount))
+                    .where(transactions.c.user_id == 1)
+                    .group_by(transactions.c.category)
+                ).all()
+            counters["reads"] += 1
+
+    async def main():
+        queue = GroupCommitQueue(engine, transactions)
+        stop = time.monotonic() + seconds
+
+        async def writer(n):
+            i = n
+            while time.monotonic() < stop:
+                started = time.perf_counter()
+                try:
+                    await queue.submit(row(i))
+                    counters["writes"] += 1
+                    counters["latencies"].append(time.perf_counter() - started)
+                except Exception as e:
+                    counters["write_errors"] += 1
+                    counters["lock_errors"] += is_lock_error(e)
+                i += writers
+
+        await asyncio.gather(*(writer(n) for n in range(writers)))
+        await queue.close()
+        counters["batches"] = queue.batches_committed
+
+    threads = [threading.Thread(target=reader) for _ in range(readers)]
+    for t in threads:
+        t.start()
+    asyncio.run(main())
+    stop_readers.set()
+    for t in threads:
+        t.join()
+    return counters
+
+
+def report(name, counters, seconds):
+    latencies = sorted(counters["latencies"]) or [0.0]
+    attempts = counters["writes"] + counters["write_errors"]
+    p50 = latencies[len(latencies) // 2] * 1000
+    p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000
+    extra = f"  batches={counters['batches']}" if "batches" in counters else ""
+    print(
+        f"{name:9s} writes/s={counters['writes'] / seconds:9.1f}  "
+        f"lock_errors={counters['lock_errors']:5d} ({100.0 * counters['lock_errors'] / max(attempts, 1):5.2f}%)  "
+        f"p50={p50:7.2f}ms  p99={p99:8.2f}ms  reads/s={counters['reads'] / seconds:8.1f}{extra}"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--writers", type=int, default=16)
+    parser.add_argument("--readers", type=int, default=4)
+    parser.add_argument("--seconds", type=float, default=5.0)
+    parser.add_argument("--busy-timeout", type=float, default=0.1,
+                        help="seconds a connection waits on a lock before raising 'database is locked'")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for name in ("baseline", "tuned", "queued"):
+            engine = make_engine(os.path.join(tmp, f"{name}.db"), name != "baseline", args.busy_timeout)
+            if name == "queued":
+                counters = run_queued(engine, args.writers, args.readers, args.seconds)
+            else:
+                counters = run_threads(engine, args.writers, args.readers, args.seconds)
+            report(name, counters, args.seconds)
+            engine.dispose()
+
+
+if __name__ == "__main__":
+    main()
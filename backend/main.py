@@ -1,16 +1,46 @@
-from fastapi import FastAPI, HTTPException, Depends, status
+from fastapi import FastAPI, HTTPException, Depends, Header, Request, WebSocket, WebSocketDisconnect, status
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from fastapi.middleware.cors import CORSMiddleware
-from sqlalchemy import create_engine, Column, Integer, String, Boolean, Float, DateTime, ForeignKey, text, inspect
+from fastapi.responses import FileResponse, Response, StreamingResponse
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import create_engine, Column, Integer, String, Boolean, Float, DateTime, ForeignKey, Index, Text, LargeBinary, UniqueConstraint, text, inspect, event, delete, update, insert, select, func
+from sqlalchemy.engine import make_url
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, Session, relationship, backref
 from passlib.context import CryptContext
 from datetime import datetime, timedelta
 from jose import JWTError, jwt
-from typing import Optional, List
+from typing import Optional, List, Union
+import asyncio
+import itertools
+import json
 import os
 from dotenv import load_dotenv
-from pydantic import BaseModel
+from pydantic import BaseModel, ValidationError
+from app.utils.sqlite_profile import apply_sqlite_profile, GroupCommitQueue
+from app.utils.db_routing import ReplicaRouter
+from app.utils.sharding import ShardRouter
+from app.utils.partitioning import attach_sqlite_archive, add_missing_archive_columns, ensure_sqlite_autoincrement, TransactionPartitions
+from app.utils.idempotency import IdempotencyStore
+from app.utils.response_cache import MemoCache
+from app.utils.event_broker import EventBroker, format_sse
+from app.utils.admission import AdmissionController, AdmissionMiddleware
+from app.utils.rate_limit import AuthRateLimiter
+from app.utils.single_flight import SingleFlight
+from app.utils.profiling import Profiler, ProfilingMiddleware
+from app.utils.jobs import JobLimitExceeded, JobQueue, JobRunner
+from app.utils.refresh_tokens import RefreshTokenError, RefreshTokenStore
+from app.utils.backup import BackupInProgress, BackupManager
+from app.utils.audit_log import AuditLog, audit_entry, flush_changes
+from app.services.forecast import anchor_date, forecast_for_user
+from app.services.categoriser import CategoriserRegistry
+from app.services.fx import FxRates, converted_totals, normalise_currency
+from app.services.tags import split_tags, set_transaction_tags, tags_for, tag_condition, tagged_rows
+from app.services.distributions import DEFAULT_COMPRESSION, SketchVerifier, category_distributions, mark_stale, mark_user_stale, record_additions
+from app.services.balances import CheckpointVerifier, apply_deltas, balance_as_of, balance_series, checkpoint_deltas, converted_balance
+from app.services.pivot import PivotCache, load_frame, pivot
+from app.services.reports import init_worker, remove_result, run_report, validate_params
+from app.services.duplicates import DATE_BUCKET_DAYS, transaction_fingerprint, backfill_fingerprints, duplicate_clusters
 
 # Load environment variables
 load_dotenv()
@@ -18,13 +48,29 @@ load_dotenv()
 # Database setup
 SQLALCHEMY_DATABASE_URL = "sqlite:///./finance_app.db"
 engine = create_engine(SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False})
+# WAL, synchronous=NORMAL, mmap/cache sizing and busy_timeout (see SQLITE_* in .env)
+apply_sqlite_profile(engine)
+# Cold years archived to SQLITE_ARCHIVE_PATH (python -m app.utils.partitioning archive)
+attach_sqlite_archive(engine)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
 
+# Heavy read endpoints go to DATABASE_REPLICA_URLS when configured
+replica_router = ReplicaRouter.from_env(engine, session_factory=SessionLocal, connect_args={"check_same_thread": False})
+# Replica reads of archived years go through the same archive file as the primary's
+for replica in replica_router.replicas:
+    attach_sqlite_archive(replica)
+
+# Per-user data in DATABASE_SHARD_URLS files picked by consistent hashing; users stay in this file
+shard_router = ShardRouter.from_env(engine, session_factory=SessionLocal, connect_args={"check_same_thread": False})
+
 # Security
 SECRET_KEY = os.getenv("SECRET_KEY", "your-secret-key-here")
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
+# Accounts allowed on /api/admin/* (comma-separated emails)
+ADMIN_EMAILS = {email.strip().lower() for email in os.getenv("ADMIN_EMAILS", "").split(",") if email.strip()}
+DEFAULT_CURRENCY = normalise_currency(os.getenv("DEFAULT_CURRENCY", "USD")) or "USD"
 
 pwd_context = CryptContext(schemes=["argon2"], deprecated="auto")
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="api/auth/login")
@@ -37,6 +83,7 @@ class User(Base):
     email = Column(String, unique=True, index=True)
     hashed_password = Column(String)
     is_active = Column(Boolean, default=True)
+    default_currency = Column(String(3), default=DEFAULT_CURRENCY)
     
     transactions = relationship("Transaction", back_populates="user")
     categories = relationship("Category", back_populates="user")
@@ -70,9 +117,217 @@ class Transaction(Base):
     recurrence_frequency = Column(String(50))
     next_recurrence_date = Column(DateTime)
     type = Column(String(10))
+    currency = Column(String(3))  # NULL on legacy rows: the owner's default currency
+    fingerprint = Column(String(32))
 
     user = relationship("User", back_populates="transactions")
 
+    __table_args__ = (
+        Index("ix_transactions_user_date", "user_id", "date"),
+        Index("ix_transactions_user_fingerprint", "user_id", "fingerprint"),
+        # Ids of archived rows must never be reused by the live table (app/utils/partitioning.py)
+        {"sqlite_autoincrement": True},
+    )
+
+# Every ORM insert or update keeps the duplicate fingerprint in step with the row
+@event.listens_for(Transaction, "before_insert")
+@event.listens_for(Transaction, "before_update")
+def _set_fingerprint(mapper, connection, target):
+    target.fingerprint = transaction_fingerprint(target.user_id, target.amount, target.date, target.title)
+
+class Tag(Base):
+    __tablename__ = "tags"
+
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    name = Column(String(50), nullable=False)
+
+    __table_args__ = (
+        UniqueConstraint("user_id", "name", name="uq_tags_user_name"),
+    )
+
+class TransactionTag(Base):
+    # No FK to transactions: archived/partitioned rows move tables but keep their ids
+    __tablename__ = "transaction_tags"
+
+    transaction_id = Column(Integer, primary_key=True)
+    tag_id = Column(Integer, ForeignKey("tags.id"), primary_key=True)
+
+    __table_args__ = (
+        Index("ix_transaction_tags_tag_transaction", "tag_id", "transaction_id"),
+    )
+
+# A transaction's tag links go with it
+@event.listens_for(Transaction, "after_delete")
+def _delete_tag_links(mapper, connection, target):
+    connection.execute(delete(TransactionTag.__table__).where(TransactionTag.transaction_id == target.id))
+
+class IdempotencyKey(Base):
+    __tablename__ = "idempotency_keys"
+
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    key = Column(String(255), nullable=False)
+    request_hash = Column(String(64), nullable=False)
+    response_body = Column(Text)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    expires_at = Column(DateTime, nullable=False, index=True)
+
+    __table_args__ = (
+        UniqueConstraint("user_id", "key", name="uq_idempotency_keys_user_key"),
+    )
+
+class ForecastSnapshot(Base):
+    __tablename__ = "forecast_snapshots"
+
+    user_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    horizon_days = Column(Integer, nullable=False)
+    computed_at = Column(DateTime, nullable=False)
+    payload = Column(Text, nullable=False)
+
+class InsightSnapshot(Base):
+    # Written by the nightly batch (python -m app.services.insights run); payload is the /api/insights body
+    __tablename__ = "insight_snapshots"
+
+    user_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    as_of = Column(DateTime, nullable=False)
+    computed_at = Column(DateTime, nullable=False)
+    payload = Column(Text, nullable=False)
+
+class CategoriserModel(Base):
+    __tablename__ = "categoriser_models"
+
+    user_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    state = Column(LargeBinary, nullable=False)
+    trained_through_id = Column(Integer, default=0)
+    updated_at = Column(DateTime, default=datetime.utcnow)
+
+class CategoryDistribution(Base):
+    # t-digest of absolute amounts per (user, category, month, currency); see app/services/distributions.py
+    __tablename__ = "category_distributions"
+
+    user_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    category = Column(String, primary_key=True)
+    month = Column(String(7), primary_key=True)  # YYYY-MM
+    currency = Column(String(3), primary_key=True, default="")  # "" for rows without a currency
+    transaction_count = Column(Integer, nullable=False)
+    total_amount = Column(Float, nullable=False)
+    min_amount = Column(Float)
+    max_amount = Column(Float)
+    centroids = Column(LargeBinary, nullable=False)
+    stale = Column(Boolean, default=False, nullable=False)
+    updated_at = Column(DateTime, default=datetime.utcnow)
+
+class BalanceCheckpoint(Base):
+    # Running balance through the end of each month with transactions; see app/services/balances.py
+    __tablename__ = "balance_checkpoints"
+
+    user_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    currency = Column(String(3), primary_key=True, default="")  # "" for rows without a currency
+    month = Column(String(7), primary_key=True)  # YYYY-MM
+    balance = Column(Float, nullable=False)
+    transaction_count = Column(Integer, nullable=False)
+    updated_at = Column(DateTime, default=datetime.utcnow)
+
+class ReportJob(Base):
+    # Background report jobs (app/utils/jobs.py); kept in the main database whatever the user's shard
+    __tablename__ = "report_jobs"
+    __table_args__ = (
+        Index("ix_report_jobs_status_available", "status", "available_at"),
+        Index("ix_report_jobs_user_status", "user_id", "status"),
+    )
+
+    id = Column(String(32), primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    kind = Column(String, nullable=False)
+    params = Column(Text, nullable=False)  # JSON
+    status = Column(String(16), nullable=False)  # queued, running, succeeded, failed
+    attempts = Column(Integer, default=0, nullable=False)
+    available_at = Column(DateTime, nullable=False)  # retry backoff
+    lease_owner = Column(String)
+    lease_expires_at = Column(DateTime)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    started_at = Column(DateTime)
+    finished_at = Column(DateTime)
+    error = Column(Text)
+    result = Column(Text)  # JSON: file, media_type, bytes, rows
+
+class RefreshToken(Base):
+    # Rotating refresh tokens (app/utils/refresh_tokens.py); next to users in the main database
+    __tablename__ = "refresh_tokens"
+
+    id = Column(Integer, primary_key=True)
+    token_hash = Column(String(64), unique=True, index=True, nullable=False)  # SHA-256 hex of the token
+    family_id = Column(String(32), index=True, nullable=False)  # one per login
+    user_id = Column(Integer, ForeignKey("users.id"), index=True, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    expires_at = Column(DateTime, nullable=False, index=True)
+    used_at = Column(DateTime)  # rotated; presenting it again revokes the family
+    replaced_by = Column(Integer)
+    revoked_at = Column(DateTime)
+
+class InsightRun(Base):
+    # One nightly insights batch; resumed from its unfinished chunks until complete
+    __tablename__ = "insight_runs"
+
+    id = Column(String(32), primary_key=True)
+    as_of = Column(DateTime, nullable=False)
+    status = Column(String(16), nullable=False)  # running, partial, complete
+    started_at = Column(DateTime, nullable=False)
+    finished_at = Column(DateTime)
+    chunks_total = Column(Integer, default=0, nullable=False)
+    chunks_done = Column(Integer, default=0, nullable=False)
+    users_done = Column(Integer, default=0, nullable=False)
+    rows_read = Column(Integer, default=0, nullable=False)
+
+class InsightRunChunk(Base):
+    # A range of consecutive user ids in a run; finished_at is the resume checkpoint
+    __tablename__ = "insight_run_chunks"
+
+    run_id = Column(String(32), ForeignKey("insight_runs.id"), primary_key=True)
+    first_user_id = Column(Integer, primary_key=True)
+    last_user_id = Column(Integer, nullable=False)
+    finished_at = Column(DateTime)
+    users = Column(Integer)
+    rows_read = Column(Integer)
+
+class AuditEntry(Base):
+    # Append-only change log (app/utils/audit_log.py), in the main database so it survives shard moves
+    __tablename__ = "audit_entries"
+
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer)  # owner of the changed row
+    actor_id = Column(Integer)  # who made the change; NULL for system writes
+    entity = Column(String(20), nullable=False)  # transaction, category
+    entity_id = Column(Integer)  # NULL for bulk updates
+    action = Column(String(16), nullable=False)  # created, updated, deleted, bulk_updated
+    before = Column(Text)  # JSON row image
+    after = Column(Text)
+    created_at = Column(DateTime, nullable=False)
+
+    __table_args__ = (
+        Index("ix_audit_entries_user", "user_id"),
+        Index("ix_audit_entries_user_entity", "user_id", "entity", "entity_id"),
+    )
+
+class TransactionWrite(BaseModel):
+    # Body of the transaction create endpoints. Lax mode accepts what the old hand-written parsing did:
+    # numeric strings for amount, ISO 8601 or "YYYY-MM-DD HH:MM:SS" dates, with or without a trailing Z
+    title: str
+    amount: float
+    type: Optional[str] = None
+    category: str
+    date: datetime
+    currency: Optional[str] = None
+    is_recurring: Optional[bool] = False
+    recurrence_frequency: Optional[str] = None
+    next_recurrence_date: Optional[datetime] = None
+    tags: Optional[Union[List[str], str]] = None
+
+class TypedTransactionWrite(TransactionWrite):
+    # POST /api/transactions; the expense/income endpoints set the type themselves
+    type: str
+
 class TransactionCreate(BaseModel):
     title: str
     amount: float
@@ -82,13 +337,109 @@ class TransactionCreate(BaseModel):
     is_recurring: bool = False
     recurrence_frequency: Optional[str] = None
     next_recurrence_date: Optional[datetime] = None
+    tags: Optional[List[str]] = None
+
+class PivotRequest(BaseModel):
+    # Body of /api/analytics/pivot; names and filters are checked in app/services/pivot.py
+    dimensions: List[str] = []
+    measures: List[str] = ["sum", "count"]
+    filters: dict = {}
+    amount_bands: Optional[List[float]] = None
+    sort: Optional[str] = None
+    limit: int = 1000
+
+# The users and audit tables live in the global database whichever shard a session is bound to
+SessionLocal.configure(binds={User: engine, AuditEntry: engine})
 
 # Create tables
 Base.metadata.create_all(bind=engine)
+shard_router.create_all(Base.metadata, global_tables=[
+    User.__tablename__, ReportJob.__tablename__, RefreshToken.__tablename__,
+    InsightRun.__tablename__, InsightRunChunk.__tablename__, AuditEntry.__tablename__,
+])
+
+# Routes date-bounded reads to the live table plus only the overlapping archived years
+transaction_partitions = TransactionPartitions(engine, Transaction)
+
+# Idempotency-Key replay for transaction POSTs (IDEMPOTENCY_TTL_HOURS)
+idempotency_store = IdempotencyStore.from_env(IdempotencyKey)
+
+# Per-user memoised /api/categories/stats bodies, invalidated on commit (STATS_CACHE_*)
+category_stats_cache = MemoCache.from_env("STATS_CACHE")
+
+# Identical concurrent GETs share one computation (keyed by user, write generation, route, params)
+read_coalescer = SingleFlight.from_env()
+
+# Warm per-user title -> category models, updated from committed writes
+category_registry = CategoriserRegistry.from_env(
+    engine, Transaction.__table__, CategoriserModel.__table__, engine_for=shard_router.engine_for
+)
+
+# Centroid budget of the per-category spend sketches (DISTRIBUTION_COMPRESSION)
+distribution_compression = float(os.getenv("DISTRIBUTION_COMPRESSION") or DEFAULT_COMPRESSION)
+distribution_verifier = SketchVerifier()
+balance_verifier = CheckpointVerifier()
+
+# Per-user change feed for /api/events (EVENTS_* in .env)
+event_broker = EventBroker.from_env()
+
+# Local FX rate table for reporting in the user's default currency (FX_* in .env)
+fx_rates = FxRates.from_env()
+
+# Per-user columnar transaction frames for /api/analytics/pivot, patched on write (PIVOT_CACHE_*)
+pivot_cache = PivotCache.from_env(fx_rates)
+
+# Optional single-writer queue per database file that group-commits transaction inserts (SQLITE_WRITE_QUEUE=true)
+transaction_write_queues = {
+    data_engine: GroupCommitQueue.from_env(data_engine, Transaction.__table__) for data_engine in shard_router.engines
+}
+
+# Token buckets per client IP and per account for login/register (AUTH_RATE_* in .env)
+auth_rate_limiter = AuthRateLimiter.from_env()
+
+# Rotating refresh tokens, so sessions renew without Argon2 (REFRESH_TOKEN_* in .env)
+refresh_tokens = RefreshTokenStore.from_env(engine, RefreshToken.__table__, User.__table__)
+
+# Who changed which transaction or category: before/after images, written behind the request (AUDIT_LOG_* in .env)
+audit_log = AuditLog.from_env(engine, AuditEntry.__table__)
+AUDITED_ENTITIES = {Transaction: "transaction", Category: "category"}
+
+# Per-route-class concurrency limits with bounded, deadline-aware queues (ADMISSION_* in .env)
+admission_controller = AdmissionController.from_env()
+
+# Opt-in per-request stack sampling and SQL timing to speedscope files (PROFILING_* in .env)
+request_profiler = Profiler.from_env()
+
+# Online backups of the main database and each shard file (BACKUP_* in .env); shards get a subdirectory each
+def _backup_managers():
+    managers = {"main": BackupManager.from_env(SQLALCHEMY_DATABASE_URL)}
+    for url in shard_router.shards:
+        name = os.path.splitext(os.path.basename(make_url(url).database))[0]
+        managers[name] = BackupManager.from_env(url, name)
+    return {name: manager for name, manager in managers.items() if manager is not None}
+
+database_backups = _backup_managers()
+
+# Report jobs: DB job table with leases; run by the dedicated worker process, or here when REPORTS_RUNNER=true (REPORTS_* in .env)
+REPORTS_DIR = os.path.abspath(os.getenv("REPORTS_DIR") or "./reports")
+report_queue = JobQueue.from_env(engine, ReportJob.__table__)
+report_runner = JobRunner.from_env(
+    report_queue, run_report, initializer=init_worker, initargs=(SQLALCHEMY_DATABASE_URL, REPORTS_DIR),
+    on_purge=lambda job: remove_result(REPORTS_DIR, job),
+)
 
 # FastAPI app
 app = FastAPI()
 
+# Innermost, so a capture starts once the request is admitted and leaves out its queueing
+if request_profiler is not None:
+    request_profiler.install()
+    app.add_middleware(ProfilingMiddleware, profiler=request_profiler)
+
+# Added before CORS so shed 503s still carry the CORS headers
+if admission_controller is not None:
+    app.add_middleware(AdmissionMiddleware, controller=admission_controller)
+
 # CORS middleware
 app.add_middleware(
     CORSMiddleware,
@@ -99,6 +450,354 @@ app.add_middleware(
     expose_headers=["*"],
 )
 
+@app.on_event("shutdown")
+async def drain_write_queue():
+    for queue in transaction_write_queues.values():
+        if queue is not None:
+            await queue.close()
+
+@app.on_event("shutdown")
+def save_categoriser_models():
+    category_registry.save_dirty()
+
+@app.on_event("startup")
+def start_report_runner():
+    if report_runner is not None:
+        os.makedirs(REPORTS_DIR, exist_ok=True)
+        report_runner.start()
+
+@app.on_event("shutdown")
+def stop_report_runner():
+    if report_runner is not None:
+        report_runner.close()
+
+@app.on_event("shutdown")
+def close_audit_log():
+    if audit_log is not None:
+        audit_log.close()
+
+@app.on_event("startup")
+async def start_event_broker():
+    event_broker.start(asyncio.get_running_loop())
+
+@app.on_event("shutdown")
+def stop_event_broker():
+    event_broker.close()
+
+def _run_in_background(fn, *args):
+    """Run fn in the default executor when called from the event loop, inline otherwise."""
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        return fn(*args)
+    return loop.run_in_executor(None, fn, *args)
+
+def _transaction_currency(transaction_data, user):
+    """Currency of a new transaction: the one in the request, else the user's default."""
+    if transaction_data.get("currency") is None:
+        return user.default_currency or DEFAULT_CURRENCY
+    currency = normalise_currency(transaction_data["currency"])
+    if currency is None:
+        raise HTTPException(status_code=400, detail="currency must be a three-letter ISO 4217 code")
+    return currency
+
+def _save_tags(db, user_id, transaction_id, value):
+    """Replace a transaction's tags from a list or comma-separated string; None leaves them as they are."""
+    if value is None:
+        return []
+    names = split_tags(value)
+    set_transaction_tags(db.connection(), Tag.__table__, TransactionTag.__table__, user_id, transaction_id, names)
+    return names
+
+def _find_duplicate(db, user_id, fingerprint, date, exclude_id=None):
+    """Id of an existing transaction with the same fingerprint: one probe of ix_transactions_user_fingerprint.
+
+    Archived years that the fingerprint's date bucket can reach are probed too, by (user_id, date).
+    """
+    if fingerprint is None:
+        return None
+    query = db.query(Transaction.id).filter(Transaction.user_id == user_id, Transaction.fingerprint == fingerprint)
+    if exclude_id is not None:
+        query = query.filter(Transaction.id != exclude_id)
+    row = query.order_by(Transaction.id).first()
+    archived = None
+    if date is not None and transaction_partitions.years():
+        window = timedelta(days=DATE_BUCKET_DAYS)
+        archived = transaction_partitions.archived_duplicate(db.connection(), user_id, fingerprint, date - window, date + window)
+    ids = [row_id for row_id in (row.id if row else None, archived) if row_id is not None]
+    return min(ids) if ids else None
+
+def _parse_transaction(transaction_data, model=TransactionWrite) -> TransactionWrite:
+    try:
+        return model.model_validate(transaction_data)
+    except ValidationError as e:
+        error = e.errors()[0]
+        field = ".".join(str(part) for part in error["loc"])
+        if error["type"] == "missing":
+            raise HTTPException(status_code=400, detail=f"Missing required field: {field}")
+        raise HTTPException(status_code=400, detail=f"Invalid {field}: {error['msg']}")
+
+def _transaction_values(data: TransactionWrite, user, sign=None, kind=None):
+    """Column values for a new transaction; `sign` forces the amount's sign and `kind` the type."""
+    amount = data.amount if sign is None else abs(data.amount) * sign
+    values = dict(
+        user_id=user.id,
+        title=data.title,
+        amount=amount,
+        currency=_transaction_currency({"currency": data.currency}, user),
+        type=kind or data.type,
+        category=data.category,
+        date=data.date,
+        is_recurring=bool(data.is_recurring),
+        recurrence_frequency=data.recurrence_frequency,
+        next_recurrence_date=data.next_recurrence_date,
+    )
+    values["fingerprint"] = transaction_fingerprint(user.id, amount, data.date, data.title)
+    return values
+
+_INSERT_TRANSACTION = insert(Transaction.__table__).returning(Transaction.__table__.c.id)
+
+def _insert_transaction(db, values, tags):
+    """The shared create pipeline: one INSERT ... RETURNING id, no flush and no refresh.
+
+    Returns (row, tag names, duplicate_of); the row is `values` plus the new id.
+    """
+    transaction_id = db.execute(_INSERT_TRANSACTION, values).scalar_one()
+    row = {**values, "id": transaction_id}
+    _record_new_transactions(db, [row])
+    tags = _save_tags(db, values["user_id"], transaction_id, tags)
+    return row, tags, _find_duplicate(db, values["user_id"], values["fingerprint"], values["date"], transaction_id)
+
+def _queued_insert(values, tags, actor_id):
+    """A write-queue job running _insert_transaction on the writer's connection, inside its transaction.
+
+    The job's session is a plain Session, so the SessionLocal commit hooks do
+    not fire before the batch commits; the caller runs _after_user_commit on
+    the returned session once the queue hands back the result.
+    """
+    def job(conn):
+        # Tables of the global database share the writer's connection when the data lives there too
+        global_bind = conn if conn.engine is engine else engine
+        db = Session(bind=conn, binds={User: global_bind, AuditEntry: global_bind},
+                     join_transaction_mode="create_savepoint")
+        db.info["user_id"] = actor_id
+        try:
+            row, names, duplicate_of = _insert_transaction(db, values, tags)
+            db.commit()
+        finally:
+            db.close()
+        return db, row, names, duplicate_of
+    return job
+
+def _record_audit(session, entries):
+    """Audit entries go out after commit, or in transactional mode into the session's own transaction."""
+    if not entries:
+        return
+    if audit_log.mode == "transactional":
+        audit_log.write(session.connection(bind_arguments={"clause": AuditEntry.__table__}), entries)
+    else:
+        session.info.setdefault("audit", []).extend(entries)
+
+def _record_new_transactions(db, rows):
+    """What _track_flush does for ORM inserts, for rows written with a Core INSERT or the write queue."""
+    conn = db.connection()
+    conn.execute(delete(ForecastSnapshot).where(ForecastSnapshot.user_id.in_({row["user_id"] for row in rows})))
+    record_additions(conn, CategoryDistribution.__table__, [
+        (row["user_id"], row["category"], row["date"], row["currency"], row["amount"]) for row in rows
+    ], distribution_compression)
+    apply_deltas(conn, BalanceCheckpoint.__table__, checkpoint_deltas([
+        (row["user_id"], row["currency"], row["date"], row["amount"], 1) for row in rows
+    ]))
+    db.info["wrote"] = True
+    db.info.setdefault("changed", set()).add("Transaction")
+    db.info.setdefault("categoriser_ops", []).extend(
+        (row["user_id"], "add", row["id"], row["title"], row["category"]) for row in rows
+    )
+    db.info.setdefault("events", []).extend(
+        (row["user_id"], {"type": "transaction.created", "data": _transaction_delta(row)}) for row in rows
+    )
+    if audit_log is not None:
+        _record_audit(db, [
+            audit_entry(row["user_id"], db.info.get("user_id"), "transaction", row["id"], "created", after=row)
+            for row in rows
+        ])
+
+def _transaction_response(row, tags, duplicate_of):
+    return {
+        "id": row["id"],
+        "title": row["title"],
+        "amount": row["amount"],
+        "currency": row["currency"],
+        "type": row["type"],
+        "category": row["category"],
+        "date": row["date"].isoformat(),
+        "is_recurring": row["is_recurring"],
+        "recurrence_frequency": row["recurrence_frequency"],
+        "next_recurrence_date": row["next_recurrence_date"].isoformat() if row["next_recurrence_date"] else None,
+        "tags": tags,
+        "duplicate_of": duplicate_of
+    }
+
+def _categoriser_ops(session):
+    """(user_id, op, id, title, category) for every title/category change in a flush."""
+    ops = []
+    for obj in session.new:
+        if isinstance(obj, Transaction):
+            ops.append((obj.user_id, "add", obj.id, obj.title, obj.category))
+    for obj in session.deleted:
+        if isinstance(obj, Transaction):
+            ops.append((obj.user_id, "remove", obj.id, obj.title, obj.category))
+    for obj in session.dirty:
+        if isinstance(obj, Transaction):
+            state = inspect(obj)
+            title, category = state.attrs.title.history, state.attrs.category.history
+            if not (title.has_changes() or category.has_changes()):
+                continue
+            old_title = (title.deleted or title.unchanged or [obj.title])[0]
+            old_category = (category.deleted or category.unchanged or [obj.category])[0]
+            ops.append((obj.user_id, "remove", obj.id, old_title, old_category))
+            ops.append((obj.user_id, "add", obj.id, obj.title, obj.category))
+    return ops
+
+def _distribution_changes(session):
+    """(new rows, stale buckets) for the spend sketches from the Transaction rows in a flush."""
+    added, stale = [], []
+    for obj in session.new:
+        if isinstance(obj, Transaction):
+            added.append((obj.user_id, obj.category, obj.date, obj.currency, obj.amount))
+    for obj in session.deleted:
+        if isinstance(obj, Transaction):
+            stale.append((obj.user_id, obj.category, obj.date))
+    for obj in session.dirty:
+        if isinstance(obj, Transaction):
+            state = inspect(obj)
+            histories = [state.attrs[key].history for key in ("amount", "date", "category", "currency")]
+            if not any(history.has_changes() for history in histories):
+                continue
+            when, category = state.attrs.date.history, state.attrs.category.history
+            old_date = (when.deleted or when.unchanged or [obj.date])[0]
+            old_category = (category.deleted or category.unchanged or [obj.category])[0]
+            # The old bucket is rebuilt; a different new bucket takes the row like an insert
+            stale.append((obj.user_id, old_category, old_date))
+            added.append((obj.user_id, obj.category, obj.date, obj.currency, obj.amount))
+    return added, stale
+
+def _balance_changes(session):
+    """(user_id, currency, date, amount delta, count delta) for the balance checkpoints from a flush."""
+    changes = []
+    for obj in session.new:
+        if isinstance(obj, Transaction):
+            changes.append((obj.user_id, obj.currency, obj.date, obj.amount, 1))
+    for obj in session.deleted:
+        if isinstance(obj, Transaction):
+            changes.append((obj.user_id, obj.currency, obj.date, -(obj.amount or 0.0), -1))
+    for obj in session.dirty:
+        if isinstance(obj, Transaction):
+            state = inspect(obj)
+            histories = {key: state.attrs[key].history for key in ("amount", "date", "currency")}
+            if not any(history.has_changes() for history in histories.values()):
+                continue
+            old = {key: (history.deleted or history.unchanged or [getattr(obj, key)])[0] for key, history in histories.items()}
+            # Back-dated edits move the amount out of the old month and into the new one
+            changes.append((obj.user_id, old["currency"], old["date"], -(old["amount"] or 0.0), -1))
+            changes.append((obj.user_id, obj.currency, obj.date, obj.amount, 1))
+    return checkpoint_deltas(changes)
+
+def _transaction_delta(values):
+    return {
+        "id": values["id"],
+        "title": values["title"],
+        "amount": values["amount"],
+        "currency": values["currency"],
+        "type": values["type"],
+        "category": values["category"],
+        "date": values["date"].isoformat() if values["date"] else None,
+        "is_recurring": values["is_recurring"],
+    }
+
+def _change_events(session):
+    """(user_id, event) change-feed deltas for the Transaction and Category rows in a flush."""
+    events = []
+    for kind, objects in (("created", session.new), ("updated", session.dirty), ("deleted", session.deleted)):
+        for obj in objects:
+            if isinstance(obj, Transaction):
+                data = {"id": obj.id} if kind == "deleted" else _transaction_delta(
+                    {key: getattr(obj, key) for key in ("id", "title", "amount", "currency", "type", "category", "date", "is_recurring")}
+                )
+                events.append((obj.user_id, {"type": f"transaction.{kind}", "data": data}))
+            elif isinstance(obj, Category):
+                data = {"id": obj.id} if kind == "deleted" else {
+                    "id": obj.id,
+                    "name": obj.name,
+                    "type": obj.type,
+                    "budget": obj.budget,
+                    "transaction_count": obj.transaction_count,
+                }
+                events.append((obj.user_id, {"type": f"category.{kind}", "data": data}))
+    return events
+
+def _transaction_conditions(T, user_id, query=None, category=None, start=None, end=None, min_amount=None, max_amount=None):
+    """The search_transactions filter grammar as WHERE clauses; T is the model, an alias of it or a table's .c."""
+    conditions = [T.user_id == user_id]
+    if query:
+        conditions.append(T.title.ilike(f"%{query}%"))
+    if category:
+        conditions.append(T.category == category)
+    if start:
+        conditions.append(T.date >= start)
+    if end:
+        conditions.append(T.date <= end)
+    if min_amount is not None:
+        conditions.append(T.amount >= min_amount)
+    if max_amount is not None:
+        conditions.append(T.amount <= max_amount)
+    return conditions
+
+def _bulk_update_transactions(db, user_id, conditions_for, values, start=None, end=None):
+    """One UPDATE per partition table (just the live table unless archived years overlap).
+
+    Set-based writes bypass the ORM flush, so this records the write for the
+    after_commit hooks itself and drops what cannot be patched in place: the
+    user's forecast snapshot and categoriser model. Balance checkpoints are
+    left alone; no bulk patch touches amount, date or currency.
+    """
+    updated = 0
+    for table in transaction_partitions.tables_for(start, end):
+        result = db.execute(update(table).where(*conditions_for(table.c)).values(**values))
+        updated += result.rowcount
+    if updated:
+        db.execute(delete(ForecastSnapshot).where(ForecastSnapshot.user_id == user_id))
+        db.info["wrote"] = True
+        db.info.setdefault("changed", set()).add("Transaction")
+        db.info.setdefault("events", []).append(
+            (user_id, {"type": "transactions.bulk_updated", "data": {"count": updated, "patch": values}})
+        )
+        if audit_log is not None:
+            # One entry for the set-based patch; per-row before images would cost a read of every matched row
+            _record_audit(db, [audit_entry(user_id, db.info.get("user_id"), "transaction", None, "bulk_updated",
+                                           after={"count": updated, "patch": values})])
+        if "category" in values:
+            db.info.setdefault("forget_categoriser", set()).add(user_id)
+            mark_user_stale(db.connection(), CategoryDistribution.__table__, user_id, start, end)
+    return updated
+
+def _refresh_category_counts(db, user_id, names):
+    """Recount transaction_count for the user's categories with these names from the live table."""
+    names = [name for name in names if name]
+    if not names:
+        return
+    count = (
+        select(func.count(Transaction.id))
+        .where(Transaction.user_id == Category.user_id, Transaction.category == Category.name)
+        .scalar_subquery()
+    )
+    db.execute(
+        update(Category)
+        .where(Category.user_id == user_id, Category.name.in_(names))
+        .values(transaction_count=count)
+        .execution_options(synchronize_session=False)
+    )
+
 # Dependency
 def get_db():
     db = SessionLocal()
@@ -107,6 +806,97 @@ def get_db():
     finally:
         db.close()
 
+# Write tracking: get_current_user tags the request session with the user id,
+# flushes record which models changed, and on commit the user is pinned to the
+# primary for reads and their cached stats are invalidated
+@event.listens_for(SessionLocal, "after_flush")
+def _track_flush(session, flush_context):
+    session.info["wrote"] = True
+    changed_objects = list(itertools.chain(session.new, session.dirty, session.deleted))
+    session.info.setdefault("changed", set()).update(type(obj).__name__ for obj in changed_objects)
+    session.info.setdefault("categoriser_ops", []).extend(_categoriser_ops(session))
+    session.info.setdefault("events", []).extend(_change_events(session))
+    if audit_log is not None:
+        _record_audit(session, flush_changes(session, AUDITED_ENTITIES, session.info.get("user_id")))
+    # Precomputed forecasts go stale with the user's transactions; drop them in the same transaction
+    forecast_users = {obj.user_id for obj in changed_objects if isinstance(obj, Transaction)}
+    if forecast_users:
+        session.connection().execute(delete(ForecastSnapshot).where(ForecastSnapshot.user_id.in_(forecast_users)))
+        # Spend sketches: new amounts are merged in, edited and deleted ones mark their month for a rebuild
+        added, stale = _distribution_changes(session)
+        mark_stale(session.connection(), CategoryDistribution.__table__, stale)
+        record_additions(session.connection(), CategoryDistribution.__table__, added, distribution_compression)
+        apply_deltas(session.connection(), BalanceCheckpoint.__table__, _balance_changes(session))
+
+def _after_user_write(user_id, changed, pivot_patched=False):
+    replica_router.mark_write(user_id)
+    read_coalescer.invalidate(user_id)
+    if changed & {"Transaction", "Category"}:
+        category_stats_cache.invalidate(user_id)
+    if "Transaction" in changed:
+        if not pivot_patched:
+            pivot_cache.invalidate(user_id)
+        event_broker.publish(user_id, [{"type": "stats.changed", "data": {}}])
+
+def _patch_pivot(user_id, changes):
+    """Patch the rows behind transaction.* events into the user's pivot frame; False when some change has no row image."""
+    rows = []
+    for change in changes:
+        if change["type"] in ("transaction.created", "transaction.updated", "transaction.deleted"):
+            rows.append((change["type"].split(".", 1)[1], change["data"]))
+        elif change["type"].startswith("transactions."):
+            return False
+    if rows:
+        pivot_cache.apply(user_id, rows)
+    return bool(rows)
+
+def _after_remote_write(user_id, change):
+    """Another worker committed this change-feed event: drop or patch what this process cached for the user."""
+    kind = change["type"]
+    if kind == "stats.changed" or kind.startswith(("transaction.", "transactions.", "category.")):
+        replica_router.mark_write(user_id)
+        read_coalescer.invalidate(user_id)
+        category_stats_cache.invalidate(user_id)
+        if kind.startswith("transaction") and not _patch_pivot(user_id, [change]):
+            pivot_cache.invalidate(user_id)
+
+# With a shared events backend (EVENTS_BACKEND=postgres) writes on other workers reach these
+# caches too; with the local backend STATS_CACHE_TTL_SECONDS bounds how stale they can be
+event_broker.on_remote_event(_after_remote_write)
+
+@event.listens_for(SessionLocal, "after_commit")
+def _after_user_commit(session):
+    if audit_log is not None:
+        audit_log.record(session.info.pop("audit", []))
+    events_by_user = {}
+    for user_id, change in session.info.pop("events", []):
+        events_by_user.setdefault(user_id, []).append(change)
+    pivot_patched = set()
+    for user_id, changes in events_by_user.items():
+        event_broker.publish(user_id, changes)
+        if _patch_pivot(user_id, changes):
+            pivot_patched.add(user_id)
+    changed = session.info.pop("changed", set())
+    if session.info.pop("wrote", False) and session.info.get("user_id") is not None:
+        _after_user_write(session.info["user_id"], changed, session.info["user_id"] in pivot_patched)
+    ops_by_user = {}
+    for user_id, *op in session.info.pop("categoriser_ops", []):
+        ops_by_user.setdefault(user_id, []).append(op)
+    for user_id, ops in ops_by_user.items():
+        if category_registry.apply(user_id, ops):
+            _run_in_background(category_registry.save, user_id)
+    for user_id in session.info.pop("forget_categoriser", set()):
+        _run_in_background(category_registry.forget, user_id)
+
+@event.listens_for(SessionLocal, "after_rollback")
+def _after_user_rollback(session):
+    session.info.pop("wrote", None)
+    session.info.pop("changed", None)
+    session.info.pop("categoriser_ops", None)
+    session.info.pop("events", None)
+    session.info.pop("forget_categoriser", None)
+    session.info.pop("audit", None)
+
 # Helper functions
 def verify_password(plain_password, hashed_password):
     return pwd_context.verify(plain_password, hashed_password)
@@ -141,12 +931,75 @@ async def get_current_user(token: str = Depends(oauth2_scheme), db: Session = De
     user = db.query(User).filter(User.email == email).first()
     if user is None:
         raise credentials_exception
+    # Hand the connection back now: read endpoints use a second session, and holding this
+    # one while they wait for another can exhaust the pool under concurrent threadpool reads
+    db.expunge(user)
+    db.rollback()
+    db.info["user_id"] = user.id
+    # Everything after authentication reads and writes the user's shard
+    shard_router.bind(db, user.id)
     return user
 
+def _read_session(user_id: int) -> Session:
+    if shard_router.sharded:
+        return shard_router.session(user_id)
+    return replica_router.read_session(user_id)
+
+def get_read_db(current_user: User = Depends(get_current_user)):
+    db = _read_session(current_user.id)
+    try:
+        yield db
+    finally:
+        db.close()
+
+async def get_admin_user(current_user: User = Depends(get_current_user)):
+    if current_user.email.lower() not in ADMIN_EMAILS:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Admin access required")
+    return current_user
+
 # Routes
+def _check_auth_rate(request: Request, email):
+    if auth_rate_limiter is None:
+        return
+    ip = auth_rate_limiter.client_ip(request.client.host if request.client else None,
+                                     request.headers.get("x-forwarded-for"))
+    retry_after = auth_rate_limiter.check(ip, email)
+    if retry_after:
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="Too many attempts, please try again later",
+            headers={"Retry-After": str(retry_after)},
+        )
+
+def _token_pair(email: str, refresh_token: Optional[str]):
+    access_token = create_access_token(
+        data={"sub": email}, expires_delta=timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
+    )
+    body = {"access_token": access_token, "token_type": "bearer", "expires_in": ACCESS_TOKEN_EXPIRE_MINUTES * 60}
+    if refresh_token is not None:
+        body.update(refresh_token=refresh_token, refresh_expires_in=refresh_tokens.expires_in)
+    return body
+
+async def _issue_tokens(user_id: int, email: str):
+    # A new refresh token family per login; without refresh tokens clients log in again on expiry
+    refresh_token = await run_in_threadpool(refresh_tokens.issue, user_id) if refresh_tokens is not None else None
+    return _token_pair(email, refresh_token)
+
+def _enabled_refresh_tokens() -> RefreshTokenStore:
+    if refresh_tokens is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Refresh tokens are disabled")
+    return refresh_tokens
+
+def _refresh_token_field(body: dict) -> str:
+    token = body.get("refresh_token")
+    if not isinstance(token, str) or not token:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="refresh_token is required")
+    return token
+
 @app.post("/api/auth/register")
-async def register(user_data: dict, db: Session = Depends(get_db)):
+async def register(user_data: dict, request: Request, db: Session = Depends(get_db)):
     print(f"Received registration request for email: {user_data.get('email')}")
+    _check_auth_rate(request, user_data.get('email'))
     
     # Check if user already exists
     db_user = db.query(User).filter(User.email == user_data['email']).first()
@@ -159,23 +1012,20 @@ async def register(user_data: dict, db: Session = Depends(get_db)):
     
     try:
         # Create new user
-        hashed_password = get_password_hash(user_data['password'])
-        db_user = User(email=user_data['email'], hashed_password=hashed_password)
+        # Argon2 is deliberately slow; keep it off the event loop
+        hashed_password = await run_in_threadpool(get_password_hash, user_data['password'])
+        default_currency = normalise_currency(user_data.get('default_currency')) or DEFAULT_CURRENCY
+        db_user = User(email=user_data['email'], hashed_password=hashed_password, default_currency=default_currency)
         db.add(db_user)
+        db.flush()
+        user_id = db_user.id
         db.commit()
-        db.refresh(db_user)
         print("User created successfully")
         
-        # Create access token
-        access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
-        access_token = create_access_token(
-            data={"sub": db_user.email}, expires_delta=access_token_expires
-        )
-        
+        # Tokens from the request's email and the flushed id: reading db_user after commit would reload it
         return {
             "message": "User created successfully",
-            "access_token": access_token,
-            "token_type": "bearer"
+            **await _issue_tokens(user_id, user_data['email'])
         }
     except Exception as e:
         print(f"Error during registration: {str(e)}")
@@ -186,9 +1036,10 @@ async def register(user_data: dict, db: Session = Depends(get_db)):
         )
 
 @app.post("/api/auth/login")
-async def login(user_data: dict, db: Session = Depends(get_db)):
+async def login(user_data: dict, request: Request, db: Session = Depends(get_db)):
     print("=== Login Request ===")
     print(f"Received data: {user_data}")
+    _check_auth_rate(request, user_data.get('email'))
     
     try:
         email = user_data.get('email')
@@ -213,7 +1064,7 @@ async def login(user_data: dict, db: Session = Depends(get_db)):
             )
         
         print("User found, verifying password")
-        if not verify_password(password, user.hashed_password):
+        if not await run_in_threadpool(verify_password, password, user.hashed_password):
             print("Invalid password")
             raise HTTPException(
                 status_code=status.HTTP_401_UNAUTHORIZED,
@@ -222,12 +1073,9 @@ async def login(user_data: dict, db: Session = Depends(get_db)):
             )
         
         print("Password verified, generating token")
-        access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
-        access_token = create_access_token(
-            data={"sub": user.email}, expires_delta=access_token_expires
-        )
+        tokens = await _issue_tokens(user.id, user.email)
         print("Token generated successfully")
-        return {"access_token": access_token, "token_type": "bearer"}
+        return tokens
     except HTTPException as he:
         print(f"HTTP Exception: {he.detail}")
         raise he
@@ -238,33 +1086,58 @@ async def login(user_data: dict, db: Session = Depends(get_db)):
             detail=f"An unexpected error occurred: {str(e)}"
         )
 
+@app.post("/api/auth/refresh")
+async def refresh_access_token(body: dict):
+    # One indexed lookup and a rotation instead of an Argon2 verify; a replayed token revokes its whole family
+    store = _enabled_refresh_tokens()
+    try:
+        _, email, refresh_token = await run_in_threadpool(store.rotate, _refresh_token_field(body))
+    except RefreshTokenError as e:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail=str(e),
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    return _token_pair(email, refresh_token)
+
+@app.post("/api/auth/logout")
+async def logout(body: dict):
+    # Ends the login the refresh token belongs to; access tokens already issued run out on their own
+    await run_in_threadpool(_enabled_refresh_tokens().revoke, _refresh_token_field(body))
+    return {"message": "Logged out"}
+
+@app.post("/api/auth/logout-all")
+async def logout_all(current_user: User = Depends(get_current_user)):
+    revoked = await run_in_threadpool(_enabled_refresh_tokens().revoke_user, current_user.id)
+    return {"message": "Logged out of all sessions", "revoked": revoked}
+
 @app.post("/api/transactions/expense")
 async def create_expense(
     transaction_data: dict,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: Session = Depends(get_db),
+    idempotency_key: Optional[str] = Header(None)
 ):
     print(f"Received expense data: {transaction_data}")
     try:
-        # Log the parsed values
-        amount = abs(float(transaction_data['amount'])) * -1
-        date = datetime.fromisoformat(transaction_data['date'].replace('Z', '+00:00'))
-        print(f"Parsed amount: {amount}")
-        print(f"Parsed date: {date}")
+        replay, reservation = idempotency_store.begin(db, current_user.id, idempotency_key, "expense", transaction_data)
+        if replay is not None:
+            return replay
         
-        transaction = Transaction(
-            user_id=current_user.id,
-            title=transaction_data['title'],
-            amount=amount,
-            category=transaction_data['category'],
-            date=date,
+        data = _parse_transaction(transaction_data)
+        row, _, duplicate_of = _insert_transaction(
+            db, _transaction_values(data, current_user, sign=-1, kind="expense"), data.tags
+        )
+        response = idempotency_store.finish(
+            reservation,
+            {"message": "Expense added successfully", "id": row["id"], "status": "success", "duplicate_of": duplicate_of}
         )
-        print(f"Created transaction object: {transaction.title}, {transaction.amount}, {transaction.category}, {transaction.date}")
-        db.add(transaction)
         db.commit()
-        db.refresh(transaction)
-        print(f"Successfully added expense with ID: {transaction.id}")
-        return {"message": "Expense added successfully", "id": transaction.id, "status": "success"}
+        print(f"Successfully added expense with ID: {row['id']}")
+        return response
+    except HTTPException:
+        db.rollback()
+        raise
     except Exception as e:
         print(f"Error in create_expense: {str(e)}")
         print(f"Error type: {type(e)}")
@@ -278,29 +1151,29 @@ async def create_expense(
 async def create_income(
     transaction_data: dict,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: Session = Depends(get_db),
+    idempotency_key: Optional[str] = Header(None)
 ):
     print(f"Received income data: {transaction_data}")
     try:
-        # Log the parsed values
-        amount = abs(float(transaction_data['amount']))
-        date = datetime.fromisoformat(transaction_data['date'].replace('Z', '+00:00'))
-        print(f"Parsed amount: {amount}")
-        print(f"Parsed date: {date}")
+        replay, reservation = idempotency_store.begin(db, current_user.id, idempotency_key, "income", transaction_data)
+        if replay is not None:
+            return replay
         
-        transaction = Transaction(
-            user_id=current_user.id,
-            title=transaction_data['title'],
-            amount=amount,
-            category=transaction_data['category'],
-            date=date,
+        data = _parse_transaction(transaction_data)
+        row, _, duplicate_of = _insert_transaction(
+            db, _transaction_values(data, current_user, sign=1, kind="income"), data.tags
+        )
+        response = idempotency_store.finish(
+            reservation,
+            {"message": "Income added successfully", "id": row["id"], "status": "success", "duplicate_of": duplicate_of}
         )
-        print(f"Created transaction object: {transaction.title}, {transaction.amount}, {transaction.category}, {transaction.date}")
-        db.add(transaction)
         db.commit()
-        db.refresh(transaction)
-        print(f"Successfully added income with ID: {transaction.id}")
-        return {"message": "Income added successfully", "id": transaction.id, "status": "success"}
+        print(f"Successfully added income with ID: {row['id']}")
+        return response
+    except HTTPException:
+        db.rollback()
+        raise
     except Exception as e:
         print(f"Error in create_income: {str(e)}")
         print(f"Error type: {type(e)}")
@@ -312,20 +1185,36 @@ async def create_income(
 
 @app.get("/api/transactions")
 async def get_transactions(
-    current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    request: Request,
+    current_user: User = Depends(get_current_user)
 ):
-    transactions = db.query(Transaction).filter(
-        Transaction.user_id == current_user.id
-    ).order_by(Transaction.date.desc()).all()
-    
-    return [{
-        "id": t.id,
-        "title": t.title,
-        "amount": t.amount,
-        "category": t.category,
-        "date": t.date.isoformat(),
-    } for t in transactions]
+    user_id = current_user.id
+    currency = current_user.default_currency or DEFAULT_CURRENCY
+
+    def compute():
+        # Shared by every coalesced caller, so it must not borrow one request's session
+        db = _read_session(user_id)
+        try:
+            T = transaction_partitions.model_for(user_id)
+            transactions = db.query(T).filter(
+                T.user_id == user_id
+            ).order_by(T.date.desc()).all()
+
+            return json.dumps([{
+                "id": t.id,
+                "title": t.title,
+                "amount": t.amount,
+                "currency": t.currency or currency,
+                "category": t.category,
+                "date": t.date.isoformat(),
+            } for t in transactions]).encode()
+        finally:
+            db.close()
+
+    # Parallel identical calls (several widgets, client retries) share one query and its bytes
+    key = read_coalescer.key_for(user_id, request.url.path, request.query_params)
+    body = await read_coalescer.run(key, lambda: run_in_threadpool(compute))
+    return Response(content=body, media_type="application/json")
 
 # Category routes
 @app.get("/api/categories")
@@ -376,9 +1265,9 @@ async def create_category(
             parent_id=category_data.get('parent_id'),
         )
         db.add(category)
-        db.commit()
-        db.refresh(category)
-        return {
+        # The flush's INSERT brings back the id; build the response before commit expires the object
+        db.flush()
+        response = {
             "id": category.id,
             "name": category.name,
             "type": category.type,
@@ -386,6 +1275,8 @@ async def create_category(
             "parent_id": category.parent_id,
             "subcategories": []
         }
+        db.commit()
+        return response
     except Exception as e:
         db.rollback()
         raise HTTPException(
@@ -440,8 +1331,18 @@ async def update_category(
         )
     
     try:
+        old_name = category.name
         category.name = category_data['name']
         category.type = category_data['type']
+        if category.name != old_name:
+            # Transactions reference categories by name, so a rename cascades to them
+            db.flush()
+            _bulk_update_transactions(
+                db, current_user.id,
+                lambda t: [t.user_id == current_user.id, t.category == old_name],
+                {"category": category.name},
+            )
+            _refresh_category_counts(db, current_user.id, [category.name])
         db.commit()
         db.refresh(category)
         return {
@@ -461,6 +1362,181 @@ async def update_category(
 async def root():
     return {"message": "Welcome to the Finance Assistant API"}
 
+@app.get("/api/metrics")
+async def get_metrics(current_user: User = Depends(get_current_user)):
+    # Per-worker counters; each uvicorn worker reports its own
+    return {
+        "single_flight": read_coalescer.snapshot(),
+        "stats_cache": category_stats_cache.snapshot(),
+        "admission": admission_controller.snapshot() if admission_controller is not None else None,
+        "profiler": request_profiler.snapshot() if request_profiler is not None else None,
+        "reports": report_runner.snapshot() if report_runner is not None else None,
+        "refresh_tokens": refresh_tokens.snapshot() if refresh_tokens is not None else None,
+        "pivot_cache": pivot_cache.snapshot(),
+        "audit_log": audit_log.snapshot() if audit_log is not None else None,
+    }
+
+def _enabled_profiler() -> Profiler:
+    if request_profiler is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Profiling is disabled")
+    return request_profiler
+
+@app.get("/api/admin/profiles")
+async def list_profiles(limit: int = 50, admin: User = Depends(get_admin_user)):
+    # Captures from every worker sharing PROFILING_DIR, newest first
+    return await run_in_threadpool(_enabled_profiler().captures, max(1, min(limit, 500)))
+
+@app.get("/api/admin/profiles/{profile_id}")
+async def download_profile(profile_id: str, admin: User = Depends(get_admin_user)):
+    path = _enabled_profiler().path_for(profile_id)
+    if path is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Profile not found")
+    # Open with https://www.speedscope.app
+    return FileResponse(path, media_type="application/json", filename=os.path.basename(path))
+
+def _enabled_backup(database: str) -> BackupManager:
+    if not database_backups:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Backups are disabled")
+    if database not in database_backups:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Unknown database {database!r}")
+    return database_backups[database]
+
+@app.post("/api/admin/backups")
+async def create_backup(database: str = "main", incremental: bool = False, admin: User = Depends(get_admin_user)):
+    # Online: stepped SQLite backup API (or pg_dump), so writers keep committing while it runs
+    manager = _enabled_backup(database)
+    try:
+        return await run_in_threadpool(manager.backup, incremental)
+    except BackupInProgress as e:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+
+@app.get("/api/admin/backups")
+async def list_backups(admin: User = Depends(get_admin_user)):
+    _enabled_backup("main")
+    return {name: await run_in_threadpool(manager.list) for name, manager in database_backups.items()}
+
+@app.post("/api/admin/backups/{seq}/verify")
+async def verify_backup(seq: int, database: str = "main", admin: User = Depends(get_admin_user)):
+    # Restores into a scratch file and checks the checksum and PRAGMA integrity_check; restore itself is CLI-only
+    manager = _enabled_backup(database)
+    if manager.get(seq) is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Backup not found")
+    try:
+        return await run_in_threadpool(manager.verify, seq)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=str(e))
+
+def _audit_entries(entity=None, before_id=None, limit=100, **filters):
+    if audit_log is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="The audit log is disabled")
+    if entity is not None and entity not in AUDITED_ENTITIES.values():
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Unknown entity {entity!r}; expected one of {', '.join(AUDITED_ENTITIES.values())}",
+        )
+    # Write-behind: push out what this worker still holds so a client sees its own changes
+    audit_log.flush()
+    entries = audit_log.query(entity=entity, before_id=before_id, limit=max(1, min(limit, 500)), **filters)
+    return {"entries": entries, "next_before_id": entries[-1]["id"] if entries else None}
+
+@app.get("/api/audit")
+async def list_audit_entries(
+    entity: Optional[str] = None,
+    entity_id: Optional[int] = None,
+    action: Optional[str] = None,
+    before_id: Optional[int] = None,
+    limit: int = 100,
+    current_user: User = Depends(get_current_user)
+):
+    # Changes to the user's rows, newest first; page with before_id=next_before_id
+    return await run_in_threadpool(
+        _audit_entries, entity, before_id, limit, user_id=current_user.id, entity_id=entity_id, action=action
+    )
+
+@app.get("/api/admin/audit")
+async def list_all_audit_entries(
+    user_id: Optional[int] = None,
+    actor_id: Optional[int] = None,
+    entity: Optional[str] = None,
+    entity_id: Optional[int] = None,
+    action: Optional[str] = None,
+    before_id: Optional[int] = None,
+    limit: int = 100,
+    admin: User = Depends(get_admin_user)
+):
+    return await run_in_threadpool(
+        _audit_entries, entity, before_id, limit, user_id=user_id, actor_id=actor_id, entity_id=entity_id, action=action
+    )
+
+def _enabled_report_queue() -> JobQueue:
+    if report_queue is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Reports are disabled")
+    return report_queue
+
+def _report_job(job):
+    result = json.loads(job["result"]) if job["result"] else None
+    return {
+        "id": job["id"],
+        "kind": job["kind"],
+        "params": job["params"],
+        "status": job["status"],
+        "attempts": job["attempts"],
+        "created_at": job["created_at"].isoformat() if job["created_at"] else None,
+        "started_at": job["started_at"].isoformat() if job["started_at"] else None,
+        "finished_at": job["finished_at"].isoformat() if job["finished_at"] else None,
+        "error": job["error"],
+        "result": None if result is None else {
+            "media_type": result["media_type"],
+            "bytes": result["bytes"],
+            "rows": result["rows"],
+            "url": f"/api/reports/{job['id']}/result",
+        },
+    }
+
+@app.post("/api/reports", status_code=status.HTTP_202_ACCEPTED)
+async def create_report(payload: dict, current_user: User = Depends(get_current_user)):
+    queue = _enabled_report_queue()
+    kind = payload.get("kind")
+    try:
+        params = validate_params(kind, payload.get("params") or {})
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    params["currency"] = current_user.default_currency or DEFAULT_CURRENCY
+    try:
+        job = await run_in_threadpool(queue.enqueue, current_user.id, kind, params)
+    except JobLimitExceeded as e:
+        raise HTTPException(status_code=status.HTTP_429_TOO_MANY_REQUESTS, detail=str(e))
+    if report_runner is not None:
+        report_runner.wake()
+    return _report_job({**job, "started_at": None, "finished_at": None, "error": None, "result": None})
+
+@app.get("/api/reports")
+async def list_reports(limit: int = 50, current_user: User = Depends(get_current_user)):
+    jobs = await run_in_threadpool(_enabled_report_queue().list, current_user.id, max(1, min(limit, 200)))
+    return [_report_job(job) for job in jobs]
+
+@app.get("/api/reports/{report_id}")
+async def get_report(report_id: str, current_user: User = Depends(get_current_user)):
+    job = await run_in_threadpool(_enabled_report_queue().get, report_id, current_user.id)
+    if job is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Report not found")
+    return _report_job(job)
+
+@app.get("/api/reports/{report_id}/result")
+async def download_report(report_id: str, current_user: User = Depends(get_current_user)):
+    job = await run_in_threadpool(_enabled_report_queue().get, report_id, current_user.id)
+    if job is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Report not found")
+    if job["status"] != "succeeded":
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=f"Report is {job['status']}")
+    result = json.loads(job["result"])
+    path = os.path.join(REPORTS_DIR, result["file"])
+    if not os.path.exists(path):
+        raise HTTPException(status_code=status.HTTP_410_GONE, detail="Report result has expired")
+    return FileResponse(path, media_type=result["media_type"], filename=f"{job['kind']}-{report_id}{os.path.splitext(path)[1]}")
+
 # Add predefined categories on startup
 def create_predefined_categories(db: Session):
     predefined_categories = [
@@ -501,7 +1577,7 @@ def create_predefined_categories(db: Session):
             
             db.commit()
 
-def update_database_schema():
+def update_database_schema(engine):
     inspector = inspect(engine)
     existing_columns = [col['name'] for col in inspector.get_columns('categories')]
     
@@ -521,19 +1597,47 @@ def update_database_schema():
             conn.execute(text("ALTER TABLE transactions ADD COLUMN next_recurrence_date DATE"))
             conn.execute(text("ALTER TABLE transactions ADD COLUMN type VARCHAR(10)"))
             conn.commit()
+    
+    if 'currency' not in existing_columns:
+        with engine.connect() as conn:
+            conn.execute(text("ALTER TABLE transactions ADD COLUMN currency VARCHAR(3)"))
+            conn.commit()
+    user_columns = [col['name'] for col in inspector.get_columns('users')] if inspector.has_table('users') else None
+    if user_columns is not None and 'default_currency' not in user_columns:
+        with engine.connect() as conn:
+            conn.execute(text("ALTER TABLE users ADD COLUMN default_currency VARCHAR(3)"))
+            conn.commit()
+    if 'fingerprint' not in existing_columns:
+        with engine.connect() as conn:
+            conn.execute(text("ALTER TABLE transactions ADD COLUMN fingerprint VARCHAR(32)"))
+            conn.commit()
+    add_missing_archive_columns(engine, Transaction.__table__)
+    ensure_sqlite_autoincrement(engine, Transaction.__table__)
+    
+    # Composite indexes for per-user date ranges and duplicate lookups (create_all skips indexes on existing tables)
+    with engine.connect() as conn:
+        conn.execute(text("CREATE INDEX IF NOT EXISTS ix_transactions_user_date ON transactions (user_id, date)"))
+        conn.execute(text("CREATE INDEX IF NOT EXISTS ix_transactions_user_fingerprint ON transactions (user_id, fingerprint)"))
+        conn.commit()
+    # Rows written before fingerprints existed (python -m app.services.duplicates --recompute redoes all)
+    backfill_fingerprints(engine, Transaction.__table__)
+    if engine.dialect.name == "sqlite":
+        # Without statistics SQLite drives tag filters from (user_id, date) instead of the
+        # tag link index; a sampled ANALYZE keeps this cheap on large ledgers
+        with engine.connect() as conn:
+            conn.exec_driver_sql("PRAGMA analysis_limit=1000")
+            conn.exec_driver_sql("ANALYZE")
+            conn.commit()
 
-# Update the database schema before creating predefined categories
-update_database_schema()
-create_predefined_categories(SessionLocal())
+# Update the database schema before creating predefined categories, in every shard
+for data_engine in dict.fromkeys([engine, *shard_router.engines]):
+    update_database_schema(data_engine)
+    create_predefined_categories(SessionLocal(bind=data_engine))
 
-@app.get("/api/categories/stats")
-async def get_category_stats(
-    current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
-):
+def _category_stats(db: Session, user_id: int, currency: str):
     # Get all categories for the user
     categories = db.query(Category).filter(
-        Category.user_id == current_user.id,
+        Category.user_id == user_id,
         Category.parent_id == None  # Only get top-level categories
     ).all()
     
@@ -545,44 +1649,77 @@ async def get_category_stats(
     
     all_categories = predefined_categories + categories
     
+    # Totals for every category at once, converted to the user's currency
+    t = transaction_partitions.selectable_for(user_id)
+    conn = db.connection()
+    totals = converted_totals(conn, t, [t.c.user_id == user_id], currency, fx_rates, group_by=t.c.category)
+    
     stats = []
     for category in all_categories:
-        # Get transactions for this category
-        transactions = db.query(Transaction).filter(
-            Transaction.user_id == current_user.id,
-            Transaction.category == category.name
-        ).all()
-        
-        # Calculate total amount and transaction count
-        total_amount = sum(t.amount for t in transactions)
-        transaction_count = len(transactions)
+        total_amount, transaction_count, unconverted = totals.get(category.name, (0.0, 0, 0))
         
         # Get recent transactions (last 5)
-        recent_transactions = sorted(
-            transactions,
-            key=lambda t: t.date,
-            reverse=True
-        )[:5]
+        recent_transactions = conn.execute(
+            select(t.c.id, t.c.amount, t.c.currency, t.c.title, t.c.date)
+            .where(t.c.user_id == user_id, t.c.category == category.name)
+            .order_by(t.c.date.desc())
+            .limit(5)
+        ).all() if transaction_count or unconverted else []
         
         stats.append({
             "name": category.name,
             "type": category.type,
             "total_amount": total_amount,
             "transaction_count": transaction_count,
+            "currency": currency,
+            "unconverted_count": unconverted,
             "budget": category.budget,
             "recent_transactions": [
                 {
-                    "id": t.id,
-                    "amount": t.amount,
-                    "description": t.title,
-                    "date": t.date.isoformat(),
+                    "id": r.id,
+                    "amount": fx_rates.convert_one(r.amount, r.currency, r.date, currency),
+                    "original_amount": r.amount,
+                    "original_currency": r.currency or currency,
+                    "description": r.title,
+                    "date": r.date.isoformat(),
                 }
-                for t in recent_transactions
+                for r in recent_transactions
             ],
         })
     
     return stats
 
+@app.get("/api/categories/stats")
+async def get_category_stats(
+    request: Request,
+    current_user: User = Depends(get_current_user)
+):
+    user_id = current_user.id
+    currency = current_user.default_currency or DEFAULT_CURRENCY
+
+    def compute():
+        # Shared by coalesced callers and reused by the stale refresh after the response is sent,
+        # so it opens its own session rather than borrowing a request's
+        session = _read_session(user_id)
+        try:
+            return json.dumps(_category_stats(session, user_id, currency)).encode()
+        finally:
+            session.close()
+
+    loop = asyncio.get_running_loop()
+
+    def cached_body():
+        # Runs in the threadpool, so the stale refresh is handed back to the loop to schedule
+        return category_stats_cache.get_or_compute(
+            user_id,
+            compute,
+            lambda job: loop.call_soon_threadsafe(loop.run_in_executor, None, job),
+        )
+
+    key = read_coalescer.key_for(user_id, request.url.path, request.query_params)
+    body = await read_coalescer.run(key, lambda: run_in_threadpool(cached_body))
+    return Response(content=body, media_type="application/json")
+
 @app.post("/api/categories/{category_name}/budget")
 async def set_category_budget(
     category_name: str,
@@ -618,90 +1755,35 @@ async def set_category_budget(
 async def create_transaction(
     transaction_data: dict,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: Session = Depends(get_db),
+    idempotency_key: Optional[str] = Header(None)
 ):
     try:
         print(f"Received transaction data: {transaction_data}")  # Debug log
         
-        # Validate required fields
-        required_fields = ['title', 'amount', 'type', 'category', 'date']
-        for field in required_fields:
-            if field not in transaction_data:
-                raise HTTPException(
-                    status_code=400,
-                    detail=f"Missing required field: {field}"
-                )
+        replay, reservation = idempotency_store.begin(db, current_user.id, idempotency_key, "transaction", transaction_data)
+        if replay is not None:
+            return replay
         
-        # Parse amount
-        try:
-            amount = float(transaction_data['amount'])
-        except (ValueError, TypeError):
-            raise HTTPException(
-                status_code=400,
-                detail="Invalid amount format"
-            )
-        
-        # Parse date
-        try:
-            date_str = transaction_data['date']
-            if 'T' in date_str:
-                date = datetime.fromisoformat(date_str.replace('Z', '+00:00'))
-            else:
-                date = datetime.strptime(date_str, "%Y-%m-%d %H:%M:%S")
-        except (ValueError, TypeError) as e:
-            print(f"Date parsing error: {str(e)}")  # Debug log
-            raise HTTPException(
-                status_code=400,
-                detail=f"Invalid date format: {date_str}"
+        data = _parse_transaction(transaction_data, TypedTransactionWrite)
+        values = _transaction_values(data, current_user)
+
+        transaction_write_queue = transaction_write_queues[shard_router.engine_for(current_user.id)]
+        if transaction_write_queue is not None and reservation is None:
+            # Insert, tags and derived rows run as one job in the single writer's group commit
+            job_db, row, tags, duplicate_of = await transaction_write_queue.submit_job(
+                _queued_insert(values, data.tags, current_user.id)
             )
-        
-        # Parse next_recurrence_date if it exists
-        next_recurrence_date = None
-        if transaction_data.get("next_recurrence_date"):
-            try:
-                next_date_str = transaction_data["next_recurrence_date"]
-                if 'T' in next_date_str:
-                    next_recurrence_date = datetime.fromisoformat(next_date_str.replace('Z', '+00:00'))
-                else:
-                    next_recurrence_date = datetime.strptime(next_date_str, "%Y-%m-%d %H:%M:%S")
-            except (ValueError, TypeError) as e:
-                print(f"Next recurrence date parsing error: {str(e)}")  # Debug log
-                raise HTTPException(
-                    status_code=400,
-                    detail=f"Invalid next recurrence date format: {next_date_str}"
-                )
-        
-        # Create the transaction
-        transaction = Transaction(
-            user_id=current_user.id,
-            title=transaction_data["title"],
-            amount=amount,
-            type=transaction_data["type"],
-            category=transaction_data["category"],
-            date=date,
-            is_recurring=transaction_data.get("is_recurring", False),
-            recurrence_frequency=transaction_data.get("recurrence_frequency"),
-            next_recurrence_date=next_recurrence_date
-        )
-        
-        print(f"Creating transaction: {transaction.__dict__}")  # Debug log
-        
-        db.add(transaction)
+            _after_user_commit(job_db)
+            return _transaction_response(row, tags, duplicate_of)
+
+        row, tags, duplicate_of = _insert_transaction(db, values, data.tags)
+        # The idempotency key, if any, commits together with the transaction
+        response = idempotency_store.finish(reservation, _transaction_response(row, tags, duplicate_of))
         db.commit()
-        db.refresh(transaction)
-        
-        return {
-            "id": transaction.id,
-            "title": transaction.title,
-            "amount": transaction.amount,
-            "type": transaction.type,
-            "category": transaction.category,
-            "date": transaction.date.isoformat(),
-            "is_recurring": transaction.is_recurring,
-            "recurrence_frequency": transaction.recurrence_frequency,
-            "next_recurrence_date": transaction.next_recurrence_date.isoformat() if transaction.next_recurrence_date else None
-        }
+        return response
     except HTTPException:
+        db.rollback()
         raise
     except Exception as e:
         print(f"Error creating transaction: {str(e)}")  # Debug log
@@ -794,66 +1876,73 @@ async def search_transactions(
     end_date: str = None,
     min_amount: float = None,
     max_amount: float = None,
+    tags: str = None,
+    tag_mode: str = "any",
     sort_by: str = "date",
     sort_order: str = "desc",
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: Session = Depends(get_read_db)
 ):
     try:
-        # Start with base query
-        base_query = db.query(Transaction).filter(Transaction.user_id == current_user.id)
+        start = datetime.fromisoformat(start_date) if start_date else None
+        end = datetime.fromisoformat(end_date) if end_date else None
         
-        # Apply filters
-        if query:
-            base_query = base_query.filter(Transaction.title.ilike(f"%{query}%"))
-        if category:
-            base_query = base_query.filter(Transaction.category == category)
-        if start_date:
-            base_query = base_query.filter(Transaction.date >= datetime.fromisoformat(start_date))
-        if end_date:
-            base_query = base_query.filter(Transaction.date <= datetime.fromisoformat(end_date))
-        if min_amount is not None:
-            base_query = base_query.filter(Transaction.amount >= min_amount)
-        if max_amount is not None:
-            base_query = base_query.filter(Transaction.amount <= max_amount)
+        # Start with base query; a date-bounded search only touches the overlapping partitions
+        T = transaction_partitions.model_for(current_user.id, start, end)
+        base_query = db.query(T).filter(*_transaction_conditions(
+            T, current_user.id, query, category, start, end, min_amount, max_amount
+        ))
+        tag_names = split_tags(tags)
+        if tag_names:
+            if tag_mode not in ("any", "all"):
+                raise HTTPException(status_code=400, detail="tag_mode must be 'any' or 'all'")
+            base_query = base_query.filter(
+                tag_condition(T.id, Tag.__table__, TransactionTag.__table__, current_user.id, tag_names, tag_mode)
+            )
         
         # Apply sorting
         if sort_by == "amount":
-            base_query = base_query.order_by(Transaction.amount.desc() if sort_order == "desc" else Transaction.amount.asc())
+            base_query = base_query.order_by(T.amount.desc() if sort_order == "desc" else T.amount.asc())
         elif sort_by == "title":
-            base_query = base_query.order_by(Transaction.title.desc() if sort_order == "desc" else Transaction.title.asc())
+            base_query = base_query.order_by(T.title.desc() if sort_order == "desc" else T.title.asc())
         else:  # Default to date
-            base_query = base_query.order_by(Transaction.date.desc() if sort_order == "desc" else Transaction.date.asc())
+            base_query = base_query.order_by(T.date.desc() if sort_order == "desc" else T.date.asc())
         
         # Execute query
         transactions = base_query.all()
+        transaction_tags = tags_for(db.connection(), Tag.__table__, TransactionTag.__table__, [t.id for t in transactions])
         
         return [
             {
                 "id": t.id,
                 "title": t.title,
                 "amount": t.amount,
+                "currency": t.currency or current_user.default_currency or DEFAULT_CURRENCY,
                 "type": t.type,
                 "category": t.category,
                 "date": t.date.isoformat(),
                 "is_recurring": t.is_recurring,
                 "recurrence_frequency": t.recurrence_frequency,
-                "next_recurrence_date": t.next_recurrence_date.isoformat() if t.next_recurrence_date else None
+                "next_recurrence_date": t.next_recurrence_date.isoformat() if t.next_recurrence_date else None,
+                "tags": transaction_tags.get(t.id, [])
             }
             for t in transactions
         ]
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/api/transactions/recurring")
 async def get_recurring_transactions(
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: Session = Depends(get_read_db)
 ):
     try:
-        recurring_transactions = db.query(Transaction).filter(
-            Transaction.user_id == current_user.id,
-            Transaction.is_recurring == True
+        T = transaction_partitions.model_for(current_user.id)
+        recurring_transactions = db.query(T).filter(
+            T.user_id == current_user.id,
+            T.is_recurring == True
         ).all()
         
         return [
@@ -872,6 +1961,14 @@ async def get_recurring_transactions(
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+def _live_transaction(db, user_id, transaction_id):
+    """The user's transaction as an ORM object; an archived one is moved back to the live table first."""
+    query = db.query(Transaction).filter(Transaction.id == transaction_id, Transaction.user_id == user_id)
+    db_transaction = query.first()
+    if db_transaction is None and transaction_partitions.unarchive(db.connection(), user_id, transaction_id):
+        db_transaction = query.first()
+    return db_transaction
+
 @app.put("/api/transactions/{transaction_id}")
 async def update_transaction(
     transaction_id: int,
@@ -880,10 +1977,7 @@ async def update_transaction(
     current_user: User = Depends(get_current_user)
 ):
     try:
-        db_transaction = db.query(Transaction).filter(
-            Transaction.id == transaction_id,
-            Transaction.user_id == current_user.id
-        ).first()
+        db_transaction = _live_transaction(db, current_user.id, transaction_id)
         
         if not db_transaction:
             raise HTTPException(status_code=404, detail="Transaction not found")
@@ -896,11 +1990,15 @@ async def update_transaction(
         db_transaction.is_recurring = transaction.is_recurring
         db_transaction.recurrence_frequency = transaction.recurrence_frequency
         db_transaction.next_recurrence_date = transaction.next_recurrence_date
+        _save_tags(db, current_user.id, db_transaction.id, transaction.tags)
         
         db.commit()
         db.refresh(db_transaction)
         
         return {"message": "Transaction updated successfully"}
+    except HTTPException:
+        db.rollback()
+        raise
     except Exception as e:
         db.rollback()
         raise HTTPException(status_code=500, detail=str(e))
@@ -912,10 +2010,7 @@ async def delete_transaction(
     current_user: User = Depends(get_current_user)
 ):
     try:
-        db_transaction = db.query(Transaction).filter(
-            Transaction.id == transaction_id,
-            Transaction.user_id == current_user.id
-        ).first()
+        db_transaction = _live_transaction(db, current_user.id, transaction_id)
         
         if not db_transaction:
             raise HTTPException(status_code=404, detail="Transaction not found")
@@ -924,6 +2019,427 @@ async def delete_transaction(
         db.commit()
         
         return {"message": "Transaction deleted successfully"}
+    except HTTPException:
+        db.rollback()
+        raise
+    except Exception as e:
+        db.rollback()
+        raise HTTPException(status_code=500, detail=str(e)) 
+
+@app.get("/api/analytics/forecast")
+async def get_forecast(
+    horizon_days: int = 90,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_read_db)
+):
+    if horizon_days < 1 or horizon_days > 730:
+        raise HTTPException(status_code=400, detail="horizon_days must be between 1 and 730")
+    
+    # Serve today's batch-precomputed forecast if no write has invalidated it (anchored on the local date, like ours)
+    snapshot = db.get(ForecastSnapshot, current_user.id)
+    if snapshot and snapshot.horizon_days == horizon_days and anchor_date(snapshot.computed_at) == datetime.now().date():
+        return Response(content=snapshot.payload, media_type="application/json")
+    
+    try:
+        return await run_in_threadpool(
+            forecast_for_user,
+            db.connection(),
+            transaction_partitions.selectable_for(current_user.id),
+            current_user.id,
+            horizon_days,
+            currency=current_user.default_currency or DEFAULT_CURRENCY,
+            fx=fx_rates
+        )
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/api/analytics/pivot")
+async def analytics_pivot(
+    body: PivotRequest,
+    current_user: User = Depends(get_current_user)
+):
+    user_id = current_user.id
+    currency = current_user.default_currency or DEFAULT_CURRENCY
+
+    def load():
+        # May run on the cache's refresh thread after this request is gone, so it opens its own session
+        db = _read_session(user_id)
+        try:
+            return load_frame(db.connection(), transaction_partitions.selectable_for(user_id), user_id, currency, fx_rates)
+        finally:
+            db.close()
+
+    def run():
+        # The user's history is read once into the columnar cache and patched on write; pivots never touch SQL
+        frame = pivot_cache.get(user_id, currency, load)
+        return pivot(frame, body.dimensions, body.measures, body.filters, body.amount_bands, body.sort, body.limit)
+
+    try:
+        return await run_in_threadpool(run)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.get("/api/insights")
+async def get_insights(current_user: User = Depends(get_current_user), db: Session = Depends(get_read_db)):
+    # Precomputed nightly for every user; the stored payload is the response body
+    snapshot = db.get(InsightSnapshot, current_user.id)
+    if snapshot is None:
+        raise HTTPException(status_code=404, detail="No insights yet; they are computed nightly")
+    return Response(content=snapshot.payload, media_type="application/json")
+
+@app.get("/api/analytics/distribution")
+async def get_category_distribution(
+    start_date: str = None,
+    end_date: str = None,
+    category: str = None,
+    quantiles: str = "0.5,0.9,0.99",
+    outliers: int = 0,
+    current_user: User = Depends(get_current_user)
+):
+    try:
+        start = datetime.fromisoformat(start_date) if start_date else None
+        end = datetime.fromisoformat(end_date) if end_date else None
+        levels = [float(q) for q in quantiles.split(",") if q.strip()]
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if not levels or len(levels) > 20 or any(not 0 <= q <= 1 for q in levels):
+        raise HTTPException(status_code=400, detail="quantiles must be 1 to 20 comma-separated values between 0 and 1")
+    if outliers < 0 or outliers > 100:
+        raise HTTPException(status_code=400, detail="outliers must be between 0 and 100")
+    
+    # Merged per-month sketches; reads the primary because stale months are rebuilt in place
+    return await run_in_threadpool(
+        category_distributions,
+        shard_router.engine_for(current_user.id),
+        CategoryDistribution.__table__,
+        transaction_partitions.selectable_for(current_user.id),
+        current_user.id,
+        start,
+        end,
+        category,
+        current_user.default_currency or DEFAULT_CURRENCY,
+        fx_rates,
+        levels,
+        compression=distribution_compression,
+        outliers=outliers,
+        verifier=distribution_verifier,
+    )
+
+def _balance_days(start, end, interval):
+    """The last day of each interval from start to end, with end itself as the final point."""
+    days, current = [], start
+    while current <= end:
+        if interval == "day":
+            point = current
+        elif interval == "week":
+            point = current + timedelta(days=6 - current.weekday())
+        else:
+            point = (current.replace(day=28) + timedelta(days=4)).replace(day=1) - timedelta(days=1)
+        days.append(min(point, end))
+        current = point + timedelta(days=1)
+    return days
+
+def _balance_response(by_currency, target, as_of):
+    total, unconverted = converted_balance(by_currency, target, fx_rates, as_of)
+    # Rows without a currency are in the user's default currency
+    native = {}
+    for currency, amount in by_currency.items():
+        native[currency or target] = native.get(currency or target, 0.0) + amount
+    return {
+        "balance": total,
+        "by_currency": dict(sorted(native.items())),
+        "unconverted_currencies": unconverted,
+    }
+
+@app.get("/api/balance")
+async def get_balance(
+    as_of: str = None,
+    current_user: User = Depends(get_current_user)
+):
+    try:
+        moment = datetime.fromisoformat(as_of) if as_of else datetime.utcnow()
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    user_id = current_user.id
+    target = current_user.default_currency or DEFAULT_CURRENCY
+    month_start = datetime(moment.year, moment.month, 1)
+
+    def compute():
+        engine_for_user = shard_router.engine_for(user_id)
+        balance_verifier.ensure(engine_for_user, BalanceCheckpoint.__table__,
+                                transaction_partitions.selectable_for(user_id), user_id)
+        # One checkpoint lookup, then this month's rows up to the moment
+        with engine_for_user.connect() as conn:
+            totals = balance_as_of(conn, BalanceCheckpoint.__table__,
+                                   transaction_partitions.selectable_for(user_id, month_start, moment), user_id, moment)
+        return {
+            "as_of": moment.isoformat(),
+            "currency": target,
+            "transaction_count": sum(count for _, count in totals.values()),
+            **_balance_response({currency: amount for currency, (amount, _) in totals.items()}, target, moment.date()),
+        }
+
+    return await run_in_threadpool(compute)
+
+@app.get("/api/balance/series")
+async def get_balance_series(
+    start_date: str,
+    end_date: str = None,
+    interval: str = "month",
+    current_user: User = Depends(get_current_user)
+):
+    try:
+        start = datetime.fromisoformat(start_date).date()
+        end = datetime.fromisoformat(end_date).date() if end_date else datetime.utcnow().date()
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if interval not in ("day", "week", "month"):
+        raise HTTPException(status_code=400, detail="interval must be day, week or month")
+    if end < start:
+        raise HTTPException(status_code=400, detail="end_date must not be before start_date")
+    days = _balance_days(start, end, interval)
+    if len(days) > 1000:
+        raise HTTPException(status_code=400, detail="At most 1000 points per series; use a longer interval")
+    user_id = current_user.id
+    target = current_user.default_currency or DEFAULT_CURRENCY
+
+    def compute():
+        engine_for_user = shard_router.engine_for(user_id)
+        transactions = transaction_partitions.selectable_for(user_id)
+        balance_verifier.ensure(engine_for_user, BalanceCheckpoint.__table__, transactions, user_id)
+        with engine_for_user.connect() as conn:
+            series = balance_series(conn, BalanceCheckpoint.__table__, transactions, user_id, days)
+        return {
+            "currency": target,
+            "interval": interval,
+            "points": [
+                {"date": day.isoformat(), **_balance_response(balances, target, day)}
+                for day, balances in zip(days, series)
+            ],
+        }
+
+    return await run_in_threadpool(compute)
+
+@app.post("/api/transactions/suggest-category")
+async def suggest_category(
+    payload: dict,
+    current_user: User = Depends(get_current_user)
+):
+    titles = payload.get("titles")
+    if titles is None and payload.get("title"):
+        titles = [payload["title"]]
+    if not titles or not isinstance(titles, list):
+        raise HTTPException(status_code=400, detail="Provide a title or a list of titles")
+    if len(titles) > 10000:
+        raise HTTPException(status_code=400, detail="At most 10000 titles per request")
+    top_k = int(payload.get("top_k", 3))
+    
+    results = await run_in_threadpool(category_registry.suggest, current_user.id, [str(t) for t in titles], top_k)
+    suggestions = [
+        [{"category": category, "confidence": round(confidence, 4)} for category, confidence in ranked]
+        for ranked in results
+    ]
+    if "titles" not in payload:
+        return {"title": titles[0], "suggestions": suggestions[0]}
+    return {"results": [{"title": title, "suggestions": s} for title, s in zip(titles, suggestions)]}
+
+def _stream_user_id(token: Optional[str]) -> Optional[int]:
+    """Resolve a bearer token without holding a DB session for the life of the stream."""
+    if not token:
+        return None
+    try:
+        email = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM]).get("sub")
+    except JWTError:
+        return None
+    if email is None:
+        return None
+    db = SessionLocal()
+    try:
+        user = db.query(User).filter(User.email == email).first()
+        return user.id if user else None
+    finally:
+        db.close()
+
+def _parse_event_id(value: Optional[str]) -> Optional[int]:
+    try:
+        return int(value) if value else None
+    except ValueError:
+        return None
+
+@app.get("/api/events")
+async def stream_events(
+    request: Request,
+    token: Optional[str] = None,
+    last_event_id: Optional[str] = Header(None)
+):
+    # EventSource cannot send headers, so the token may also come as ?token=
+    authorization = request.headers.get("authorization", "")
+    if authorization.lower().startswith("bearer "):
+        token = authorization[7:]
+    user_id = _stream_user_id(token)
+    if user_id is None:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Could not validate credentials",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    resume_from = _parse_event_id(last_event_id or request.query_params.get("last_event_id"))
+    subscription = event_broker.subscribe(user_id, resume_from)
+
+    async def stream():
+        try:
+            yield b"retry: 3000\n\n"
+            while True:
+                change = await subscription.next(event_broker.heartbeat)
+                yield format_sse(change) if change is not None else b": ping\n\n"
+        finally:
+            event_broker.unsubscribe(subscription)
+
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+@app.websocket("/api/events/ws")
+async def websocket_events(websocket: WebSocket, token: Optional[str] = None, last_event_id: Optional[str] = None):
+    user_id = _stream_user_id(token)
+    if user_id is None:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+    await websocket.accept()
+    subscription = event_broker.subscribe(user_id, _parse_event_id(last_event_id))
+    try:
+        while True:
+            change = await subscription.next(event_broker.heartbeat)
+            await websocket.send_json(change if change is not None else {"type": "ping"})
+    except (WebSocketDisconnect, RuntimeError, OSError):
+        # Client went away; RuntimeError/OSError come from sends after the socket closed
+        pass
+    finally:
+        event_broker.unsubscribe(subscription)
+
+@app.get("/api/transactions/duplicates")
+async def get_duplicate_transactions(
+    limit: int = 100,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_read_db)
+):
+    if limit < 1 or limit > 1000:
+        raise HTTPException(status_code=400, detail="limit must be between 1 and 1000")
+    # Off the event loop, so admission control can keep serving and shedding meanwhile
+    return await run_in_threadpool(
+        duplicate_clusters, db.connection(), transaction_partitions.selectable_for(current_user.id), current_user.id, limit
+    )
+
+BULK_PATCH_FIELDS = {"category", "type", "is_recurring", "recurrence_frequency"}
+
+@app.post("/api/transactions/bulk-update")
+async def bulk_update_transactions(
+    payload: dict,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    filters = payload.get("filter") or {}
+    patch = payload.get("patch") or {}
+    if not patch:
+        raise HTTPException(status_code=400, detail="patch must set at least one field")
+    unknown = set(patch) - BULK_PATCH_FIELDS
+    if unknown:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Cannot bulk-update {', '.join(sorted(unknown))}; allowed fields: {', '.join(sorted(BULK_PATCH_FIELDS))}"
+        )
+    if "category" in patch and not patch["category"]:
+        raise HTTPException(status_code=400, detail="category cannot be empty")
+    if "type" in patch and patch["type"] not in ("income", "expense"):
+        raise HTTPException(status_code=400, detail="type must be 'income' or 'expense'")
+    
+    try:
+        start = datetime.fromisoformat(filters["start_date"]) if filters.get("start_date") else None
+        end = datetime.fromisoformat(filters["end_date"]) if filters.get("end_date") else None
+        min_amount = float(filters["min_amount"]) if filters.get("min_amount") is not None else None
+        max_amount = float(filters["max_amount"]) if filters.get("max_amount") is not None else None
+    except (ValueError, TypeError) as e:
+        raise HTTPException(status_code=400, detail=f"Invalid filter: {str(e)}")
+    
+    tag_names = split_tags(filters.get("tags"))
+    tag_mode = filters.get("tag_mode", "any")
+    if tag_mode not in ("any", "all"):
+        raise HTTPException(status_code=400, detail="tag_mode must be 'any' or 'all'")
+    
+    def conditions_for(t):
+        conditions = _transaction_conditions(
+            t, current_user.id, filters.get("query"), filters.get("category"), start, end, min_amount, max_amount
+        )
+        if tag_names:
+            conditions.append(tag_condition(t.id, Tag.__table__, TransactionTag.__table__, current_user.id, tag_names, tag_mode))
+        return conditions
+    
+    try:
+        if "category" in patch:
+            # Categories losing rows, for the counter refresh below
+            affected = {
+                name for (name,) in db.execute(
+                    select(Transaction.category).where(*conditions_for(Transaction)).distinct()
+                )
+            } | {patch["category"]}
+        updated = _bulk_update_transactions(db, current_user.id, conditions_for, patch, start, end)
+        if updated and "category" in patch:
+            _refresh_category_counts(db, current_user.id, affected)
+        db.commit()
+        return {"updated": updated}
     except Exception as e:
         db.rollback()
-        raise HTTPException(status_code=500, detail=str(e)) 
\ No newline at end of file
+        raise HTTPException(
+            status_code=500,
+            detail=f"Error updating transactions: {str(e)}"
+        )
+
+@app.get("/api/tags")
+async def get_tags(
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_read_db)
+):
+    rows = db.execute(
+        select(Tag.name, func.count(TransactionTag.transaction_id))
+        .join_from(Tag, TransactionTag, TransactionTag.tag_id == Tag.id, isouter=True)
+        .where(Tag.user_id == current_user.id)
+        .group_by(Tag.id, Tag.name)
+        .order_by(Tag.name)
+    ).all()
+    return [{"name": name, "transaction_count": count} for name, count in rows]
+
+@app.get("/api/tags/stats")
+async def get_tag_stats(
+    start_date: str = None,
+    end_date: str = None,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_read_db)
+):
+    try:
+        start = datetime.fromisoformat(start_date) if start_date else None
+        end = datetime.fromisoformat(end_date) if end_date else None
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    # One grouped query over the tag links, converted to the user's currency
+    currency = current_user.default_currency or DEFAULT_CURRENCY
+    tagged = tagged_rows(
+        transaction_partitions.selectable_for(current_user.id, start, end),
+        Tag.__table__, TransactionTag.__table__, current_user.id
+    )
+    conditions = _transaction_conditions(tagged.c, current_user.id, start=start, end=end)
+    totals = await run_in_threadpool(
+        converted_totals, db.connection(), tagged, conditions, currency, fx_rates, group_by=tagged.c.tag
+    )
+    return [
+        {
+            "tag": tag,
+            "total_amount": total,
+            "transaction_count": count,
+            "currency": currency,
+            "unconverted_count": unconverted,
+        }
+        for tag, (total, count, unconverted) in sorted(totals.items())
+    ]